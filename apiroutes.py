@@ -18,6 +18,7 @@ Failure messages are in this JSON format:
 
 from flask import (
     Blueprint,
+    current_app,
     request,
     jsonify,
     Response,
@@ -26,15 +27,51 @@ from flask import (
 from flask.views import MethodView
 
 import base64
-from datetime import datetime
-from colorama import Fore, Style
+import hmac
 import os
+from datetime import datetime, timedelta, timezone
+from colorama import Fore, Style
 
 from device import DeviceManager, SiteManager, device_manager, site_manager
 from vpn import vpn_manager
 from settings import AppSettings, config
 from sql import SqlServer
 from encryption import CryptoSecret
+from cache import Dataset, dataset_cache, compiled_cache
+from archive import config_archive
+from scheduler import device_state, poll_scheduler
+from concurrency import concurrency
+from configdiff import diff_configs
+from gpsessions import clean_session, gp_sessions
+from gphistory import ALL, gp_history
+from vpnhealth import clean_tunnel, tunnel_monitor
+from events import EVENT_TYPES, STREAMS_BUSY_RETRY, EventBus, event_bus
+from metrics import MetricsRegistry, metrics, record_request, start_request
+from profiling import (
+    RequestLog,
+    end_request,
+    finish_request,
+    request_log,
+    start_request as start_trace,
+)
+from httpcache import make_etag, not_modified, finalize_response
+from jsonprovider import encode, list_response
+from fleet import FleetQuery, select_devices
+from ipindex import INDEXED_DATASETS, format_results, ip_index, vpn_records
+from objectdiff import diff
+from objectanalysis import (
+    OBJECT_DATASETS as ANALYSIS_OBJECTS,
+    POLICY_DATASETS as ANALYSIS_POLICIES,
+    analyse_device,
+    analyse_fleet,
+    object_values,
+)
+from natsim import NatSimulator
+from intervals import format_address, parse_address
+from resolver import GroupResolver
+from ruleanalysis import RuleAnalysis
+from rulelookup import RuleLookup
+from zonematrix import ZoneMatrix
 
 from pa_api import DeviceApi as PaDeviceApi
 from junos_api import DeviceApi as JunosDeviceApi
@@ -45,6 +82,1269 @@ from azure import login_required
 # Define a blueprint for the web routes
 api_bp = Blueprint('api', __name__)
 
+# Query parameters for filtering, sorting and paginating datasets
+QUERY_PARAMS = (
+    'limit', 'cursor', 'sort', 'order', 'name', 'tag', 'address', 'zone'
+)
+
+# Fleet queries, with the route and parameter that collects each type
+FLEET_QUERIES = {
+    'objects': (
+        '/api/objects',
+        'object',
+        (
+            'tags', 'addresses', 'address_groups',
+            'app_groups', 'services', 'service_groups',
+        ),
+    ),
+    'policies': ('/api/policies', 'type', ('nat', 'security', 'qos')),
+    'vpn': ('/api/vpn', 'type', ('gp',)),
+}
+
+# Group datasets, and the kind of names they hold
+GROUP_KINDS = {
+    'address_groups': 'address',
+    'service_groups': 'service',
+    'app_groups': 'app',
+}
+
+# Object datasets that are resolved into flattened groups
+OBJECT_DATASETS = (
+    ('/api/objects', 'object', 'addresses'),
+    ('/api/objects', 'object', 'address_groups'),
+    ('/api/objects', 'object', 'services'),
+    ('/api/objects', 'object', 'service_groups'),
+    ('/api/objects', 'object', 'app_groups'),
+)
+
+# Parts of a PAN-OS config that are not synchronized between HA peers
+HA_LOCAL_CONFIG = ('deviceconfig',)
+
+# The most flows that can be translated in one request
+NAT_BATCH_LIMIT = 10000
+
+
+def dataset_response(
+    dataset: Dataset,
+) -> jsonify:
+    '''
+    Build a response from a cached dataset
+
+    If there are no query parameters, the full list is returned
+        This is the original response format
+    If there are query parameters, the dataset is filtered, sorted and
+        paginated, and the total count is included
+
+    Args:
+        dataset (Dataset): The dataset to respond with
+
+    Returns:
+        jsonify: The list of entries, or a page of entries
+    '''
+
+    # Skip all the work if the browser already has this version
+    etag = make_etag(dataset.version, request.query_string)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # Return the full list if no query parameters are used
+    # Large lists are streamed, rather than built in memory
+    if not any(param in request.args for param in QUERY_PARAMS):
+        response = list_response(dataset.items)
+        response.set_etag(etag)
+        return response
+
+    # Filter, sort and paginate
+    try:
+        limit = request.args.get('limit')
+        page = dataset.query(
+            name=request.args.get('name'),
+            tag=request.args.get('tag'),
+            address=request.args.get('address'),
+            zone=request.args.get('zone'),
+            sort=request.args.get('sort'),
+            order=request.args.get('order', 'asc'),
+            limit=max(int(limit), 1) if limit else None,
+            cursor=request.args.get('cursor'),
+        )
+
+    except ValueError as e:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": str(e)
+            }
+        ), 500
+
+    response = jsonify(page)
+    response.set_etag(etag)
+    return response
+
+
+def session_headers(
+) -> dict:
+    '''
+    Get the headers that carry the user's session
+        Used to run internal requests as the same user
+
+    Returns:
+        dict: The headers to send with internal requests
+    '''
+
+    headers = {}
+    if 'Cookie' in request.headers:
+        headers['Cookie'] = request.headers['Cookie']
+
+    return headers
+
+
+def internal_get(
+    app,
+    path: str,
+    query_string: dict,
+    headers: dict,
+) -> tuple[bool, list | str]:
+    '''
+    Run a GET request against one of the API routes, without HTTP
+        This reuses the route's code and cache for a single device
+        It is safe to call from worker threads
+
+    Args:
+        app (Flask): The Flask app
+        path (str): The route (eg, '/api/objects')
+        query_string (dict): The query parameters
+        headers (dict): Headers to send (eg, the session cookie)
+
+    Returns:
+        tuple: (True, list of entries) or (False, error message)
+    '''
+
+    with app.test_request_context(
+        path,
+        query_string=query_string,
+        headers=headers,
+    ):
+        response = app.make_response(app.dispatch_request())
+        data = response.get_json(silent=True)
+
+    if response.status_code == 200 and isinstance(data, list):
+        return True, data
+
+    # Some routes return a message when there is nothing to list
+    if isinstance(data, dict):
+        if data.get('result') == 'Success':
+            return True, []
+        return False, data.get('message')
+
+    return False, f"Unexpected response ({response.status_code})"
+
+
+def load_dataset(
+    path: str,
+    param: str,
+    data_type: str,
+    device_id: str,
+) -> Dataset | str:
+    '''
+    Get a dataset for a device, from the cache or from the device
+
+    Args:
+        path (str): The route that collects the data (eg, '/api/objects')
+        param (str): The parameter for the type of data (eg, 'object')
+        data_type (str): The type of data (eg, 'addresses')
+        device_id (str): The device ID
+
+    Returns:
+        Dataset: The dataset
+        str: An error message, if the data could not be collected
+    '''
+
+    # Passive HA peers are read from the active peer
+    device_id = device_manager.config_source(device_id)
+
+    refresh = request.args.get('refresh') == 'true'
+    dataset = dataset_cache.get(device_id, data_type)
+    if dataset is not None and not refresh:
+        return dataset
+
+    query_string = {param: data_type, 'id': device_id}
+    if refresh:
+        query_string['refresh'] = 'true'
+
+    try:
+        success, data = internal_get(
+            current_app._get_current_object(),
+            path,
+            query_string=query_string,
+            headers=session_headers(),
+        )
+
+    except Exception as e:
+        print(
+            Fore.RED,
+            f"Could not collect {data_type} from device '{device_id}'.",
+            Style.RESET_ALL
+        )
+        print(e)
+        success, data = False, str(e)
+
+    if not success:
+        return data or f"Could not collect {data_type} from {device_id}"
+
+    # The route caches what it collects (empty lists are not cached)
+    dataset = dataset_cache.get(device_id, data_type)
+    if dataset is None:
+        dataset = Dataset(device_id, data_type, data)
+
+    return dataset
+
+
+def diff_response(
+    path: str,
+    param: str,
+    data_type: str,
+    ordered: bool = False,
+) -> Response:
+    '''
+    Compare the same type of data from two devices
+        Only the differences are returned
+
+    Args:
+        path (str): The route that collects the data (eg, '/api/objects')
+        param (str): The parameter for the type of data (eg, 'object')
+        data_type (str): The type of data (eg, 'addresses')
+        ordered (bool): The order of entries matters (eg, policies)
+
+    Returns:
+        Response: The differences, or a failure message
+    '''
+
+    # The two devices to compare
+    device_a = request.args.get('id')
+    device_b = request.args.get('compare')
+    if not device_a or not device_b:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": "Two devices are needed, 'id' and 'compare'"
+            }
+        ), 500
+
+    datasets = []
+    for device_id in (device_a, device_b):
+        dataset = load_dataset(path, param, data_type, device_id)
+        if isinstance(dataset, str):
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": dataset
+                }
+            ), 500
+        datasets.append(dataset)
+
+    # Skip the work if the browser already has this comparison
+    etag = make_etag(
+        datasets[0].version,
+        datasets[1].version,
+        request.query_string,
+    )
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    result = diff(datasets[0].items, datasets[1].items, ordered=ordered)
+    result['a'] = device_a
+    result['b'] = device_b
+
+    response = jsonify(result)
+    response.set_etag(etag)
+    return response
+
+
+def group_resolver(
+    device_id: str,
+) -> tuple[GroupResolver, tuple] | str:
+    '''
+    Get the group resolver for a device
+        The objects are collected (or taken from the cache)
+        When they change, only the changed objects are updated
+
+    Args:
+        device_id (str): The device ID
+
+    Returns:
+        tuple: The GroupResolver, and the versions of its datasets
+        str: An error message, if the objects could not be collected
+    '''
+
+    datasets = {}
+    for path, param, data_type in OBJECT_DATASETS:
+        dataset = load_dataset(path, param, data_type, device_id)
+        if isinstance(dataset, str):
+            return dataset
+        datasets[data_type] = dataset
+
+    items = {
+        data_type: dataset.items
+        for data_type, dataset in datasets.items()
+    }
+    versions = tuple(dataset.version for dataset in datasets.values())
+
+    # Only the objects that changed are updated
+    def update(resolver):
+        resolver.sync(**items)
+        return resolver
+
+    resolver = compiled_cache.get(
+        ('resolver', device_id),
+        versions,
+        lambda: GroupResolver(**items),
+        update=update,
+    )
+
+    return resolver, versions
+
+
+def resolve_response(
+    object_type: str,
+) -> Response:
+    '''
+    Get the flattened members of groups, and any problems with them
+        Nested groups are expanded, and addresses are merged into prefixes
+        Only one group is returned if 'name' is given
+
+    Args:
+        object_type (str): The type of group (eg, 'address_groups')
+
+    Returns:
+        Response: The groups, cycles and dangling members
+    '''
+
+    kind = GROUP_KINDS.get(object_type)
+    if kind is None:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": "Only groups can be resolved"
+            }
+        ), 500
+
+    resolved = group_resolver(request.args.get('id'))
+    if isinstance(resolved, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": resolved
+            }
+        ), 500
+    resolver, versions = resolved
+
+    # Skip the work if the browser already has these groups
+    etag = make_etag(*versions, request.query_string)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    names = resolver.groups(kind)
+    if request.args.get('name'):
+        names = [name for name in names if name == request.args['name']]
+
+    groups = []
+    for name in names:
+        membership = resolver.resolve(kind, name)
+
+        # Ranges are written the same way they are entered on the device
+        if kind == 'address':
+            values = [
+                prefix
+                for interval in membership.values
+                for prefix in format_address(interval)
+            ]
+        elif kind == 'service':
+            values = [
+                f'{protocol}/{first}' if first == last
+                else f'{protocol}/{first}-{last}'
+                for protocol, first, last in membership.values
+            ]
+        else:
+            values = list(membership.values)
+
+        groups.append(
+            {
+                'name': name,
+                'members': values,
+                'unresolved': list(membership.unresolved),
+            }
+        )
+
+    report = resolver.report()
+    response = jsonify(
+        {
+            'groups': groups,
+            'cycles': [
+                cycle for cycle in report['cycles']
+                if cycle['kind'] == kind
+            ],
+            'dangling': [
+                entry for entry in report['dangling']
+                if entry['kind'] == kind
+            ],
+        }
+    )
+    response.set_etag(etag)
+    return response
+
+
+def analysis_response(
+) -> Response:
+    '''
+    Find unused and duplicate objects on a device
+        Objects and policies are collected (or taken from the cache)
+        Policies that can't be collected are listed as 'incomplete'
+
+    Returns:
+        Response: The analysis, or a failure message
+    '''
+
+    device_id = request.args.get('id')
+    datasets = {}
+    for data_type in ANALYSIS_OBJECTS:
+        dataset = load_dataset('/api/objects', 'object', data_type, device_id)
+        if isinstance(dataset, str):
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": dataset
+                }
+            ), 500
+        datasets[data_type] = dataset
+
+    # Without policies, objects can't be checked for use
+    for data_type in ANALYSIS_POLICIES:
+        dataset = load_dataset('/api/policies', 'type', data_type, device_id)
+        if not isinstance(dataset, str):
+            datasets[data_type] = dataset
+
+    versions = tuple(
+        (data_type, dataset.version)
+        for data_type, dataset in datasets.items()
+    )
+
+    # Skip the work if the browser already has this analysis
+    etag = make_etag(versions)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    result = compiled_cache.get(
+        ('objects', device_id),
+        versions,
+        lambda: analyse_device(datasets),
+    )
+
+    response = jsonify(result)
+    response.set_etag(etag)
+    return response
+
+
+def fleet_analysis_response(
+    devices: list,
+) -> Response:
+    '''
+    Compare objects across many devices
+        Only objects that have already been collected are compared
+        Collected objects are shared between workers (see cache.py),
+        so every worker compares the same objects
+
+    Args:
+        devices (list): The Device objects to compare
+
+    Returns:
+        Response: The duplicate and inconsistent objects
+    '''
+
+    reports = []
+    versions = []
+    missing = []
+    for device in devices:
+        datasets = {}
+        for data_type in ANALYSIS_OBJECTS:
+            dataset = dataset_cache.get(device.id, data_type, expired=True)
+            if dataset is not None:
+                datasets[data_type] = dataset
+
+        # Devices without collected objects are listed, not compared
+        if not datasets:
+            missing.append(device.hostname)
+            continue
+
+        # Each device's values are cached, so only changed devices are hashed
+        device_versions = tuple(
+            (data_type, dataset.version)
+            for data_type, dataset in datasets.items()
+        )
+        versions.append((str(device.id), device_versions))
+        reports.append(
+            {
+                'id': str(device.id),
+                'name': device.hostname,
+                'site': device.site_name,
+                'values': compiled_cache.get(
+                    ('object_values', str(device.id)),
+                    device_versions,
+                    lambda: object_values(datasets),
+                ),
+            }
+        )
+
+    # Skip the work if the browser already has this analysis
+    etag = make_etag(versions, missing, request.query_string)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    result = analyse_fleet(reports)
+    result['devices'] = [report['name'] for report in reports]
+    result['missing'] = sorted(missing)
+
+    response = jsonify(result)
+    response.set_etag(etag)
+    return response
+
+
+def compiled_rulebase(
+    device_id: str,
+) -> RuleLookup | str:
+    '''
+    Get the compiled security rulebase for a device
+        The rules and objects are collected (or taken from the cache),
+        and compiled once for each version of them
+
+    Args:
+        device_id (str): The device ID
+
+    Returns:
+        RuleLookup: The compiled rulebase
+        str: An error message, if the rules or objects could not be collected
+    '''
+
+    rules = load_dataset('/api/policies', 'type', 'security', device_id)
+    if isinstance(rules, str):
+        return rules
+
+    resolved = group_resolver(device_id)
+    if isinstance(resolved, str):
+        return resolved
+    resolver, versions = resolved
+
+    return compiled_cache.get(
+        ('lookup', device_id),
+        (rules.version,) + versions,
+        lambda: RuleLookup(rules=rules.items, resolver=resolver),
+    )
+
+
+def rule_analysis_response(
+) -> Response:
+    '''
+    Find shadowed, redundant and mergeable security rules on a device
+        The report is cached until the rules or objects change
+
+    Returns:
+        Response: The report, or a failure message
+    '''
+
+    device_id = request.args.get('id')
+    rules = load_dataset('/api/policies', 'type', 'security', device_id)
+    if isinstance(rules, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": rules
+            }
+        ), 500
+
+    resolved = group_resolver(device_id)
+    if isinstance(resolved, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": resolved
+            }
+        ), 500
+    resolver, versions = resolved
+    versions = (rules.version,) + versions
+
+    # Skip the work if the browser already has this report
+    etag = make_etag(*versions)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    report = compiled_cache.get(
+        ('rule_analysis', device_id),
+        versions,
+        lambda: RuleAnalysis(rules.items, resolver).report(),
+    )
+
+    response = jsonify(report)
+    response.set_etag(etag)
+    return response
+
+
+def zone_matrix_response(
+) -> Response:
+    '''
+    Get the security rules that apply to each pair of zones
+        The matrix is cached until the rules or objects change
+
+    Returns:
+        Response: The matrix, or a failure message
+    '''
+
+    device_id = request.args.get('id')
+    rules = load_dataset('/api/policies', 'type', 'security', device_id)
+    if isinstance(rules, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": rules
+            }
+        ), 500
+
+    resolved = group_resolver(device_id)
+    if isinstance(resolved, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": resolved
+            }
+        ), 500
+    resolver, versions = resolved
+    versions = (rules.version,) + versions
+
+    # The filters change the response, so they are part of the ETag
+    source = request.args.get('from')
+    target = request.args.get('to')
+    etag = make_etag(*versions, source, target)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    matrix = compiled_cache.get(
+        ('zone_matrix', device_id),
+        versions,
+        lambda: ZoneMatrix(rules.items, resolver),
+    )
+
+    response = jsonify(matrix.report(source, target))
+    response.set_etag(etag)
+    return response
+
+
+def lookup_response(
+) -> Response:
+    '''
+    Find the security rule that matches a flow
+        The flow is described in the query parameters
+
+    Returns:
+        Response: The matching rule and action, or a failure message
+    '''
+
+    rulebase = compiled_rulebase(request.args.get('id'))
+    if isinstance(rulebase, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": rulebase
+            }
+        ), 500
+
+    try:
+        port = request.args.get('port')
+        result = rulebase.lookup(
+            source=request.args.get('source'),
+            destination=request.args.get('destination'),
+            protocol=request.args.get('protocol', 'tcp'),
+            port=int(port) if port else None,
+            from_zone=request.args.get('from'),
+            to_zone=request.args.get('to'),
+            application=request.args.get('application'),
+        )
+
+    except ValueError as e:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": str(e)
+            }
+        ), 500
+
+    # Warn if the matching rule has objects that couldn't be resolved
+    if result['match'] is not None:
+        unresolved = rulebase.unresolved.get(result['match'].get('name'))
+        if unresolved:
+            result['unresolved'] = unresolved
+
+    return jsonify(result)
+
+
+def compiled_nat(
+    device_id: str,
+) -> NatSimulator | str:
+    '''
+    Get the compiled NAT rulebase for a device
+        The rules and objects are collected (or taken from the cache),
+        and compiled once for each version of them
+
+    Args:
+        device_id (str): The device ID
+
+    Returns:
+        NatSimulator: The compiled NAT rulebase
+        str: An error message, if the rules or objects could not be collected
+    '''
+
+    rules = load_dataset('/api/policies', 'type', 'nat', device_id)
+    if isinstance(rules, str):
+        return rules
+
+    resolved = group_resolver(device_id)
+    if isinstance(resolved, str):
+        return resolved
+    resolver, versions = resolved
+
+    return compiled_cache.get(
+        ('nat', device_id),
+        (rules.version,) + versions,
+        lambda: NatSimulator(rules=rules.items, resolver=resolver),
+    )
+
+
+def nat_lookup_response(
+) -> Response:
+    '''
+    Translate a flow with the NAT rulebase of a device
+        The flow is described in the query parameters
+
+    Returns:
+        Response: The matching rule and the flow after NAT
+    '''
+
+    simulator = compiled_nat(request.args.get('id'))
+    if isinstance(simulator, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": simulator
+            }
+        ), 500
+
+    try:
+        port = request.args.get('port')
+        result = simulator.translate(
+            source=request.args.get('source'),
+            destination=request.args.get('destination'),
+            protocol=request.args.get('protocol', 'tcp'),
+            port=int(port) if port else None,
+            from_zone=request.args.get('from'),
+            to_zone=request.args.get('to'),
+        )
+
+    except ValueError as e:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": str(e)
+            }
+        ), 500
+
+    return jsonify(result)
+
+
+def nat_batch_response(
+) -> Response:
+    '''
+    Translate many flows with the NAT rulebase of a device
+        The flows are a list in the JSON body, under 'flows'
+        A flow that can't be translated has an error, and doesn't stop
+        the others
+
+    Returns:
+        Response: The result of each flow, in the same order
+    '''
+
+    data = request.get_json(silent=True) or {}
+    flows = data.get('flows')
+    if not isinstance(flows, list):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": "A list of 'flows' is needed"
+            }
+        ), 500
+
+    if len(flows) > NAT_BATCH_LIMIT:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": f"No more than {NAT_BATCH_LIMIT} flows at a time"
+            }
+        ), 500
+
+    simulator = compiled_nat(request.args.get('id'))
+    if isinstance(simulator, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": simulator
+            }
+        ), 500
+
+    results = simulator.translate_many(
+        [flow if isinstance(flow, dict) else {} for flow in flows]
+    )
+
+    return jsonify(
+        {
+            "count": len(results),
+            "errors": sum(1 for result in results if 'error' in result),
+            "results": results,
+        }
+    )
+
+
+def device_config(
+    device_id: str,
+) -> tuple[str, str, str] | str:
+    '''
+    Download the running config of a device
+
+    Args:
+        device_id (str): The device ID
+
+    Returns:
+        tuple: (hostname, vendor, config)
+        str: An error message
+    '''
+
+    # Read the device details from the database
+    with SqlServer(
+        server=config.sql_server,
+        database=config.sql_database,
+        table='devices',
+        config=config,
+    ) as sql:
+        output = sql.read(
+            field='id',
+            value=device_id,
+        )
+
+    # Return a failure message if the database read failed
+    if not output:
+        return "Problems reading from the database"
+
+    # Parse the device details
+    hostname = output[0][1]
+    vendor = output[0][3]
+    username = output[0][6]
+    password = output[0][7]
+    salt = output[0][8]
+
+    # Decrypt the password
+    with CryptoSecret() as decryptor:
+        real_pw = decryptor.decrypt(
+            secret=password,
+            salt=base64.urlsafe_b64decode(salt.encode())
+        )
+
+    # Connect to the API, and download the config
+    if vendor == 'paloalto':
+        api_pass = base64.b64encode(
+            f'{username}:{real_pw}'.encode()
+        ).decode()
+        my_device = PaDeviceApi(
+            hostname=hostname,
+            xml_key=api_pass,
+        )
+
+    elif vendor == 'juniper':
+        my_device = JunosDeviceApi(
+            hostname=hostname,
+            username=username,
+            password=real_pw,
+        )
+
+    else:
+        return "Unknown vendor"
+
+    dev_config = my_device.get_config()
+    if isinstance(dev_config, int):
+        return f"Could not get the config (error {dev_config})"
+
+    return hostname, vendor, dev_config
+
+
+def config_response(
+    hostname: str,
+    vendor: str,
+    dev_config: str,
+    when: datetime,
+) -> Response:
+    '''
+    Return a config as a file to download
+
+    Args:
+        hostname (str): The device hostname
+        vendor (str): The device vendor
+        dev_config (str): The config
+        when (datetime): When the config was taken, for the filename
+
+    Returns:
+        Response: The config, as an attachment
+    '''
+
+    extension, mimetype = (
+        ('xml', 'text/xml') if vendor == 'paloalto'
+        else ('txt', 'text/plain')
+    )
+    filename = f"{hostname}_{when.strftime('%Y%m%d%H%M%S')}.{extension}"
+    print(f"downloading {filename}")
+    response = Response(dev_config, mimetype=mimetype)
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename="{filename}"'
+    )
+    response.headers['X-Filename'] = filename
+    return response
+
+
+def archived_config(
+    device_id: str,
+    ref: str,
+) -> tuple[dict, str] | str:
+    '''
+    Get a config from the archive
+        'live' downloads the config from the device, and archives it
+
+    Args:
+        device_id (str): The device ID
+        ref (str): A snapshot ID, 'latest', 'previous' or 'live'
+
+    Returns:
+        tuple: (snapshot, config)
+        str: An error message
+    '''
+
+    if ref == 'live':
+        result = device_config(device_id)
+        if isinstance(result, str):
+            return result
+
+        hostname, vendor, dev_config = result
+        snapshot = config_archive.capture(
+            device_id,
+            dev_config,
+            hostname=hostname,
+            vendor=vendor,
+        )
+        return snapshot, dev_config
+
+    # The snapshot before the newest one
+    if ref == 'previous':
+        snapshots = config_archive.snapshots(device_id)['snapshots']
+        if len(snapshots) < 2:
+            return f"There is no previous snapshot of '{device_id}'"
+        ref = snapshots[-2]['id']
+
+    try:
+        found = config_archive.read(
+            device_id,
+            None if ref == 'latest' else ref,
+        )
+    except (OSError, ValueError) as e:
+        return f"Could not read the snapshot: {e}"
+
+    if found is None:
+        return f"Snapshot '{ref}' of '{device_id}' not found"
+
+    return found
+
+
+def config_diff_response(
+) -> Response:
+    '''
+    Compare two configs, by structure
+        Configs come from the archive (or live from a device)
+        The diff is cached by the hashes of the two configs
+
+    Returns:
+        Response: The differences, or a failure message
+    '''
+
+    device_id = request.args.get('id')
+    compare = request.args.get('compare') or device_id
+    old = archived_config(device_id, request.args.get('old', 'previous'))
+    if isinstance(old, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": old
+            }
+        ), 500
+
+    new = archived_config(compare, request.args.get('new', 'latest'))
+    if isinstance(new, str):
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": new
+            }
+        ), 500
+
+    (old_snapshot, old_config), (new_snapshot, new_config) = old, new
+    versions = (old_snapshot['digest'], new_snapshot['digest'])
+
+    # The configs are content-addressed, so their hashes are the ETag
+    etag = make_etag(*versions)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    try:
+        result = compiled_cache.get(
+            ('config_diff', device_id, compare),
+            versions,
+            lambda: diff_configs(old_config, new_config),
+        )
+    except ValueError as e:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": f"Could not compare the configs: {e}"
+            }
+        ), 500
+
+    response = jsonify(
+        dict(
+            result,
+            old={'device': device_id, 'snapshot': old_snapshot['id']},
+            new={'device': compare, 'snapshot': new_snapshot['id']},
+        )
+    )
+    response.set_etag(etag)
+    return response
+
+
+def ha_status_response(
+) -> Response:
+    '''
+    Get the state of each HA pair, and check their configs match
+        The configs are only compared if 'check' is 'true'
+        Settings that aren't synchronized (eg, hostname) are ignored
+
+    Returns:
+        Response: Each HA pair
+    '''
+
+    check = request.args.get('check') == 'true'
+    ref = 'live' if request.args.get('live') == 'true' else 'latest'
+
+    pairs = []
+    for pair in device_manager.ha_pairs:
+        active = pair['active']
+        passive = pair['passive']
+        entry = {
+            'active': {
+                'id': str(active.id),
+                'name': active.name,
+                'state': active.ha_local_state,
+            },
+            'passive': {
+                'id': str(passive.id),
+                'name': passive.name,
+                'state': passive.ha_local_state,
+            },
+            'sync': passive.ha_sync or active.ha_sync,
+            'drift': device_manager.ha_drift.get(str(passive.id)),
+        }
+
+        if check:
+            active_config = archived_config(active.id, ref)
+            passive_config = archived_config(passive.id, ref)
+            for result in (active_config, passive_config):
+                if isinstance(result, str):
+                    entry['error'] = result
+                    break
+
+            # The same hash means the same config, so there's no drift
+            else:
+                versions = (
+                    active_config[0]['digest'],
+                    passive_config[0]['digest'],
+                )
+                changes = []
+                if versions[0] != versions[1]:
+                    try:
+                        result = compiled_cache.get(
+                            ('config_diff', str(active.id), str(passive.id)),
+                            versions,
+                            lambda: diff_configs(
+                                active_config[1],
+                                passive_config[1],
+                            ),
+                        )
+                        changes = [
+                            change for change in result['changes']
+                            if not any(
+                                part.startswith(HA_LOCAL_CONFIG)
+                                for part in change['path'].split('/')
+                            )
+                        ]
+                    except ValueError as e:
+                        entry['error'] = str(e)
+
+                if 'error' not in entry:
+                    device_manager.set_drift(passive.id, bool(changes))
+                    entry['drift'] = bool(changes)
+                    entry['changes'] = changes
+
+        # Where the passive peer's config is read from
+        entry['source'] = str(device_manager.config_source(passive.id))
+        pairs.append(entry)
+
+    return jsonify(pairs)
+
+
+def gp_sessions_response(
+) -> Response:
+    '''
+    Get the Global Protect sessions across every gateway
+        Served from memory, from the background polls
+
+    The 'action' parameter picks the view
+        None: The sessions, filtered, sorted and paginated
+        users: Each user once, with the gateways they're on
+        summary: Counts of sessions, users, gateways and regions
+
+    Returns:
+        Response: The sessions, users or summary
+    '''
+
+    action = request.args.get('action')
+    index = gp_sessions.index(device_manager.device_list)
+
+    # Skip the work if the browser already has this version
+    etag = make_etag(index.version, index.stale, request.query_string)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    if action == 'summary':
+        response = jsonify(index.summary())
+
+    elif action == 'users':
+        response = jsonify(
+            index.user_list(roaming=request.args.get('roaming') == 'true')
+        )
+
+    else:
+        try:
+            limit = request.args.get('limit')
+            response = jsonify(
+                index.query(
+                    user=request.args.get('user'),
+                    ip=request.args.get('ip'),
+                    region=request.args.get('region'),
+                    gateway=request.args.get('gateway'),
+                    sort=request.args.get('sort'),
+                    order=request.args.get('order', 'asc'),
+                    limit=max(int(limit), 1) if limit else None,
+                    cursor=request.args.get('cursor'),
+                )
+            )
+
+        except ValueError as e:
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": str(e)
+                }
+            ), 500
+
+    response.set_etag(etag)
+    return response
+
+
+def gp_history_response(
+    action: str,
+) -> Response:
+    '''
+    Get the Global Protect history
+        history: Concurrent users over time, from the rollups
+        logins: Logins and logouts, newest first
+
+    Times are in UTC (ISO format). The default range is the last day
+
+    Args:
+        action (str): 'history' or 'logins'
+
+    Returns:
+        Response: The trend, or the list of logins and logouts
+    '''
+
+    try:
+        end = request.args.get('end')
+        end = (
+            datetime.fromisoformat(end) if end
+            else datetime.now(timezone.utc).replace(tzinfo=None)
+        )
+        start = request.args.get('start')
+        start = (
+            datetime.fromisoformat(start) if start
+            else end - timedelta(days=1)
+        )
+
+        # Gateways can be given by name or device ID
+        gateway = request.args.get('gateway')
+        if gateway:
+            gateway = next(
+                (
+                    str(device.id) for device in device_manager.device_list
+                    if gateway in (str(device.id), device.name)
+                ),
+                gateway,
+            )
+
+        if action == 'history':
+            resolution = request.args.get('resolution')
+            result = gp_history.trend(
+                start,
+                end,
+                gateway=gateway or ALL,
+                region=request.args.get('region') or ALL,
+                resolution=int(resolution) if resolution else None,
+            )
+
+        else:
+            result = gp_history.events(
+                start,
+                end,
+                user=request.args.get('user'),
+                gateway=gateway,
+            )
+
+    except (ValueError, RuntimeError) as e:
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": str(e)
+            }
+        ), 500
+
+    return jsonify(result)
+
 
 class AzureView(MethodView):
     '''
@@ -551,6 +1851,12 @@ class DeviceView(MethodView):
         action (str): The action to perform.
             list: List all devices in the database.
             refresh: Refresh the device list.
+            snapshots: List the archived configs of a device.
+            snapshot: Download an archived config.
+            configdiff: Compare two configs, by structure.
+            ha: List HA pairs, and check their configs match.
+            polling: The background polling jobs, and latest results.
+            limits: The concurrency limits for each vendor and device.
 
     POST Parameters:
         action (str): The action to perform.
@@ -558,6 +1864,7 @@ class DeviceView(MethodView):
             delete: Delete a device from the database.
             update: Update a device in the database.
             download: Download the device configuration.
+            capture: Archive the device configuration now.
             reset: Reset the encryption for devices.
     '''
 
@@ -585,6 +1892,12 @@ class DeviceView(MethodView):
 
         # List all devices in the database
         if parameters == 'list':
+            # Skip the work if the browser already has this version
+            etag = make_etag(device_manager.version, request.query_string)
+            cached = not_modified(etag)
+            if cached is not None:
+                return cached
+
             # Create a list of device names
             device_list = []
             for device in device_manager.device_list:
@@ -601,7 +1914,9 @@ class DeviceView(MethodView):
 
             # If there is no device parameter, return the device list
             if device is None:
-                return jsonify(device_list)
+                response = jsonify(device_list)
+                response.set_etag(etag)
+                return response
 
             # If there is a device parameter, return the device entry
             device_entry = None
@@ -624,6 +1939,7 @@ class DeviceView(MethodView):
         elif parameters == 'refresh':
             # Refresh the site and device list
             device_manager.get_devices()
+            poll_scheduler.sync(device_manager.device_list)
 
             return jsonify(
                 {
@@ -632,6 +1948,71 @@ class DeviceView(MethodView):
                 }
             )
 
+        # List the archived snapshots (of one device, or all devices)
+        elif parameters == 'snapshots':
+            device_id = request.args.get('id')
+            if device_id is None:
+                return jsonify(
+                    {
+                        "devices": config_archive.devices(),
+                        "stats": config_archive.stats(),
+                    }
+                )
+
+            return jsonify(config_archive.snapshots(device_id))
+
+        # HA pairs, and whether their configs have drifted
+        elif parameters == 'ha':
+            return ha_status_response()
+
+        # Background polling (of one device, or all jobs)
+        elif parameters == 'polling':
+            device_id = request.args.get('id')
+            if device_id is None:
+                return jsonify(poll_scheduler.status())
+
+            return jsonify(device_state.device(device_id))
+
+        # The adaptive concurrency limits, and how they are being used
+        elif parameters == 'limits':
+            return jsonify(concurrency.status())
+
+        # Compare two configs (snapshots, or live), by structure
+        elif parameters == 'configdiff':
+            return config_diff_response()
+
+        # Download an archived snapshot (the newest, if none is given)
+        elif parameters == 'snapshot':
+            try:
+                found = config_archive.read(
+                    request.args.get('id'),
+                    request.args.get('snapshot'),
+                )
+            except (OSError, ValueError) as e:
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": f"Could not read the snapshot: {e}"
+                    }
+                ), 500
+
+            if found is None:
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": "Snapshot not found"
+                    }
+                ), 500
+
+            snapshot, dev_config = found
+            index = config_archive.snapshots(request.args.get('id'))
+            return config_response(
+                index['hostname'],
+                index['vendor'],
+                dev_config,
+                datetime.fromisoformat(snapshot['time']),
+            )
+
         # Unknown or missing action
         else:
             return jsonify(
@@ -795,161 +2176,76 @@ class DeviceView(MethodView):
         elif parameters == 'download':
             # Get the device ID from the JSON request
             device_id = request.json['deviceId']
-            table = 'devices'
-
-            # Read the device details from the database
-            with SqlServer(
-                server=config.sql_server,
-                database=config.sql_database,
-                table=table,
-                config=config,
-            ) as sql:
-                output = sql.read(
-                    field='id',
-                    value=device_id,
-                )
 
-            # Return a failure message if the database read failed
-            if not output:
+            result = device_config(device_id)
+            if isinstance(result, str):
                 return jsonify(
                     {
                         "result": "Failure",
-                        "message": "Problems reading from the database"
+                        "message": result
                     }
                 ), 500
 
-            # Parse the device details
-            hostname = output[0][1]
-            vendor = output[0][3]
-            username = output[0][6]
-            password = output[0][7]
-            salt = output[0][8]
-
-            # Decrypt the password
-            with CryptoSecret() as decryptor:
-                # Decrypt the password
-                real_pw = decryptor.decrypt(
-                    secret=password,
-                    salt=base64.urlsafe_b64decode(salt.encode())
-                )
-            api_pass = base64.b64encode(
-                f'{username}:{real_pw}'.encode()
-            ).decode()
-
-            # Connect to the API
-            if vendor == 'paloalto':
-                my_device = PaDeviceApi(
-                    hostname=hostname,
-                    xml_key=api_pass,
-                )
-
-                # Download the device configuration, return as a file
-                dev_config = my_device.get_config()
-                filename = (
-                    f"{hostname}_{datetime.now().strftime('%Y%m%d%H%M%S')}.xml"
-                )
-                print(f"downloading {filename}")
-                response = Response(dev_config, mimetype='text/xml')
-                response.headers['Content-Disposition'] = (
-                    f'attachment; filename="{filename}"'
-                )
-                response.headers['X-Filename'] = filename
-                return response
-
-            elif vendor == 'juniper':
-                my_device = JunosDeviceApi(
-                    hostname=hostname,
-                    username=username,
-                    password=real_pw,
-                )
+            # Keep a copy in the archive, then return it as a file
+            hostname, vendor, dev_config = result
+            config_archive.capture(
+                device_id,
+                dev_config,
+                hostname=hostname,
+                vendor=vendor,
+            )
+            return config_response(
+                hostname,
+                vendor,
+                dev_config,
+                datetime.now(),
+            )
 
-                # Download the device configuration, return as a file
-                dev_config = my_device.get_config()
-                filename = (
-                    f"{hostname}_{datetime.now().strftime('%Y%m%d%H%M%S')}.txt"
-                )
-                print(f"downloading {filename}")
-                response = Response(dev_config, mimetype='text/plain')
-                response.headers['Content-Disposition'] = (
-                    f'attachment; filename="{filename}"'
-                )
-                response.headers['X-Filename'] = filename
-                return response
+        # Capture a device's config in the archive now
+        elif parameters == 'capture':
+            device_id = request.json['deviceId']
 
-            else:
+            result = device_config(device_id)
+            if isinstance(result, str):
                 return jsonify(
                     {
                         "result": "Failure",
-                        "message": "Unknown vendor"
+                        "message": result
                     }
                 ), 500
 
+            hostname, vendor, dev_config = result
+            snapshot = config_archive.capture(
+                device_id,
+                dev_config,
+                hostname=hostname,
+                vendor=vendor,
+            )
+            return jsonify(snapshot)
+
         # Reset encryption for devices
         elif parameters == 'reset':
             # Get the master password from the request body
             master_password = request.json['password']
 
-            print(f"Existing master password: {os.getenv('api_master_pw')}")
-            print(f"New master password: {master_password}")
-
-            # Loop through device list
-            for device in device_manager.device_list:
-                result = device.reset_password(password=master_password)
-                if not result:
-                    return jsonify(
-                        {
-                            "result": "Failure",
-                            "message": "Failed resetting device password"
-                        }
-                    ), 500
-
-            # Decrypt SQL password (from config)
-            with CryptoSecret() as decryptor:
-                real_pw = decryptor.decrypt(
-                    secret=config.sql_password,
-                    salt=base64.urlsafe_b64decode(
-                        config.sql_salt.encode()
-                    )
-                )
-
-            # Encrypt SQL password
-            try:
-                with CryptoSecret() as encryptor:
-                    encrypted = encryptor.encrypt(
-                        password=real_pw,
-                        master_pw=master_password,
-                    )
-                    password_encoded = encrypted[0].decode()
-                    salt_encoded = base64.urlsafe_b64encode(
-                        encrypted[1]
-                    ).decode()
-
-            except Exception as e:
-                print(
-                    Fore.RED,
-                    "Could not encrypt SQL password",
-                    Style.RESET_ALL
-                )
-                print(e)
-
-            # Update SQL PW in config object
-            print(
-                Fore.CYAN,
-                "Updating SQL password in config.yaml",
-                Style.RESET_ALL
-            )
-            config.sql_password = password_encoded
-            config.sql_salt = salt_encoded
-            config.write_config()
-
-            # Update environnment variable
-            os.environ['api_master_pw'] = master_password
+            # Re-encrypt all device passwords and the SQL password
+            result = device_manager.reset_passwords(password=master_password)
+            if result is False:
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": "Failed resetting device passwords"
+                    }
+                ), 500
 
-            # Return a success message if the device was updated
+            # Return a success message if the devices were updated
             return jsonify(
                 {
                     "result": "Success",
-                    "message": "Master Password has been changed"
+                    "message": (
+                        "Master Password has been changed "
+                        f"({result} devices re-encrypted)"
+                    )
                 }
             )
 
@@ -977,6 +2273,11 @@ class ObjectsView(MethodView):
             app_groups: Get the application groups for a device.
             services: Get the services for a device.
             service_groups: Get the service groups for a device.
+        action (str): Optional action.
+            diff: Compare with the device in the 'compare' parameter.
+            resolve: Flatten nested groups, and report cycles and
+                dangling members.
+            analyse: Find unused and duplicate objects.
 
     POST Parameters:
         object (str): The object type.
@@ -1003,10 +2304,31 @@ class ObjectsView(MethodView):
         # Get the action parameter from the request
         object_type = request.args.get('object')
 
+        # Compare the objects on this device with another device
+        if request.args.get('action') == 'diff':
+            return diff_response('/api/objects', 'object', object_type)
+
+        # Flatten nested groups
+        if request.args.get('action') == 'resolve':
+            return resolve_response(object_type)
+
+        # Find unused and duplicate objects
+        if request.args.get('action') == 'analyse':
+            return analysis_response()
+
+        # Passive HA peers are read from the active peer, as the config
+        #   is synchronized (unless it has drifted)
+        device_id = device_manager.config_source(request.args.get('id'))
+
+        # Use the cached objects, unless a refresh is requested
+        dataset = dataset_cache.get(device_id, object_type)
+        if dataset is not None and request.args.get('refresh') != 'true':
+            return dataset_response(dataset)
+
         # Get the tags for a device
         if object_type == 'tags':
             # Get the tags from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -1061,13 +2383,15 @@ class ObjectsView(MethodView):
             # Sort the tags by name
             tag_list.sort(key=lambda x: x['name'])
 
-            # Return the tags as JSON
-            return jsonify(tag_list)
+            # Cache and return the tags as JSON
+            return dataset_response(
+                dataset_cache.store(device, object_type, tag_list)
+            )
 
         # Get the addresses for a device
         elif object_type == 'addresses':
             # Get the address objects from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -1202,13 +2526,15 @@ class ObjectsView(MethodView):
             # Sort the addresses by name
             address_list.sort(key=lambda x: x['name'])
 
-            # Return the addresses as JSON
-            return jsonify(address_list)
+            # Cache and return the addresses as JSON
+            return dataset_response(
+                dataset_cache.store(device, object_type, address_list)
+            )
 
         # Get the address groups for a device
         elif object_type == 'address_groups':
             # Get the address group objects from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -1315,10 +2641,10 @@ class ObjectsView(MethodView):
                         for address in address_book['address-set']:
                             entry = {}
                             entry["name"] = address['name']
-                            entry["static"] = address.get(
-                                'address',
-                                'None'
-                            )
+                            entry["static"] = (
+                                address.get('address', []) +
+                                address.get('address-set', [])
+                            ) or 'None'
                             entry["description"] = address.get(
                                 'description',
                                 'None'
@@ -1344,13 +2670,15 @@ class ObjectsView(MethodView):
             else:
                 address_group_list.sort(key=lambda x: x['name'])
 
-            # Return the address groups as JSON
-            return jsonify(address_group_list)
+            # Cache and return the address groups as JSON
+            return dataset_response(
+                dataset_cache.store(device, object_type, address_group_list)
+            )
 
         # Get the application groups for a device
         elif object_type == 'app_groups':
             # Get the application group objects from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -1471,13 +2799,19 @@ class ObjectsView(MethodView):
             # Sort the application groups by name
             application_group_list.sort(key=lambda x: x['name'])
 
-            # Return the application groups as JSON
-            return jsonify(application_group_list)
+            # Cache and return the application groups as JSON
+            return dataset_response(
+                dataset_cache.store(
+                    device,
+                    object_type,
+                    application_group_list
+                )
+            )
 
         # Get the services for a device
         elif object_type == 'services':
             # Get the service objects from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -1605,13 +2939,15 @@ class ObjectsView(MethodView):
             # Sort the service objects by name
             services_list.sort(key=lambda x: x['name'])
 
-            # Return the service objects as JSON
-            return jsonify(services_list)
+            # Cache and return the service objects as JSON
+            return dataset_response(
+                dataset_cache.store(device, object_type, services_list)
+            )
 
         # Get the service groups for a device
         elif object_type == 'service_groups':
             # Get the service groups from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -1734,8 +3070,10 @@ class ObjectsView(MethodView):
             # Sort the service groups by name
             service_groups_list.sort(key=lambda x: x['name'])
 
-            # Return the service groups as JSON
-            return jsonify(service_groups_list)
+            # Cache and return the service groups as JSON
+            return dataset_response(
+                dataset_cache.store(device, object_type, service_groups_list)
+            )
 
         # Unknown or missing object type
         else:
@@ -1761,6 +3099,10 @@ class ObjectsView(MethodView):
         # Get the action parameter from the request
         action = request.args.get('action')
 
+        # New objects make the cached objects for the device stale
+        if action == 'create':
+            dataset_cache.invalidate(request.args.get('id'), object_type)
+
         # Create a new tag
         if object_type == 'tags' and action == 'create':
             # Get device information
@@ -2351,13 +3693,19 @@ class PolicyView(MethodView):
     '''
     Class to manage policies for a device.
 
-    Methods: GET
+    Methods: GET, POST
 
     Parameters:
         type (str): The type of policy to get.
             nat: Get the NAT policies for a device.
             security: Get the security policies for a device.
             qos: Get the QoS policies for a device.
+            lookup: Find the security rule that matches a flow.
+            nat_lookup: Translate a flow with the NAT policies.
+            zones: Get the security rules for each pair of zones.
+        action (str): Optional action.
+            diff: Compare with the device in the 'compare' parameter.
+            analyse: Find shadowed, redundant and mergeable rules.
     '''
 
     @ login_required
@@ -2378,10 +3726,52 @@ class PolicyView(MethodView):
         # Get the action parameter from the request
         policy_type = request.args.get('type')
 
+        # Compare the policies on this device with another device
+        # Policies are evaluated in order, so moved rules are reported
+        if request.args.get('action') == 'diff':
+            return diff_response(
+                '/api/policies',
+                'type',
+                policy_type,
+                ordered=True,
+            )
+
+        # Find security rules that never match, or could be merged
+        if request.args.get('action') == 'analyse':
+            if policy_type != 'security':
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": "Only security rules can be analysed"
+                    }
+                ), 500
+            return rule_analysis_response()
+
+        # The security rules that apply to each pair of zones
+        if policy_type == 'zones':
+            return zone_matrix_response()
+
+        # Find the security rule that matches a flow
+        if policy_type == 'lookup':
+            return lookup_response()
+
+        # Translate a flow with the NAT policies
+        if policy_type == 'nat_lookup':
+            return nat_lookup_response()
+
+        # Passive HA peers are read from the active peer, as the config
+        #   is synchronized (unless it has drifted)
+        device_id = device_manager.config_source(request.args.get('id'))
+
+        # Use the cached policies, unless a refresh is requested
+        dataset = dataset_cache.get(device_id, policy_type)
+        if dataset is not None and request.args.get('refresh') != 'true':
+            return dataset_response(dataset)
+
         # Get the NAT policies for a device
         if policy_type == 'nat':
             # Get the NAT policies from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -2445,13 +3835,15 @@ class PolicyView(MethodView):
                 entry["disabled"] = policy.get('disabled', 'no')
                 nat_list.append(entry)
 
-            # Return the NAT policies as JSON
-            return jsonify(nat_list)
+            # Cache and return the NAT policies as JSON
+            return dataset_response(
+                dataset_cache.store(device, policy_type, nat_list)
+            )
 
         # Get the security policies for a device
         elif policy_type == 'security':
             # Get the security policies from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -2505,7 +3897,7 @@ class PolicyView(MethodView):
                 entry["application"] = rule.get('application', 'None')
                 entry["service"] = rule.get('service', 'None')
                 entry["action"] = rule.get('action', 'None')
-                entry["type"] = rule.get('rule-tupe', 'None')
+                entry["type"] = rule.get('rule-type', 'None')
                 entry["log"] = rule.get('log-setting', 'None')
                 entry["log_start"] = rule.get('log-start', 'no')
                 entry["log_end"] = rule.get('log-end', 'no')
@@ -2515,13 +3907,15 @@ class PolicyView(MethodView):
                 entry["description"] = rule.get('description', 'None')
                 security_list.append(entry)
 
-            # Return the security policies as JSON
-            return jsonify(security_list)
+            # Cache and return the security policies as JSON
+            return dataset_response(
+                dataset_cache.store(device, policy_type, security_list)
+            )
 
         # Get the QoS policies for a device
         elif policy_type == 'qos':
             # Get the QoS policies from the device
-            device = request.args.get('id')
+            device = device_id
             sql_server = config.sql_server
             sql_database = config.sql_database
             table = 'devices'
@@ -2581,8 +3975,10 @@ class PolicyView(MethodView):
                 entry["description"] = rule.get('description', 'None')
                 security_list.append(entry)
 
-            # Return the security policies as JSON
-            return jsonify(security_list)
+            # Cache and return the QoS policies as JSON
+            return dataset_response(
+                dataset_cache.store(device, policy_type, security_list)
+            )
 
         # Unknown or missing policy type
         else:
@@ -2593,6 +3989,33 @@ class PolicyView(MethodView):
                 }
             ), 500
 
+    @ login_required
+    def post(
+        self,
+        config: AppSettings,
+    ) -> jsonify:
+        '''
+        Post method for device policies
+            Used for requests that are too large for query parameters
+
+        Args:
+            config (AppSettings): The application settings object.
+
+        Returns:
+            jsonify: The result of the request.
+        '''
+
+        # Translate a batch of flows with the NAT policies
+        if request.args.get('type') == 'nat_lookup':
+            return nat_batch_response()
+
+        return jsonify(
+            {
+                "result": "Failure",
+                "message": "Unknown policy type supplied"
+            }
+        ), 500
+
 
 class VpnView(MethodView):
     '''
@@ -2604,7 +4027,10 @@ class VpnView(MethodView):
     Parameters:
         type (str): The type of VPN to get.
             gp: Get the Global Protect sessions for a device.
+                Without an ID, the sessions across every gateway.
             ipsec: Get the IPSec tunnels for a device.
+        live (str): 'true' to get the status from the device, rather
+            than the last background poll.
     '''
 
     @ login_required
@@ -2628,58 +4054,65 @@ class VpnView(MethodView):
         action = request.args.get('action')
         id = request.args.get('id')
 
+        # Global Protect history (concurrent users, or logins)
+        if vpn_type == 'gp' and action in ('history', 'logins'):
+            return gp_history_response(action)
+
+        # Global Protect sessions across every gateway
+        if vpn_type == 'gp' and id is None:
+            return gp_sessions_response()
+
         # Get the Global Protect sessions for a device
         if vpn_type == 'gp':
-            # Get the Global Protect sessions from the device
+            # Use the last background poll, unless it's stale
             device_id = request.args.get('id')
-            for device in device_manager.device_list:
-                if str(device.id) == device_id:
-                    hostname = device.hostname
-                    username = device.username
-                    password = device.decrypted_pw
-                    break
+            raw_gp_sessions = None
+            if request.args.get('live') != 'true':
+                raw_gp_sessions = poll_scheduler.latest(device_id, 'gp')
 
-            api_pass = base64.b64encode(
-                f'{username}:{password}'.encode()
-            ).decode()
+            # Get the Global Protect sessions from the device
+            if raw_gp_sessions is None:
+                for device in device_manager.device_list:
+                    if str(device.id) == device_id:
+                        hostname = device.hostname
+                        username = device.username
+                        password = device.decrypted_pw
+                        break
 
-            # Create the device object
-            device_api = PaDeviceApi(
-                hostname=hostname,
-                xml_key=api_pass,
-            )
+                api_pass = base64.b64encode(
+                    f'{username}:{password}'.encode()
+                ).decode()
+
+                # Create the device object
+                device_api = PaDeviceApi(
+                    hostname=hostname,
+                    xml_key=api_pass,
+                )
 
-            # The Global Protect sessions from the device
-            raw_gp_sessions = device_api.get_gp_sessions()
+                # The Global Protect sessions from the device
+                raw_gp_sessions = device_api.get_gp_sessions()
 
             # A cleaned up list of Global Protect sessions
-            session_list = []
-            for gp_session in raw_gp_sessions:
-                entry = {}
-                entry["name"] = gp_session.get('username', 'None')
-                entry["username"] = gp_session.get('primary-username', 'None')
-                entry["region"] = gp_session.get('source-region', 'None')
-                entry["computer"] = gp_session.get('computer', 'None')
-                entry["client"] = gp_session.get('client', 'None')
-                entry["vpn_type"] = gp_session.get('vpn-type', 'None')
-                entry["host"] = gp_session.get('host-id', 'None')
-                entry["version"] = gp_session.get('app-version', 'None')
-                entry["inside_ip"] = gp_session.get('virtual-ip', 'None')
-                entry["outside_ip"] = gp_session.get('public-ip', 'None')
-                entry["tunnel_type"] = gp_session.get('tunnel-type', 'None')
-                entry["login"] = gp_session.get('login-time', 'None')
-                session_list.append(entry)
+            session_list = [
+                clean_session(gp_session) for gp_session in raw_gp_sessions
+            ]
 
             # Sort the security policies by name
             session_list.sort(key=lambda x: x['name'])
 
             # Return the security policies as JSON
-            return jsonify(session_list)
+            return list_response(session_list)
 
         # If IPSec tunnels are requested
         elif vpn_type == 'ipsec':
             # If there is no action, return the list of managed VPN tunnels
             if action is None:
+                # Skip the work if the browser already has this version
+                etag = make_etag(vpn_manager.version, device_manager.version)
+                cached = not_modified(etag)
+                if cached is not None:
+                    return cached
+
                 vpn_list = []
 
                 for vpn in vpn_manager:
@@ -2729,7 +4162,27 @@ class VpnView(MethodView):
                     vpn_list.append(entry)
 
                 # Return the VPN tunnels as JSON
-                return jsonify(vpn_list)
+                response = jsonify(vpn_list)
+                response.set_etag(etag)
+                return response
+
+            # The health of every managed tunnel, from memory
+            elif action == 'health':
+                etag = make_etag(
+                    tunnel_monitor.version,
+                    device_state.version,
+                    vpn_manager.version,
+                    request.query_string,
+                )
+                cached = not_modified(etag)
+                if cached is not None:
+                    return cached
+
+                response = jsonify(
+                    tunnel_monitor.status(state=request.args.get('state'))
+                )
+                response.set_etag(etag)
+                return response
 
             # If the action is 'status', return the status of the VPN tunnel
             elif action == 'status':
@@ -2761,118 +4214,81 @@ class VpnView(MethodView):
                         }
                     ), 500
 
-                # Get device details from SQL
-                table = 'devices'
-                with SqlServer(
-                    server=config.sql_server,
-                    database=config.sql_database,
-                    table=table,
-                    config=config,
-                ) as sql:
-                    output = sql.read(
-                        field='id',
-                        value=id,
-                    )
-
-                # Return a failure message if the database read failed
-                if not output:
-                    return jsonify(
-                        {
-                            "result": "Failure",
-                            "message": "Problems reading from the database"
-                        }
-                    ), 500
+                # Use the last background poll, unless it's stale
+                vpn_status = None
+                if request.args.get('live') != 'true':
+                    vpn_status = poll_scheduler.latest(id, 'vpn')
+
+                # Otherwise, get the status from the device
+                if vpn_status is None:
+                    # Get device details from SQL
+                    table = 'devices'
+                    with SqlServer(
+                        server=config.sql_server,
+                        database=config.sql_database,
+                        table=table,
+                        config=config,
+                    ) as sql:
+                        output = sql.read(
+                            field='id',
+                            value=id,
+                        )
 
-                # Parse the device details
-                hostname = output[0][1]
-                vendor = output[0][3]
-                username = output[0][6]
-                password = output[0][7]
-                salt = output[0][8]
+                    # Return a failure message if the database read failed
+                    if not output:
+                        return jsonify(
+                            {
+                                "result": "Failure",
+                                "message": "Problems reading from the database"
+                            }
+                        ), 500
+
+                    # Parse the device details
+                    hostname = output[0][1]
+                    vendor = output[0][3]
+                    username = output[0][6]
+                    password = output[0][7]
+                    salt = output[0][8]
 
-                # Decrypt the password
-                with CryptoSecret() as decryptor:
                     # Decrypt the password
-                    real_pw = decryptor.decrypt(
-                        secret=password,
-                        salt=base64.urlsafe_b64decode(salt.encode())
-                    )
-                api_pass = base64.b64encode(
-                    f'{username}:{real_pw}'.encode()
-                ).decode()
-
-                # Select the right vendor
-                if vendor == 'paloalto':
-                    device_api = PaDeviceApi(
-                        hostname=hostname,
-                        xml_key=api_pass,
-                    )
+                    with CryptoSecret() as decryptor:
+                        # Decrypt the password
+                        real_pw = decryptor.decrypt(
+                            secret=password,
+                            salt=base64.urlsafe_b64decode(salt.encode())
+                        )
+                    api_pass = base64.b64encode(
+                        f'{username}:{real_pw}'.encode()
+                    ).decode()
 
-                elif vendor == 'juniper':
-                    device_api = JunosDeviceApi(
-                        hostname=hostname,
-                        username=username,
-                        password=real_pw,
-                    )
+                    # Select the right vendor
+                    if vendor == 'paloalto':
+                        device_api = PaDeviceApi(
+                            hostname=hostname,
+                            xml_key=api_pass,
+                        )
 
-                else:
-                    return jsonify(
-                        {
-                            "result": "Failure",
-                            "message": "Unknown vendor"
-                        }
-                    ), 500
+                    elif vendor == 'juniper':
+                        device_api = JunosDeviceApi(
+                            hostname=hostname,
+                            username=username,
+                            password=real_pw,
+                        )
 
-                # Get the VPN status
-                vpn_status = device_api.get_vpn_status()
+                    else:
+                        return jsonify(
+                            {
+                                "result": "Failure",
+                                "message": "Unknown vendor"
+                            }
+                        ), 500
+
+                    # Get the VPN status
+                    vpn_status = device_api.get_vpn_status()
                 if vpn_status:
-                    tunnel_list = []
-                    for tunnel in vpn_status:
-                        entry = {}
-
-                        entry['ike_name'] = tunnel.get('ike-name', 'None')
-                        entry['ike_status'] = tunnel.get('ike_state', 'None')
-                        entry['local_ip'] = tunnel.get('localip', 'None')
-
-                        if 'ipsec-name' in tunnel:
-                            entry['ipsec_name'] = tunnel.get('ipsec-name')
-                        elif 'name' in tunnel:
-                            entry['ipsec_name'] = tunnel.get('name')
-                        else:
-                            entry['ipsec_name'] = 'None'
-
-                        if 'peerip' in tunnel:
-                            entry['destination'] = tunnel.get('peerip')
-                        elif 'ike_address' in tunnel:
-                            entry['destination'] = tunnel.get('ike_address')
-                        else:
-                            entry['destination'] = 'None'
-
-                        if 'ipsec_state' in tunnel:
-                            entry['ipsec_status'] = tunnel.get('ipsec_state')
-                        elif 'state' in tunnel:
-                            entry['ipsec_status'] = tunnel.get('state')
-                        else:
-                            entry['ipsec_status'] = 'None'
-
-                        if entry['ipsec_status'] == 'active':
-                            entry['ipsec_status'] = 'up'
-
-                        if 'outer-if' in tunnel:
-                            entry['physical_if'] = tunnel.get('outer-if')
-                        elif 'ike_interface' in tunnel:
-                            entry['physical_if'] = tunnel.get('ike_interface')
-                        else:
-                            entry['physical_if'] = 'None'
-
-                        if 'inner-if' in tunnel:
-                            entry['tunnel_if'] = tunnel.get('inner-if')
-                        elif 'ipsec_interface' in tunnel:
-                            entry['tunnel_if'] = tunnel.get('ipsec_interface')
-                        else:
-                            entry['tunnel_if'] = 'None'
-
-                        tunnel_list.append(entry)
+                    tunnel_list = [
+                        clean_tunnel(tunnel) for tunnel in vpn_status
+                    ]
 
                     return jsonify(tunnel_list)
 
@@ -2983,6 +4399,464 @@ class VpnView(MethodView):
             ), 500
 
 
+class FleetView(MethodView):
+    '''
+    Class to run the same query against many devices at once
+
+    Methods: GET
+
+    Parameters:
+        query (str): The kind of data to collect.
+            objects: Objects, such as addresses.
+            policies: Policies, such as security rules.
+            vpn: VPN sessions (GP only).
+        type (str): The type of data, as used by the single device route.
+            For example, 'addresses' or 'security'.
+            With the 'objects' query, 'analysis' compares the objects
+            already collected from each device (returned as JSON).
+        ids (str): Comma separated device IDs (optional).
+        site (str): Only query devices at this site (optional).
+        vendor (str): Only query devices from this vendor (optional).
+        refresh (str): 'true' to ignore cached data (optional).
+
+    Results are streamed as newline delimited JSON (NDJSON)
+        One line per device, as each device completes
+        The last line is a summary
+    '''
+
+    @ login_required
+    def get(
+        self,
+        device_manager: DeviceManager,
+    ) -> Response:
+        '''
+        Get method to query many devices at once
+
+        Args:
+            device_manager (DeviceManager): The device manager object.
+
+        Returns:
+            Response: A stream of results, one line per device.
+        '''
+
+        # Get parameters from the request
+        query = request.args.get('query')
+        data_type = request.args.get('type')
+
+        # Compare the objects already collected from each device
+        if query == 'objects' and data_type == 'analysis':
+            ids = request.args.get('ids')
+            return fleet_analysis_response(
+                select_devices(
+                    device_manager.device_list,
+                    ids=ids.split(',') if ids else None,
+                    site=request.args.get('site'),
+                    vendor=request.args.get('vendor'),
+                )
+            )
+
+        # Check the query is one that can be run across the fleet
+        if (
+            query not in FLEET_QUERIES or
+            data_type not in FLEET_QUERIES[query][2]
+        ):
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": "Unknown fleet query or type supplied"
+                }
+            ), 500
+
+        path, param, _ = FLEET_QUERIES[query]
+
+        # Find the devices to query (GP is only on Palo Alto devices)
+        ids = request.args.get('ids')
+        vendor = request.args.get('vendor')
+        if query == 'vpn':
+            vendor = 'paloalto'
+
+        devices = select_devices(
+            device_manager.device_list,
+            ids=ids.split(',') if ids else None,
+            site=request.args.get('site'),
+            vendor=vendor,
+        )
+
+        # Details needed to run each device's query in a worker thread
+        app = current_app._get_current_object()
+        headers = session_headers()
+
+        args = {param: data_type}
+        if request.args.get('refresh') == 'true':
+            args['refresh'] = 'true'
+
+        # Each device is collected through its single device route
+        def collect(device):
+            return internal_get(
+                app,
+                path,
+                query_string={**args, 'id': str(device.id)},
+                headers=headers,
+            )
+
+        # Stream each device's result as it completes
+        fleet_query = FleetQuery(devices, collect)
+        return Response(
+            (
+                encode(result, default=app.json.default, newline=True)
+                for result in fleet_query.run()
+            ),
+            mimetype='application/x-ndjson',
+        )
+
+
+class SearchView(MethodView):
+    '''
+    Class to search for an IP address across all devices
+
+    Methods: GET
+
+    Parameters:
+        ip (str): An IP, prefix, or range (eg, 10.0.0.1-10.0.0.9).
+        match (str): How entries must match the IP (optional).
+            overlap: Share any IP with the search (default).
+            contains: Cover the whole search.
+            within: Be inside the search.
+        type (str): Comma separated datasets to include (optional).
+            addresses, address_groups, nat, security, or vpn.
+        ids (str): Comma separated device IDs (optional).
+
+    Only data that has already been collected is searched
+        Use the fleet API to collect data from many devices
+    '''
+
+    @ login_required
+    def get(
+        self,
+        device_manager: DeviceManager,
+    ) -> jsonify:
+        '''
+        Get method to search for an IP address
+
+        Args:
+            device_manager (DeviceManager): The device manager object.
+
+        Returns:
+            jsonify: The entries that reference the IP.
+        '''
+
+        query = request.args.get('ip', '')
+        mode = request.args.get('match', 'overlap')
+
+        # Bring the index up to date with the collected data
+        devices = {str(device.id) for device in device_manager.device_list}
+        for device_id in devices:
+            datasets = {}
+            for name in INDEXED_DATASETS:
+                dataset = dataset_cache.get(device_id, name, expired=True)
+                if dataset is not None:
+                    datasets[name] = dataset
+            ip_index.sync_device(device_id, datasets)
+
+        ip_index.update(
+            ('vpn',),
+            vpn_manager.version,
+            lambda: vpn_records(list(vpn_manager.vpn_list)),
+        )
+
+        # Devices that have been removed are not searched
+        segments = ip_index.segments()
+        for key in segments:
+            if key != ('vpn',) and key[0] not in devices:
+                ip_index.remove(key)
+
+        # Skip the work if the browser already has these results
+        etag = make_etag(sorted(segments.items()), request.query_string)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        try:
+            found = ip_index.search(query, mode)
+
+        except ValueError as e:
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": str(e)
+                }
+            ), 500
+
+        results = format_results(found, parse_address(query)[0])
+
+        # Optional filters
+        types = request.args.get('type')
+        if types:
+            types = types.split(',')
+            results = [entry for entry in results if entry['type'] in types]
+
+        ids = request.args.get('ids')
+        if ids:
+            ids = ids.split(',')
+            results = [entry for entry in results if entry['device'] in ids]
+
+        names = {
+            str(device.id): device.hostname
+            for device in device_manager.device_list
+        }
+        for entry in results:
+            entry['device_name'] = names.get(entry['device'])
+
+        response = jsonify(
+            {
+                "ip": query,
+                "match": mode,
+                "count": len(results),
+                "indexed": len(ip_index),
+                "results": results,
+            }
+        )
+        response.set_etag(etag)
+        return response
+
+
+class EventsView(MethodView):
+    '''
+    Class to stream live changes to the browser (Server-Sent Events)
+
+    Methods: GET
+
+    Parameters:
+        types (str): Comma separated kinds of event (optional).
+            tunnel, gp, ha, or device.
+        last_id (int): The last event ID the browser saw (optional).
+            Browsers send this as the Last-Event-ID header when they
+            reconnect, so it's only needed to resume a new connection.
+
+    Events are found as background polls finish
+        A 'reset' event means some were missed, so lists should be
+        fetched again
+
+    Each worker serves a limited number of streams at once
+        Past this, a 503 is returned, with a Retry-After header
+    '''
+
+    @ login_required
+    def get(
+        self,
+        event_bus: EventBus,
+    ) -> Response:
+        '''
+        Get method to stream events
+
+        Args:
+            event_bus (EventBus): The event bus object.
+
+        Returns:
+            Response: A stream of events (text/event-stream).
+        '''
+
+        # Only the kinds of event that were asked for
+        kinds = None
+        types = request.args.get('types')
+        if types:
+            kinds = types.split(',')
+            unknown = [kind for kind in kinds if kind not in EVENT_TYPES]
+            if unknown:
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": f"Unknown event types: {unknown}"
+                    }
+                ), 500
+
+        # Resume from the last event the browser saw
+        last_id = request.headers.get(
+            'Last-Event-ID',
+            request.args.get('last_id'),
+        )
+        if last_id is not None:
+            try:
+                last_id = int(last_id)
+            except ValueError:
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": "The last event ID must be a number"
+                    }
+                ), 500
+
+        # Each stream holds a thread, so limit how many are open
+        if not event_bus.open_stream():
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": "Too many event streams are open, "
+                               "try again later"
+                }
+            ), 503, {'Retry-After': str(STREAMS_BUSY_RETRY)}
+
+        response = Response(
+            event_bus.stream(last_id, kinds),
+            mimetype='text/event-stream',
+        )
+
+        # Free the place when the stream ends (or the browser leaves)
+        response.call_on_close(event_bus.close_stream)
+
+        # Stop proxies (eg, NGINX) from caching or buffering the stream
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class MetricsView(MethodView):
+    '''
+    Class to expose metrics to Prometheus
+
+    Methods: GET
+
+    Login isn't needed, so Prometheus can scrape this
+        The token in the 'metrics_token' environment variable must be
+        sent as a bearer token (Authorization header)
+        If there is no token, metrics are not available
+
+    The metrics from every worker process are added together
+    '''
+
+    def get(
+        self,
+        metrics: MetricsRegistry,
+    ) -> Response:
+        '''
+        Get method to render the metrics
+
+        Args:
+            metrics (MetricsRegistry): The metrics registry object.
+
+        Returns:
+            Response: The metrics, in the Prometheus text format.
+        '''
+
+        # Metrics are only available with a token
+        token = os.getenv('metrics_token')
+        if not token:
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": "Metrics are disabled (no metrics token)"
+                }
+            ), 403
+
+        # Check the token
+        sent = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(sent, f'Bearer {token}'):
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": "A valid metrics token is required"
+                }
+            ), 401
+
+        response = Response(
+            metrics.render(),
+            mimetype='text/plain',
+        )
+        response.headers['Content-Type'] = (
+            'text/plain; version=0.0.4; charset=utf-8'
+        )
+        return response
+
+
+class ProfilingView(MethodView):
+    '''
+    Class to find slow API requests, and their traces
+
+    Methods: GET
+
+    Parameters:
+        action (str): What to get (optional).
+            slow: The slowest recent requests (default).
+            trace: One request's trace.
+        limit (int): The most requests to return (slow, default 20).
+        route (str): Only requests to this route (slow, optional).
+            eg, /api/objects
+        id (str): The trace ID, from the X-Profile-Id header (trace).
+
+    Requests slower than a second are kept, and so are requests that
+        admins profile (with an X-Profile header or 'profile' parameter)
+    '''
+
+    @ login_required
+    def get(
+        self,
+        request_log: RequestLog,
+    ) -> jsonify:
+        '''
+        Get method to find slow requests
+
+        Args:
+            request_log (RequestLog): The request log object.
+
+        Returns:
+            jsonify: The requests, or a trace.
+        '''
+
+        action = request.args.get('action', 'slow')
+
+        # One request's trace, with its spans and profile
+        if action == 'trace':
+            entry = request_log.get(request.args.get('id', ''))
+            if entry is None:
+                return jsonify(
+                    {
+                        "result": "Failure",
+                        "message": "The trace was not found"
+                    }
+                ), 500
+
+            return jsonify(entry)
+
+        if action != 'slow':
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": f"Unknown action: {action}"
+                }
+            ), 500
+
+        # The slowest requests, with a summary of their spans
+        try:
+            limit = int(request.args.get('limit', 20))
+        except ValueError:
+            return jsonify(
+                {
+                    "result": "Failure",
+                    "message": "The limit must be a number"
+                }
+            ), 500
+
+        return jsonify(
+            request_log.slowest(
+                limit=limit,
+                route=request.args.get('route'),
+            )
+        )
+
+
+# Trace every API request, and profile it if an admin asks
+#   The trace finishes last, so it covers the other hooks
+api_bp.before_request(start_trace)
+api_bp.after_request(finish_request)
+api_bp.teardown_request(end_request)
+
+# Time every API request (recorded after ETags, so 304s are seen)
+api_bp.before_request(start_request)
+api_bp.after_request(record_request)
+
+# Add ETags and compression to all API responses
+api_bp.after_request(finalize_response)
+
 # Register Azure view
 api_bp.add_url_rule(
     '/api/azure',
@@ -3044,3 +4918,38 @@ api_bp.add_url_rule(
     view_func=VpnView.as_view('vpn'),
     defaults={'config': config, 'device_manager': device_manager}
 )
+
+# Register fleet view
+api_bp.add_url_rule(
+    '/api/fleet',
+    view_func=FleetView.as_view('fleet'),
+    defaults={'device_manager': device_manager}
+)
+
+# Register IP search view
+api_bp.add_url_rule(
+    '/api/search',
+    view_func=SearchView.as_view('search'),
+    defaults={'device_manager': device_manager}
+)
+
+# Register live events view
+api_bp.add_url_rule(
+    '/api/events',
+    view_func=EventsView.as_view('events'),
+    defaults={'event_bus': event_bus}
+)
+
+# Register metrics view
+api_bp.add_url_rule(
+    '/metrics',
+    view_func=MetricsView.as_view('metrics'),
+    defaults={'metrics': metrics}
+)
+
+# Register profiling view
+api_bp.add_url_rule(
+    '/api/profiling',
+    view_func=ProfilingView.as_view('profiling'),
+    defaults={'request_log': request_log}
+)
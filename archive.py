@@ -0,0 +1,713 @@
+'''
+Keep a history of each device's configuration on local disk
+
+Snapshots are captured periodically, and can be listed and read back
+    A snapshot is only added when the config changes
+    Otherwise, the time it was last checked is updated
+
+Storage is content-addressed, so each piece of config is stored once
+    (1) Configs are split into chunks at line boundaries
+        Boundaries are picked by the content of the lines, not by offset,
+        so a change only affects the chunks around it
+    (2) Each chunk is compressed, and stored under its SHA-256 hash
+        Chunks that are already stored (from any device) are reused
+    (3) A manifest lists the chunks in a config, stored under the hash of
+        the whole config
+    (4) An index per device lists the snapshots, in time order
+
+Near-identical daily snapshots share almost all of their chunks
+    Storage grows with the amount of change, not the number of snapshots
+
+A retention policy thins out old snapshots
+    Every snapshot is kept for a while, then one per day, then one per
+    week. The newest snapshot is always kept.
+    Chunks and manifests that are no longer used are then removed
+    New files are left alone for a while, in case a capture is using them
+
+Several worker processes share the archive
+    Changes (captures and pruning) lock a file in the archive, so only
+    one process changes it at a time
+    Only one worker captures on a schedule (the first to lock a file)
+    Captures from API routes can happen in any worker
+
+Classes:
+    ConfigArchive
+        A content-addressed store of config snapshots
+
+Functions:
+    split_chunks
+        Split a config into content-defined chunks
+
+Misc Variables:
+    config_archive
+        The shared ConfigArchive object
+'''
+
+from colorama import Fore, Style
+from datetime import datetime, timedelta
+
+import contextlib
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import typing as t
+import zlib
+
+from concurrency import concurrency
+from state import STATE_DIR, leader_lock, locked, write_atomic
+
+
+# Where the archive is stored (relative to the app directory)
+ARCHIVE_DIR = 'archive'
+
+# How often each device is captured (seconds)
+CAPTURE_INTERVAL = 24 * 60 * 60
+
+# How long snapshots are kept (days)
+#   all: Every snapshot
+#   daily: The newest snapshot each day
+#   weekly: The newest snapshot each week
+RETENTION = {
+    'all': 7,
+    'daily': 60,
+    'weekly': 365,
+}
+
+# Chunk sizes (bytes), and the chance a line ends a chunk (1 in N)
+MIN_CHUNK = 2048
+MAX_CHUNK = 65536
+BOUNDARY = 64
+
+# Files newer than this (seconds) aren't pruned, as a capture may be
+#   about to use them
+PRUNE_GRACE = 60 * 60
+
+# The file that chooses the worker that captures on a schedule
+LEADER_FILE = os.path.join(STATE_DIR, 'archive.lock')
+
+
+def split_chunks(
+    text: str,
+) -> list[bytes]:
+    '''
+    Split a config into content-defined chunks
+        A line ends a chunk if its hash matches a pattern, so the same
+        lines give the same chunks wherever they are in the config
+
+    Args:
+        text (str): The config
+
+    Returns:
+        list: The chunks, which join back into the config
+    '''
+
+    chunks = []
+    current = []
+    size = 0
+    for line in text.encode().splitlines(keepends=True):
+        current.append(line)
+        size += len(line)
+
+        if size >= MAX_CHUNK or (
+            size >= MIN_CHUNK and zlib.crc32(line) % BOUNDARY == 0
+        ):
+            chunks.append(b''.join(current))
+            current = []
+            size = 0
+
+    if current:
+        chunks.append(b''.join(current))
+
+    return chunks
+
+
+class ConfigArchive:
+    '''
+    A content-addressed store of config snapshots
+        Safe to share between threads and processes
+
+    Methods:
+        __init__: Constructor for the ConfigArchive class
+        _locked: Lock the archive, while it's changed
+        capture: Store a config, if it has changed
+        snapshots: List the snapshots of a device
+        devices: List the devices in the archive
+        read: Read a snapshot back
+        prune: Apply the retention policy, and remove unused data
+        stats: Get the size of the archive
+        start: Capture configs periodically, in the background
+        capture_all: Capture every device that is due
+        _path: Get the path of a file in the archive
+        _load_index: Read a device's index
+        _save_index: Write a device's index
+        _keep: Pick the snapshots to keep
+    '''
+
+    def __init__(
+        self,
+        path: str = ARCHIVE_DIR,
+        retention: dict = None,
+    ) -> None:
+        '''
+        Constructor for the ConfigArchive class
+
+        Args:
+            path (str): The directory to store the archive in
+            retention (dict): Days to keep 'all', 'daily' and 'weekly'
+                snapshots for
+        '''
+
+        self.path = path
+        self.retention = retention or RETENTION
+        self._lock = threading.RLock()
+        self._thread = None
+
+        # How deeply the archive is locked (the file is locked once)
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def _locked(
+        self
+    ) -> t.Iterator[None]:
+        '''
+        Lock the archive, while it's changed
+            Threads share a lock, and processes lock a file
+            Can be nested (eg, a capture while pruning)
+            Without file locks (eg, Windows), only threads are locked
+        '''
+
+        with self._lock:
+            if self._depth == 0:
+                file_lock = locked(self._path('.lock'))
+            else:
+                file_lock = contextlib.nullcontext()
+
+            with file_lock:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+
+    def _path(
+        self,
+        *parts: str,
+    ) -> str:
+        '''
+        Get the path of a file in the archive
+
+        Args:
+            parts (str): The parts of the path, under the archive directory
+
+        Returns:
+            str: The path
+        '''
+
+        return os.path.join(self.path, *parts)
+
+    def _load_index(
+        self,
+        device_id: str,
+    ) -> dict:
+        '''
+        Read a device's index
+
+        Args:
+            device_id (str): The device ID
+
+        Returns:
+            dict: The index (empty if the device has no snapshots)
+                device (str): The device ID
+                hostname (str): The device hostname
+                vendor (str): The device vendor
+                checked (str): When the config was last checked
+                snapshots (list): The snapshots, oldest first
+        '''
+
+        try:
+            with open(self._path('index', f"{device_id}.json")) as f:
+                return json.load(f)
+
+        except FileNotFoundError:
+            return {
+                'device': str(device_id),
+                'hostname': None,
+                'vendor': None,
+                'checked': None,
+                'snapshots': [],
+            }
+
+    def _save_index(
+        self,
+        index: dict,
+    ) -> None:
+        '''
+        Write a device's index
+
+        Args:
+            index (dict): The index
+        '''
+
+        write_atomic(
+            self._path('index', f"{index['device']}.json"),
+            json.dumps(index, indent=1).encode(),
+        )
+
+    def capture(
+        self,
+        device_id: str,
+        text: str,
+        hostname: str = None,
+        vendor: str = None,
+        when: datetime = None,
+    ) -> dict:
+        '''
+        Store a config, if it has changed
+
+        Args:
+            device_id (str): The device ID
+            text (str): The config
+            hostname (str): The device hostname
+            vendor (str): The device vendor
+            when (datetime): When the config was captured (default is now)
+
+        Returns:
+            dict: The snapshot
+                id (str): The snapshot ID (a timestamp)
+                time (str): When it was captured
+                digest (str): The SHA-256 hash of the config
+                size (int): The size of the config
+                chunks (int): The number of chunks
+                new_chunks (int): Chunks that weren't already stored
+                stored (int): Bytes added to the archive
+                changed (bool): False if the config was the same as the
+                    newest snapshot (so no snapshot was added)
+        '''
+
+        when = when or datetime.now()
+        data = text.encode()
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._locked():
+            index = self._load_index(device_id)
+            index['hostname'] = hostname or index['hostname']
+            index['vendor'] = vendor or index['vendor']
+            index['checked'] = when.isoformat(timespec='seconds')
+
+            # The same as the newest snapshot, so only record the check
+            snapshots = index['snapshots']
+            if snapshots and snapshots[-1]['digest'] == digest:
+                self._save_index(index)
+                return dict(snapshots[-1], changed=False)
+
+            # Store any chunks that aren't already in the archive
+            hashes = []
+            new_chunks = 0
+            stored = 0
+            for chunk in split_chunks(text):
+                chunk_hash = hashlib.sha256(chunk).hexdigest()
+                hashes.append(chunk_hash)
+                path = self._path('chunks', chunk_hash[:2], chunk_hash)
+                if not os.path.exists(path):
+                    compressed = zlib.compress(chunk, 9)
+                    write_atomic(path, compressed)
+                    new_chunks += 1
+                    stored += len(compressed)
+
+            manifest = self._path('manifests', f"{digest}.json")
+            if not os.path.exists(manifest):
+                write_atomic(manifest, json.dumps(hashes).encode())
+
+            # IDs are timestamps, made unique if two are in one second
+            snapshot_id = when.strftime('%Y%m%d%H%M%S')
+            while any(entry['id'] == snapshot_id for entry in snapshots):
+                snapshot_id = str(int(snapshot_id) + 1)
+
+            snapshot = {
+                'id': snapshot_id,
+                'time': when.isoformat(timespec='seconds'),
+                'digest': digest,
+                'size': len(data),
+                'chunks': len(hashes),
+                'new_chunks': new_chunks,
+                'stored': stored,
+            }
+            snapshots.append(snapshot)
+            snapshots.sort(key=lambda entry: entry['time'])
+            self._save_index(index)
+
+        return dict(snapshot, changed=True)
+
+    def snapshots(
+        self,
+        device_id: str,
+    ) -> dict:
+        '''
+        List the snapshots of a device
+
+        Args:
+            device_id (str): The device ID
+
+        Returns:
+            dict: The device's index, with the snapshots oldest first
+        '''
+
+        with self._lock:
+            return self._load_index(device_id)
+
+    def devices(
+        self
+    ) -> list:
+        '''
+        List the devices in the archive
+
+        Returns:
+            list: Dictionaries for each device
+                device (str): The device ID
+                hostname (str): The device hostname
+                checked (str): When the config was last checked
+                snapshots (int): The number of snapshots
+                latest (str): The ID of the newest snapshot
+        '''
+
+        try:
+            names = sorted(os.listdir(self._path('index')))
+        except FileNotFoundError:
+            return []
+
+        devices = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            index = self.snapshots(name[:-len('.json')])
+            devices.append(
+                {
+                    'device': index['device'],
+                    'hostname': index['hostname'],
+                    'checked': index['checked'],
+                    'snapshots': len(index['snapshots']),
+                    'latest': (
+                        index['snapshots'][-1]['id']
+                        if index['snapshots'] else None
+                    ),
+                }
+            )
+
+        return devices
+
+    def read(
+        self,
+        device_id: str,
+        snapshot_id: str = None,
+    ) -> tuple[dict, str] | None:
+        '''
+        Read a snapshot back
+
+        Args:
+            device_id (str): The device ID
+            snapshot_id (str): The snapshot ID (default is the newest)
+
+        Raises:
+            ValueError: If the stored data is missing, or doesn't match
+                the snapshot
+
+        Returns:
+            tuple: (snapshot, config)
+            None: If there is no such snapshot
+        '''
+
+        with self._lock:
+            snapshots = self._load_index(device_id)['snapshots']
+            if not snapshots:
+                return None
+
+            if snapshot_id is None:
+                snapshot = snapshots[-1]
+            else:
+                snapshot = next(
+                    (
+                        entry for entry in snapshots
+                        if entry['id'] == snapshot_id
+                    ),
+                    None,
+                )
+                if snapshot is None:
+                    return None
+
+            manifest = self._path('manifests', f"{snapshot['digest']}.json")
+            try:
+                with open(manifest) as f:
+                    hashes = json.load(f)
+
+                data = b''
+                for chunk_hash in hashes:
+                    path = self._path('chunks', chunk_hash[:2], chunk_hash)
+                    with open(path, 'rb') as f:
+                        data += zlib.decompress(f.read())
+
+            # Another process may have pruned the snapshot since
+            except FileNotFoundError:
+                snapshots = self._load_index(device_id)['snapshots']
+                if not any(
+                    entry['id'] == snapshot['id'] for entry in snapshots
+                ):
+                    return None
+                raise ValueError(
+                    f"Snapshot {snapshot['id']} is missing stored data"
+                )
+
+        if hashlib.sha256(data).hexdigest() != snapshot['digest']:
+            raise ValueError(f"Snapshot {snapshot['id']} is corrupt")
+
+        return snapshot, data.decode()
+
+    def _keep(
+        self,
+        snapshots: list,
+        now: datetime,
+    ) -> list:
+        '''
+        Pick the snapshots to keep
+
+        Args:
+            snapshots (list): The snapshots, oldest first
+            now (datetime): The current time
+
+        Returns:
+            list: The snapshots to keep, oldest first
+        '''
+
+        keep = []
+        seen = set()
+
+        # Newest first, so the newest in each day or week is kept
+        for position, snapshot in enumerate(reversed(snapshots)):
+            when = datetime.fromisoformat(snapshot['time'])
+            age = now - when
+
+            if position == 0 or age <= timedelta(days=self.retention['all']):
+                bucket = None
+            elif age <= timedelta(days=self.retention['daily']):
+                bucket = ('day', when.date())
+            elif age <= timedelta(days=self.retention['weekly']):
+                bucket = ('week',) + tuple(when.isocalendar())[:2]
+            else:
+                continue
+
+            if bucket is not None:
+                if bucket in seen:
+                    continue
+                seen.add(bucket)
+            keep.append(snapshot)
+
+        keep.reverse()
+        return keep
+
+    def prune(
+        self,
+        now: datetime = None,
+    ) -> dict:
+        '''
+        Apply the retention policy, and remove unused data
+            Chunks are removed when no remaining snapshot uses them
+            New files, and files being written, are left alone
+
+        Args:
+            now (datetime): The current time (default is now)
+
+        Returns:
+            dict: What was removed
+                snapshots (int): Snapshots removed
+                manifests (int): Manifests removed
+                chunks (int): Chunks removed
+        '''
+
+        now = now or datetime.now()
+        removed = {'snapshots': 0, 'manifests': 0, 'chunks': 0}
+
+        def unused(path: str) -> bool:
+            # Temporary files are still being written
+            if path.endswith('.tmp'):
+                return False
+            try:
+                return time.time() - os.stat(path).st_mtime > PRUNE_GRACE
+            except FileNotFoundError:
+                return False
+
+        with self._locked():
+            # Thin out each device's snapshots, and note what's still used
+            digests = set()
+            for device in self.devices():
+                index = self._load_index(device['device'])
+                keep = self._keep(index['snapshots'], now)
+                if len(keep) != len(index['snapshots']):
+                    removed['snapshots'] += len(index['snapshots']) - len(keep)
+                    index['snapshots'] = keep
+                    self._save_index(index)
+                digests.update(snapshot['digest'] for snapshot in keep)
+
+            # Remove manifests that no snapshot uses
+            used = set()
+            manifests = self._path('manifests')
+            names = os.listdir(manifests) if os.path.isdir(manifests) else []
+            for name in names:
+                path = os.path.join(manifests, name)
+                if name[:-len('.json')] in digests or not unused(path):
+                    if name.endswith('.json'):
+                        with open(path) as f:
+                            used.update(json.load(f))
+                else:
+                    os.remove(path)
+                    removed['manifests'] += 1
+
+            # Remove chunks that no manifest uses
+            chunks = self._path('chunks')
+            if os.path.isdir(chunks):
+                for folder in os.listdir(chunks):
+                    for name in os.listdir(os.path.join(chunks, folder)):
+                        path = os.path.join(chunks, folder, name)
+                        if name not in used and unused(path):
+                            os.remove(path)
+                            removed['chunks'] += 1
+
+        return removed
+
+    def stats(
+        self
+    ) -> dict:
+        '''
+        Get the size of the archive
+
+        Returns:
+            dict: The sizes
+                devices (int): Devices with snapshots
+                snapshots (int): The number of snapshots
+                logical (int): Bytes, if every snapshot was stored in full
+                stored (int): Bytes actually stored
+                chunks (int): The number of stored chunks
+        '''
+
+        devices = self.devices()
+        logical = 0
+        for device in devices:
+            index = self.snapshots(device['device'])
+            logical += sum(snapshot['size'] for snapshot in index['snapshots'])
+
+        stored = 0
+        count = 0
+        for folder, _, names in os.walk(self._path('chunks')):
+            for name in names:
+                stored += os.path.getsize(os.path.join(folder, name))
+                count += 1
+
+        return {
+            'devices': len(devices),
+            'snapshots': sum(device['snapshots'] for device in devices),
+            'logical': logical,
+            'stored': stored,
+            'chunks': count,
+        }
+
+    def capture_all(
+        self,
+        devices: t.Iterable,
+        fetch: t.Callable[[str], tuple[str, str, str] | str],
+        interval: int = CAPTURE_INTERVAL,
+    ) -> int:
+        '''
+        Capture every device that is due
+            A device is due if it hasn't been checked within the interval
+
+        Args:
+            devices (Iterable): Device objects
+            fetch (Callable): Gets a device's config from its ID
+                Returns (hostname, vendor, config), or an error message
+            interval (int): Seconds between captures of a device
+
+        Returns:
+            int: The number of devices captured
+        '''
+
+        captured = 0
+        for device in list(devices):
+            checked = self.snapshots(device.id)['checked']
+            if checked is not None:
+                age = datetime.now() - datetime.fromisoformat(checked)
+                if age.total_seconds() < interval:
+                    continue
+
+            # Downloads share the vendor and device limits
+            try:
+                with concurrency.slot(device.vendor, device.id) as slot:
+                    result = fetch(device.id)
+                    slot.ok = not isinstance(result, str)
+            except Exception as e:
+                result = str(e)
+
+            if isinstance(result, str):
+                print(
+                    Fore.RED,
+                    f"Could not archive the config of '{device.id}'. ",
+                    Style.RESET_ALL
+                )
+                print(result)
+                continue
+
+            hostname, vendor, text = result
+            self.capture(device.id, text, hostname=hostname, vendor=vendor)
+            captured += 1
+
+        return captured
+
+    def start(
+        self,
+        devices: t.Callable[[], t.Iterable],
+        fetch: t.Callable[[str], tuple[str, str, str] | str],
+        interval: int = CAPTURE_INTERVAL,
+    ) -> None:
+        '''
+        Capture configs periodically, in the background
+            Checks for devices that are due every hour (or interval),
+            then applies the retention policy
+            Each worker tries to become the one that captures, so if it
+            exits, another takes over
+
+        Args:
+            devices (Callable): Returns the current Device objects
+            fetch (Callable): Gets a device's config from its ID
+            interval (int): Seconds between captures of a device
+        '''
+
+        if self._thread is not None:
+            return
+
+        def run():
+            # A random delay, so workers don't all start at once
+            time.sleep(random.uniform(0, 60))
+            while True:
+                try:
+                    if leader_lock(LEADER_FILE):
+                        self.capture_all(devices(), fetch, interval)
+                        self.prune()
+                except Exception as e:
+                    print(
+                        Fore.RED,
+                        'Config archive failed',
+                        Style.RESET_ALL
+                    )
+                    print(e)
+                time.sleep(min(interval, 3600))
+
+        self._thread = threading.Thread(
+            target=run,
+            name='config-archive',
+            daemon=True,
+        )
+        self._thread.start()
+
+
+# The shared config archive
+config_archive = ConfigArchive()
@@ -0,0 +1,201 @@
+'''
+Benchmark JSON serialization of large API responses
+
+Compares Flask's default JSON provider with FastJSONProvider,
+    and with streaming the list in batches
+    Time is the best of several runs
+    Peak memory is measured with tracemalloc, while the body is built
+
+Payloads are generated to match the entries the API returns
+    Security rules, as returned by /api/policies?type=security
+    GP sessions, as returned by /api/vpn?type=gp
+
+Usage:
+    $ python benchmarks/json_serialization.py
+    $ python benchmarks/json_serialization.py --rules 20000 --sessions 5000
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import jsonprovider                                         # noqa: E402
+from jsonprovider import FastJSONProvider, stream_array     # noqa: E402
+
+
+def make_rules(
+    count: int,
+) -> list:
+    '''
+    Generate a security rulebase, as returned by the API
+
+    Args:
+        count (int): Number of rules
+
+    Returns:
+        list: The security rules
+    '''
+
+    rng = random.Random(1)
+    zones = ['inside', 'outside', 'dmz', 'vpn', 'guest']
+    apps = ['ssl', 'web-browsing', 'dns', 'ssh', 'ms-rdp', 'smtp']
+
+    rules = []
+    for index in range(count):
+        rules.append(
+            {
+                "name": f"rule-{index:05}",
+                "to": {"member": rng.sample(zones, 1)},
+                "from": {"member": rng.sample(zones, 2)},
+                "source": {
+                    "member": [
+                        f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.0/24"
+                        for _ in range(rng.randint(1, 4))
+                    ]
+                },
+                "destination": {"member": [f"host-{rng.randint(1, 999)}"]},
+                "source_user": {"member": ["any"]},
+                "category": {"member": ["any"]},
+                "application": {"member": rng.sample(apps, 2)},
+                "service": {"member": ["application-default"]},
+                "action": rng.choice(['allow', 'deny', 'drop']),
+                "type": 'None',
+                "log": 'default',
+                "log_start": 'no',
+                "log_end": 'yes',
+                "disabled": 'no',
+                "tag": {"member": [f"tag-{rng.randint(1, 20)}"]},
+                "tag_group": 'None',
+                "description": f"Rule {index} for application access",
+            }
+        )
+
+    return rules
+
+
+def make_sessions(
+    count: int,
+) -> list:
+    '''
+    Generate GP sessions, as returned by the API
+
+    Args:
+        count (int): Number of sessions
+
+    Returns:
+        list: The GP sessions
+    '''
+
+    rng = random.Random(2)
+
+    sessions = []
+    for index in range(count):
+        sessions.append(
+            {
+                "name": f"user{index}@example.com",
+                "username": f"EXAMPLE\\user{index}",
+                "region": rng.choice(['AU', 'NZ', 'US', 'GB']),
+                "computer": f"LAPTOP-{index:05}",
+                "client": 'Microsoft Windows 11 Enterprise , 64-bit',
+                "vpn_type": 'Device Level VPN',
+                "host": f"{rng.getrandbits(128):032x}",
+                "version": '6.2.1-34',
+                "inside_ip": f"172.16.{index // 250}.{index % 250 + 1}",
+                "outside_ip": f"203.0.113.{rng.randint(1, 254)}",
+                "tunnel_type": 'IPSec',
+                "login": 'Oct.17 09:12:45',
+            }
+        )
+
+    return sessions
+
+
+def measure(
+    build,
+    repeat: int,
+) -> tuple[float, float, int]:
+    '''
+    Measure the time and peak memory to build a response body
+
+    Args:
+        build (callable): Builds the body and returns its size
+        repeat (int): Number of timed runs
+
+    Returns:
+        tuple: Best time (ms), peak memory (MiB), and body size (bytes)
+    '''
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = build()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best * 1000, peak / 1024 / 1024, size
+
+
+def main(
+) -> None:
+    '''
+    Run the benchmarks and print a table of results
+    '''
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rules', type=int, default=10000)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    default_app = Flask('default')
+    default_app.json = DefaultJSONProvider(default_app)
+    fast_app = Flask('fast')
+    fast_app.json = FastJSONProvider(fast_app)
+
+    payloads = {
+        'rules': make_rules(args.rules),
+        'sessions': make_sessions(args.sessions),
+    }
+
+    print(f"orjson installed: {jsonprovider.orjson is not None}")
+    print(
+        f"{'payload':<10} {'method':<10} {'time (ms)':>10} "
+        f"{'peak (MiB)':>11} {'size (KiB)':>11}"
+    )
+
+    for name, items in payloads.items():
+        # Streaming only holds one batch in memory at a time
+        methods = {
+            'default': lambda: len(
+                default_app.json.response(items).get_data()
+            ),
+            'fast': lambda: len(
+                fast_app.json.response(items).get_data()
+            ),
+            'streamed': lambda: sum(
+                len(chunk) for chunk in stream_array(items, sort_keys=True)
+            ),
+        }
+
+        for method, build in methods.items():
+            elapsed, peak, size = measure(build, args.repeat)
+            print(
+                f"{name:<10} {method:<10} {elapsed:>10.1f} "
+                f"{peak:>11.2f} {size / 1024:>11.1f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
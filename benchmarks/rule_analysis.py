@@ -0,0 +1,54 @@
+'''
+Benchmark shadowed and redundant rule detection on a large rulebase
+
+Uses the same generated rulebase as the rule lookup benchmark
+    Times resolving and indexing the rules, then the report
+
+Usage:
+    $ python benchmarks/rule_analysis.py
+    $ python benchmarks/rule_analysis.py --rules 20000
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from resolver import GroupResolver                       # noqa: E402
+from ruleanalysis import RuleAnalysis                    # noqa: E402
+from rule_lookup import make_rulebase                    # noqa: E402
+
+
+def main(
+) -> None:
+    '''
+    Run the benchmark and print the results
+    '''
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rules', type=int, default=10000)
+    args = parser.parse_args()
+
+    data = make_rulebase(args.rules)
+    rules = data.pop('rules')
+
+    start = time.perf_counter()
+    analysis = RuleAnalysis(rules, GroupResolver(**data))
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = analysis.report()
+    report_time = time.perf_counter() - start
+
+    print(f"rules: {args.rules}")
+    print(f"shadowed:  {len(report['shadowed']):10}")
+    print(f"redundant: {len(report['redundant']):10}")
+    print(f"mergeable: {len(report['mergeable']):10}")
+    print(f"build:     {build_time * 1000:10.1f} ms")
+    print(f"report:    {report_time * 1000:10.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+'''
+Benchmark security rule lookups on a large rulebase
+
+Resolves the nested groups, then again after one address changes
+    Only the groups that contain the address are resolved again
+
+Compiles a generated rulebase, and compares lookups with a linear scan
+    The linear scan checks each rule in order, like reading the rulebase
+    Both must find the same rule for every flow
+
+Usage:
+    $ python benchmarks/rule_lookup.py
+    $ python benchmarks/rule_lookup.py --rules 20000 --flows 5000
+'''
+
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from intervals import contains                           # noqa: E402
+from objectdiff import members                           # noqa: E402
+from resolver import GroupResolver                       # noqa: E402
+from rulelookup import RuleLookup                        # noqa: E402
+
+
+ZONES = ['inside', 'outside', 'dmz', 'vpn', 'guest', 'servers']
+APPS = ['ssl', 'web-browsing', 'dns', 'ssh', 'ms-rdp', 'smtp', 'ldap']
+
+
+def make_rulebase(
+    count: int,
+) -> dict:
+    '''
+    Generate a rulebase, with the objects it uses
+
+    Args:
+        count (int): Number of rules
+
+    Returns:
+        dict: Lists of rules, addresses, address groups, and services
+    '''
+
+    rng = random.Random(1)
+
+    # Address objects, and groups of them (some nested)
+    addresses = [
+        {
+            'name': f'net-{index}',
+            'addr': f'10.{index // 256 % 256}.{index % 256}.0/24',
+        }
+        for index in range(2000)
+    ]
+    addresses += [
+        {
+            'name': f'host-{index}',
+            'addr': f'172.16.{index // 250}.{index % 250}',
+        }
+        for index in range(2000)
+    ]
+    address_groups = [
+        {
+            'name': f'group-{index}',
+            'static': {
+                'member': [
+                    f'net-{rng.randrange(2000)}' for _ in range(5)
+                ] + ([f'group-{index - 1}'] if index % 10 else [])
+            },
+        }
+        for index in range(300)
+    ]
+
+    # Services, and a few groups
+    services = [
+        {
+            'name': f'tcp-{port}',
+            'protocol': {'tcp': {'port': str(port)}},
+        }
+        for port in range(8000, 8200)
+    ]
+    service_groups = [
+        {
+            'name': f'svc-group-{index}',
+            'members': {
+                'member': [
+                    f'tcp-{rng.randrange(8000, 8200)}' for _ in range(4)
+                ]
+            },
+        }
+        for index in range(20)
+    ]
+
+    def address():
+        choice = rng.random()
+        if choice < 0.1:
+            return 'any'
+        if choice < 0.4:
+            return f'group-{rng.randrange(300)}'
+        if choice < 0.7:
+            return f'net-{rng.randrange(2000)}'
+        return f'host-{rng.randrange(2000)}'
+
+    def service():
+        choice = rng.random()
+        if choice < 0.2:
+            return 'application-default'
+        if choice < 0.3:
+            return f'svc-group-{rng.randrange(20)}'
+        return f'tcp-{rng.randrange(8000, 8200)}'
+
+    rules = [
+        {
+            'name': f'rule-{index}',
+            'from': {'member': rng.sample(ZONES, 1)},
+            'to': {'member': rng.sample(ZONES, 1)},
+            'source': {
+                'member': [address() for _ in range(rng.randint(1, 3))]
+            },
+            'destination': {'member': [address()]},
+            'application': {
+                'member': (
+                    ['any'] if rng.random() < 0.5 else rng.sample(APPS, 2)
+                )
+            },
+            'service': {'member': [service()]},
+            'action': rng.choice(['allow', 'deny']),
+            'disabled': 'yes' if rng.random() < 0.02 else 'no',
+        }
+        for index in range(count)
+    ]
+
+    return {
+        'rules': rules,
+        'addresses': addresses,
+        'address_groups': address_groups,
+        'services': services,
+        'service_groups': service_groups,
+    }
+
+
+def make_flows(
+    count: int,
+) -> list:
+    '''
+    Generate flows to look up
+
+    Args:
+        count (int): Number of flows
+
+    Returns:
+        list: Dictionaries of lookup arguments
+    '''
+
+    rng = random.Random(2)
+
+    def ip():
+        if rng.random() < 0.5:
+            return f'10.{rng.randrange(8)}.{rng.randrange(256)}.1'
+        return f'172.16.{rng.randrange(8)}.{rng.randrange(250)}'
+
+    return [
+        {
+            'source': ip(),
+            'destination': ip(),
+            'protocol': 'tcp',
+            'port': rng.randrange(8000, 8200),
+            'from_zone': rng.choice(ZONES),
+            'to_zone': rng.choice(ZONES),
+            'application': rng.choice(APPS),
+        }
+        for _ in range(count)
+    ]
+
+
+def linear_scan(
+    resolved: list,
+    flow: dict,
+) -> int | None:
+    '''
+    Find the first matching rule by checking every rule in order
+
+    Args:
+        resolved (list): Resolved fields for each rule
+        flow (dict): The flow to look up
+
+    Returns:
+        int: The position of the first matching rule, or None
+    '''
+
+    source = ipaddress.ip_address(flow['source'])
+    destination = ipaddress.ip_address(flow['destination'])
+
+    for position, rule in enumerate(resolved):
+        if rule is None:
+            continue
+
+        zones_from, zones_to, apps, sources, destinations, services = rule
+        if zones_from and flow['from_zone'] not in zones_from:
+            continue
+        if zones_to and flow['to_zone'] not in zones_to:
+            continue
+        if apps and flow['application'] not in apps:
+            continue
+        if sources is not None and not contains(
+            sources, (source.version, int(source))
+        ):
+            continue
+        if destinations is not None and not contains(
+            destinations, (destination.version, int(destination))
+        ):
+            continue
+        if services is not None and not contains(
+            services, (flow['protocol'], flow['port'])
+        ):
+            continue
+
+        return position
+
+    return None
+
+
+def resolve_rules(
+    rulebase: RuleLookup,
+) -> list:
+    '''
+    Resolve each rule's fields, for the linear scan
+
+    Args:
+        rulebase (RuleLookup): The compiled rulebase
+
+    Returns:
+        list: Resolved fields for each rule (None if disabled)
+            Empty lists or None mean 'any'
+    '''
+
+    resolver = rulebase.resolver
+
+    def addresses(names):
+        return list(resolver.resolve_many('address', names).values)
+
+    resolved = []
+    for rule in rulebase.rules:
+        if rule.get('disabled') == 'yes':
+            resolved.append(None)
+            continue
+
+        def values(field):
+            names = members(rule.get(field))
+            return [] if 'any' in names else names
+
+        sources = values('source')
+        destinations = values('destination')
+        services = members(rule.get('service'))
+        resolved.append(
+            (
+                set(values('from')),
+                set(values('to')),
+                set(values('application')),
+                addresses(sources) if sources else None,
+                addresses(destinations) if destinations else None,
+                (
+                    None if 'application-default' in services
+                    else list(
+                        resolver.resolve_many('service', services).values
+                    )
+                ),
+            )
+        )
+
+    return resolved
+
+
+def main(
+) -> None:
+    '''
+    Run the benchmark and print the results
+    '''
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rules', type=int, default=10000)
+    parser.add_argument('--flows', type=int, default=2000)
+    args = parser.parse_args()
+
+    data = make_rulebase(args.rules)
+    flows = make_flows(args.flows)
+    rules = data.pop('rules')
+
+    # Flatten every group, then again after one nested address changes
+    resolver = GroupResolver(**data)
+    start = time.perf_counter()
+    for group in data['address_groups']:
+        resolver.resolve('address', group['name'])
+    resolve_time = time.perf_counter() - start
+
+    resolver.update('address', {'name': 'net-0', 'addr': '10.255.0.0/24'})
+    start = time.perf_counter()
+    for group in data['address_groups']:
+        resolver.resolve('address', group['name'])
+    update_time = time.perf_counter() - start
+    resolver.update('address', data['addresses'][0])
+
+    start = time.perf_counter()
+    rulebase = RuleLookup(rules=rules, resolver=resolver)
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [rulebase.lookup(**flow)['position'] for flow in flows]
+    indexed_time = time.perf_counter() - start
+
+    # The linear scan uses the same resolved objects, for a fair check
+    resolved = resolve_rules(rulebase)
+    start = time.perf_counter()
+    scanned = [linear_scan(resolved, flow) for flow in flows]
+    scan_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(indexed, scanned) if a != b)
+    matched = sum(1 for position in indexed if position is not None)
+
+    print(f"rules: {args.rules}, flows: {args.flows}, matched: {matched}")
+    print(f"resolve groups: {resolve_time * 1000:10.1f} ms")
+    print(f"after a change: {update_time * 1000:10.1f} ms")
+    print(f"compile:        {compile_time * 1000:10.1f} ms")
+    print(
+        f"indexed lookup: {indexed_time / len(flows) * 1e6:10.1f} us/flow"
+    )
+    print(f"linear scan:    {scan_time / len(flows) * 1e6:10.1f} us/flow")
+    print(f"mismatches:     {mismatches:10}")
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
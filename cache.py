@@ -0,0 +1,733 @@
+'''
+Caches datasets that have been collected from devices
+
+A dataset is a cleaned up list of entries from a device,
+    such as the address objects or the security rules
+    These are expensive to collect, as the device needs to be polled
+
+Each dataset has a version, which is a hash of its contents
+    The version changes whenever the contents change
+
+Datasets are shared between worker processes
+    Each dataset is saved to a file when it's stored, and every worker
+    uses the newest one, whichever worker collected it
+    Removing a dataset saves an empty marker, so other workers remove
+    their copy too
+
+Datasets support server-side filtering, sorting and pagination
+    Indexes are built the first time they are needed,
+    and are reused until the dataset is replaced
+
+Objects compiled from datasets (such as rule indexes) are cached too
+    They are rebuilt when the versions of their datasets change
+
+Classes:
+    Dataset
+        A cached list of entries from a device, with indexes
+    DatasetCache
+        Stores datasets per device
+    CompiledCache
+        Stores objects compiled from datasets
+
+Misc Variables:
+    dataset_cache
+        The shared DatasetCache object
+    compiled_cache
+        The shared CompiledCache object
+'''
+
+from colorama import Fore, Style
+
+import base64
+import bisect
+import hashlib
+import ipaddress
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from intervals import parse_address
+from jsonprovider import encode
+from metrics import cache_requests
+from objectdiff import members
+from state import STATE_DIR, SharedJsonFile
+
+
+# Where datasets are shared between worker processes
+DATASET_DIR = os.path.join(STATE_DIR, 'datasets')
+
+
+class Dataset:
+    '''
+    A cached list of entries collected from a device
+
+    Methods:
+        __init__: Constructor for the Dataset class
+        __len__: Returns the number of entries
+        age: The number of seconds since the dataset was collected
+        query: Filter, sort and paginate the entries
+        _order: Get the order of entries when sorted by a field
+        _name_index: Get the sorted list of names
+        _member_index: Get an inverted index of a field's members
+        _address_index: Get the IP ranges of each entry
+        _address_matches: Find entries that contain an address
+    '''
+
+    def __init__(
+        self,
+        device_id: str,
+        name: str,
+        items: list,
+        created: float = None,
+    ) -> None:
+        '''
+        Constructor for the Dataset class
+
+        Args:
+            device_id (str): The device the dataset was collected from
+            name (str): The name of the dataset (eg, 'addresses')
+            items (list): The entries in the dataset
+            created (float): When it was collected (default is now)
+        '''
+
+        self.device_id = device_id
+        self.name = name
+        self.items = items
+        self.created = time.time() if created is None else created
+
+        # The version is a hash of the contents
+        self.version = hashlib.sha1(
+            encode(items, sort_keys=True, default=str)
+        ).hexdigest()[:16]
+
+        # Indexes, built when they're first needed
+        self._indexes = {}
+
+    def __len__(
+        self
+    ) -> int:
+        '''
+        Returns the number of entries in the dataset
+
+        Returns:
+            int: Number of entries
+        '''
+
+        return len(self.items)
+
+    @property
+    def age(
+        self
+    ) -> float:
+        '''
+        The number of seconds since the dataset was collected
+
+        Returns:
+            float: Age of the dataset in seconds
+        '''
+
+        return time.time() - self.created
+
+    def query(
+        self,
+        name: str = None,
+        tag: str = None,
+        address: str = None,
+        zone: str = None,
+        sort: str = None,
+        order: str = 'asc',
+        limit: int = None,
+        cursor: str = None,
+    ) -> dict:
+        '''
+        Filter, sort and paginate the entries
+
+        Args:
+            name (str): Only include entries with names starting with this
+            tag (str): Only include entries with this tag
+            address (str): Only include entries containing this address
+                If this is an IP address, it must fall in the entry's range
+                Otherwise, it is a substring of the address fields
+            zone (str): Only include entries with this 'from' or 'to' zone
+            sort (str): The field to sort by (default is the stored order)
+            order (str): 'asc' or 'desc'
+            limit (int): The maximum number of entries to return
+            cursor (str): The cursor from the previous page
+
+        Raises:
+            ValueError: If the cursor or sort field is invalid
+
+        Returns:
+            dict: The page of results
+                total (int): Number of entries that match the filters
+                count (int): Number of entries in this page
+                cursor (str): The cursor for the next page (None if done)
+                version (str): The version of the dataset
+                items (list): The entries in this page
+        '''
+
+        # Work out where to start from the cursor
+        offset = 0
+        if cursor:
+            try:
+                version, offset = base64.urlsafe_b64decode(
+                    cursor.encode()
+                ).decode().split(':')
+                offset = int(offset)
+            except Exception:
+                raise ValueError('Invalid cursor')
+
+            if version != self.version:
+                raise ValueError('The dataset has changed, cursor expired')
+
+        # Find candidate entries with the indexes
+        candidates = None
+
+        if name:
+            names = self._name_index()
+            prefix = name.lower()
+            start = bisect.bisect_left(names, (prefix, -1))
+            end = bisect.bisect_left(names, (prefix + '\uffff', -1))
+            candidates = {index for _, index in names[start:end]}
+
+        if tag:
+            matches = self._member_index('tag').get(tag, set())
+            candidates = (
+                matches if candidates is None else candidates & matches
+            )
+
+        if zone:
+            matches = (
+                self._member_index('from').get(zone, set()) |
+                self._member_index('to').get(zone, set())
+            )
+            candidates = (
+                matches if candidates is None else candidates & matches
+            )
+
+        if address:
+            matches = self._address_matches(address)
+            candidates = (
+                matches if candidates is None else candidates & matches
+            )
+
+        # Sort the entries, and filter by the candidates
+        if sort:
+            ordered = self._order(sort)
+        else:
+            ordered = range(len(self.items))
+
+        if order == 'desc':
+            ordered = reversed(ordered)
+
+        if candidates is not None:
+            ordered = [index for index in ordered if index in candidates]
+        else:
+            ordered = list(ordered)
+
+        # Paginate
+        total = len(ordered)
+        if limit is None:
+            end = total
+        else:
+            end = min(offset + limit, total)
+        page = [self.items[index] for index in ordered[offset:end]]
+
+        next_cursor = None
+        if end < total:
+            next_cursor = base64.urlsafe_b64encode(
+                f'{self.version}:{end}'.encode()
+            ).decode()
+
+        return {
+            'total': total,
+            'count': len(page),
+            'cursor': next_cursor,
+            'version': self.version,
+            'items': page,
+        }
+
+    def _order(
+        self,
+        field: str,
+    ) -> list:
+        '''
+        Get the order of entries when sorted by a field
+
+        Args:
+            field (str): The field to sort by
+
+        Raises:
+            ValueError: If no entry has this field
+
+        Returns:
+            list: Entry indexes, in sorted order
+        '''
+
+        key = ('order', field)
+        if key not in self._indexes:
+            if self.items and not any(field in item for item in self.items):
+                raise ValueError(f"Unknown sort field '{field}'")
+
+            self._indexes[key] = sorted(
+                range(len(self.items)),
+                key=lambda index: ', '.join(
+                    members(self.items[index].get(field))
+                ).lower()
+            )
+
+        return self._indexes[key]
+
+    def _name_index(
+        self
+    ) -> list:
+        '''
+        Get the sorted list of names, for prefix searches
+
+        Returns:
+            list: Tuples of (lowercase name, entry index)
+        '''
+
+        key = ('name',)
+        if key not in self._indexes:
+            self._indexes[key] = sorted(
+                (str(item.get('name', '')).lower(), index)
+                for index, item in enumerate(self.items)
+            )
+
+        return self._indexes[key]
+
+    def _member_index(
+        self,
+        field: str,
+    ) -> dict:
+        '''
+        Get an inverted index of a field's members
+            For example, a tag name to the entries with that tag
+
+        Args:
+            field (str): The field to index
+
+        Returns:
+            dict: Member names to sets of entry indexes
+        '''
+
+        key = ('member', field)
+        if key not in self._indexes:
+            index = {}
+            for position, item in enumerate(self.items):
+                for member in members(item.get(field)):
+                    index.setdefault(member, set()).add(position)
+
+            self._indexes[key] = index
+
+        return self._indexes[key]
+
+    def _address_index(
+        self
+    ) -> list:
+        '''
+        Get the IP ranges of each entry with an address
+            Addresses may be prefixes or ranges (eg, 10.0.0.1-10.0.0.9)
+
+        Returns:
+            list: Tuples of (version, first IP, last IP, entry index)
+        '''
+
+        key = ('address',)
+        if key not in self._indexes:
+            ranges = []
+            for position, item in enumerate(self.items):
+                for value in members(item.get('addr')):
+                    # FQDNs and other values are not IP ranges
+                    interval = parse_address(value)
+                    if interval is not None:
+                        ranges.append(interval + (position,))
+
+            ranges.sort()
+            self._indexes[key] = ranges
+
+        return self._indexes[key]
+
+    def _address_matches(
+        self,
+        address: str,
+    ) -> set:
+        '''
+        Find entries that contain an address
+
+        Args:
+            address (str): An IP address, or text to search for
+
+        Returns:
+            set: Entry indexes that match
+        '''
+
+        # An IP address must fall within the entry's range
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            ip = None
+
+        if ip is not None:
+            ranges = self._address_index()
+            value = int(ip)
+
+            # Only ranges that start at or before the IP can contain it
+            end = bisect.bisect_right(
+                ranges,
+                (ip.version, value, float('inf'), float('inf'))
+            )
+            return {
+                position
+                for version, first, last, position in ranges[:end]
+                if version == ip.version and last >= value
+            }
+
+        # Otherwise, search the text of address fields
+        text = address.lower()
+        return {
+            position
+            for position, item in enumerate(self.items)
+            if any(
+                text in member.lower()
+                for field in ('addr', 'source', 'destination', 'static')
+                for member in members(item.get(field))
+            )
+        }
+
+
+class DatasetCache:
+    '''
+    Stores datasets collected from devices
+        Datasets are stored per device and name, and expire after a time
+        They're shared with other workers through a file each
+
+    Methods:
+        __init__: Constructor for the DatasetCache class
+        get: Get a dataset if it has not expired
+        store: Store a new dataset
+        invalidate: Remove datasets from the cache
+        _file: Get the shared file for a dataset
+        _read: Use the shared dataset, if it's newer
+        _share: Save a dataset for the other workers
+        _saved: List the datasets that have been shared
+    '''
+
+    def __init__(
+        self,
+        ttl: int = 300,
+        path: str = DATASET_DIR,
+    ) -> None:
+        '''
+        Constructor for the DatasetCache class
+
+        Args:
+            ttl (int): Number of seconds a dataset is valid for
+            path (str): The directory datasets are shared through
+        '''
+
+        self.ttl = ttl
+        self.path = path
+        self._datasets = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        device_id: str,
+        name: str,
+        expired: bool = False,
+    ) -> Dataset | None:
+        '''
+        Get a dataset, if there is one and it has not expired
+            A newer dataset from another worker is used, if there is one
+
+        Args:
+            device_id (str): The device ID
+            name (str): The name of the dataset
+            expired (bool): Return the dataset even if it has expired
+                For example, to search the last data collected
+
+        Returns:
+            Dataset: The dataset
+            None: If there is no valid dataset
+        '''
+
+        key = (str(device_id), name)
+        self._read(key)
+
+        dataset = self._datasets.get(key)
+        if dataset is None or (dataset.age > self.ttl and not expired):
+            cache_requests.inc(cache='dataset', dataset=name, result='miss')
+            return None
+
+        cache_requests.inc(cache='dataset', dataset=name, result='hit')
+        return dataset
+
+    def store(
+        self,
+        device_id: str,
+        name: str,
+        items: list,
+    ) -> Dataset:
+        '''
+        Store a new dataset, replacing any old one
+            It is shared with the other workers
+
+        Args:
+            device_id (str): The device ID
+            name (str): The name of the dataset
+            items (list): The entries in the dataset
+
+        Returns:
+            Dataset: The new dataset
+        '''
+
+        dataset = Dataset(
+            device_id=str(device_id),
+            name=name,
+            items=items,
+        )
+
+        with self._lock:
+            self._datasets[(str(device_id), name)] = dataset
+
+        self._share((str(device_id), name), dataset.created, items)
+        return dataset
+
+    def invalidate(
+        self,
+        device_id: str = None,
+        name: str = None,
+    ) -> None:
+        '''
+        Remove datasets from the cache
+            Leave the device and name empty to remove everything
+            Other workers remove their copies when they next get them
+
+        Args:
+            device_id (str): Only remove datasets for this device
+            name (str): Only remove datasets with this name
+        '''
+
+        now = time.time()
+        with self._lock:
+            keys = set(self._datasets) | self._saved(device_id)
+            for key in keys:
+                if device_id is not None and key[0] != str(device_id):
+                    continue
+                if name is not None and key[1] != name:
+                    continue
+                self._datasets.pop(key, None)
+                self._share(key, now, None)
+
+    def _file(
+        self,
+        key: tuple,
+    ) -> SharedJsonFile:
+        '''
+        Get the shared file for a dataset
+
+        Args:
+            key (tuple): The device ID, and the name of the dataset
+
+        Returns:
+            SharedJsonFile: The file
+        '''
+
+        file = self._files.get(key)
+        if file is None:
+            file = self._files.setdefault(
+                key,
+                SharedJsonFile(
+                    os.path.join(self.path, key[0], f"{key[1]}.json")
+                ),
+            )
+
+        return file
+
+    def _read(
+        self,
+        key: tuple,
+    ) -> None:
+        '''
+        Use the shared dataset, if it's newer than this worker's
+            An empty marker (no items) means it was removed
+
+        Args:
+            key (tuple): The device ID, and the name of the dataset
+        '''
+
+        file = self._file(key)
+        if not file.read():
+            return
+
+        saved = file.data
+        with self._lock:
+            current = self._datasets.get(key)
+            if current is not None and current.created >= saved['created']:
+                return
+
+            if saved['items'] is None:
+                self._datasets.pop(key, None)
+            else:
+                self._datasets[key] = Dataset(
+                    device_id=key[0],
+                    name=key[1],
+                    items=saved['items'],
+                    created=saved['created'],
+                )
+
+    def _share(
+        self,
+        key: tuple,
+        created: float,
+        items: list | None,
+    ) -> None:
+        '''
+        Save a dataset for the other workers
+            If it can't be saved, only this worker has it
+
+        Args:
+            key (tuple): The device ID, and the name of the dataset
+            created (float): When it was collected
+            items (list): The entries (None if it was removed)
+        '''
+
+        try:
+            self._file(key).write(
+                {'created': created, 'items': items},
+                keep=True,
+            )
+
+        except (OSError, TypeError) as e:
+            print(
+                Fore.RED,
+                f"Could not share the '{key[1]}' dataset for '{key[0]}'",
+                Style.RESET_ALL
+            )
+            print(e)
+
+    def _saved(
+        self,
+        device_id: str = None,
+    ) -> set:
+        '''
+        List the datasets that have been shared
+
+        Args:
+            device_id (str): Only list datasets for this device
+
+        Returns:
+            set: Tuples of the device ID, and the name of the dataset
+        '''
+
+        if device_id is None:
+            try:
+                devices = os.listdir(self.path)
+            except OSError:
+                devices = []
+        else:
+            devices = [str(device_id)]
+
+        saved = set()
+        for device in devices:
+            try:
+                files = os.listdir(os.path.join(self.path, device))
+            except OSError:
+                continue
+
+            saved.update(
+                (device, file[:-len('.json')])
+                for file in files if file.endswith('.json')
+            )
+
+        return saved
+
+
+class CompiledCache:
+    '''
+    Stores objects compiled from datasets, such as rule indexes
+        These are expensive to build, so are kept until a dataset changes
+
+    Methods:
+        __init__: Constructor for the CompiledCache class
+        get: Get a compiled object, building it if needed
+        invalidate: Remove compiled objects from the cache
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Constructor for the CompiledCache class
+        '''
+
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        key: tuple,
+        versions: tuple,
+        build: Callable[[], Any],
+        update: Callable[[Any], Any] = None,
+    ) -> Any:
+        '''
+        Get a compiled object, building it if needed
+            It is rebuilt if the versions of its datasets have changed
+            If it can be updated in place, that is done instead
+
+        Args:
+            key (tuple): Identifies the object (eg, ('lookup', device_id))
+            versions (tuple): The versions of the datasets it is built from
+            build (Callable): Builds the object
+            update (Callable): Updates an old object, and returns it
+
+        Returns:
+            Any: The compiled object
+        '''
+
+        entry = self._compiled.get(key)
+        if entry is not None and entry[0] == versions:
+            cache_requests.inc(cache='compiled', dataset=key[0], result='hit')
+            return entry[1]
+
+        if entry is not None and update is not None:
+            cache_requests.inc(
+                cache='compiled',
+                dataset=key[0],
+                result='update',
+            )
+            compiled = update(entry[1])
+        else:
+            cache_requests.inc(cache='compiled', dataset=key[0], result='miss')
+            compiled = build()
+        with self._lock:
+            self._compiled[key] = (versions, compiled)
+
+        return compiled
+
+    def invalidate(
+        self,
+        key: tuple = None,
+    ) -> None:
+        '''
+        Remove compiled objects from the cache
+
+        Args:
+            key (tuple): The object to remove (default is all of them)
+        '''
+
+        with self._lock:
+            if key is None:
+                self._compiled.clear()
+            else:
+                self._compiled.pop(key, None)
+
+
+# The shared caches
+dataset_cache = DatasetCache()
+compiled_cache = CompiledCache()
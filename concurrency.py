@@ -0,0 +1,696 @@
+'''
+Limit how many calls are made to devices at once, and adapt the limits
+
+Every path that calls many devices at once shares one controller
+    Loading the device list, fleet queries, and background polling
+    Each vendor has a limit, and so does each device
+    A call waits for a slot in both before it starts
+    Async calls (eg, AsyncDeviceApi) share the same limits
+
+Limits adapt to how devices respond (AIMD, as in TCP)
+    Additive increase: Each fast, successful call raises the limit a
+        little (about one extra slot for each full set of calls)
+    Multiplicative decrease: A failed or slow call halves the limit
+        It is only halved once per round trip, so a burst of failures
+        from calls that were already running doesn't collapse it
+        A device that keeps failing only affects its vendor once
+    A call is slow if it takes more than twice the device's usual time
+        The usual time is a moving average of successful calls
+
+This finds the most calls a vendor (or device) handles well, without
+    tripping session limits (eg, Junos NETCONF sessions)
+
+Limits are shared between worker processes
+    Each worker (and the one that polls) adapts its own limits, but a
+    call also locks one of the limit's slot files (under state/slots)
+    A limit of N has N files, so all the workers together never make
+    more calls to a device or vendor than the highest limit allows
+    Without file locks (eg, Windows), limits are per worker
+
+Classes:
+    AdaptiveLimit
+        A concurrency limit that adapts to latency and errors
+    Slot
+        A call that is running within its limits
+    ConcurrencyController
+        Vendor and device limits, shared by every fan-out path
+
+Misc Variables:
+    concurrency
+        The shared ConcurrencyController object
+'''
+
+import asyncio
+import collections
+import contextlib
+import os
+import threading
+import time
+import typing as t
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Limits for each vendor (start, lowest, and highest)
+VENDOR_LIMITS = {
+    'paloalto': {'start': 8, 'min': 2, 'max': 32},
+    'juniper': {'start': 4, 'min': 1, 'max': 16},
+}
+
+# Limits for each device, by vendor
+DEVICE_LIMITS = {
+    'paloalto': {'start': 2, 'min': 1, 'max': 4},
+    'juniper': {'start': 1, 'min': 1, 'max': 3},
+}
+
+# Limits for vendors that are not listed above
+DEFAULT_VENDOR_LIMIT = {'start': 2, 'min': 1, 'max': 8}
+DEFAULT_DEVICE_LIMIT = {'start': 1, 'min': 1, 'max': 2}
+
+# What the limit is multiplied by when a call fails or is slow
+DECREASE = 0.5
+
+# A call is slow if it takes this many times the usual time
+SLOW_FACTOR = 2
+
+# How quickly the usual time follows new calls (0 to 1)
+SMOOTHING = 0.1
+
+# The most threads a fan-out uses (the limits decide how many run)
+MAX_WORKERS = 32
+
+# Where the slot files are, that share limits between workers
+SLOTS_DIR = os.path.join('state', 'slots')
+
+# Seconds between checks for a free slot file
+CLAIM_WAIT = 0.05
+
+
+def _set_done(
+    waiter: asyncio.Future,
+) -> None:
+    '''
+    Wake an async waiter (on its own event loop)
+
+    Args:
+        waiter (Future): The waiter
+    '''
+
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdaptiveLimit:
+    '''
+    A concurrency limit that adapts to latency and errors
+
+    Methods:
+        __init__: Create a limit
+        acquire: Wait for a free slot
+        acquire_async: Wait for a free slot, without blocking the event loop
+        _wake: Wake waiters, after a slot is released
+        release: Free a slot, and adapt the limit
+        status: Get the current state of the limit
+    '''
+
+    def __init__(
+        self,
+        start: int,
+        minimum: int,
+        maximum: int,
+    ) -> None:
+        '''
+        Create a limit
+
+        Args:
+            start (int): The limit to start with
+            minimum (int): The lowest the limit can go
+            maximum (int): The highest the limit can go
+        '''
+
+        self.limit = float(start)
+        self.minimum = minimum
+        self.maximum = maximum
+
+        # Calls running now, and the usual time of a call (seconds)
+        self.active = 0
+        self.latency = None
+
+        # Whether the last call failed
+        self.failing = False
+
+        # When the limit was last decreased, and counts for status
+        self._decreased = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.slow = 0
+        self.waits = 0
+
+        self._condition = threading.Condition()
+        self._async_waiters = collections.deque()
+
+    def acquire(
+        self
+    ) -> None:
+        '''
+        Wait for a free slot
+        '''
+
+        with self._condition:
+            if self.active >= int(self.limit):
+                self.waits += 1
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+
+    async def acquire_async(
+        self
+    ) -> None:
+        '''
+        Wait for a free slot, without blocking the event loop
+            The waiter is woken when a slot is released
+        '''
+
+        counted = False
+        while True:
+            with self._condition:
+                if self.active < int(self.limit):
+                    self.active += 1
+                    return
+
+                if not counted:
+                    self.waits += 1
+                    counted = True
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # If this waiter was woken, pass the slot to another one
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    else:
+                        self._wake()
+                raise
+
+    def _wake(
+        self
+    ) -> None:
+        '''
+        Wake waiters, after a slot is released
+            The caller must hold the condition
+            Async waiters are woken on their own event loop, one for
+            each free slot
+        '''
+
+        self._condition.notify_all()
+        free = max(int(self.limit) - self.active, 1)
+        while self._async_waiters and free:
+            loop, waiter = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_set_done, waiter)
+            free -= 1
+
+    def release(
+        self,
+        elapsed: float = None,
+        ok: bool = True,
+        slow: bool = None,
+    ) -> bool:
+        '''
+        Free a slot, and adapt the limit
+
+        Args:
+            elapsed (float): Seconds the call took
+                None if the call didn't run, so the limit isn't changed
+            ok (bool): False if the call failed
+            slow (bool): Whether the call was slow
+                None to compare it to the usual time of this limit
+
+        Returns:
+            bool: Whether the call was slow
+        '''
+
+        with self._condition:
+            self.active -= 1
+            self._wake()
+            if elapsed is None:
+                return False
+            self.calls += 1
+
+            if slow is None:
+                slow = (
+                    self.latency is not None and
+                    elapsed > self.latency * SLOW_FACTOR
+                )
+            self.failing = not ok
+            if not ok:
+                self.errors += 1
+            elif slow:
+                self.slow += 1
+
+            # Track the usual time of a successful call
+            if ok:
+                if self.latency is None:
+                    self.latency = elapsed
+                else:
+                    self.latency += SMOOTHING * (elapsed - self.latency)
+
+            # Halve on failure (once per round trip), or grow a little
+            now = time.monotonic()
+            if not ok or slow:
+                if now - self._decreased > (self.latency or 0):
+                    self.limit = max(self.minimum, self.limit * DECREASE)
+                    self._decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            return slow
+
+    def status(
+        self
+    ) -> dict:
+        '''
+        Get the current state of the limit
+
+        Returns:
+            dict: The limit, calls running, usual latency, and counts
+        '''
+
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'active': self.active,
+                'latency': (
+                    round(self.latency, 3)
+                    if self.latency is not None else None
+                ),
+                'calls': self.calls,
+                'errors': self.errors,
+                'slow': self.slow,
+                'waits': self.waits,
+            }
+
+
+class Slot:
+    '''
+    A call that is running within its limits
+        Set 'ok' to False if the call failed without raising an error
+        (eg, an API returned an error code)
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Constructor for the Slot class
+        '''
+
+        self.ok = True
+
+
+class ConcurrencyController:
+    '''
+    Vendor and device limits, shared by every fan-out path
+
+    Methods:
+        __init__: Create a controller with no limits yet
+        _limit: Get (or create) a limit
+        slot: Run a call within a vendor's and device's limits
+        async_slot: Run an async call within a vendor's and device's limits
+        _limits: Get the limits for a device
+        _try_claim: Lock free slot files for a call, if there are some
+        _claim: Wait for slot files for a call
+        _claim_async: Wait for slot files, without blocking the event loop
+        _unclaim: Unlock a call's slot files
+        _release: Free a call's slots, and adapt both limits
+        status: Get the state of every limit
+    '''
+
+    def __init__(
+        self,
+        path: str = SLOTS_DIR,
+    ) -> None:
+        '''
+        Create a controller with no limits yet
+            Limits are created the first time a vendor or device is used
+
+        Args:
+            path (str): The directory for the slot files
+        '''
+
+        self.path = path
+        self._vendors = {}
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def _limit(
+        self,
+        limits: dict,
+        key: str,
+        settings: dict,
+    ) -> AdaptiveLimit:
+        '''
+        Get (or create) a limit
+
+        Args:
+            limits (dict): The vendor or device limits
+            key (str): The vendor or device ID
+            settings (dict): The start, min and max for a new limit
+
+        Returns:
+            AdaptiveLimit: The limit
+        '''
+
+        with self._lock:
+            limit = limits.get(key)
+            if limit is None:
+                limit = limits[key] = AdaptiveLimit(
+                    settings['start'],
+                    settings['min'],
+                    settings['max'],
+                )
+
+        return limit
+
+    @contextlib.contextmanager
+    def slot(
+        self,
+        vendor: str,
+        device_id: str,
+    ) -> t.Iterator[Slot]:
+        '''
+        Run a call within a vendor's and device's limits
+            Waits for the device first, so a busy device doesn't hold up
+            other devices from the same vendor
+            Exceptions count as failures, and are raised again
+
+        Args:
+            vendor (str): The device's vendor (eg, 'paloalto')
+            device_id (str): The device ID
+
+        Yields:
+            Slot: Set 'ok' to False if the call failed
+        '''
+
+        device_limit, vendor_limit = self._limits(vendor, device_id)
+
+        slot = Slot()
+        device_limit.acquire()
+        try:
+            vendor_limit.acquire()
+        except BaseException:
+            device_limit.release()
+            raise
+
+        # Then the slots shared with other workers
+        try:
+            claims = self._claim(
+                vendor, device_id, device_limit, vendor_limit,
+            )
+        except BaseException:
+            device_limit.release()
+            vendor_limit.release()
+            raise
+
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException:
+            slot.ok = False
+            raise
+        finally:
+            self._unclaim(claims)
+            self._release(
+                device_limit,
+                vendor_limit,
+                time.monotonic() - start,
+                slot.ok,
+            )
+
+    @contextlib.asynccontextmanager
+    async def async_slot(
+        self,
+        vendor: str,
+        device_id: str,
+    ) -> t.AsyncIterator[Slot]:
+        '''
+        Run an async call within a vendor's and device's limits
+            The same as slot(), but waits without blocking the event loop
+
+        Args:
+            vendor (str): The device's vendor (eg, 'paloalto')
+            device_id (str): The device ID
+
+        Yields:
+            Slot: Set 'ok' to False if the call failed
+        '''
+
+        device_limit, vendor_limit = self._limits(vendor, device_id)
+
+        slot = Slot()
+        await device_limit.acquire_async()
+        try:
+            await vendor_limit.acquire_async()
+        except BaseException:
+            device_limit.release()
+            raise
+
+        # Then the slots shared with other workers
+        try:
+            claims = await self._claim_async(
+                vendor, device_id, device_limit, vendor_limit,
+            )
+        except BaseException:
+            device_limit.release()
+            vendor_limit.release()
+            raise
+
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException:
+            slot.ok = False
+            raise
+        finally:
+            self._unclaim(claims)
+            self._release(
+                device_limit,
+                vendor_limit,
+                time.monotonic() - start,
+                slot.ok,
+            )
+
+    def _limits(
+        self,
+        vendor: str,
+        device_id: str,
+    ) -> tuple[AdaptiveLimit, AdaptiveLimit]:
+        '''
+        Get the limits for a device
+
+        Args:
+            vendor (str): The device's vendor
+            device_id (str): The device ID
+
+        Returns:
+            tuple: The device's limit, and the vendor's limit
+        '''
+
+        return (
+            self._limit(
+                self._devices,
+                str(device_id),
+                DEVICE_LIMITS.get(vendor, DEFAULT_DEVICE_LIMIT),
+            ),
+            self._limit(
+                self._vendors,
+                vendor,
+                VENDOR_LIMITS.get(vendor, DEFAULT_VENDOR_LIMIT),
+            ),
+        )
+
+    def _try_claim(
+        self,
+        vendor: str,
+        device_id: str,
+        device_limit: AdaptiveLimit,
+        vendor_limit: AdaptiveLimit,
+        claims: list,
+    ) -> bool:
+        '''
+        Lock free slot files for a call, if there are some
+            The device's slot is locked first, then the vendor's
+            A limit of N has N files, and any free one is used
+
+        Args:
+            vendor (str): The device's vendor
+            device_id (str): The device ID
+            device_limit (AdaptiveLimit): The device's limit
+            vendor_limit (AdaptiveLimit): The vendor's limit
+            claims (list): The files locked so far (added to)
+
+        Returns:
+            bool: True if both are locked
+        '''
+
+        wanted = (
+            (f"device-{device_id}", device_limit),
+            (f"vendor-{vendor}", vendor_limit),
+        )
+        for name, limit in wanted[len(claims):]:
+            for number in range(max(int(limit.limit), 1)):
+                handle = open(
+                    os.path.join(self.path, f"{name}.{number}.lock"),
+                    'w',
+                )
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    handle.close()
+                    continue
+
+                claims.append(handle)
+                break
+
+            else:
+                return False
+
+        return True
+
+    def _claim(
+        self,
+        vendor: str,
+        device_id: str,
+        device_limit: AdaptiveLimit,
+        vendor_limit: AdaptiveLimit,
+    ) -> list:
+        '''
+        Wait for slot files for a call (see _try_claim)
+
+        Returns:
+            list: The locked files (empty without file locks)
+        '''
+
+        claims = []
+        if fcntl is None:
+            return claims
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            while not self._try_claim(
+                vendor, device_id, device_limit, vendor_limit, claims,
+            ):
+                time.sleep(CLAIM_WAIT)
+
+        except BaseException:
+            self._unclaim(claims)
+            raise
+
+        return claims
+
+    async def _claim_async(
+        self,
+        vendor: str,
+        device_id: str,
+        device_limit: AdaptiveLimit,
+        vendor_limit: AdaptiveLimit,
+    ) -> list:
+        '''
+        Wait for slot files, without blocking the event loop
+            The same as _claim()
+
+        Returns:
+            list: The locked files (empty without file locks)
+        '''
+
+        claims = []
+        if fcntl is None:
+            return claims
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            while not self._try_claim(
+                vendor, device_id, device_limit, vendor_limit, claims,
+            ):
+                await asyncio.sleep(CLAIM_WAIT)
+
+        except BaseException:
+            self._unclaim(claims)
+            raise
+
+        return claims
+
+    @staticmethod
+    def _unclaim(
+        claims: list,
+    ) -> None:
+        '''
+        Unlock a call's slot files
+            Closing a file releases its lock
+
+        Args:
+            claims (list): The locked files
+        '''
+
+        for handle in claims:
+            handle.close()
+
+    @staticmethod
+    def _release(
+        device_limit: AdaptiveLimit,
+        vendor_limit: AdaptiveLimit,
+        elapsed: float,
+        ok: bool,
+    ) -> None:
+        '''
+        Free a call's slots, and adapt both limits
+
+        Args:
+            device_limit (AdaptiveLimit): The device's limit
+            vendor_limit (AdaptiveLimit): The vendor's limit
+            elapsed (float): Seconds the call took
+            ok (bool): False if the call failed
+        '''
+
+        # Slow is judged against the device's own usual time, so a
+        #   device that is always slower doesn't cut its vendor's limit
+        #   A device that keeps failing (eg, it's down) only cuts its
+        #   vendor's limit the first time
+        failing = device_limit.failing
+        slow = device_limit.release(elapsed, ok)
+        vendor_limit.release(elapsed, ok or failing, slow)
+
+    def status(
+        self
+    ) -> dict:
+        '''
+        Get the state of every limit
+
+        Returns:
+            dict: The limits
+                vendors (dict): Vendors, to their limit's state
+                devices (dict): Device IDs, to their limit's state
+        '''
+
+        with self._lock:
+            vendors = dict(self._vendors)
+            devices = dict(self._devices)
+
+        return {
+            'vendors': {
+                vendor: limit.status() for vendor, limit in vendors.items()
+            },
+            'devices': {
+                device: limit.status() for device, limit in devices.items()
+            },
+        }
+
+
+# The shared concurrency controller
+concurrency = ConcurrencyController()
@@ -0,0 +1,601 @@
+'''
+Compare two configs of the same kind, by structure
+
+Works with PAN-OS XML configs and Junos set-format configs
+    For example, today's config against yesterday's snapshot,
+    or the active HA peer against the passive peer
+
+Each config is parsed into a tree
+    PAN-OS: XML elements, with entries matched by their 'name' attribute,
+        and member lists matched by value (so order doesn't matter)
+    Junos: each word of a set line is a level, so lines that share a
+        path share nodes (eg, 'set security zones ...')
+
+Every node has a hash of its whole subtree (a Merkle tree)
+    Hashes are compared from the top down. If two subtrees have the same
+    hash, they are the same, and are skipped without looking inside.
+    A small change in a large config only visits the path to the change
+
+Most of a large XML config is in named entries (addresses, rules, etc)
+    that have no other entries inside them
+    The config is parsed as a stream (lxml's iterparse), which stops at
+    the end of each entry. Entries are hashed from their XML, and their
+    elements are freed, so the full XML tree is never held in memory
+    An entry is only made into nodes if the diff needs to look inside
+    it, so unchanged entries are skipped without building their nodes
+
+The result is a minimal list of changes
+    added / removed: A subtree only in one config (the top of it)
+    changed: A value that is different
+    moved: Entries that are in a different order (eg, rules)
+
+Classes:
+    Node
+        A node in a config tree, with a hash of its subtree
+
+Functions:
+    parse_config
+        Parse a config into a tree, detecting the format
+    parse_xml
+        Parse a PAN-OS XML config into a tree
+    parse_set
+        Parse a Junos set-format config into a tree
+    diff_configs
+        Compare two configs
+'''
+
+from lxml import etree
+
+import hashlib
+import io
+import re
+import time
+
+from objectdiff import moved
+
+
+# Splits a set line into words, keeping quoted strings together
+SET_WORDS = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+# Parses the XML of collapsed entries (see Node.expand)
+_PARSER = etree.XMLParser(
+    remove_comments=True,
+    remove_pis=True,
+    resolve_entities=False,
+    huge_tree=True,
+)
+
+# XML elements that are lists of values, and are matched by value
+VALUE_TAGS = ('member',)
+VALUE_KEYS = tuple(f"{tag}[.=" for tag in VALUE_TAGS)
+
+
+class Node:
+    '''
+    A node in a config tree, with a hash of its subtree
+
+    Attributes:
+        value (str): The node's own value (text, or None)
+        children (dict): Child keys, to Node objects, in config order
+        digest (bytes): The hash of the node and everything below it
+        raw (bytes): The XML of an entry that hasn't been expanded yet
+            (None once it has, or for other nodes)
+        size (int): The number of nodes in an entry that hasn't been
+            expanded yet
+
+    Methods:
+        __init__: Create a node
+        seal: Calculate the hash of this node
+        collapsed: Create a node for an entry, from its XML
+        expand: Make the nodes of an entry, from its XML
+        count: Count the nodes in this subtree
+    '''
+
+    __slots__ = ('value', 'children', 'digest', 'raw', 'size')
+
+    def __init__(
+        self,
+        value: str = None,
+        children: dict = None,
+    ) -> None:
+        '''
+        Constructor for the Node class
+
+        Args:
+            value (str): The node's own value
+            children (dict): Child keys, to Node objects
+        '''
+
+        self.value = value
+        self.children = children if children is not None else {}
+        self.digest = None
+        self.raw = None
+        self.size = None
+
+    def seal(
+        self
+    ) -> 'Node':
+        '''
+        Calculate the hash of this node, from its value and children
+            The children must already be sealed
+
+        Returns:
+            Node: This node
+        '''
+
+        parts = [repr(self.value).encode()]
+        for key, child in self.children.items():
+            parts.append(key.encode())
+            parts.append(child.digest)
+        self.digest = hashlib.blake2b(
+            b'\0'.join(parts),
+            digest_size=16,
+        ).digest()
+
+        return self
+
+    @classmethod
+    def collapsed(
+        cls,
+        element: etree._Element,
+    ) -> 'Node':
+        '''
+        Create a node for an entry, from its XML
+            The hash is of the XML, so entries with the same XML match
+            without building their nodes
+            Entries with the same content but different XML (eg, the
+            same members in a different order) are expanded, and match
+            when their nodes are compared
+
+        Args:
+            element (etree._Element): The entry, with all of its children
+
+        Returns:
+            Node: The node, to expand() when it's needed
+        '''
+
+        node = cls()
+        node.raw = etree.tostring(element, with_tail=False)
+
+        # Each element has one start tag (text can't have a raw '<')
+        node.size = node.raw.count(b'<') - node.raw.count(b'</')
+        node.digest = hashlib.blake2b(
+            b'raw\0' + node.raw,
+            digest_size=16,
+        ).digest()
+
+        return node
+
+    def expand(
+        self
+    ) -> 'Node':
+        '''
+        Make the nodes of an entry, from its XML
+            Nothing is done if the node has been expanded already
+            The hash isn't changed
+
+        Returns:
+            Node: This node
+        '''
+
+        if self.raw is not None:
+            built = _build(etree.fromstring(self.raw, _PARSER))
+            self.value = built.value
+            self.children = built.children
+            self.raw = None
+            self.size = None
+
+        return self
+
+    def count(
+        self
+    ) -> int:
+        '''
+        Count the nodes in this subtree
+
+        Returns:
+            int: The number of nodes, including this one
+        '''
+
+        if self.raw is not None:
+            return self.size
+
+        return 1 + sum(child.count() for child in self.children.values())
+
+
+def _key(
+    element: etree._Element,
+    children: dict,
+) -> str:
+    '''
+    Get the key of an XML element, unique among its siblings
+
+    Args:
+        element (etree._Element): The element
+        children (dict): The siblings seen so far, by key
+
+    Returns:
+        str: The key (eg, "entry[@name='web']" or "member[.='any']")
+    '''
+
+    name = element.get('name')
+    if name is not None:
+        return f"{element.tag}[@name='{name}']"
+
+    if element.tag in VALUE_TAGS:
+        return f"{element.tag}[.='{(element.text or '').strip()}']"
+
+    # Repeated elements without a name are numbered
+    key = element.tag
+    number = 1
+    while key in children:
+        number += 1
+        key = f"{element.tag}[{number}]"
+
+    return key
+
+
+def _finish(
+    node: Node,
+    element: etree._Element,
+) -> Node:
+    '''
+    Set a node's value from its XML element, and seal it
+        The node's children must already be added
+
+    Args:
+        node (Node): The node
+        element (etree._Element): The element it's for
+
+    Returns:
+        Node: The node, sealed
+    '''
+
+    text_value = (element.text or '').strip()
+    attributes = {
+        key: value for key, value in element.attrib.items()
+        if key != 'name'
+    }
+    if attributes:
+        node.value = f"{text_value} {attributes}".strip()
+    elif text_value:
+        node.value = text_value
+
+    # Member lists are sets, so their order doesn't matter
+    if node.children and all(
+        key.startswith(VALUE_KEYS) for key in node.children
+    ):
+        node.children = dict(sorted(node.children.items()))
+
+    return node.seal()
+
+
+def _build(
+    element: etree._Element,
+    collapsed: dict = None,
+) -> Node:
+    '''
+    Make the nodes for an element and everything inside it
+
+    Args:
+        element (etree._Element): The element
+        collapsed (dict): Nodes for entries that were collapsed, by
+            element (see Node.collapsed)
+
+    Returns:
+        Node: The element's node, sealed
+    '''
+
+    if collapsed and element in collapsed:
+        return collapsed[element]
+
+    node = Node()
+    for child in element:
+        node.children[_key(child, node.children)] = _build(child, collapsed)
+
+    return _finish(node, element)
+
+
+def parse_xml(
+    text: str,
+) -> Node:
+    '''
+    Parse a PAN-OS XML config into a tree
+        Named entries with no named entries inside are collapsed (see
+        Node.collapsed) as they end, and their elements are freed
+        The rest of the config is made into nodes at the end
+
+    Args:
+        text (str): The XML config
+
+    Raises:
+        ValueError: If the XML is invalid
+
+    Returns:
+        Node: The root, with the top level element as its only child
+    '''
+
+    collapsed = {}
+    events = etree.iterparse(
+        io.BytesIO(text.encode()),
+        tag='entry',
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities=False,
+        huge_tree=True,
+    )
+    try:
+        for _, element in events:
+            if (
+                element.get('name') is None or
+                element.find('.//entry[@name]') is not None
+            ):
+                continue
+
+            # The name is kept, as the parent needs it for the key
+            collapsed[element] = Node.collapsed(element)
+            del element[:]
+            element.text = None
+
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"The XML config is invalid: {e}") from e
+
+    root = events.root
+    return Node(
+        children={_key(root, {}): _build(root, collapsed)},
+    ).seal()
+
+
+def parse_set(
+    text: str,
+) -> Node:
+    '''
+    Parse a Junos set-format config into a tree
+        Each word is a level, so 'set a b c' is a > b > c
+        A node's value is True if a line ends there
+
+    Args:
+        text (str): The set-format config
+
+    Returns:
+        Node: The root
+    '''
+
+    root = Node()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        node = root
+        for word in SET_WORDS.findall(line):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = Node()
+            node = child
+        node.value = True
+
+    # Hash from the bottom up, without recursion
+    pending = [(root, False)]
+    while pending:
+        node, ready = pending.pop()
+        if ready:
+            node.seal()
+            continue
+        pending.append((node, True))
+        pending.extend((child, False) for child in node.children.values())
+
+    return root
+
+
+def parse_config(
+    text: str,
+) -> tuple[str, Node]:
+    '''
+    Parse a config into a tree, detecting the format
+
+    Args:
+        text (str): A PAN-OS XML config, or a Junos set-format config
+
+    Raises:
+        ValueError: If an XML config is invalid
+
+    Returns:
+        tuple: ('xml' or 'set', the root Node)
+    '''
+
+    if text.lstrip().startswith('<'):
+        return 'xml', parse_xml(text)
+
+    return 'set', parse_set(text)
+
+
+def _lines(
+    node: Node,
+    path: list,
+    kind: str,
+) -> list:
+    '''
+    List everything in a subtree, one line per value
+
+    Args:
+        node (Node): The top of the subtree
+        path (list): The keys from the root to this node
+        kind (str): 'xml' or 'set'
+
+    Returns:
+        list: For Junos, the set lines
+            For XML, 'path = value' for each value in the subtree
+    '''
+
+    lines = []
+    pending = [(node, path)]
+    while pending:
+        current, keys = pending.pop()
+        current.expand()
+        if current.value is not None:
+            if kind == 'set':
+                lines.append(' '.join(keys))
+            else:
+                lines.append(f"{_path(keys, kind)} = {current.value}")
+
+        pending.extend(
+            (child, keys + [key])
+            for key, child in reversed(current.children.items())
+        )
+
+    return lines
+
+
+def _path(
+    keys: list,
+    kind: str,
+) -> str:
+    '''
+    Format the keys from the root to a node
+
+    Args:
+        keys (list): The keys
+        kind (str): 'xml' or 'set'
+
+    Returns:
+        str: An XPath-like path for XML, or a partial set line
+    '''
+
+    if kind == 'set':
+        return ' '.join(keys)
+
+    return '/' + '/'.join(keys)
+
+
+def diff_configs(
+    old: str,
+    new: str,
+) -> dict:
+    '''
+    Compare two configs
+        Both must be the same format (XML or set)
+
+    Args:
+        old (str): The first config (eg, yesterday)
+        new (str): The second config (eg, today)
+
+    Raises:
+        ValueError: If the configs are different formats, or an XML
+            config is invalid
+
+    Returns:
+        dict: The differences
+            format (str): 'xml' or 'set'
+            changes (list): The changes, in config order
+                op (str): 'added', 'removed', 'changed' or 'moved'
+                path (str): Where the change is
+                lines (list): What was added or removed
+                old / new: The values before and after a change
+                keys (list): The entries that moved
+            summary (dict): The number of each kind of change
+            nodes (dict): The size of each tree ('old', 'new')
+            skipped (int): Unchanged subtrees that were skipped
+            elapsed (float): Seconds taken
+    '''
+
+    start = time.perf_counter()
+    kind, old_root = parse_config(old)
+    new_kind, new_root = parse_config(new)
+    if kind != new_kind:
+        raise ValueError('The configs are in different formats')
+
+    changes = []
+    skipped = 0
+
+    # Walk both trees together, only into subtrees that are different
+    pending = [(old_root, new_root, [])]
+    while pending:
+        old_node, new_node, keys = pending.pop()
+        if old_node.digest == new_node.digest:
+            skipped += 1
+            continue
+
+        # Entries that were only hashed are needed now
+        old_node.expand()
+        new_node.expand()
+
+        if old_node.value != new_node.value:
+            if kind == 'set':
+                # A line was added or removed at this exact path
+                op = 'added' if new_node.value else 'removed'
+                changes.append(
+                    {
+                        'op': op,
+                        'path': _path(keys, kind),
+                        'lines': [_path(keys, kind)],
+                    }
+                )
+            else:
+                changes.append(
+                    {
+                        'op': 'changed',
+                        'path': _path(keys, kind),
+                        'old': old_node.value,
+                        'new': new_node.value,
+                    }
+                )
+
+        old_children = old_node.children
+        new_children = new_node.children
+        nested = []
+        for key, child in old_children.items():
+            if key not in new_children:
+                changes.append(
+                    {
+                        'op': 'removed',
+                        'path': _path(keys + [key], kind),
+                        'lines': _lines(child, keys + [key], kind),
+                    }
+                )
+            else:
+                nested.append((child, new_children[key], keys + [key]))
+
+        for key, child in new_children.items():
+            if key not in old_children:
+                changes.append(
+                    {
+                        'op': 'added',
+                        'path': _path(keys + [key], kind),
+                        'lines': _lines(child, keys + [key], kind),
+                    }
+                )
+
+        # Entries in both, in a different order (order matters in rules)
+        common = [path[-1] for _, _, path in nested]
+        if len(common) > 1:
+            position = {
+                key: index
+                for index, key in enumerate(
+                    key for key in new_children if key in old_children
+                )
+            }
+            keys_moved = moved(common, position)
+            if keys_moved:
+                changes.append(
+                    {
+                        'op': 'moved',
+                        'path': _path(keys, kind),
+                        'keys': keys_moved,
+                    }
+                )
+
+        pending.extend(reversed(nested))
+
+    summary = {'added': 0, 'removed': 0, 'changed': 0, 'moved': 0}
+    for change in changes:
+        summary[change['op']] += 1
+
+    return {
+        'format': kind,
+        'changes': changes,
+        'summary': summary,
+        'nodes': {'old': old_root.count(), 'new': new_root.count()},
+        'skipped': skipped,
+        'elapsed': round(time.perf_counter() - start, 3),
+    }
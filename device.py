@@ -5,18 +5,27 @@ Tracks each of these objects, and contains methods to manage them
 
 from sql import SqlServer
 from settings import AppSettings
-from encryption import CryptoSecret
+from encryption import CryptoSecret, rekey
 from settings import config
 
 from pa_api import DeviceApi as PaDeviceApi
 from junos_api import DeviceApi as JunosDeviceApi
+from concurrency import MAX_WORKERS, concurrency
+from metrics import device_load_queue
 
 from colorama import Fore, Style
 import concurrent.futures
+import hashlib
 import uuid
 import base64
 import os
 
+from state import STATE_DIR, SharedJsonFile
+
+
+# Where HA drift is shared between worker processes
+DRIFT_FILE = os.path.join(STATE_DIR, 'ha_drift.json')
+
 
 class Site:
     '''
@@ -100,6 +109,10 @@ class Device:
     Methods:
         __init__: Constructor for Device class
         __str__: String representation of the device
+        get_details: Get the device details from the API
+        set_ha: Update the HA details from the API
+        reset_password: Reencrypt the password for the device
+        _update_db: Update the device details in the database
     '''
 
     def __init__(
@@ -163,6 +176,7 @@ class Device:
         self.ha_local_state = None
         self.ha_peer_state = None
         self.ha_peer_serial = None
+        self.ha_sync = None
 
         # Track the site name
         self.site_name = ''
@@ -182,10 +196,16 @@ class Device:
 
     def get_details(
         self,
+        facts: bool = True,
     ) -> None:
         '''
         Get the device details from the API
         Update the device object
+
+        Args:
+            facts (bool): Get the model, serial and version as well as
+                the HA state. These rarely change, so a light poll
+                (eg, of a passive HA peer) can skip them.
         '''
 
         settings = AppSettings()
@@ -259,24 +279,19 @@ class Device:
                 )
 
             # Get device details
-            details = dev_api.get_device()
+            details = dev_api.get_device() if facts else None
             ha = dev_api.get_ha()
 
             # Update the device object
             #   Integers are returned if the API call fails
-            if type(details) is not int:
+            if details is not None and type(details) is not int:
                 self.model = details[0]
                 self.serial = details[1]
                 self.version = details[2]
 
             # Update the HA details
             if type(ha) is not int:
-                self.ha_enabled = ha[0]
-
-                if self.ha_enabled:
-                    self.ha_local_state = ha[1]
-                    self.ha_peer_state = ha[2]
-                    self.ha_peer_serial = ha[3]
+                self.set_ha(ha)
 
         # If the password was not decrypted, return
         else:
@@ -287,10 +302,55 @@ class Device:
             )
             details = None
 
-        # Update the DB
-        if type(details) is not int or type(ha) is not int:
+        # Update the DB (a light poll has nothing new to store)
+        if facts and (type(details) is not int or type(ha) is not int):
             self._update_db()
 
+    def set_ha(
+        self,
+        ha: bool | tuple,
+    ) -> bool:
+        '''
+        Update the HA details from the API
+
+        Args:
+            ha (bool | tuple): The result of get_ha()
+                False if HA is disabled, otherwise a tuple of the
+                details (enabled, local state, peer state, peer serial,
+                and config sync state)
+
+        Returns:
+            bool: True if the HA details changed
+        '''
+
+        before = (
+            self.ha_enabled,
+            self.ha_local_state,
+            self.ha_peer_state,
+            self.ha_peer_serial,
+            self.ha_sync,
+        )
+
+        # HA is disabled
+        if not isinstance(ha, tuple):
+            self.ha_enabled = bool(ha)
+            return before[0] != self.ha_enabled
+
+        self.ha_enabled = ha[0]
+        if self.ha_enabled:
+            self.ha_local_state = ha[1]
+            self.ha_peer_state = ha[2]
+            self.ha_peer_serial = ha[3]
+            self.ha_sync = ha[4] if len(ha) > 4 else None
+
+        return before != (
+            self.ha_enabled,
+            self.ha_local_state,
+            self.ha_peer_state,
+            self.ha_peer_serial,
+            self.ha_sync,
+        )
+
     def reset_password(
         self,
         password: str,
@@ -307,25 +367,15 @@ class Device:
             bool: True if successful, otherwise False
         '''
 
-        # Update details
-        self.get_details()
-
-        # Encrypt with new master password
+        # Re-encrypt from the stored ciphertext (no need to poll the device)
         print(f"Encrypting password for device '{self.name}'")
-        print(f"Decrypted PW: {self.decrypted_pw}")
-        print(f'old master pw: {os.getenv('api_master_pw')}')
-        print(f'new master pw: {password}')
-
         try:
-            with CryptoSecret() as encryptor:
-                encrypted = encryptor.encrypt(
-                    password=self.decrypted_pw,
-                    master_pw=password,
-                )
-                self.password_encoded = encrypted[0].decode()
-                self.salt_encoded = base64.urlsafe_b64encode(
-                    encrypted[1]
-                ).decode()
+            result = rekey(
+                secret=self.password,
+                salt=self.salt,
+                old_master=os.getenv('api_master_pw'),
+                new_master=password,
+            )
 
         except Exception as e:
             print(
@@ -336,6 +386,16 @@ class Device:
             print(e)
             return False
 
+        if result is None:
+            print(
+                Fore.RED,
+                f"Could not decrypt password for device '{self.name}'.",
+                Style.RESET_ALL
+            )
+            return False
+
+        self.password_encoded, self.salt_encoded = result
+
         # Update the database with password and salt
         with SqlServer(
             server=config.sql_server,
@@ -343,35 +403,30 @@ class Device:
             table='devices',
             config=config,
         ) as sql:
-            try:
-                sql.update(
-                    field='id',
-                    value=self.id,
-                    body={
-                        'friendly_name': self.name,
-                        'name': self.hostname,
-                        'site': self.site,
-                        'token': self.key,
-                        'username': self.username,
-                        'secret': self.password_encoded,
-                        'salt': self.salt_encoded,
-                    }
-                )
+            result = sql.update(
+                field='id',
+                value=self.id,
+                body={
+                    'secret': self.password_encoded,
+                    'salt': self.salt_encoded,
+                }
+            )
 
-            except Exception as e:
-                print(
-                    Fore.RED,
-                    "Could not update device in the database.",
-                    Style.RESET_ALL,
-                    e,
-                )
-                return False
+        if not result:
+            print(
+                Fore.RED,
+                "Could not update device in the database.",
+                Style.RESET_ALL,
+            )
+            return False
+
+        # Track the new values
+        self.password = self.password_encoded
+        self.salt = self.salt_encoded
 
         print(
             Fore.GREEN,
             f'Resetting password for device {self.name}',
-            f'Encrypted PW: {self.password_encoded}',
-            f'Salt: {self.salt_encoded}',
             Style.RESET_ALL
         )
         return True
@@ -706,11 +761,16 @@ class DeviceManager():
         _new_uuid: Generate a new UUID for a device
         _site_assignment: Assign devices to sites
         _ha_pairs: Find devices that are paired in an HA configuration
+        _update_version: Update the version of the device list
+        update_state: Update the HA pairs and version, after a poll
         get_devices: Get all devices from the database
+        config_source: Get the device to read a device's config from
+        ha_drift: Get the passive HA peers that have drifted
+        set_drift: Record whether an HA pair's configs have drifted
         add_device: Add a new device to the database
         delete_device: Delete a device from the database
         update_device: Update a device in the database
-        reset_password: Reset the password for a device
+        reset_passwords: Re-encrypt all device passwords with a new master
         id_to_name: Convert a device ID to a device name
     '''
 
@@ -741,6 +801,14 @@ class DeviceManager():
         self.device_list = []
         self.ha_pairs = []
 
+        # Passive HA peers whose config differs from the active peer
+        #   Their config is read from the device, not from the active peer
+        #   Shared with other workers through a file
+        self._drift = SharedJsonFile(DRIFT_FILE)
+
+        # Changes whenever the device list or device states change
+        self.version = ''
+
     def __len__(
         self
     ) -> int:
@@ -782,6 +850,7 @@ class DeviceManager():
         self,
         device: tuple,
         config: AppSettings,
+        previous: Device = None,
     ) -> Device:
         '''
         Create a new Device object from a tuple
@@ -790,6 +859,9 @@ class DeviceManager():
         Args:
             device (tuple): A tuple of device details
             config (AppSettings): Application settings
+            previous (Device): The device from the last poll, if it was a
+                passive HA peer. Its facts are reused, and only the HA
+                state is polled.
 
         Returns:
             Device: A new Device object
@@ -820,8 +892,19 @@ class DeviceManager():
             config=config,
         )
 
-        # Collect the device details
-        this_device.get_details()
+        # Collect the device details (only the HA state for passive peers)
+        #   Within the vendor's and device's limits, shared with other
+        #   fan-outs. Without an HA state, the API calls failed
+        with concurrency.slot(vendor, device[0]) as slot:
+            device_load_queue.dec()
+            if previous is not None:
+                this_device.model = previous.model
+                this_device.serial = previous.serial
+                this_device.version = previous.version
+                this_device.get_details(facts=False)
+            else:
+                this_device.get_details()
+            slot.ok = this_device.ha_enabled is not None
 
         # Return the device object
         return this_device
@@ -891,7 +974,9 @@ class DeviceManager():
         '''
 
         # Loop through devices
-        self.ha_pairs = []
+        #   The list is replaced when it's complete, as it may be read
+        #   while it's found again (eg, after a background poll)
+        ha_pairs = []
         for device in self.device_list:
             # Find actice devices
             if device.ha_peer_serial and device.ha_local_state == 'active':
@@ -900,12 +985,14 @@ class DeviceManager():
                     # Find matching passive devices
                     if device.ha_peer_serial == peer.serial:
                         # Save the pair
-                        self.ha_pairs.append({
+                        ha_pairs.append({
                             'active': device,
                             'passive': peer
                         })
                         break
 
+        self.ha_pairs = ha_pairs
+
     def get_devices(
         self,
     ) -> None:
@@ -935,13 +1022,27 @@ class DeviceManager():
             print("Could not read from the database.")
             return
 
+        # Passive HA peers from the last poll only need a light poll
+        #   Their config is synchronized with the active peer
+        passive = {
+            str(pair['passive'].id): pair['passive']
+            for pair in self.ha_pairs
+        }
+
         # Create a list of Device objects
         #   Iterate through the device list in SQL output
+        #   Devices are queued until they have a thread and a slot
         self.device_list = []
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        device_load_queue.set(len(output))
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(MAX_WORKERS, len(output)),
+        ) as executor:
             futures = [
                 executor.submit(
-                    self._create_device, device, self.config
+                    self._create_device,
+                    device,
+                    self.config,
+                    passive.get(str(device[0])),
                 ) for device in output
             ]
             for future in concurrent.futures.as_completed(futures):
@@ -953,6 +1054,120 @@ class DeviceManager():
         # Find HA pairs
         self._ha_pairs()
 
+        # Track the version of the device list
+        self._update_version()
+
+    def config_source(
+        self,
+        device_id: str,
+    ) -> str:
+        '''
+        Get the device to read a device's config from
+            A passive HA peer has the same config as the active peer,
+            so its config is read from the active peer (and its cache)
+            This isn't done if the peers are out of sync, or have drifted
+
+        Args:
+            device_id (str): The device ID
+
+        Returns:
+            str: The ID of the device to read the config from
+        '''
+
+        for pair in self.ha_pairs:
+            passive = pair['passive']
+            if str(passive.id) != str(device_id):
+                continue
+
+            if (
+                passive.ha_sync in (None, 'synchronized') and
+                not self.ha_drift.get(str(passive.id))
+            ):
+                return str(pair['active'].id)
+            break
+
+        return device_id
+
+    @property
+    def ha_drift(
+        self
+    ) -> dict:
+        '''
+        Get the passive HA peers that have drifted
+            Drift found by any worker is shared with the others
+
+        Returns:
+            dict: Passive peer IDs, to True if their config has drifted
+        '''
+
+        self._drift.read()
+        return self._drift.data
+
+    def set_drift(
+        self,
+        device_id: str,
+        drifted: bool,
+    ) -> None:
+        '''
+        Record whether an HA pair's configs have drifted
+            The shared file is changed while it's locked
+
+        Args:
+            device_id (str): The ID of the passive peer
+            drifted (bool): True if its config differs from the active peer
+        '''
+
+        try:
+            self._drift.update(
+                lambda drift: dict(drift, **{str(device_id): drifted})
+            )
+
+        except OSError as e:
+            print(
+                Fore.RED,
+                'Could not share the HA drift',
+                Style.RESET_ALL
+            )
+            print(e)
+            self._drift.data = dict(
+                self._drift.data,
+                **{str(device_id): drifted},
+            )
+
+    def _update_version(
+        self,
+    ) -> None:
+        '''
+        Update the version of the device list
+            This is a hash of the details that are shown to users
+            It is used to check if the browser already has the device list
+        '''
+
+        details = sorted(
+            (
+                str(device.id),
+                str(device.name),
+                str(device.vendor),
+                str(device.site_name),
+                str(device.ha_local_state),
+                str(device.ha_peer_state),
+            )
+            for device in self.device_list
+        )
+        self.version = hashlib.sha1(str(details).encode()).hexdigest()[:16]
+
+    def update_state(
+        self,
+    ) -> None:
+        '''
+        Update the HA pairs and version, after a poll
+            Used when devices are polled in the background, and their
+            HA state has changed
+        '''
+
+        self._ha_pairs()
+        self._update_version()
+
     def add_device(
         self,
         name: str,
@@ -1188,6 +1403,139 @@ class DeviceManager():
             print("Could not update device in the database.")
             return False
 
+    def reset_passwords(
+        self,
+        password: str,
+    ) -> int | bool:
+        '''
+        Re-encrypt all device passwords (and the SQL password) with a new
+            master password
+
+        (1) Read all encrypted passwords from SQL Server
+            Devices are not polled, the stored ciphertext is used
+        (2) Re-encrypt each secret in a process pool
+            Each secret needs two PBKDF2 derivations, which are CPU bound
+        (3) Write all new secrets and salts in a single transaction
+        (4) Swap the master password (config.yaml and environment)
+
+        If any step fails, nothing is changed
+
+        Args:
+            password (str): The new master password
+
+        Returns:
+            int: The number of devices that were re-encrypted
+            bool: False if the master password was not changed
+        '''
+
+        old_master = os.getenv('api_master_pw')
+
+        # Read all device secrets from the database
+        with SqlServer(
+            server=self.sql_server,
+            database=self.sql_database,
+            table=self.table,
+            config=self.config,
+        ) as sql:
+            output = sql.read(
+                field='',
+                value='',
+            )
+
+        if output is False:
+            print("Could not read from the database.")
+            return False
+
+        # Build the list of secrets to re-encrypt (ID, secret, salt)
+        #   The SQL password is included, so it is swapped at the same time
+        jobs = [
+            (device[0], device[7], device[8])
+            for device in output
+            if device[7] and device[8]
+        ]
+        jobs.append((None, self.config.sql_password, self.config.sql_salt))
+
+        # Re-encrypt all secrets in parallel
+        total = len(jobs)
+        results = {}
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            futures = {
+                executor.submit(
+                    rekey, secret, salt, old_master, password
+                ): id for id, secret, salt in jobs
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                id = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(Fore.RED, e, Style.RESET_ALL)
+                    result = None
+
+                if result is None:
+                    print(
+                        Fore.RED,
+                        "Could not re-encrypt the password for "
+                        f"'{id if id is not None else 'SQL Server'}'.",
+                        "The master password has not been changed.",
+                        Style.RESET_ALL
+                    )
+                    executor.shutdown(cancel_futures=True)
+                    return False
+
+                results[id] = result
+                print(
+                    Fore.CYAN,
+                    f"Re-encrypted {len(results)}/{total} secrets",
+                    Style.RESET_ALL
+                )
+
+        # Write all device secrets in a single transaction
+        sql_secret = results.pop(None)
+        with SqlServer(
+            server=self.sql_server,
+            database=self.sql_database,
+            table=self.table,
+            config=self.config,
+        ) as sql:
+            committed = sql.update_many(
+                field='id',
+                entries={
+                    id: {
+                        'secret': secret,
+                        'salt': salt,
+                    } for id, (secret, salt) in results.items()
+                }
+            )
+
+        if not committed:
+            print(
+                Fore.RED,
+                "Could not update device passwords in the database.",
+                "The master password has not been changed.",
+                Style.RESET_ALL
+            )
+            return False
+
+        # Swap the master password (SQL password first, as it's needed
+        #   to connect to the database)
+        self.config.sql_password, self.config.sql_salt = sql_secret
+        self.config.write_config()
+        os.environ['api_master_pw'] = password
+
+        # Update the device objects with the new secrets
+        for device in self.device_list:
+            if device.id in results:
+                device.password, device.salt = results[device.id]
+
+        print(
+            Fore.GREEN,
+            f"Master password changed, {len(results)} devices re-encrypted",
+            Style.RESET_ALL
+        )
+        return len(results)
+
     def id_to_name(
         self,
         id: uuid,
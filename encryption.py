@@ -4,7 +4,7 @@ Uses the master password stored in an environment variable (api_master_pw)
 
 Modules:
     3rd Party: cryptography, base64, colorama, os
-    Custom: None
+    Custom: metrics
 
 Classes:
 
@@ -13,7 +13,9 @@ Classes:
 
 Functions
 
-    None
+    rekey
+        Re-encrypt a secret from one master password to another
+        Designed to be run in a process pool
 
 Exceptions:
 
@@ -39,6 +41,8 @@ from colorama import Fore, Style
 import traceback
 from typing import Tuple
 
+from metrics import pbkdf2_seconds
+
 
 class CryptoSecret:
     '''
@@ -233,7 +237,10 @@ class CryptoSecret:
             salt=salt,
             iterations=100000
         )
-        key = base64.urlsafe_b64encode(kdf.derive(self.master.encode()))
+        with pbkdf2_seconds.time():
+            key = base64.urlsafe_b64encode(
+                kdf.derive(self.master.encode())
+            )
 
         # create a Fernet object using the key
         fernet = Fernet(key)
@@ -241,6 +248,59 @@ class CryptoSecret:
         return fernet
 
 
+def rekey(
+    secret: str,
+    salt: str,
+    old_master: str,
+    new_master: str,
+) -> Tuple[str, str] | None:
+    '''
+    Re-encrypt a secret from one master password to another
+        This is done when the master password is changed
+
+    This is a module level function so it can be pickled and run in a
+        process pool (the PBKDF2 derivations are CPU bound)
+
+    Args:
+        secret : str
+            The secret (encrypted password), as stored in the database
+        salt : str
+            The salt, URL-safe base64 encoded, as stored in the database
+        old_master : str
+            The master password the secret is currently encrypted with
+        new_master : str
+            The master password to encrypt the secret with
+
+    Returns:
+        Tuple[str, str]:
+            The new secret and new salt (URL-safe base64 encoded)
+        None:
+            If the secret could not be decrypted
+    '''
+
+    crypto = CryptoSecret()
+
+    # Decrypt with the old master password
+    crypto.master = old_master
+    password = crypto.decrypt(
+        secret=secret,
+        salt=base64.urlsafe_b64decode(salt.encode())
+    )
+    if password is False:
+        return None
+
+    # Encrypt with the new master password
+    encrypted = crypto.encrypt(
+        password=password,
+        master_pw=new_master,
+    )
+
+    return (
+        encrypted[0].decode(),
+        base64.urlsafe_b64encode(encrypted[1]).decode(),
+    )
+
+
 if __name__ == '__main__':
     print("This module is not designed to be run as a script")
     print("Please import it into another module")
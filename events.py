@@ -0,0 +1,593 @@
+'''
+Push live changes to browsers, as Server-Sent Events (SSE)
+
+Pages that are left open can apply changes as they happen, rather than
+    fetching full lists again (which may call the devices again)
+
+Changes are found as background polls finish (see scheduler.py)
+    tunnel: A managed VPN changed state (see vpnhealth.py)
+    gp: Users logged in to, or out of, a GlobalProtect gateway
+    ha: A device's HA state changed (eg, a failover)
+    device: A device became reachable or unreachable
+
+Recent events are kept in a ring buffer, each with an increasing ID
+    A browser that reconnects sends the last ID it saw, and gets the
+    events it missed
+    If they're no longer in the buffer, it is sent a 'reset' event,
+    and should fetch the full lists again
+
+Events are shared between worker processes through a file
+    Changes are found in the worker that polls (see scheduler.py), but
+    streams are served by every worker
+    Events are appended to the file while it's locked, so IDs are the
+    same in every worker, and a browser can reconnect to any of them
+    Each worker reads new lines from the file as they're added
+    The file is cut back to the newest events when it gets too long
+
+Classes:
+    EventBus
+        A ring buffer of recent events, that streams can wait on
+    ChangeDetector
+        Finds changes in background polls, and publishes them
+
+Misc Variables:
+    event_bus
+        The shared EventBus object
+    change_detector
+        The shared ChangeDetector object
+'''
+
+from colorama import Fore, Style
+
+import collections
+import json
+import os
+import threading
+import time
+import typing as t
+
+from device import device_manager
+from gpsessions import clean_session, session_key
+from jsonprovider import encode
+from scheduler import INTERVALS, device_state
+from state import STATE_DIR, locked, write_atomic
+
+
+# Kinds of event
+EVENT_TYPES = ('tunnel', 'gp', 'ha', 'device')
+
+# The number of recent events kept, for browsers that reconnect
+BUFFER_SIZE = 1000
+
+# Seconds between keep-alive comments, when there are no events
+HEARTBEAT = 15
+
+# Seconds before a stream ends, and the browser reconnects
+#   Each open stream holds a worker thread
+STREAM_TIMEOUT = 300
+
+# Milliseconds the browser waits before reconnecting
+RETRY = 3000
+
+# The most streams each worker serves at once
+#   Each stream holds one of the worker's threads (see uwsgi.ini), so
+#   the rest are kept for other requests
+MAX_STREAMS = 4
+
+# Seconds a browser waits before trying again, when there are too many
+STREAMS_BUSY_RETRY = 30
+
+# The file events are shared through
+EVENTS_FILE = os.path.join(STATE_DIR, 'events.jsonl')
+
+# How often streams check the file for new events (seconds)
+READ_INTERVAL = 1
+
+
+class EventBus:
+    '''
+    A ring buffer of recent events, that streams can wait on
+        Shared with other workers through a file
+
+    Methods:
+        __init__: Create an empty bus
+        publish: Add an event, and wake the streams
+        since: Get the events after an ID
+        open_stream: Reserve a place for a new stream
+        close_stream: Free a stream's place
+        stream: Stream events as SSE messages
+        _read: Read new events from the file
+        _compact: Cut the file back to the events that are kept
+        _message: Format an event as an SSE message
+    '''
+
+    def __init__(
+        self,
+        path: str = EVENTS_FILE,
+        size: int = BUFFER_SIZE,
+        max_streams: int = MAX_STREAMS,
+    ) -> None:
+        '''
+        Create an empty bus
+
+        Args:
+            path (str): The file events are shared through
+            size (int): The number of recent events to keep
+            max_streams (int): The most streams served at once
+        '''
+
+        self.path = path
+        self.size = size
+        self.max_streams = max_streams
+        self._streams = 0
+        self._events = collections.deque(maxlen=size)
+        self._last_id = 0
+        self._condition = threading.Condition()
+
+        # The file that was read, how far, and how many lines it has
+        self._inode = None
+        self._offset = 0
+        self._lines = 0
+        self._checked = 0
+
+    def _read(
+        self,
+        force: bool = False,
+    ) -> None:
+        '''
+        Read new events from the file
+            Only whole lines are read, as the last may be part written
+            If the file was replaced (cut back), it's read again
+            The file is checked at most once each READ_INTERVAL
+            The caller must hold the condition
+
+        Args:
+            force (bool): Check the file now
+        '''
+
+        now = time.monotonic()
+        if not force and now - self._checked < READ_INTERVAL:
+            return
+        self._checked = now
+
+        try:
+            stat = os.stat(self.path)
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._inode = stat.st_ino
+                self._offset = 0
+                self._lines = 0
+                self._events.clear()
+                self._last_id = 0
+
+            if stat.st_size == self._offset:
+                return
+
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+
+        except OSError:
+            return
+
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            self._lines += 1
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event['id'] > self._last_id:
+                self._events.append(event)
+                self._last_id = event['id']
+
+    def _compact(
+        self
+    ) -> None:
+        '''
+        Cut the file back to the events that are kept
+            The file is replaced in one step, so readers never see part
+            The caller must hold the condition, and the file lock
+        '''
+
+        write_atomic(
+            self.path,
+            b''.join(
+                encode(event, default=str, newline=True)
+                for event in self._events
+            ),
+        )
+        self._read(force=True)
+
+    def publish(
+        self,
+        kind: str,
+        data: dict,
+    ) -> int:
+        '''
+        Add an event, and wake the streams
+            The file is locked while the event is added, so each event
+            gets the next ID, whichever worker adds it
+            If the file can't be written, the event is only kept here
+
+        Args:
+            kind (str): The kind of event (see EVENT_TYPES)
+            data (dict): The details of the change
+
+        Returns:
+            int: The event's ID
+        '''
+
+        with self._condition:
+            try:
+                with locked(f"{self.path}.lock"):
+                    # Catch up with other workers, for the newest ID
+                    self._read(force=True)
+                    event = {
+                        'id': self._last_id + 1,
+                        'type': kind,
+                        'time': time.time(),
+                        'data': data,
+                    }
+                    with open(self.path, 'ab') as f:
+                        f.write(encode(event, default=str, newline=True))
+                    self._read(force=True)
+
+                    if self._lines > self.size * 2:
+                        self._compact()
+
+            except OSError as e:
+                print(
+                    Fore.RED,
+                    f"Could not share the '{kind}' event",
+                    Style.RESET_ALL
+                )
+                print(e)
+                self._last_id += 1
+                self._events.append(
+                    {
+                        'id': self._last_id,
+                        'type': kind,
+                        'time': time.time(),
+                        'data': data,
+                    }
+                )
+
+            self._condition.notify_all()
+
+            return self._last_id
+
+    def since(
+        self,
+        last_id: int,
+        kinds: t.Iterable = None,
+    ) -> tuple[list | None, int]:
+        '''
+        Get the events after an ID
+
+        Args:
+            last_id (int): The last event ID that was seen
+            kinds (Iterable): Only these kinds of event (None for all)
+
+        Returns:
+            tuple:
+                list: The events, oldest first
+                    None if some were missed (they're no longer kept)
+                int: The newest event ID, to continue from
+        '''
+
+        with self._condition:
+            self._read()
+            newest = self._last_id
+            if last_id == newest:
+                return [], newest
+
+            # Events are numbered in order, so the oldest kept is first
+            oldest = self._events[0]['id'] if self._events else newest + 1
+            if last_id > newest or last_id < oldest - 1:
+                return None, newest
+
+            return [
+                event for event in list(self._events)[last_id - oldest + 1:]
+                if kinds is None or event['type'] in kinds
+            ], newest
+
+    def open_stream(
+        self,
+    ) -> bool:
+        '''
+        Reserve a place for a new stream
+            Call close_stream() when the stream ends
+
+        Returns:
+            bool: False if this worker has too many streams open
+        '''
+
+        with self._condition:
+            if self._streams >= self.max_streams:
+                return False
+            self._streams += 1
+            return True
+
+    def close_stream(
+        self,
+    ) -> None:
+        '''
+        Free a stream's place
+        '''
+
+        with self._condition:
+            self._streams = max(self._streams - 1, 0)
+
+    def stream(
+        self,
+        last_id: int = None,
+        kinds: t.Iterable = None,
+        timeout: float = STREAM_TIMEOUT,
+    ) -> t.Iterator[str]:
+        '''
+        Stream events as SSE messages
+            Events from this worker wake the stream at once. Events
+            from other workers are read from the file each second
+            Keep-alive comments are sent when there are no events
+            The stream ends after a time, and the browser reconnects
+
+        Args:
+            last_id (int): The last event ID the browser saw
+                None to start with new events
+            kinds (Iterable): Only these kinds of event (None for all)
+            timeout (float): Seconds before the stream ends
+
+        Yields:
+            str: SSE messages
+        '''
+
+        yield f"retry: {RETRY}\n\n"
+
+        if last_id is None:
+            with self._condition:
+                self._read(force=True)
+                last_id = self._last_id
+
+        end = time.monotonic() + timeout
+        sent = time.monotonic()
+        while time.monotonic() < end:
+            events, newest = self.since(last_id, kinds)
+            last_id = newest
+
+            # Missed events can't be sent, so the browser starts again
+            if events is None:
+                yield self._message(
+                    {'id': newest, 'type': 'reset', 'data': {}}
+                )
+                sent = time.monotonic()
+                continue
+
+            if events:
+                for event in events:
+                    yield self._message(event)
+                sent = time.monotonic()
+                continue
+
+            # Wait for new events, and send a keep-alive if it's quiet
+            with self._condition:
+                if self._last_id == last_id:
+                    self._condition.wait(
+                        min(READ_INTERVAL, max(end - time.monotonic(), 0))
+                    )
+
+            if time.monotonic() - sent >= HEARTBEAT:
+                yield ': keep-alive\n\n'
+                sent = time.monotonic()
+
+    @staticmethod
+    def _message(
+        event: dict,
+    ) -> str:
+        '''
+        Format an event as an SSE message
+
+        Args:
+            event (dict): The event
+
+        Returns:
+            str: The message (id, event and data lines)
+        '''
+
+        data = encode(
+            dict(event['data'], time=event.get('time')),
+            default=str,
+        ).decode()
+
+        return (
+            f"id: {event['id']}\n"
+            f"event: {event['type']}\n"
+            f"data: {data}\n\n"
+        )
+
+
+class ChangeDetector:
+    '''
+    Finds changes in background polls, and publishes them
+        Only runs in the worker that polls
+
+    Methods:
+        __init__: Create a detector that hasn't seen any polls
+        observe: Check a poll for changes
+        _reachability: Publish when a device becomes (un)reachable
+        _ha: Publish when a device's HA state changes
+        _gp: Publish GlobalProtect logins and logouts
+    '''
+
+    def __init__(
+        self,
+        bus: EventBus,
+    ) -> None:
+        '''
+        Create a detector that hasn't seen any polls
+
+        Args:
+            bus (EventBus): Where changes are published
+        '''
+
+        self.bus = bus
+        self._lock = threading.Lock()
+
+        # What was seen last, for each device
+        self._reachable = {}
+        self._ha_states = {}
+        self._sessions = {}
+
+    def observe(
+        self,
+        device_id: str,
+        metric: str,
+    ) -> None:
+        '''
+        Check a poll for changes
+            Called by the state store, after each poll
+
+        Args:
+            device_id (str): The device that was polled
+            metric (str): The metric that was polled
+        '''
+
+        entry = device_state.get(device_id, metric)
+        if entry is None:
+            return
+
+        with self._lock:
+            self._reachability(device_id)
+            if entry['error'] is None and metric == 'ha':
+                self._ha(device_id, entry['value'])
+            if entry['error'] is None and metric == 'gp':
+                self._gp(device_id, entry['value'])
+
+    def _reachability(
+        self,
+        device_id: str,
+    ) -> None:
+        '''
+        Publish when a device becomes reachable or unreachable
+            A device is reachable if its most recent poll worked
+            Metrics are polled at different intervals, so an older
+            success (eg, the hourly facts) doesn't hide new failures
+            The caller must hold the lock
+
+        Args:
+            device_id (str): The device ID
+        '''
+
+        polls = device_state.device(device_id)
+        latest = max(
+            (poll for poll in polls.values() if poll is not None),
+            key=lambda poll: poll.get('polled') or poll['updated'] or 0,
+            default=None,
+        )
+        if latest is None:
+            return
+        reachable = latest['error'] is None
+
+        previous = self._reachable.get(device_id)
+        self._reachable[device_id] = reachable
+        if previous is None or previous == reachable:
+            return
+
+        errors = sorted(
+            {
+                poll['error'] for poll in polls.values()
+                if poll is not None and poll['error']
+            }
+        )
+        self.bus.publish(
+            'device',
+            {
+                'device': device_id,
+                'name': device_manager.id_to_name(device_id),
+                'reachable': reachable,
+                'errors': errors,
+            }
+        )
+
+    def _ha(
+        self,
+        device_id: str,
+        ha: dict,
+    ) -> None:
+        '''
+        Publish when a device's HA state changes (eg, passive to active)
+            The caller must hold the lock
+
+        Args:
+            device_id (str): The device ID
+            ha (dict): The HA state, from the poll
+        '''
+
+        state = (ha or {}).get('local_state')
+        previous = self._ha_states.get(device_id)
+        self._ha_states[device_id] = state
+        if previous is None or previous == state:
+            return
+
+        self.bus.publish(
+            'ha',
+            {
+                'device': device_id,
+                'name': device_manager.id_to_name(device_id),
+                'from': previous,
+                'to': state,
+                'peer_state': ha.get('peer_state'),
+            }
+        )
+
+    def _gp(
+        self,
+        device_id: str,
+        sessions: list,
+    ) -> None:
+        '''
+        Publish GlobalProtect logins and logouts on a gateway
+            One event for each poll that has changes
+            The caller must hold the lock
+
+        Args:
+            device_id (str): The gateway's device ID
+            sessions (list): The sessions, from the poll
+        '''
+
+        current = {}
+        for session in sessions or []:
+            entry = clean_session(session)
+            current[session_key(entry)] = entry
+
+        previous = self._sessions.get(device_id)
+        self._sessions[device_id] = current
+        if previous is None:
+            return
+
+        logins = [
+            entry for key, entry in current.items() if key not in previous
+        ]
+        logouts = [
+            entry for key, entry in previous.items() if key not in current
+        ]
+        if not logins and not logouts:
+            return
+
+        self.bus.publish(
+            'gp',
+            {
+                'device': device_id,
+                'gateway': device_manager.id_to_name(device_id),
+                'logins': logins,
+                'logouts': logouts,
+                'sessions': len(current),
+            }
+        )
+
+
+# The shared event bus, and the detector that watches every poll
+event_bus = EventBus()
+change_detector = ChangeDetector(event_bus)
+for _metric in INTERVALS:
+    device_state.watch(_metric, change_detector.observe)
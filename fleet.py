@@ -0,0 +1,188 @@
+'''
+Run the same query against many devices at once
+
+A fleet query takes a set of devices (by ID, site, vendor, or all),
+    and collects the same data from each of them
+    For example, all address objects, or all GP sessions
+
+Devices are queried concurrently, so the whole query takes about as long
+    as the slowest device, rather than the sum of all of them
+    Each vendor and device has a limit on the number of calls at once
+    These are shared with other fan-outs (see concurrency.py)
+
+Results are returned as each device completes
+    One device failing does not stop the others
+
+Classes:
+    FleetQuery
+        Collects results from a set of devices concurrently
+
+Functions:
+    select_devices
+        Find the devices that match a set of filters
+'''
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from colorama import Fore, Style
+
+import time
+import typing as t
+
+from concurrency import MAX_WORKERS, concurrency
+
+
+def select_devices(
+    devices: list,
+    ids: list = None,
+    site: str = None,
+    vendor: str = None,
+) -> list:
+    '''
+    Find the devices that match a set of filters
+        Filters are combined, and no filters means all devices
+
+    Args:
+        devices (list): All the Device objects
+        ids (list): Only include devices with these IDs
+        site (str): Only include devices at this site (ID or name)
+        vendor (str): Only include devices from this vendor
+
+    Returns:
+        list: The matching Device objects
+    '''
+
+    selected = []
+    for device in devices:
+        if ids and str(device.id) not in ids:
+            continue
+
+        if site and site not in (str(device.site), device.site_name):
+            continue
+
+        if vendor and device.vendor != vendor:
+            continue
+
+        selected.append(device)
+
+    return selected
+
+
+class FleetQuery:
+    '''
+    Collects results from a set of devices concurrently
+
+    The work for each device is done by a 'collect' function
+        This takes a device, and returns a tuple of (success, data)
+
+    Methods:
+        __init__: Constructor for the FleetQuery class
+        run: Query all devices, and yield results as they complete
+        _query_device: Query a single device, within its limits
+    '''
+
+    def __init__(
+        self,
+        devices: list,
+        collect: t.Callable[[t.Any], tuple[bool, t.Any]],
+    ) -> None:
+        '''
+        Constructor for the FleetQuery class
+
+        Args:
+            devices (list): The Device objects to query
+            collect (Callable): Collects the data from a single device
+        '''
+
+        self.devices = devices
+        self.collect = collect
+
+    def run(
+        self
+    ) -> t.Iterator[dict]:
+        '''
+        Query all devices, and yield results as they complete
+
+        Yields:
+            dict: The result for each device, in the order they complete
+                A final summary is yielded once all devices are done
+        '''
+
+        start = time.monotonic()
+        succeeded = 0
+        failed = 0
+
+        if self.devices:
+            # The shared limits decide how many of these run at once
+            workers = min(MAX_WORKERS, len(self.devices))
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self._query_device, device)
+                    for device in self.devices
+                ]
+
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result['result'] == 'Success':
+                        succeeded += 1
+                    else:
+                        failed += 1
+                    yield result
+
+        yield {
+            "summary": {
+                "devices": len(self.devices),
+                "succeeded": succeeded,
+                "failed": failed,
+                "elapsed": round(time.monotonic() - start, 3),
+            }
+        }
+
+    def _query_device(
+        self,
+        device,
+    ) -> dict:
+        '''
+        Query a single device, within its limits
+            Errors are caught, so they're reported with the device
+
+        Args:
+            device (Device): The device to query
+
+        Returns:
+            dict: The result for this device
+        '''
+
+        result = {
+            "id": str(device.id),
+            "name": device.name,
+            "site": device.site_name,
+            "vendor": device.vendor,
+        }
+
+        with concurrency.slot(device.vendor, device.id) as slot:
+            start = time.monotonic()
+            try:
+                success, data = self.collect(device)
+
+            except Exception as e:
+                print(
+                    Fore.RED,
+                    f"Fleet query failed for device '{device.name}'.",
+                    Style.RESET_ALL
+                )
+                print(e)
+                success, data = False, str(e)
+
+            slot.ok = success
+            result["elapsed"] = round(time.monotonic() - start, 3)
+
+        if success:
+            result["result"] = "Success"
+            result["count"] = len(data) if isinstance(data, list) else 0
+            result["items"] = data
+        else:
+            result["result"] = "Failure"
+            result["message"] = data
+
+        return result
@@ -0,0 +1,736 @@
+'''
+Keep a history of GlobalProtect logins, and of concurrent users
+
+The sessions across every gateway (see gpsessions.py) are snapshotted
+    each time the gateways are polled
+
+Only changes are written to the database
+    Each snapshot is compared to the last one. New sessions are written
+    as logins, and sessions that have gone are written as logouts
+    Rows are written in bulk (many rows per INSERT, in one transaction)
+    If the database is unavailable, rows are kept and written later
+
+Concurrent users are rolled up into time buckets as they're snapshotted
+    Every 5 minutes, hour and day, for each gateway and region, and for
+    all of them together ('*')
+    Each bucket has the peak and average number of users
+    A bucket is written when it ends, so each one is written once
+
+Trend queries read the rollups, not the logins
+    The resolution is picked so a query returns at most a few hundred
+    rows, so months of history are as fast as a day
+    Rollups are keyed by resolution, gateway, region and time, so each
+    query is a single range read
+
+Only one worker process records the history
+    The first worker to lock a shared file does the recording
+    The last snapshot and the open buckets are saved to a file, so a
+    restart doesn't write every session as a new login
+
+Times are stored in UTC
+
+Classes:
+    GpHistory
+        Records and reads the GlobalProtect session history
+
+Misc Variables:
+    gp_history
+        The shared GpHistory object
+'''
+
+from colorama import Fore, Style
+from datetime import datetime, timezone
+
+import copy
+import os
+import random
+import threading
+import time
+import typing as t
+
+from gpsessions import GpSessionIndex, gp_sessions, session_key
+from scheduler import INTERVALS
+from settings import config
+from sql import SqlServer
+from state import STATE_DIR, SharedJsonFile, leader_lock
+
+
+# Tables for logins and logouts, and for rollups
+EVENTS_TABLE = 'gp_events'
+ROLLUPS_TABLE = 'gp_rollups'
+
+# Columns in the tables (rows are clustered by time, for range reads)
+EVENT_FIELDS = {
+    'id': 'BIGINT IDENTITY(1,1) NOT NULL',
+    'event_time': 'DATETIME2(0) NOT NULL',
+    'event': 'VARCHAR(8) NOT NULL',
+    'gateway_id': 'VARCHAR(64) NOT NULL',
+    'name': 'NVARCHAR(255)',
+    'username': 'NVARCHAR(255)',
+    'host': 'NVARCHAR(255)',
+    'region': 'VARCHAR(64)',
+    'inside_ip': 'VARCHAR(45)',
+    'outside_ip': 'VARCHAR(45)',
+    'client': 'NVARCHAR(255)',
+    'PRIMARY KEY CLUSTERED': '(event_time, id)',
+}
+ROLLUP_FIELDS = {
+    'resolution': 'INT NOT NULL',
+    'gateway_id': 'VARCHAR(64) NOT NULL',
+    'region': 'VARCHAR(64) NOT NULL',
+    'bucket': 'DATETIME2(0) NOT NULL',
+    'peak': 'INT NOT NULL',
+    'average': 'FLOAT NOT NULL',
+    'samples': 'INT NOT NULL',
+    'PRIMARY KEY CLUSTERED': '(resolution, gateway_id, region, bucket)',
+}
+
+# Session fields written with each login and logout
+EVENT_COLUMNS = (
+    'name', 'username', 'host', 'region', 'inside_ip', 'outside_ip',
+    'client',
+)
+
+# Rollup resolutions (seconds), and how long each is kept (days)
+#   Daily rollups are kept forever
+RESOLUTIONS = {
+    300: 14,
+    3600: 180,
+    86400: None,
+}
+
+# How long logins and logouts are kept (days)
+EVENT_RETENTION = 365
+
+# The most points a trend query returns (picks the resolution)
+MAX_POINTS = 500
+
+# The most logins and logouts a query returns
+MAX_EVENTS = 10000
+
+# The most rows kept while the database is unavailable
+MAX_PENDING = 100000
+
+# Means every gateway, or every region, in the rollups
+ALL = '*'
+
+# Files for the last snapshot, and for choosing the recording worker
+STATE_FILE = os.path.join(STATE_DIR, 'gp_history.json')
+LOCK_FILE = os.path.join(STATE_DIR, 'gp_history.lock')
+
+
+def _utc(
+    epoch: float,
+) -> datetime:
+    '''
+    Convert epoch seconds to a UTC time, as stored in the database
+
+    Args:
+        epoch (float): Seconds since the epoch
+
+    Returns:
+        datetime: The time in UTC (without a timezone)
+    '''
+
+    return datetime.fromtimestamp(
+        int(epoch),
+        timezone.utc,
+    ).replace(tzinfo=None)
+
+
+def _sql(
+    table: str,
+) -> SqlServer:
+    '''
+    Create an SQL connection to a history table
+
+    Args:
+        table (str): The table name
+
+    Returns:
+        SqlServer: The connection (use it with 'with')
+    '''
+
+    return SqlServer(
+        server=config.sql_server,
+        database=config.sql_database,
+        table=table,
+        config=config,
+    )
+
+
+class GpHistory:
+    '''
+    Records and reads the GlobalProtect session history
+
+    Methods:
+        __init__: Create a recorder, with no history loaded yet
+        snapshot: Record the changes since the last snapshot
+        _event: Build a login or logout row
+        _sample: Add a sample of concurrent users to the open buckets
+        _flush: Write pending rows to the database
+        _ensure_tables: Create the tables, if they don't exist
+        prune: Delete history that is older than its retention
+        trend: Get concurrent users over time, from the rollups
+        events: Get logins and logouts
+        _read_state: Read the saved snapshot and open buckets
+        _load: Load the last snapshot and open buckets
+        _save: Save the last snapshot and open buckets
+        start: Record the history in the background
+    '''
+
+    def __init__(
+        self,
+        path: str = STATE_FILE,
+        lock_path: str = LOCK_FILE,
+    ) -> None:
+        '''
+        Create a recorder, with no history loaded yet
+
+        Args:
+            path (str): The file for the last snapshot and open buckets
+            lock_path (str): The file that picks the recording worker
+        '''
+
+        self._state = SharedJsonFile(path)
+        self.lock_path = lock_path
+        self._lock = threading.Lock()
+
+        # The last snapshot: gateway IDs, to session keys, to sessions
+        self._sessions = None
+
+        # The open buckets for each resolution
+        #   start (float): When the bucket started (epoch seconds)
+        #   samples (int): Snapshots in the bucket
+        #   counts (dict): 'gateway|region', to [total, peak]
+        self._buckets = {}
+
+        # Rows waiting to be written
+        self._events = []
+        self._rollups = []
+
+        self._tables = False
+        self._pruned = 0.0
+        self._thread = None
+
+    def snapshot(
+        self,
+        index: GpSessionIndex,
+        now: float = None,
+    ) -> dict:
+        '''
+        Record the changes since the last snapshot
+            Gateways without recent sessions (stale) are skipped, so
+            their sessions aren't written as logouts
+
+        Args:
+            index (GpSessionIndex): The current sessions
+            now (float): The time of the snapshot (epoch seconds)
+
+        Returns:
+            dict: What was recorded
+                logins (int): New sessions
+                logouts (int): Sessions that have gone
+                rollups (int): Closed buckets, as rows
+                pending (int): Rows not yet written to the database
+        '''
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            if self._sessions is None:
+                self._load()
+
+            # Each gateway's sessions, keyed by user, host and login time
+            current = {device_id: {} for device_id in index.gateways}
+            for entry in index.sessions:
+                current[entry['gateway_id']][session_key(entry)] = entry
+
+            # Compare each gateway to the last snapshot
+            logins = logouts = 0
+            for device_id, sessions in current.items():
+                previous = self._sessions.get(device_id, {})
+                for key, entry in sessions.items():
+                    if key not in previous:
+                        logins += 1
+                        self._events.append(
+                            self._event('login', device_id, entry, now)
+                        )
+
+                for key, entry in previous.items():
+                    if key not in sessions:
+                        logouts += 1
+                        self._events.append(
+                            self._event('logout', device_id, entry, now)
+                        )
+
+            # Only keep what's needed to compare the next snapshot
+            self._sessions.update(
+                {
+                    device_id: {
+                        key: {
+                            column: entry[column]
+                            for column in EVENT_COLUMNS + ('login_utc',)
+                        }
+                        for key, entry in sessions.items()
+                    }
+                    for device_id, sessions in current.items()
+                }
+            )
+
+            rollups = self._sample(index, now)
+            self._flush()
+            self._save()
+
+            return {
+                'logins': logins,
+                'logouts': logouts,
+                'rollups': rollups,
+                'pending': len(self._events) + len(self._rollups),
+            }
+
+    @staticmethod
+    def _event(
+        event: str,
+        device_id: str,
+        entry: dict,
+        now: float,
+    ) -> dict:
+        '''
+        Build a login or logout row
+
+        Args:
+            event (str): 'login' or 'logout'
+            device_id (str): The gateway's device ID
+            entry (dict): The session
+            now (float): The time of the snapshot
+
+        Returns:
+            dict: The row
+                Logins use the session's login time, if it's known
+        '''
+
+        when = now
+        if event == 'login' and entry.get('login_utc'):
+            when = entry['login_utc']
+
+        row = {
+            'event_time': _utc(when),
+            'event': event,
+            'gateway_id': device_id,
+        }
+        row.update({column: entry[column] for column in EVENT_COLUMNS})
+
+        return row
+
+    def _sample(
+        self,
+        index: GpSessionIndex,
+        now: float,
+    ) -> int:
+        '''
+        Add a sample of concurrent users to the open buckets
+            Buckets that have ended are queued to be written
+            The caller must hold the lock
+
+        Args:
+            index (GpSessionIndex): The current sessions
+            now (float): The time of the snapshot
+
+        Returns:
+            int: Rows queued from buckets that have ended
+        '''
+
+        # Users for each gateway and region, and for all of them
+        users = {}
+        for entry in index.sessions:
+            for gateway in (entry['gateway_id'], ALL):
+                for region in (entry['region'], ALL):
+                    users.setdefault(f"{gateway}|{region}", set()).add(
+                        entry['name'].lower()
+                    )
+        for device_id in index.gateways:
+            users.setdefault(f"{device_id}|{ALL}", set())
+        users.setdefault(f"{ALL}|{ALL}", set())
+
+        queued = 0
+        for resolution in RESOLUTIONS:
+            start = now - now % resolution
+            bucket = self._buckets.get(str(resolution))
+
+            # Queue the bucket that has ended
+            if bucket is not None and bucket['start'] != start:
+                for key, (total, peak) in bucket['counts'].items():
+                    gateway, region = key.split('|', 1)
+                    self._rollups.append(
+                        {
+                            'resolution': resolution,
+                            'gateway_id': gateway,
+                            'region': region,
+                            'bucket': _utc(bucket['start']),
+                            'peak': peak,
+                            'average': round(total / bucket['samples'], 2),
+                            'samples': bucket['samples'],
+                        }
+                    )
+                    queued += 1
+                bucket = None
+
+            if bucket is None:
+                bucket = self._buckets[str(resolution)] = {
+                    'start': start,
+                    'samples': 0,
+                    'counts': {},
+                }
+
+            bucket['samples'] += 1
+            for key, names in users.items():
+                counts = bucket['counts'].setdefault(key, [0, 0])
+                counts[0] += len(names)
+                counts[1] = max(counts[1], len(names))
+
+        return queued
+
+    def _flush(
+        self
+    ) -> None:
+        '''
+        Write pending rows to the database
+            Rows that fail are kept, and tried again next time
+            The caller must hold the lock
+        '''
+
+        if not (self._events or self._rollups) or not self._ensure_tables():
+            return
+
+        for table, rows in (
+            (EVENTS_TABLE, self._events),
+            (ROLLUPS_TABLE, self._rollups),
+        ):
+            if not rows:
+                continue
+
+            with _sql(table) as sql:
+                if sql.cursor is not None and sql.add_many(rows):
+                    rows.clear()
+
+            # Drop the oldest rows if the database has been down too long
+            if len(rows) > MAX_PENDING:
+                print(
+                    Fore.RED,
+                    f"Dropping {len(rows) - MAX_PENDING} GlobalProtect "
+                    "history rows",
+                    Style.RESET_ALL
+                )
+                del rows[:len(rows) - MAX_PENDING]
+
+    def _ensure_tables(
+        self
+    ) -> bool:
+        '''
+        Create the tables, if they don't exist
+
+        Returns:
+            bool: True if the tables are ready
+        '''
+
+        if self._tables:
+            return True
+
+        for table, fields in (
+            (EVENTS_TABLE, EVENT_FIELDS),
+            (ROLLUPS_TABLE, ROLLUP_FIELDS),
+        ):
+            with _sql(table) as sql:
+                if sql.cursor is None:
+                    return False
+                if not sql.table_exists() and not sql.create_table(fields):
+                    return False
+
+        self._tables = True
+        return True
+
+    def prune(
+        self,
+        now: float = None,
+    ) -> None:
+        '''
+        Delete history that is older than its retention
+
+        Args:
+            now (float): The current time (epoch seconds)
+        '''
+
+        now = time.time() if now is None else now
+        if not self._ensure_tables():
+            return
+
+        with _sql(ROLLUPS_TABLE) as sql:
+            for resolution, days in RESOLUTIONS.items():
+                if days is not None:
+                    sql.delete_before(
+                        'bucket',
+                        _utc(now - days * 86400),
+                        {'resolution': resolution},
+                    )
+
+        with _sql(EVENTS_TABLE) as sql:
+            sql.delete_before(
+                'event_time',
+                _utc(now - EVENT_RETENTION * 86400),
+            )
+
+    def trend(
+        self,
+        start: datetime,
+        end: datetime,
+        gateway: str = ALL,
+        region: str = ALL,
+        resolution: int = None,
+    ) -> dict:
+        '''
+        Get concurrent users over time, from the rollups
+            Buckets that are still open are included at the end
+
+        Args:
+            start (datetime): The start of the range (UTC)
+            end (datetime): The end of the range (UTC)
+            gateway (str): A gateway's device ID, or '*' for all
+            region (str): A region, or '*' for all
+            resolution (int): Seconds per point
+                None to pick one that gives at most MAX_POINTS points
+
+        Raises:
+            ValueError: If the range or resolution is invalid
+            RuntimeError: If the database can't be read
+
+        Returns:
+            dict: The trend
+                resolution (int): Seconds per point
+                gateway (str): The gateway
+                region (str): The region
+                points (list): Each bucket, in time order
+                    time (str): The start of the bucket (UTC)
+                    peak (int): The most users at once
+                    average (float): The average users
+                    samples (int): Snapshots in the bucket
+        '''
+
+        if end <= start:
+            raise ValueError('The end must be after the start')
+
+        span = (end - start).total_seconds()
+        if resolution is None:
+            resolution = next(
+                (
+                    seconds for seconds in sorted(RESOLUTIONS)
+                    if span / seconds <= MAX_POINTS
+                ),
+                max(RESOLUTIONS),
+            )
+        elif resolution not in RESOLUTIONS:
+            raise ValueError(
+                f"The resolution must be one of {sorted(RESOLUTIONS)}"
+            )
+
+        with _sql(ROLLUPS_TABLE) as sql:
+            rows = sql.read_range(
+                'bucket',
+                start,
+                end,
+                ['bucket', 'peak', 'average', 'samples'],
+                {
+                    'resolution': resolution,
+                    'gateway_id': gateway,
+                    'region': region,
+                },
+            ) if sql.cursor is not None else False
+
+        if rows is False:
+            raise RuntimeError('Could not read the GlobalProtect history')
+
+        points = [
+            {
+                'time': bucket.isoformat(),
+                'peak': peak,
+                'average': average,
+                'samples': samples,
+            }
+            for bucket, peak, average, samples in rows
+        ]
+
+        # The open bucket, as saved by the recording worker
+        bucket = self._read_state().get('buckets', {}).get(str(resolution))
+        if bucket is not None:
+            counts = bucket['counts'].get(f"{gateway}|{region}")
+            opened = _utc(bucket['start'])
+            if counts is not None and start <= opened < end:
+                points.append(
+                    {
+                        'time': opened.isoformat(),
+                        'peak': counts[1],
+                        'average': round(counts[0] / bucket['samples'], 2),
+                        'samples': bucket['samples'],
+                    }
+                )
+
+        return {
+            'resolution': resolution,
+            'gateway': gateway,
+            'region': region,
+            'points': points,
+        }
+
+    def events(
+        self,
+        start: datetime,
+        end: datetime,
+        user: str = None,
+        gateway: str = None,
+    ) -> list:
+        '''
+        Get logins and logouts, newest first
+
+        Args:
+            start (datetime): The start of the range (UTC)
+            end (datetime): The end of the range (UTC)
+            user (str): Only this user (display name)
+            gateway (str): Only this gateway's device ID
+
+        Raises:
+            RuntimeError: If the database can't be read
+
+        Returns:
+            list: Up to MAX_EVENTS logins and logouts
+        '''
+
+        filters = {}
+        if user:
+            filters['name'] = user
+        if gateway:
+            filters['gateway_id'] = gateway
+
+        columns = ['event_time', 'event', 'gateway_id'] + list(EVENT_COLUMNS)
+        with _sql(EVENTS_TABLE) as sql:
+            rows = sql.read_range(
+                'event_time',
+                start,
+                end,
+                columns,
+                filters,
+                limit=MAX_EVENTS,
+                newest=True,
+            ) if sql.cursor is not None else False
+
+        if rows is False:
+            raise RuntimeError('Could not read the GlobalProtect history')
+
+        events = []
+        for row in rows:
+            event = dict(zip(columns, row))
+            event['event_time'] = event['event_time'].isoformat()
+            events.append(event)
+
+        return events
+
+    def _read_state(
+        self
+    ) -> dict:
+        '''
+        Read the saved snapshot and open buckets
+
+        Returns:
+            dict: The saved state (empty if there isn't any)
+        '''
+
+        self._state.read()
+        return self._state.data
+
+    def _load(
+        self
+    ) -> None:
+        '''
+        Load the last snapshot and open buckets
+            They're copied, as they're changed in place, and the saved
+            state is also read by trend queries
+            The caller must hold the lock
+        '''
+
+        state = copy.deepcopy(self._read_state())
+        self._sessions = state.get('sessions', {})
+        self._buckets = state.get('buckets', {})
+
+    def _save(
+        self
+    ) -> None:
+        '''
+        Save the last snapshot and open buckets
+            The file is replaced in one step, so readers never see part
+            The caller must hold the lock
+        '''
+
+        try:
+            self._state.write(
+                {
+                    'sessions': self._sessions,
+                    'buckets': self._buckets,
+                }
+            )
+
+        except (OSError, TypeError) as e:
+            print(
+                Fore.RED,
+                'Could not save the GlobalProtect history state',
+                Style.RESET_ALL
+            )
+            print(e)
+
+    def start(
+        self,
+        devices: t.Callable[[], t.Iterable],
+        interval: int = INTERVALS['gp'],
+    ) -> None:
+        '''
+        Record the history in the background
+            Each worker tries to become the recorder, so if it exits,
+            another takes over
+
+        Args:
+            devices (Callable): Returns the current Device objects
+            interval (int): Seconds between snapshots
+        '''
+
+        if self._thread is not None:
+            return
+
+        def run():
+            # Wait for the first polls, and don't start all at once
+            time.sleep(interval + random.uniform(0, interval))
+            while True:
+                try:
+                    if leader_lock(self.lock_path):
+                        self.snapshot(gp_sessions.index(devices()))
+                        if time.time() - self._pruned > 86400:
+                            self.prune()
+                            self._pruned = time.time()
+
+                except Exception as e:
+                    print(
+                        Fore.RED,
+                        'GlobalProtect history failed',
+                        Style.RESET_ALL
+                    )
+                    print(e)
+
+                time.sleep(interval)
+
+        self._thread = threading.Thread(
+            target=run,
+            name='gp-history',
+            daemon=True,
+        )
+        self._thread.start()
+
+
+# The shared GlobalProtect history recorder
+gp_history = GpHistory()
@@ -0,0 +1,539 @@
+'''
+Aggregate GlobalProtect sessions from every gateway
+
+Answers "where is user X connected?" and "who has IP Y?" across all
+    gateways at once, from memory, without calling the devices
+
+Sessions come from the background poller (see scheduler.py)
+    Every Palo Alto device's sessions are polled on a schedule, within
+    the shared concurrency limits. This only reads the results
+
+Every worker serves the same sessions
+    Only one worker polls, and the others read its results from the
+    shared state file (see scheduler.py), so each worker indexes the
+    same sessions
+
+The sessions are indexed when they change
+    By user (display name and primary username), virtual IP, public IP,
+    region and gateway, so lookups don't scan every session
+    Users are de-duplicated across gateways (eg, a user that roamed
+    and still has an old session on another gateway)
+    Sorted orders are built the first time they're needed
+
+Classes:
+    GpSessionIndex
+        The sessions from every gateway, with indexes
+    GpAggregator
+        Combines each gateway's sessions
+
+Functions:
+    clean_session
+        Rename the fields of a session from the API
+    session_key
+        Identify a session, so it can be compared between polls
+
+Misc Variables:
+    gp_sessions
+        The shared GpAggregator object
+'''
+
+import base64
+import hashlib
+import threading
+import time
+import typing as t
+
+from scheduler import STALE_AFTER, device_state, poll_scheduler
+
+
+# Session fields, and the API fields they come from
+SESSION_FIELDS = {
+    'name': 'username',
+    'username': 'primary-username',
+    'region': 'source-region',
+    'computer': 'computer',
+    'client': 'client',
+    'vpn_type': 'vpn-type',
+    'host': 'host-id',
+    'version': 'app-version',
+    'inside_ip': 'virtual-ip',
+    'outside_ip': 'public-ip',
+    'tunnel_type': 'tunnel-type',
+    'login': 'login-time',
+}
+
+# Indexed fields, and the session fields each one looks in
+INDEXES = {
+    'user': ('name', 'username'),
+    'ip': ('inside_ip', 'outside_ip'),
+    'inside_ip': ('inside_ip',),
+    'outside_ip': ('outside_ip',),
+    'region': ('region',),
+    'gateway': ('gateway', 'gateway_id'),
+}
+
+# Seconds between checks for new sessions
+MIN_REFRESH = 2
+
+
+def clean_session(
+    session: dict,
+) -> dict:
+    '''
+    Rename the fields of a session from the API
+        Missing fields are 'None', as the web pages expect
+
+    Args:
+        session (dict): A session, as returned by get_gp_sessions()
+
+    Returns:
+        dict: The session, with friendly field names
+    '''
+
+    entry = {
+        field: session.get(source) or 'None'
+        for field, source in SESSION_FIELDS.items()
+    }
+
+    # The login time in UTC (epoch seconds), for sorting
+    try:
+        entry['login_utc'] = int(session.get('login-time-utc'))
+    except (TypeError, ValueError):
+        entry['login_utc'] = None
+
+    return entry
+
+
+def session_key(
+    entry: dict,
+) -> str:
+    '''
+    Identify a session, so it can be compared between polls
+        The same user, host and login time is the same session
+
+    Args:
+        entry (dict): A session, from clean_session()
+
+    Returns:
+        str: The key
+    '''
+
+    return '|'.join(
+        (
+            entry['name'].lower(),
+            entry['host'],
+            str(entry['login_utc'] or entry['login']),
+        )
+    )
+
+
+class GpSessionIndex:
+    '''
+    The sessions from every gateway, with indexes
+
+    Methods:
+        __init__: Combine and index the sessions
+        __len__: Get the number of sessions
+        query: Filter, sort and paginate the sessions
+        _order: Get the order of sessions when sorted by a field
+        user_list: Get each user, with the gateways they're on
+        summary: Count the sessions and users
+    '''
+
+    def __init__(
+        self,
+        gateways: dict,
+        stale: list = None,
+    ) -> None:
+        '''
+        Combine and index the sessions
+
+        Args:
+            gateways (dict): Device IDs, to dicts of:
+                name (str): The gateway name
+                updated (float): When it was polled (epoch seconds)
+                sessions (list): Sessions, from get_gp_sessions()
+            stale (list): Gateways with no recent sessions
+        '''
+
+        self.gateways = gateways
+        self.stale = stale or []
+        self.created = time.time()
+
+        # The version changes when any gateway is polled again
+        self.version = hashlib.sha1(
+            repr(
+                sorted(
+                    (device_id, gateway['updated'])
+                    for device_id, gateway in gateways.items()
+                )
+            ).encode()
+        ).hexdigest()[:16]
+
+        # Every session, with the gateway it's on, sorted by name
+        self.sessions = []
+        for device_id, gateway in gateways.items():
+            for session in gateway['sessions']:
+                entry = clean_session(session)
+                entry['gateway'] = gateway['name']
+                entry['gateway_id'] = device_id
+                self.sessions.append(entry)
+        self.sessions.sort(key=lambda entry: entry['name'].lower())
+
+        # Lowercase values, to the positions of the sessions with them
+        self._indexes = {name: {} for name in INDEXES}
+        for position, entry in enumerate(self.sessions):
+            for name, fields in INDEXES.items():
+                for value in {
+                    str(entry[field]).lower() for field in fields
+                }:
+                    self._indexes[name].setdefault(value, []).append(
+                        position
+                    )
+
+        # Each user, once, with every gateway they're connected to
+        self.users = {}
+        for entry in self.sessions:
+            user = self.users.setdefault(
+                entry['name'].lower(),
+                {
+                    'name': entry['name'],
+                    'username': entry['username'],
+                    'gateways': [],
+                    'sessions': 0,
+                },
+            )
+            user['sessions'] += 1
+            if entry['gateway'] not in user['gateways']:
+                user['gateways'].append(entry['gateway'])
+
+        # Sorted orders, built when they're first needed
+        self._orders = {}
+
+    def __len__(
+        self
+    ) -> int:
+        '''
+        Get the number of sessions
+
+        Returns:
+            int: Number of sessions
+        '''
+
+        return len(self.sessions)
+
+    def query(
+        self,
+        user: str = None,
+        ip: str = None,
+        region: str = None,
+        gateway: str = None,
+        sort: str = None,
+        order: str = 'asc',
+        limit: int = None,
+        cursor: str = None,
+    ) -> dict:
+        '''
+        Filter, sort and paginate the sessions
+            Filters match whole values, and ignore case
+
+        Args:
+            user (str): Only sessions for this user (name or username)
+            ip (str): Only sessions with this virtual or public IP
+            region (str): Only sessions from this region
+            gateway (str): Only sessions on this gateway (name or ID)
+            sort (str): The field to sort by (default is the name)
+            order (str): 'asc' or 'desc'
+            limit (int): The maximum number of sessions to return
+            cursor (str): The cursor from the previous page
+
+        Raises:
+            ValueError: If the cursor or sort field is invalid
+
+        Returns:
+            dict: The page of results
+                total (int): Number of sessions that match the filters
+                count (int): Number of sessions in this page
+                cursor (str): The cursor for the next page (None if done)
+                version (str): The version of the sessions
+                items (list): The sessions in this page
+        '''
+
+        # Work out where to start from the cursor
+        offset = 0
+        if cursor:
+            try:
+                version, offset = base64.urlsafe_b64decode(
+                    cursor.encode()
+                ).decode().split(':')
+                offset = int(offset)
+            except Exception:
+                raise ValueError('Invalid cursor')
+
+            if version != self.version:
+                raise ValueError('The sessions have changed, cursor expired')
+
+        # Find candidate sessions with the indexes
+        candidates = None
+        for name, value in (
+            ('user', user),
+            ('ip', ip),
+            ('region', region),
+            ('gateway', gateway),
+        ):
+            if not value:
+                continue
+
+            matches = set(self._indexes[name].get(value.lower(), ()))
+            candidates = (
+                matches if candidates is None else candidates & matches
+            )
+
+        # Sort the sessions, and filter by the candidates
+        ordered = self._order(sort) if sort else range(len(self.sessions))
+        if order == 'desc':
+            ordered = reversed(ordered)
+
+        if candidates is not None:
+            ordered = [index for index in ordered if index in candidates]
+        else:
+            ordered = list(ordered)
+
+        # Paginate
+        total = len(ordered)
+        end = total if limit is None else min(offset + limit, total)
+        page = [self.sessions[index] for index in ordered[offset:end]]
+
+        next_cursor = None
+        if end < total:
+            next_cursor = base64.urlsafe_b64encode(
+                f'{self.version}:{end}'.encode()
+            ).decode()
+
+        return {
+            'total': total,
+            'count': len(page),
+            'cursor': next_cursor,
+            'version': self.version,
+            'items': page,
+        }
+
+    def _order(
+        self,
+        field: str,
+    ) -> list:
+        '''
+        Get the order of sessions when sorted by a field
+            'login' is sorted by the UTC login time
+
+        Args:
+            field (str): The field to sort by
+
+        Raises:
+            ValueError: If the field is unknown
+
+        Returns:
+            list: Session positions, in sorted order
+        '''
+
+        if field not in SESSION_FIELDS and field != 'gateway':
+            raise ValueError(f"Unknown sort field '{field}'")
+
+        if field not in self._orders:
+            if field == 'login':
+                def key(index):
+                    return self.sessions[index]['login_utc'] or 0
+            else:
+                def key(index):
+                    return str(self.sessions[index][field]).lower()
+
+            self._orders[field] = sorted(range(len(self.sessions)), key=key)
+
+        return self._orders[field]
+
+    def user_list(
+        self,
+        roaming: bool = False,
+    ) -> list:
+        '''
+        Get each user, with the gateways they're on
+
+        Args:
+            roaming (bool): Only users on more than one gateway
+
+        Returns:
+            list: Users, sorted by name
+                name (str): The display name
+                username (str): The primary username
+                gateways (list): The gateways they're connected to
+                sessions (int): Their number of sessions
+        '''
+
+        return [
+            user for _, user in sorted(self.users.items())
+            if not roaming or len(user['gateways']) > 1
+        ]
+
+    def summary(
+        self
+    ) -> dict:
+        '''
+        Count the sessions and users
+
+        Returns:
+            dict: The counts
+                sessions (int): Number of sessions
+                users (int): Number of users (each counted once)
+                roaming (int): Users on more than one gateway
+                gateways (dict): Gateway names, to their session counts
+                regions (dict): Regions, to their session counts
+                clients (dict): Client OS, to their session counts
+                stale (list): Gateways with no recent sessions
+                oldest (float): Age of the oldest gateway's sessions
+                version (str): The version of the sessions
+        '''
+
+        counts = {'gateway': {}, 'region': {}, 'client': {}}
+        for entry in self.sessions:
+            for field, totals in counts.items():
+                totals[entry[field]] = totals.get(entry[field], 0) + 1
+
+        # Gateways with no sessions are listed too
+        gateways = {gateway['name']: 0 for gateway in self.gateways.values()}
+        gateways.update(counts['gateway'])
+
+        updated = [gateway['updated'] for gateway in self.gateways.values()]
+
+        return {
+            'sessions': len(self.sessions),
+            'users': len(self.users),
+            'roaming': len(self.user_list(roaming=True)),
+            'gateways': gateways,
+            'regions': dict(
+                sorted(counts['region'].items(), key=lambda x: -x[1])
+            ),
+            'clients': dict(
+                sorted(counts['client'].items(), key=lambda x: -x[1])
+            ),
+            'stale': self.stale,
+            'oldest': (
+                round(time.time() - min(updated), 1) if updated else None
+            ),
+            'version': self.version,
+        }
+
+
+class GpAggregator:
+    '''
+    Combines each gateway's sessions
+
+    Methods:
+        __init__: Create an aggregator with no sessions yet
+        index: Get the current sessions, with indexes
+        _polled: Get the latest sessions of each gateway
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Create an aggregator with no sessions yet
+        '''
+
+        self._lock = threading.Lock()
+
+        # The current index, and when new sessions were last checked
+        self._index = None
+        self._key = None
+        self._checked = 0.0
+
+    def index(
+        self,
+        devices: t.Iterable,
+    ) -> GpSessionIndex:
+        '''
+        Get the current sessions, with indexes
+            The index is only rebuilt when a gateway has new sessions
+
+        Args:
+            devices (Iterable): Device objects (Palo Alto devices are
+                the gateways)
+
+        Returns:
+            GpSessionIndex: The sessions
+        '''
+
+        with self._lock:
+            now = time.time()
+            if (
+                self._index is not None and
+                now - self._checked < MIN_REFRESH
+            ):
+                return self._index
+            self._checked = now
+
+            gateways = {
+                str(device.id): device.name for device in devices
+                if device.vendor == 'paloalto'
+            }
+
+            # Use each gateway's sessions, if they're recent
+            polled = self._polled(gateways)
+            current = {}
+            stale = []
+            for device_id, name in gateways.items():
+                entry = polled.get(device_id)
+                max_age = poll_scheduler.interval(device_id, 'gp')
+                if entry is None or (
+                    now - entry['updated'] > max_age * STALE_AFTER
+                ):
+                    stale.append(name)
+                    continue
+
+                current[device_id] = dict(entry, name=name)
+
+            # Only rebuild the index if the sessions have changed
+            key = sorted(
+                (device_id, entry['updated'], entry['name'])
+                for device_id, entry in current.items()
+            )
+            if key != self._key or self._index is None:
+                self._index = GpSessionIndex(current, stale)
+                self._key = key
+            else:
+                self._index.stale = stale
+
+            return self._index
+
+    def _polled(
+        self,
+        gateways: dict,
+    ) -> dict:
+        '''
+        Get the latest sessions of each gateway
+            These are the polling worker's results, so they're the same
+            in every worker
+
+        Args:
+            gateways (dict): Device IDs, to names
+
+        Returns:
+            dict: Device IDs, to dicts of 'updated' and 'sessions'
+        '''
+
+        polled = {}
+        for device_id in gateways:
+            entry = device_state.get(device_id, 'gp')
+            if entry is None or entry['value'] is None:
+                continue
+
+            polled[device_id] = {
+                'updated': entry['updated'],
+                'sessions': entry['value'],
+            }
+
+        return polled
+
+
+# The shared GlobalProtect session aggregator
+gp_sessions = GpAggregator()
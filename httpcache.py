@@ -0,0 +1,259 @@
+'''
+HTTP caching and compression for API responses
+
+ETags:
+    Responses get a strong ETag, based on the version of the data
+    If the browser sends a matching 'If-None-Match' header,
+        a '304 Not Modified' is returned without a body
+    Where the version is known before the response is built
+        (such as cached datasets), this is checked first, so the
+        response never needs to be serialized
+
+Compression:
+    Responses are compressed with brotli or gzip,
+        based on the browser's 'Accept-Encoding' header
+    Brotli is only used if the 'brotli' module is installed
+    Streamed responses (such as large lists) are compressed as they are sent
+
+Functions:
+    make_etag
+        Build an ETag from one or more values
+    not_modified
+        Return a 304 response if the browser already has this version
+    select_encoding
+        Pick the best encoding the browser supports
+    compress_stream
+        Compress a streamed response as it is sent
+    finalize_response
+        Add ETags and compression to a response (after request hook)
+'''
+
+from flask import request, Response
+
+import gzip
+import hashlib
+import typing as t
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 500
+
+# Types of responses that are compressed
+COMPRESS_MIMETYPES = (
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'text/xml',
+    'text/plain',
+    'text/html',
+)
+
+# Content encodings, in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def make_etag(
+    *parts,
+) -> str:
+    '''
+    Build an ETag from one or more values
+        For example, a dataset version and the query string
+
+    Args:
+        parts: The values that identify this version of the response
+
+    Returns:
+        str: The ETag (without quotes)
+    '''
+
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, bytes):
+            digest.update(part)
+        else:
+            digest.update(str(part).encode())
+        digest.update(b'\0')
+
+    return digest.hexdigest()[:20]
+
+
+def not_modified(
+    etag: str,
+) -> Response | None:
+    '''
+    Check if the browser already has this version of the response
+
+    The ETag may have been sent back with an encoding suffix,
+        if the response was compressed
+
+    Args:
+        etag (str): The ETag of the current version
+
+    Returns:
+        Response: A '304 Not Modified' response, if the browser has it
+        None: If the response needs to be sent
+    '''
+
+    if request.method != 'GET':
+        return None
+
+    for candidate in (etag, *(f'{etag}-{enc}' for enc in ENCODINGS)):
+        if request.if_none_match.contains(candidate):
+            response = Response(status=304)
+            response.set_etag(candidate)
+            return response
+
+    return None
+
+
+def compress_stream(
+    chunks: t.Iterable[bytes],
+    encoding: str,
+) -> t.Iterator[bytes]:
+    '''
+    Compress a streamed response as it is sent
+        Each chunk is flushed, so the browser gets it straight away
+
+    Args:
+        chunks (Iterable[bytes]): The chunks of the response body
+        encoding (str): 'br' or 'gzip'
+
+    Yields:
+        bytes: Chunks of the compressed body
+    '''
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        compress = compressor.process
+        flush = compressor.flush
+        finish = compressor.finish
+    else:
+        # wbits=31 adds the gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compress = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)    # noqa: E731
+        finish = compressor.flush
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+
+    yield finish()
+
+
+def select_encoding(
+) -> str | None:
+    '''
+    Pick the best encoding the browser supports
+
+    Returns:
+        str: The encoding to use
+        None: If the browser doesn't support any of them
+    '''
+
+    for option in ENCODINGS:
+        if option in request.accept_encodings:
+            return option
+
+    return None
+
+
+def finalize_response(
+    response: Response,
+) -> Response:
+    '''
+    Add ETags and compression to a response
+        This is registered as an 'after request' hook
+
+    (1) GET responses without an ETag get one, from a hash of the body
+        If the browser has this version, a 304 is returned instead
+    (2) Large responses are compressed with brotli or gzip
+    (3) Streamed JSON is compressed as it is sent
+
+    Args:
+        response (Response): The response to finalize
+
+    Returns:
+        Response: The finalized response
+    '''
+
+    # File downloads are sent as-is
+    if response.direct_passthrough:
+        return response
+
+    # Streamed lists can't be hashed, but can be compressed as they are sent
+    if response.is_streamed:
+        if (
+            response.status_code != 200 or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESS_MIMETYPES
+        ):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = select_encoding()
+        if encoding is None:
+            return response
+
+        response.response = compress_stream(response.response, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Length', None)
+
+        etag = response.get_etag()[0]
+        if etag is not None:
+            response.set_etag(f'{etag}-{encoding}')
+
+        return response
+
+    # Add an ETag to GET responses, and check if the browser has it
+    if request.method == 'GET' and response.status_code == 200:
+        etag = response.get_etag()[0]
+        if etag is None:
+            etag = make_etag(response.get_data())
+            response.set_etag(etag)
+
+        cached = not_modified(etag)
+        if cached is not None:
+            cached.vary.add('Accept-Encoding')
+            return cached
+
+    # Only compress complete, successful responses
+    if (
+        response.status_code != 200 or
+        'Content-Encoding' in response.headers or
+        response.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+
+    # Pick the best encoding the browser supports
+    encoding = select_encoding()
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+
+    # Compress the body
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+
+    # A strong ETag must be different for each encoding
+    etag = response.get_etag()[0]
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}')
+
+    return response
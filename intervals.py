@@ -0,0 +1,312 @@
+'''
+Ranges of IP addresses and ports, as integer intervals
+
+IP addresses, prefixes and ranges are converted to (version, first, last)
+    For example, 10.0.0.0/24 is (4, 167772160, 167772415)
+    Ports are converted to (first, last), such as (8080, 8090)
+
+Classes:
+    IntervalTree
+        Find all intervals that contain a point
+
+Functions:
+    parse_address
+        Convert an IP address, prefix or range to an interval
+    format_address
+        Convert an IP interval back to prefixes
+    parse_ports
+        Convert a port list (eg, '80,443,8080-8090') to intervals
+    merge
+        Merge overlapping and adjacent intervals
+    contains
+        Check if merged intervals contain a point
+'''
+
+import bisect
+import ipaddress
+import typing as t
+
+
+def parse_address(
+    value: str,
+) -> tuple[int, int, int] | None:
+    '''
+    Convert an IP address, prefix or range to an interval
+
+    Args:
+        value (str): The address (eg, 10.0.0.0/24 or 10.0.0.1-10.0.0.9)
+
+    Returns:
+        tuple: (IP version, first IP, last IP) as integers
+        None: If this is not an IP address (eg, an FQDN)
+    '''
+
+    try:
+        if '-' in value:
+            first, last = value.split('-')
+            first = ipaddress.ip_address(first.strip())
+            last = ipaddress.ip_address(last.strip())
+            if first.version != last.version:
+                return None
+        else:
+            network = ipaddress.ip_network(value.strip(), strict=False)
+            first = network.network_address
+            last = network.broadcast_address
+
+    except ValueError:
+        return None
+
+    return first.version, int(first), int(last)
+
+
+def format_address(
+    interval: tuple[int, int, int],
+) -> list[str]:
+    '''
+    Convert an IP interval back to prefixes
+
+    Args:
+        interval (tuple): (IP version, first IP, last IP)
+
+    Returns:
+        list: The smallest list of prefixes that cover the interval
+    '''
+
+    version, first, last = interval
+    address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+
+    return [
+        str(network)
+        for network in ipaddress.summarize_address_range(
+            address(first),
+            address(last),
+        )
+    ]
+
+
+def parse_ports(
+    value: str,
+) -> list[tuple[int, int]]:
+    '''
+    Convert a port list to intervals
+
+    Args:
+        value (str): Ports, such as '80,443,8080-8090'
+
+    Returns:
+        list: Tuples of (first port, last port)
+            Invalid entries are skipped
+    '''
+
+    ports = []
+    for part in str(value).split(','):
+        part = part.strip()
+        try:
+            if '-' in part:
+                first, last = part.split('-')
+                ports.append((int(first), int(last)))
+            else:
+                ports.append((int(part), int(part)))
+
+        except ValueError:
+            continue
+
+    return ports
+
+
+def merge(
+    intervals: t.Iterable[tuple],
+) -> list[tuple]:
+    '''
+    Merge overlapping and adjacent intervals
+        Intervals may have a leading key (eg, IP version or protocol),
+        which must match for intervals to be merged
+
+    Args:
+        intervals (Iterable): Tuples of ([key,] first, last)
+
+    Returns:
+        list: The merged intervals, sorted
+    '''
+
+    merged = []
+    for interval in sorted(intervals):
+        if (
+            merged and
+            merged[-1][:-2] == interval[:-2] and
+            interval[-2] <= merged[-1][-1] + 1
+        ):
+            if interval[-1] > merged[-1][-1]:
+                merged[-1] = merged[-1][:-1] + (interval[-1],)
+        else:
+            merged.append(tuple(interval))
+
+    return merged
+
+
+def contains(
+    intervals: list[tuple],
+    point: tuple,
+) -> bool:
+    '''
+    Check if merged intervals contain a point
+
+    Args:
+        intervals (list): Merged intervals, from 'merge()'
+        point (tuple): The point, with the same key (eg, (4, ip))
+
+    Returns:
+        bool: True if an interval contains the point
+    '''
+
+    # The last interval that starts at or before the point
+    index = bisect.bisect_right(intervals, point + (float('inf'),)) - 1
+    if index < 0:
+        return False
+
+    interval = intervals[index]
+    return (
+        interval[:-2] == point[:-1] and
+        interval[-2] <= point[-1] <= interval[-1]
+    )
+
+
+class IntervalTree:
+    '''
+    Find all intervals that contain a point
+        A static centered interval tree, built once and queried many times
+        Queries take O(log n + k) time, for k results
+
+    Methods:
+        __init__: Build the tree
+        __len__: The number of intervals
+        stab: Find the values of intervals that contain a point
+    '''
+
+    def __init__(
+        self,
+        intervals: t.Iterable[tuple[int, int, t.Any]],
+    ) -> None:
+        '''
+        Build the tree
+
+        Args:
+            intervals (Iterable): Tuples of (first, last, value)
+        '''
+
+        intervals = list(intervals)
+        self._count = len(intervals)
+        self._nodes = []
+
+        # Every endpoint, sorted once, to choose the centers from
+        points = sorted(
+            {
+                point
+                for first, last, _ in intervals
+                for point in (first, last)
+            }
+        )
+        self._root = self._build(intervals, points, 0, len(points))
+
+    def __len__(
+        self
+    ) -> int:
+        '''
+        The number of intervals in the tree
+
+        Returns:
+            int: Number of intervals
+        '''
+
+        return self._count
+
+    def _build(
+        self,
+        intervals: list,
+        points: list,
+        low: int,
+        high: int,
+    ) -> int | None:
+        '''
+        Build a node, and the nodes below it
+
+        Each node is a tuple in self._nodes:
+            center (int): The point this node is centered on
+            by_first (list): Intervals containing the center, by first
+            by_last (list): Intervals containing the center, by last (desc)
+            left (int): Node with intervals before the center
+            right (int): Node with intervals after the center
+
+        Args:
+            intervals (list): The intervals to put under this node
+            points (list): All endpoints, sorted
+            low (int): The first endpoint index under this node
+            high (int): The endpoint index after the last under this node
+
+        Returns:
+            int: The index of the node
+            None: If there are no intervals
+        '''
+
+        if not intervals:
+            return None
+
+        # Center on the middle endpoint under this node
+        middle = (low + high) // 2
+        center = points[middle]
+
+        left = []
+        right = []
+        here = []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        # Reserve this node's index, before the child nodes are added
+        index = len(self._nodes)
+        self._nodes.append(None)
+        self._nodes[index] = (
+            center,
+            sorted(here, key=lambda interval: interval[0]),
+            sorted(here, key=lambda interval: -interval[1]),
+            self._build(left, points, low, middle),
+            self._build(right, points, middle + 1, high),
+        )
+
+        return index
+
+    def stab(
+        self,
+        point: int,
+    ) -> t.Iterator[t.Any]:
+        '''
+        Find the values of intervals that contain a point
+
+        Args:
+            point (int): The point
+
+        Yields:
+            The value of each interval that contains the point
+        '''
+
+        node = self._root
+        while node is not None:
+            center, by_first, by_last, left, right = self._nodes[node]
+
+            if point < center:
+                for first, _, value in by_first:
+                    if first > point:
+                        break
+                    yield value
+                node = left
+
+            else:
+                for _, last, value in by_last:
+                    if last < point:
+                        break
+                    yield value
+                node = right if point > center else None
@@ -0,0 +1,508 @@
+'''
+Search for IP addresses across every device
+
+Finds everything that references an IP or prefix, such as
+    "what uses 10.20.30.40?" or "what overlaps 10.20.0.0/16?"
+
+The index is built from data that has already been collected
+    (1) Address objects and groups (groups are flattened)
+    (2) NAT rules (original and translated addresses)
+    (3) Security rules (source and destination)
+    (4) Managed VPN tunnels (destinations and NAT addresses)
+    Collected datasets are shared between worker processes (see
+    cache.py), so each worker builds the same index
+
+The index is split into segments, one per device and dataset
+    When a dataset is refreshed, only its segment is rebuilt
+    Each segment has an interval tree, and a sorted list of start IPs
+
+Searches can find entries that:
+    overlap: share any IP with the query
+    contains: cover the whole query (eg, 10.0.0.0/8 contains 10.1.1.1)
+    within: are inside the query (eg, 10.1.1.0/24 is within 10.0.0.0/8)
+
+Entries with 'any' are not indexed, as they would match every search
+
+Classes:
+    IpIndex
+        A searchable index of IP ranges, in segments
+
+Functions:
+    segment_versions
+        Get the version of each segment for a device
+    device_records
+        Get the IP ranges referenced by a device's datasets
+    vpn_records
+        Get the IP ranges referenced by managed VPN tunnels
+    format_results
+        Group search results by the entry that references them
+
+Misc Variables:
+    ip_index
+        The shared IpIndex object
+'''
+
+import bisect
+import threading
+import typing as t
+
+from intervals import IntervalTree, format_address, parse_address
+from objectdiff import members
+from resolver import GroupResolver
+
+
+# The datasets that are indexed
+INDEXED_DATASETS = ('addresses', 'address_groups', 'nat', 'security')
+
+# VPN fields that hold IPs, and the name to report them as
+VPN_FIELDS = {
+    'a_dest': 'destination_a',
+    'a_inside_nat': 'inside_nat_a',
+    'a_outside_nat': 'outside_nat_a',
+    'b_cloud': 'cloud_b',
+    'b_dest': 'destination_b',
+    'b_inside_nat': 'inside_nat_b',
+    'b_outside_nat': 'outside_nat_b',
+}
+
+# Search modes
+MODES = ('overlap', 'contains', 'within')
+
+
+def _rule_fields(
+    rule: dict,
+    kind: str,
+) -> t.Iterator[tuple[str, list]]:
+    '''
+    Get the address fields of a rule
+
+    Args:
+        rule (dict): A NAT or security rule
+        kind (str): 'nat' or 'security'
+
+    Yields:
+        tuple: (field name, list of address names)
+    '''
+
+    yield 'source', members(rule.get('source'))
+    yield 'destination', members(rule.get('destination'))
+
+    if kind != 'nat':
+        return
+
+    # Translated addresses, in any of the PAN-OS forms
+    source_trans = rule.get('source_trans')
+    if isinstance(source_trans, dict):
+        for settings in source_trans.values():
+            if isinstance(settings, dict):
+                yield 'source_trans', members(
+                    settings.get('translated-address')
+                )
+
+    dest_trans = rule.get('dest_trans')
+    if isinstance(dest_trans, dict):
+        yield 'dest_trans', members(dest_trans.get('translated-address'))
+
+
+def segment_versions(
+    datasets: dict,
+) -> dict:
+    '''
+    Get the version of each segment for a device
+        Groups and rules use the address objects to resolve names,
+        so the versions of the objects are part of their versions
+
+    Args:
+        datasets (dict): Cached Dataset objects, by name
+
+    Returns:
+        dict: Dataset names, to segment versions
+    '''
+
+    objects = tuple(
+        datasets[name].version if name in datasets else None
+        for name in ('addresses', 'address_groups')
+    )
+
+    return {
+        name: (
+            datasets[name].version if name == 'addresses'
+            else (datasets[name].version,) + objects
+        )
+        for name in INDEXED_DATASETS
+        if name in datasets
+    }
+
+
+def device_records(
+    device_id: str,
+    datasets: dict,
+    names: t.Iterable[str] = INDEXED_DATASETS,
+) -> dict:
+    '''
+    Get the IP ranges referenced by a device's datasets
+
+    Args:
+        device_id (str): The device ID
+        datasets (dict): Cached Dataset objects, by name
+            Datasets that haven't been collected can be left out
+        names (Iterable): The datasets to get records for
+
+    Returns:
+        dict: Records for each dataset
+            Records are tuples of (IP version, first, last, reference)
+            References are (device ID, dataset, name, field)
+    '''
+
+    addresses = datasets.get('addresses')
+    groups = datasets.get('address_groups')
+    resolver = GroupResolver(
+        addresses=addresses.items if addresses else [],
+        address_groups=groups.items if groups else [],
+    )
+
+    def ranges(values):
+        if not values or 'any' in values:
+            return ()
+        return resolver.resolve_many('address', values).values
+
+    result = {}
+    for name in names:
+        dataset = datasets.get(name)
+        if dataset is None:
+            continue
+
+        records = []
+        for entry in dataset.items:
+            if name in ('nat', 'security'):
+                fields = _rule_fields(entry, name)
+            elif name == 'address_groups':
+                fields = [('static', [entry.get('name')])]
+            else:
+                fields = [('addr', members(entry.get('addr')))]
+
+            for field, values in fields:
+                for version, first, last in ranges(values):
+                    records.append(
+                        (
+                            version,
+                            first,
+                            last,
+                            (device_id, name, entry.get('name'), field),
+                        )
+                    )
+
+        result[name] = records
+
+    return result
+
+
+def vpn_records(
+    vpns: t.Iterable,
+) -> list:
+    '''
+    Get the IP ranges referenced by managed VPN tunnels
+
+    Args:
+        vpns (Iterable): ManagedVPN objects
+
+    Returns:
+        list: Tuples of (IP version, first, last, reference)
+    '''
+
+    records = []
+    for vpn in vpns:
+        for attribute, field in VPN_FIELDS.items():
+            value = getattr(vpn, attribute, None)
+            if not value:
+                continue
+
+            interval = parse_address(str(value))
+            if interval is not None:
+                records.append(interval + ((None, 'vpn', vpn.name, field),))
+
+    return records
+
+
+class IpIndex:
+    '''
+    A searchable index of IP ranges, in segments
+        Safe to share between threads
+
+    Methods:
+        __init__: Constructor for the IpIndex class
+        __len__: The number of ranges in the index
+        update: Replace a segment, if its version has changed
+        sync_device: Update the segments for a device
+        remove: Remove a segment
+        segments: Get the keys and versions of the segments
+        search: Find ranges that match a query
+        _build: Build the search structures for a segment
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Constructor for the IpIndex class
+        '''
+
+        # Segment keys, to (version, structures by IP version)
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def __len__(
+        self
+    ) -> int:
+        '''
+        The number of ranges in the index
+
+        Returns:
+            int: Number of ranges
+        '''
+
+        return sum(
+            len(records)
+            for _, structures in self._segments.values()
+            for _, _, records in structures.values()
+        )
+
+    def update(
+        self,
+        key: tuple,
+        version,
+        records: list | t.Callable[[], list],
+    ) -> bool:
+        '''
+        Replace a segment, if its version has changed
+
+        Args:
+            key (tuple): Identifies the segment (eg, (device_id, 'nat'))
+            version: The version of the data in the segment
+            records (list): Tuples of (IP version, first, last, reference)
+                This can be a function, so it is only called if needed
+
+        Returns:
+            bool: True if the segment was rebuilt
+        '''
+
+        current = self._segments.get(key)
+        if current is not None and current[0] == version:
+            return False
+
+        if callable(records):
+            records = records()
+
+        structures = self._build(records)
+        with self._lock:
+            self._segments[key] = (version, structures)
+
+        return True
+
+    def sync_device(
+        self,
+        device_id: str,
+        datasets: dict,
+    ) -> int:
+        '''
+        Update the segments for a device
+            Only segments with a new version are rebuilt
+            Segments for datasets that are no longer cached are removed
+
+        Args:
+            device_id (str): The device ID
+            datasets (dict): Cached Dataset objects, by name
+
+        Returns:
+            int: The number of segments that changed
+        '''
+
+        versions = segment_versions(datasets)
+        current = self.segments()
+        changed = [
+            name for name, version in versions.items()
+            if current.get((device_id, name)) != version
+        ]
+
+        # Build the records for all changed datasets at once
+        records = {}
+        if changed:
+            records = device_records(device_id, datasets, changed)
+        for name in changed:
+            self.update((device_id, name), versions[name], records[name])
+
+        removed = [
+            name for name in INDEXED_DATASETS
+            if name not in versions and (device_id, name) in current
+        ]
+        for name in removed:
+            self.remove((device_id, name))
+
+        return len(changed) + len(removed)
+
+    def remove(
+        self,
+        key: tuple,
+    ) -> None:
+        '''
+        Remove a segment
+
+        Args:
+            key (tuple): Identifies the segment
+        '''
+
+        with self._lock:
+            self._segments.pop(key, None)
+
+    def segments(
+        self
+    ) -> dict:
+        '''
+        Get the keys and versions of the segments
+
+        Returns:
+            dict: Segment keys, to their versions
+        '''
+
+        return {
+            key: version
+            for key, (version, _) in list(self._segments.items())
+        }
+
+    @staticmethod
+    def _build(
+        records: list,
+    ) -> dict:
+        '''
+        Build the search structures for a segment
+
+        Args:
+            records (list): Tuples of (IP version, first, last, reference)
+
+        Returns:
+            dict: For each IP version, a tuple of
+                tree (IntervalTree): Finds ranges that contain a point
+                starts (list): Sorted (first IP, record index)
+                records (list): The records
+        '''
+
+        by_version = {}
+        for record in records:
+            by_version.setdefault(record[0], []).append(record)
+
+        structures = {}
+        for version, group in by_version.items():
+            structures[version] = (
+                IntervalTree(
+                    (first, last, index)
+                    for index, (_, first, last, _) in enumerate(group)
+                ),
+                sorted(
+                    (first, index)
+                    for index, (_, first, _, _) in enumerate(group)
+                ),
+                group,
+            )
+
+        return structures
+
+    def search(
+        self,
+        query: str,
+        mode: str = 'overlap',
+    ) -> list:
+        '''
+        Find ranges that match a query
+
+        Args:
+            query (str): An IP, prefix, or range (eg, 10.0.0.1-10.0.0.9)
+            mode (str): 'overlap', 'contains' or 'within'
+
+        Raises:
+            ValueError: If the query or mode is invalid
+
+        Returns:
+            list: Matching records, as tuples of
+                (reference, first IP, last IP)
+                References are (device ID, dataset, name, field)
+        '''
+
+        interval = parse_address(query)
+        if interval is None:
+            raise ValueError(f"'{query}' is not an IP, prefix or range")
+        if mode not in MODES:
+            raise ValueError(f"Unknown search mode '{mode}'")
+
+        version, low, high = interval
+        found = []
+        for _, structures in list(self._segments.values()):
+            if version not in structures:
+                continue
+
+            tree, starts, records = structures[version]
+            indexes = set()
+
+            # Ranges that contain the start of the query
+            if mode in ('overlap', 'contains'):
+                indexes.update(tree.stab(low))
+
+            # Ranges that start inside the query
+            if mode in ('overlap', 'within'):
+                start = bisect.bisect_left(starts, (low,))
+                end = bisect.bisect_right(starts, (high, float('inf')))
+                indexes.update(index for _, index in starts[start:end])
+
+            for index in indexes:
+                _, first, last, reference = records[index]
+                if mode == 'contains' and last < high:
+                    continue
+                if mode == 'within' and (first < low or last > high):
+                    continue
+                found.append((reference, first, last))
+
+        return found
+
+
+def format_results(
+    found: list,
+    version: int,
+) -> list:
+    '''
+    Group search results by the entry that references them
+
+    Args:
+        found (list): Results from 'IpIndex.search()'
+        version (int): The IP version of the query
+
+    Returns:
+        list: One dictionary per entry and field, sorted
+            device (str): The device ID (None for VPN tunnels)
+            type (str): The dataset (eg, 'addresses', or 'vpn')
+            name (str): The name of the entry
+            field (str): The field that references the IP
+            ranges (list): The matching ranges, as prefixes
+    '''
+
+    grouped = {}
+    for reference, first, last in found:
+        grouped.setdefault(reference, []).extend(
+            format_address((version, first, last))
+        )
+
+    return [
+        {
+            'device': device,
+            'type': dataset,
+            'name': name,
+            'field': field,
+            'ranges': sorted(set(ranges)),
+        }
+        for (device, dataset, name, field), ranges in sorted(
+            grouped.items(),
+            key=lambda item: tuple(str(part) for part in item[0]),
+        )
+    ]
+
+
+# The shared IP index
+ip_index = IpIndex()
@@ -0,0 +1,279 @@
+'''
+Fast JSON serialization for the Flask app
+
+Large lists (such as security rules or GP sessions) can take a noticeable
+    amount of time to serialize with the standard 'json' module
+    'orjson' is used when it is installed, as it is much faster
+    If it is not installed, or can't handle a value, the standard
+    'json' module is used instead, so responses are always the same
+
+Very large lists are streamed to the browser in batches
+    This means the whole response body is never held in memory at once
+
+Classes:
+    FastJSONProvider
+        A Flask JSON provider that uses orjson when available
+
+Functions:
+    encode
+        Serialize an object to JSON bytes
+    stream_array
+        Serialize a list to JSON in batches
+    list_response
+        Build a response for a list, streaming it if it is large
+'''
+
+from flask import current_app, Response
+from flask.json.provider import DefaultJSONProvider
+
+import json
+import typing as t
+
+from profiling import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Lists longer than this are streamed, rather than built in memory
+STREAM_THRESHOLD = 2000
+
+# The number of list entries serialized at a time when streaming
+STREAM_BATCH = 500
+
+
+def encode(
+    obj: t.Any,
+    sort_keys: bool = False,
+    indent: bool = False,
+    default: t.Callable = None,
+    newline: bool = False,
+) -> bytes:
+    '''
+    Serialize an object to JSON bytes
+        Uses orjson if it is installed, otherwise the 'json' module
+
+    Args:
+        obj (Any): The object to serialize
+        sort_keys (bool): Sort dictionary keys
+        indent (bool): Pretty-print with a two space indent
+        default (Callable): Called for values that can't be serialized
+        newline (bool): Add a newline to the end
+
+    Raises:
+        TypeError: If the object can't be serialized
+
+    Returns:
+        bytes: The JSON, encoded as UTF-8
+    '''
+
+    if orjson is not None:
+        # Dates are passed to 'default', so they match the 'json' module
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if newline:
+            option |= orjson.OPT_APPEND_NEWLINE
+
+        # orjson is stricter (eg, integers over 64-bit), so fall back
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            pass
+
+    return json.dumps(
+        obj,
+        sort_keys=sort_keys,
+        indent=2 if indent else None,
+        separators=None if indent else (',', ':'),
+        default=default,
+    ).encode() + (b'\n' if newline else b'')
+
+
+def stream_array(
+    items: list,
+    sort_keys: bool = False,
+    default: t.Callable = None,
+    batch: int = STREAM_BATCH,
+) -> t.Iterator[bytes]:
+    '''
+    Serialize a list to JSON in batches
+        The output is the same as serializing the whole list at once
+
+    Args:
+        items (list): The entries to serialize
+        sort_keys (bool): Sort dictionary keys
+        default (Callable): Called for values that can't be serialized
+        batch (int): The number of entries to serialize at a time
+
+    Yields:
+        bytes: Chunks of the JSON array
+    '''
+
+    # The brackets and commas are sent with the entries
+    separator = b'['
+    for start in range(0, len(items), batch):
+        # Serialize a batch as an array, then remove the brackets
+        chunk = encode(
+            items[start:start + batch],
+            sort_keys=sort_keys,
+            default=default,
+        )[1:-1]
+        yield separator + chunk
+        separator = b','
+
+    yield b'[]\n' if separator == b'[' else b']\n'
+
+
+def list_response(
+    items: list,
+) -> Response:
+    '''
+    Build a JSON response for a list
+        Large lists are streamed, smaller lists are sent normally
+
+    Args:
+        items (list): The entries to respond with
+
+    Returns:
+        Response: The JSON response
+    '''
+
+    if len(items) <= STREAM_THRESHOLD:
+        return current_app.json.response(items)
+
+    return current_app.response_class(
+        stream_array(
+            items,
+            sort_keys=current_app.json.sort_keys,
+            default=current_app.json.default,
+        ),
+        mimetype=current_app.json.mimetype,
+    )
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    '''
+    A Flask JSON provider that uses orjson when it is available
+        Set as 'app.json' to be used by 'jsonify' and 'request.json'
+
+    This supports the same types as Flask's default provider
+        (dates, UUIDs, dataclasses, and decimals)
+
+    Methods:
+        dumps: Serialize an object to a JSON string
+        loads: Deserialize JSON to an object
+        response: Build a JSON response
+    '''
+
+    def dumps(
+        self,
+        obj: t.Any,
+        **kwargs: t.Any,
+    ) -> str:
+        '''
+        Serialize an object to a JSON string
+
+        Args:
+            obj (Any): The object to serialize
+            kwargs: Options for 'json.dumps'
+                Only 'indent' and 'sort_keys' are used by orjson
+
+        Returns:
+            str: The JSON string
+        '''
+
+        return self._encode(obj, **kwargs).decode()
+
+    def loads(
+        self,
+        s: str | bytes,
+        **kwargs: t.Any,
+    ) -> t.Any:
+        '''
+        Deserialize JSON to an object
+
+        Args:
+            s (str | bytes): The JSON to deserialize
+            kwargs: Options for 'json.loads'
+
+        Returns:
+            Any: The deserialized object
+        '''
+
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+
+        return super().loads(s, **kwargs)
+
+    def response(
+        self,
+        *args: t.Any,
+        **kwargs: t.Any,
+    ) -> Response:
+        '''
+        Build a JSON response
+            The body is kept as bytes, rather than decoded to a string
+
+        Args:
+            args: A single value, or a list of values to serialize
+            kwargs: Treat as a dict to serialize
+
+        Returns:
+            Response: The JSON response
+        '''
+
+        obj = self._prepare_response_obj(args, kwargs)
+
+        # Pretty-print in debug mode, the same as the default provider
+        debug = self.compact is None and self._app.debug
+        if debug or self.compact is False:
+            dump_args = {'indent': 2}
+        else:
+            dump_args = {'separators': (',', ':')}
+
+        return self._app.response_class(
+            self._encode(obj, newline=True, **dump_args),
+            mimetype=self.mimetype,
+        )
+
+    def _encode(
+        self,
+        obj: t.Any,
+        newline: bool = False,
+        **kwargs: t.Any,
+    ) -> bytes:
+        '''
+        Serialize an object to JSON bytes, with this provider's settings
+
+        Args:
+            obj (Any): The object to serialize
+            newline (bool): Add a newline to the end
+            kwargs: Options for 'json.dumps'
+
+        Returns:
+            bytes: The JSON, encoded as UTF-8
+        '''
+
+        # Time this as a span, when the request is traced
+        with span('json'):
+            # Options orjson doesn't support need the 'json' module
+            supported = {'indent', 'sort_keys', 'separators', 'default'}
+            if orjson is None or not supported.issuperset(kwargs):
+                kwargs.setdefault('default', self.default)
+                kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+                kwargs.setdefault('sort_keys', self.sort_keys)
+                body = json.dumps(obj, **kwargs).encode()
+                return body + b'\n' if newline else body
+
+            return encode(
+                obj,
+                sort_keys=kwargs.get('sort_keys', self.sort_keys),
+                indent=bool(kwargs.get('indent')),
+                default=kwargs.get('default', self.default),
+                newline=newline,
+            )
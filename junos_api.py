@@ -18,6 +18,12 @@ Authentication:
     The pyEZ library uses SSH to connect to the device,
         passing a username and password
     This user must have suitable permissions to access the device
+
+Classes:
+    DeviceApi
+        Access a Junos device through NETCONF
+    AsyncDeviceApi
+        The same methods, as coroutines, run in worker threads
 '''
 
 
@@ -38,6 +44,43 @@ import ipaddress
 from typing import Union, Tuple
 from colorama import Fore, Style
 
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+from metrics import device_api_seconds
+
+
+# Threads shared by async clients, to run NETCONF calls
+ASYNC_THREADS = 16
+
+# The shared thread pool (created when it's first used)
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _async_executor(
+) -> concurrent.futures.ThreadPoolExecutor:
+    '''
+    Get the thread pool shared by async clients
+        This is separate from the event loop's default pool, so slow
+        NETCONF sessions don't hold up other work
+
+    Returns:
+        ThreadPoolExecutor: The thread pool
+    '''
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=ASYNC_THREADS,
+                thread_name_prefix='junos',
+            )
+
+    return _executor
+
 
 class DeviceApi:
     '''
@@ -47,6 +90,8 @@ class DeviceApi:
         __init__: Initialise the class with the device details
         __enter__: Context manager
         __exit__: Context manager
+        close: Close the NETCONF session
+        _rpc: Send an RPC to the device
         get_device: Get device basics from the device
         get_ha: Get high availability details
         get_config: Get the running configuration of the device
@@ -95,7 +140,12 @@ class DeviceApi:
             passwd=self.password
         )
         try:
-            self.device.open()
+            with device_api_seconds.time(
+                vendor='juniper',
+                device=self.hostname,
+                operation='open',
+            ):
+                self.device.open()
 
         except ConnectAuthError:
             print(
@@ -178,6 +228,42 @@ class DeviceApi:
                 exc_info=(exc_type, exc_value, traceback)
             )
 
+    def close(
+        self
+    ) -> None:
+        '''
+        Close the NETCONF session
+            Used when a device is polled repeatedly, so sessions
+            don't build up on the device
+        '''
+
+        if self.device.connected:
+            self.device.close()
+
+    def _rpc(
+        self,
+        name: str,
+        **kwargs,
+    ):
+        '''
+        Send an RPC to the device
+            Each RPC is timed, by name (see metrics.py)
+
+        Args:
+            name (str): The RPC (eg, 'get_config')
+            kwargs: The RPC's arguments
+
+        Returns:
+            The RPC's response (an XML element, or a dict for JSON)
+        '''
+
+        with device_api_seconds.time(
+            vendor='juniper',
+            device=self.hostname,
+            operation=name,
+        ):
+            return getattr(self.device.rpc, name)(**kwargs)
+
     def get_device(
         self
     ) -> Union[Tuple[str, str, str], int]:
@@ -199,16 +285,16 @@ class DeviceApi:
 
     def get_ha(
         self
-    ) -> Union[bool, Tuple[bool, str, str, str], int]:
+    ) -> Union[bool, Tuple[bool, str, str, str, str], int]:
         '''
         Get high availability details.
 
         Returns:
             bool:
                 Whether the device is enabled (False if HA is disabled).
-            Tuple[bool, str, str, str]:
+            Tuple[bool, str, str, str, str]:
                 Whether the device is enabled, local state,
-                    peer state, and peer serial number.
+                    peer state, peer serial number, and config sync state.
             int:
                 The response code if an error occurred.
         '''
@@ -217,8 +303,9 @@ class DeviceApi:
         local_state = None
         peer_state = None
         peer_serial = None
+        sync_state = None
 
-        return enabled, local_state, peer_state, peer_serial
+        return enabled, local_state, peer_state, peer_serial, sync_state
 
     def get_config(
         self
@@ -232,7 +319,8 @@ class DeviceApi:
         '''
 
         # Get the committed config
-        dev_config = self.device.rpc.get_config(
+        dev_config = self._rpc(
+            'get_config',
             options={
                 'database': 'committed',
                 'format': 'set'
@@ -292,7 +380,8 @@ class DeviceApi:
 
         # Get the config
         try:
-            result = self.device.rpc.get_config(
+            result = self._rpc(
+                'get_config',
                 filter_xml=path,
                 options={
                     'format': 'json',
@@ -950,7 +1039,7 @@ class DeviceApi:
         ike_gw = self.get_partial_config('security/ike/gateway', inherit=True)
 
         # Get the current IKE status
-        ike_sa = self.device.rpc.get_ike_security_associations_information()
+        ike_sa = self._rpc('get_ike_security_associations_information')
         ike_sa = xmltodict.parse(
             etree.tostring(
                 ike_sa,
@@ -964,7 +1053,7 @@ class DeviceApi:
         ipsec_gw = self.get_partial_config('security/ipsec/vpn', inherit=True)
 
         # Get the current IPsec status
-        ipsec_sa = self.device.rpc.get_security_associations_information()
+        ipsec_sa = self._rpc('get_security_associations_information')
         ipsec_sa = xmltodict.parse(
             etree.tostring(
                 ipsec_sa,
@@ -1027,3 +1116,163 @@ class DeviceApi:
             vpn_status.append(vpn)
 
         return vpn_status
+
+
+class AsyncDeviceApi:
+    '''
+    Asynchronous access to Junos devices
+        PyEZ is synchronous (NETCONF over SSH), so each call runs in a
+        shared pool of worker threads, and the event loop isn't blocked
+        Calls to one device run one at a time, as the session is not
+        thread safe
+
+    Has the same get_ and create_ methods as DeviceApi, as coroutines
+
+    Methods:
+        __init__: Store the device details
+        open: Connect to the device
+        close: Close the NETCONF session
+        __aenter__: Connect, for async context manager
+        __aexit__: Close the session, for async context manager
+        _call: Run a DeviceApi method in a worker thread
+        __getattr__: Get a DeviceApi method, as a coroutine
+    '''
+
+    def __init__(
+        self,
+        hostname: str,
+        username: str,
+        password: str,
+    ) -> None:
+        '''
+        Store the device details
+            The connection is opened by open(), or the context manager
+
+        Args:
+            hostname (str): The hostname or IP address of the device
+            username (str): The username to connect with
+            password (str): The password to connect with
+        '''
+
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+
+        self.api = None
+        self._lock = asyncio.Lock()
+
+    async def open(
+        self
+    ) -> 'AsyncDeviceApi':
+        '''
+        Connect to the device (in a worker thread)
+
+        Returns:
+            AsyncDeviceApi: The current instance
+        '''
+
+        if self.api is None:
+            self.api = await asyncio.get_running_loop().run_in_executor(
+                _async_executor(),
+                functools.partial(
+                    DeviceApi,
+                    hostname=self.hostname,
+                    username=self.username,
+                    password=self.password,
+                ),
+            )
+
+        return self
+
+    async def close(
+        self
+    ) -> None:
+        '''
+        Close the NETCONF session
+        '''
+
+        if self.api is not None:
+            await self._call('close')
+            self.api = None
+
+    async def __aenter__(
+        self
+    ) -> 'AsyncDeviceApi':
+        '''
+        Connect, for async context manager
+
+        Returns:
+            AsyncDeviceApi: The current instance
+        '''
+
+        return await self.open()
+
+    async def __aexit__(
+        self,
+        exc_type,
+        exc_value,
+        traceback
+    ) -> None:
+        '''
+        Close the session, for async context manager
+
+        Args:
+            exc_type: Exception type
+            exc_value: Exception value
+            traceback: Traceback
+        '''
+
+        await self.close()
+
+    async def _call(
+        self,
+        name: str,
+        *args,
+        **kwargs,
+    ):
+        '''
+        Run a DeviceApi method in a worker thread
+
+        Args:
+            name (str): The method name (eg, 'get_vpn_status')
+            *args: Arguments for the method
+            **kwargs: Keyword arguments for the method
+
+        Returns:
+            The method's result
+        '''
+
+        await self.open()
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(
+                _async_executor(),
+                functools.partial(
+                    getattr(self.api, name),
+                    *args,
+                    **kwargs,
+                ),
+            )
+
+    def __getattr__(
+        self,
+        name: str,
+    ):
+        '''
+        Get a DeviceApi method, as a coroutine
+            For example, 'await api.get_vpn_status()'
+
+        Args:
+            name (str): The method name (get_ or create_ methods only)
+
+        Returns:
+            Callable: Returns a coroutine, with the method's result
+        '''
+
+        if name.startswith(('get_', 'create_')) and callable(
+            getattr(DeviceApi, name, None)
+        ):
+            return functools.partial(self._call, name)
+
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
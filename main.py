@@ -15,6 +15,12 @@ Modules:
     apiroutes: Contains the route definitions for the API endpoints.
     device: Contains the classes for managing sites and devices.
     azure: Contains the route definitions for Azure AD login.
+    scheduler: Polls devices in the background.
+    metrics: Times the hot paths, for Prometheus.
+
+Background threads start after uWSGI forks its workers
+    Threads don't survive a fork, so they're started in each worker
+    Only one worker polls devices and records history (see scheduler.py)
 
 Usage:
     Run this module to start the web application.
@@ -28,17 +34,29 @@ from flask import Flask
 import os
 from colorama import Fore, Style
 
+# Only available when running under uWSGI
+try:
+    import uwsgidecorators
+except ImportError:
+    uwsgidecorators = None
+
 from settings import config
 from webroutes import web_bp
-from apiroutes import api_bp
+from apiroutes import api_bp, device_config
 from device import site_manager, device_manager
 from azure import azure_bp
 from vpn import vpn_manager
+from jsonprovider import FastJSONProvider
+from archive import config_archive
+from scheduler import poll_scheduler
+from gphistory import gp_history
+from metrics import metrics
 
 
 # Create a Flask web app
 app = Flask(__name__)
 app.secret_key = os.getenv('api_master_pw')
+app.json = FastJSONProvider(app)
 
 if config.config_exists and config.config_valid:
     app.register_blueprint(azure_bp)
@@ -59,6 +77,32 @@ else:
         Style.RESET_ALL
     )
 
+
+def start_background() -> None:
+    '''
+    Start the background threads
+        Under uWSGI, this runs in each worker after it forks
+    '''
+
+    # Archive device configs in the background
+    config_archive.start(
+        devices=lambda: device_manager.device_list,
+        fetch=device_config,
+    )
+
+    # Poll device status in the background
+    poll_scheduler.start(
+        devices=lambda: device_manager.device_list,
+        reload=device_manager.get_devices,
+    )
+
+    # Record GlobalProtect session history in the background
+    gp_history.start(devices=lambda: device_manager.device_list)
+
+    # Share this worker's metrics with the others
+    metrics.start()
+
+
 # Load sites and devices
 if config.config_exists and config.config_valid:
     site_manager.get_sites()
@@ -66,6 +110,12 @@ if config.config_exists and config.config_valid:
     vpn_manager.load_vpn()
     print("Sites and devices loaded")
 
+    # Start the background threads once the workers have forked
+    if uwsgidecorators is not None:
+        uwsgidecorators.postfork(start_background)
+    else:
+        start_background()
+
     debug = config.web_debug
     host_ip = config.web_ip
 
@@ -0,0 +1,1101 @@
+'''
+Count and time the hot paths, and expose them for Prometheus
+
+Histograms time each call, and counters count events
+    API routes, by route, method and status
+    Device API calls, by vendor, device and operation
+        (REST and XML requests, and Junos RPCs)
+    SQL operations, by operation and table
+    PBKDF2 key derivations (used to decrypt every secret)
+    Cache lookups, as hits and misses
+A gauge tracks how many devices are waiting to load in get_devices()
+
+Cardinality is limited, so a label can't create unbounded series
+    Each metric has a limit on its series (label combinations)
+    Past the limit, new combinations are counted under 'other' labels,
+    and the number of these is counted too
+    Routes are labelled by their rule (eg, /api/device), not the URL
+
+Each worker process has its own metrics
+    Each worker saves a snapshot to the state directory every so often
+    A scrape (/metrics) adds up the snapshots from every worker, so it
+    doesn't matter which worker answers
+    When a worker stops saving (eg, uWSGI restarts it), its counters and
+    histograms are added to a file of retired totals, so the sums don't
+    go down. Its gauges are dropped, as they only make sense while it
+    runs (like prometheus_client's multiprocess mode)
+    Each worker's file is named after its PID, which is read when it
+    saves, as the registry is created before uWSGI forks the workers
+    Metrics are cleared in each new worker, so what the app counted
+    while loading isn't counted once for every worker
+
+The output is the Prometheus text format (version 0.0.4)
+
+Classes:
+    Metric
+        A metric with labels, and a limit on its series
+    Counter
+        A value that only goes up
+    Gauge
+        A value that goes up and down
+    Histogram
+        Counts values (eg, call times) in buckets
+    Timer
+        A call that is being timed
+    MetricsRegistry
+        Creates metrics, shares them between workers, and renders them
+
+Functions:
+    start_request
+        Note when an API request starts (a 'before request' hook)
+    record_request
+        Time an API request (an 'after request' hook)
+
+Misc Variables:
+    metrics
+        The shared MetricsRegistry object
+    http_seconds, device_api_seconds, sql_seconds, pbkdf2_seconds,
+    cache_requests, device_load_queue
+        The metrics for each hot path
+'''
+
+from flask import Response, g, request
+from colorama import Fore, Style
+
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+import typing as t
+
+from jsonprovider import encode
+from profiling import span as trace_span
+from state import locked, write_atomic
+
+
+# Histogram buckets, in seconds
+#   Device calls can take many seconds, local work takes milliseconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+# The most series (label combinations) a metric can have
+MAX_SERIES = 1000
+
+# The label value used when a metric has too many series
+OVERFLOW = 'other'
+
+# Where each worker saves its metrics
+STATE_DIR = os.path.join('state', 'metrics')
+
+# Seconds between saves, and before a worker is assumed to be gone
+SAVE_INTERVAL = 15
+WORKER_TIMEOUT = 120
+
+# The file that keeps the totals from workers that have stopped
+RETIRED_FILE = 'retired.json'
+
+
+def _escape(
+    value: t.Any,
+) -> str:
+    '''
+    Escape a label value, as the text format requires
+
+    Args:
+        value (Any): The label value
+
+    Returns:
+        str: The escaped value
+    '''
+
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\n', '\\n')
+        .replace('"', '\\"')
+    )
+
+
+def _number(
+    value: float,
+) -> str:
+    '''
+    Format a number, as the text format requires
+
+    Args:
+        value (float): The number
+
+    Returns:
+        str: The number (eg, '3', '0.25' or '+Inf')
+    '''
+
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+class Metric:
+    '''
+    A metric with labels, and a limit on its series
+        Subclasses decide what is stored for each series
+
+    Methods:
+        __init__: Create a metric with no series yet
+        _key: Get the series key for some labels
+        snapshot: Get the metric's series, to save or render
+        clear: Remove every series
+        _copy: Copy a series' value
+        lines: Render series in the text format
+    '''
+
+    kind = 'untyped'
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: t.Iterable = (),
+        max_series: int = MAX_SERIES,
+    ) -> None:
+        '''
+        Create a metric with no series yet
+
+        Args:
+            name (str): The metric name (eg, pafe_sql_duration_seconds)
+            description (str): The help text
+            labels (Iterable): The label names
+            max_series (int): The most label combinations to keep
+        '''
+
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.max_series = max_series
+
+        # Label values, to the series' value
+        self._series = {}
+        self._lock = threading.Lock()
+
+        # Label combinations that were counted under 'other'
+        self.overflow = 0
+
+    def _key(
+        self,
+        labels: dict,
+    ) -> tuple:
+        '''
+        Get the series key for some labels
+            Past the series limit, new combinations share one key
+            The caller must hold the lock
+
+        Args:
+            labels (dict): Label names, to values (missing ones are '')
+
+        Returns:
+            tuple: The label values, in order
+        '''
+
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        if key in self._series or len(self._series) < self.max_series:
+            return key
+
+        self.overflow += 1
+        return (OVERFLOW,) * len(self.labels)
+
+    def snapshot(
+        self
+    ) -> dict:
+        '''
+        Get the metric's series, to save or render
+
+        Returns:
+            dict: The metric
+                type (str): The kind of metric
+                help (str): The help text
+                labels (list): The label names
+                series (list): Pairs of label values and the value
+        '''
+
+        with self._lock:
+            series = [
+                [list(key), self._copy(value)]
+                for key, value in self._series.items()
+            ]
+
+        return {
+            'type': self.kind,
+            'help': self.description,
+            'labels': list(self.labels),
+            'series': series,
+        }
+
+    def clear(
+        self
+    ) -> None:
+        '''
+        Remove every series (eg, in a new worker)
+            The lock is replaced too, as another thread may have held it
+            when the worker forked
+        '''
+
+        self._lock = threading.Lock()
+        self._series = {}
+        self.overflow = 0
+
+    @staticmethod
+    def _copy(
+        value: t.Any,
+    ) -> t.Any:
+        '''
+        Copy a series' value, so it can be used outside the lock
+
+        Args:
+            value (Any): The value
+
+        Returns:
+            Any: A copy of the value
+        '''
+
+        return value
+
+    @staticmethod
+    def lines(
+        name: str,
+        snapshot: dict,
+    ) -> list:
+        '''
+        Render series in the text format
+
+        Args:
+            name (str): The metric name
+            snapshot (dict): The metric (see snapshot())
+
+        Returns:
+            list: The lines
+        '''
+
+        lines = []
+        for values, value in snapshot['series']:
+            labels = ','.join(
+                f'{label}="{_escape(v)}"'
+                for label, v in zip(snapshot['labels'], values)
+            )
+            labels = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}{labels} {_number(value)}')
+
+        return lines
+
+
+class Counter(Metric):
+    '''
+    A value that only goes up (eg, the number of cache hits)
+
+    Methods:
+        inc: Add to the counter
+    '''
+
+    kind = 'counter'
+
+    def inc(
+        self,
+        amount: float = 1,
+        **labels,
+    ) -> None:
+        '''
+        Add to the counter
+
+        Args:
+            amount (float): How much to add
+            labels: The label values
+        '''
+
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    A value that goes up and down (eg, the length of a queue)
+
+    Methods:
+        set: Set the gauge
+        inc: Add to the gauge
+        dec: Take from the gauge
+    '''
+
+    kind = 'gauge'
+
+    def set(
+        self,
+        value: float,
+        **labels,
+    ) -> None:
+        '''
+        Set the gauge
+
+        Args:
+            value (float): The new value
+            labels: The label values
+        '''
+
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(
+        self,
+        amount: float = 1,
+        **labels,
+    ) -> None:
+        '''
+        Add to the gauge
+
+        Args:
+            amount (float): How much to add
+            labels: The label values
+        '''
+
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(
+        self,
+        amount: float = 1,
+        **labels,
+    ) -> None:
+        '''
+        Take from the gauge
+
+        Args:
+            amount (float): How much to take
+            labels: The label values
+        '''
+
+        self.inc(-amount, **labels)
+
+
+class Timer:
+    '''
+    A call that is being timed
+        Set 'ok' to False if the call failed without raising an error
+        (eg, an API returned an error code)
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Constructor for the Timer class
+        '''
+
+        self.ok = True
+
+
+class Histogram(Metric):
+    '''
+    Counts values (eg, call times) in buckets
+        Each series has a count for each bucket, a sum, and a count
+        The 'result' label, if there is one, is set by time()
+        time() can also open a span in the request's trace (see
+        profiling.py), so each call shows up when a request is profiled
+
+    Methods:
+        __init__: Create a histogram with no series yet
+        observe: Count a value
+        time: Time a block of code
+        _copy: Copy a series' value
+        lines: Render series in the text format
+        snapshot: Get the histogram's series, with its buckets
+    '''
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: t.Iterable = (),
+        max_series: int = MAX_SERIES,
+        buckets: t.Iterable = DEFAULT_BUCKETS,
+        span: str = None,
+    ) -> None:
+        '''
+        Create a histogram with no series yet
+
+        Args:
+            name (str): The metric name
+            description (str): The help text
+            labels (Iterable): The label names
+            max_series (int): The most label combinations to keep
+            buckets (Iterable): The upper bound of each bucket
+            span (str): The span time() opens (eg, 'sql'), or None
+        '''
+
+        super().__init__(name, description, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+        self.span = span
+
+    def observe(
+        self,
+        value: float,
+        **labels,
+    ) -> None:
+        '''
+        Count a value
+
+        Args:
+            value (float): The value (eg, seconds)
+            labels: The label values
+        '''
+
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextlib.contextmanager
+    def time(
+        self,
+        **labels,
+    ) -> t.Iterator[Timer]:
+        '''
+        Time a block of code
+            Exceptions count as failures, and are raised again
+            Works around 'await', as only the time between is measured
+
+        Args:
+            labels: The label values (not 'result')
+
+        Yields:
+            Timer: Set 'ok' to False if the call failed
+        '''
+
+        timer = Timer()
+        traced = (
+            trace_span(self.span, **labels) if self.span is not None
+            else contextlib.nullcontext()
+        )
+
+        start = time.perf_counter()
+        with traced:
+            try:
+                yield timer
+            except BaseException:
+                timer.ok = False
+                raise
+            finally:
+                if 'result' in self.labels:
+                    labels['result'] = 'ok' if timer.ok else 'error'
+                self.observe(time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _copy(
+        value: dict,
+    ) -> dict:
+        '''
+        Copy a series' value, so it can be used outside the lock
+
+        Args:
+            value (dict): The buckets, sum and count
+
+        Returns:
+            dict: A copy
+        '''
+
+        return dict(value, buckets=list(value['buckets']))
+
+    @staticmethod
+    def lines(
+        name: str,
+        snapshot: dict,
+    ) -> list:
+        '''
+        Render series in the text format
+            Bucket counts are cumulative, with a final '+Inf' bucket
+
+        Args:
+            name (str): The metric name
+            snapshot (dict): The metric (see snapshot())
+
+        Returns:
+            list: The lines
+        '''
+
+        lines = []
+        bounds = list(snapshot['buckets']) + [math.inf]
+        for values, value in snapshot['series']:
+            labels = ''.join(
+                f'{label}="{_escape(v)}",'
+                for label, v in zip(snapshot['labels'], values)
+            )
+
+            total = 0
+            counts = list(value['buckets']) + [
+                value['count'] - sum(value['buckets'])
+            ]
+            for bound, count in zip(bounds, counts):
+                total += count
+                lines.append(
+                    f'{name}_bucket{{{labels}le="{_number(bound)}"}} '
+                    f'{total}'
+                )
+
+            labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+            lines.append(f'{name}_sum{labels} {_number(value["sum"])}')
+            lines.append(f'{name}_count{labels} {value["count"]}')
+
+        return lines
+
+    def snapshot(
+        self
+    ) -> dict:
+        '''
+        Get the histogram's series, with its buckets
+
+        Returns:
+            dict: The metric (see Metric.snapshot), and its buckets
+        '''
+
+        return dict(super().snapshot(), buckets=list(self.buckets))
+
+
+class MetricsRegistry:
+    '''
+    Creates metrics, shares them between workers, and renders them
+
+    Methods:
+        __init__: Create a registry with no metrics yet
+        _add: Add a metric, or get the one with that name
+        counter: Create a counter
+        gauge: Create a gauge
+        histogram: Create a histogram
+        snapshot: Get every metric's series
+        _file: Get this worker's file
+        _forked: Start again in a new worker
+        start: Save this worker's metrics in the background
+        _run: Save metrics until the app stops
+        save: Save this worker's metrics, for other workers to read
+        _read: Read a saved snapshot
+        _retire: Keep the totals from a worker that has stopped
+        _collect: Read the snapshots from other workers
+        _combine: Add up snapshots
+        _merge: Add up the metrics from every worker
+        render: Render every worker's metrics in the text format
+    '''
+
+    def __init__(
+        self,
+        path: str = STATE_DIR,
+    ) -> None:
+        '''
+        Create a registry with no metrics yet
+
+        Args:
+            path (str): The directory that workers save their metrics in
+        '''
+
+        self.path = path
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # The process the file is named after, and when it started
+        self._pid = None
+        self._started = None
+
+        # Workers are forked after the registry is created
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _file(
+        self
+    ) -> str:
+        '''
+        Get this worker's file
+            Named after the current process (and when it started, in
+            case a PID is reused)
+
+        Returns:
+            str: The path of the file
+        '''
+
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._started = int(time.time())
+
+        return os.path.join(self.path, f"{pid}-{self._started}.json")
+
+    def _forked(
+        self
+    ) -> None:
+        '''
+        Start again in a new worker
+            The parent's metrics are cleared, and its thread is gone
+        '''
+
+        self._lock = threading.Lock()
+        self._thread = None
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def _add(
+        self,
+        metric: Metric,
+    ) -> Metric:
+        '''
+        Add a metric, or get the one with that name
+
+        Args:
+            metric (Metric): The new metric
+
+        Returns:
+            Metric: The metric that is registered
+        '''
+
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(
+        self,
+        name: str,
+        description: str,
+        labels: t.Iterable = (),
+        max_series: int = MAX_SERIES,
+    ) -> Counter:
+        '''
+        Create a counter (see Metric for the arguments)
+
+        Returns:
+            Counter: The counter
+        '''
+
+        return self._add(Counter(name, description, labels, max_series))
+
+    def gauge(
+        self,
+        name: str,
+        description: str,
+        labels: t.Iterable = (),
+        max_series: int = MAX_SERIES,
+    ) -> Gauge:
+        '''
+        Create a gauge (see Metric for the arguments)
+
+        Returns:
+            Gauge: The gauge
+        '''
+
+        return self._add(Gauge(name, description, labels, max_series))
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labels: t.Iterable = (),
+        max_series: int = MAX_SERIES,
+        buckets: t.Iterable = DEFAULT_BUCKETS,
+        span: str = None,
+    ) -> Histogram:
+        '''
+        Create a histogram (see Histogram for the arguments)
+
+        Returns:
+            Histogram: The histogram
+        '''
+
+        return self._add(
+            Histogram(name, description, labels, max_series, buckets, span)
+        )
+
+    def snapshot(
+        self
+    ) -> dict:
+        '''
+        Get every metric's series
+            Series that overflowed are counted as a metric too
+
+        Returns:
+            dict: Metric names, to their snapshot (see Metric.snapshot)
+        '''
+
+        with self._lock:
+            registered = dict(self._metrics)
+
+        snapshot = {
+            name: metric.snapshot() for name, metric in registered.items()
+        }
+        snapshot['pafe_metrics_overflow_total'] = {
+            'type': 'counter',
+            'help': 'Label combinations counted as other, past the limit',
+            'labels': ['metric'],
+            'series': [
+                [[name], metric.overflow]
+                for name, metric in registered.items() if metric.overflow
+            ],
+        }
+
+        return snapshot
+
+    def start(
+        self
+    ) -> None:
+        '''
+        Save this worker's metrics in the background
+            Called once in each worker, after it forks
+        '''
+
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name='metrics',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(
+        self
+    ) -> None:
+        '''
+        Save metrics until the app stops
+        '''
+
+        while True:
+            time.sleep(SAVE_INTERVAL)
+            self.save()
+
+    def save(
+        self
+    ) -> dict:
+        '''
+        Save this worker's metrics, for other workers to read
+            The file is replaced in one step, so readers never see part
+            of it
+
+        Returns:
+            dict: The snapshot that was saved
+        '''
+
+        snapshot = self.snapshot()
+        try:
+            write_atomic(self._file(), encode(snapshot))
+
+        except OSError as e:
+            print(
+                Fore.RED,
+                'Could not save metrics',
+                Style.RESET_ALL
+            )
+            print(e)
+
+        return snapshot
+
+    @staticmethod
+    def _read(
+        path: str,
+    ) -> dict:
+        '''
+        Read a saved snapshot
+
+        Args:
+            path (str): The file
+
+        Returns:
+            dict: The snapshot (empty if the file is missing or broken)
+        '''
+
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(f.read())
+
+        # Another worker may have retired it
+        except (OSError, ValueError):
+            return {}
+
+    def _retire(
+        self,
+        path: str,
+    ) -> None:
+        '''
+        Keep the totals from a worker that has stopped
+            Its counters and histograms are added to the retired totals,
+            so they don't look like a reset. Gauges are dropped
+            The worker's file is removed
+            The caller must hold the retired file's lock
+
+        Args:
+            path (str): The worker's file
+
+        Raises:
+            OSError: If the totals can't be saved
+        '''
+
+        retired = os.path.join(self.path, RETIRED_FILE)
+        stopped = {
+            name: metric for name, metric in self._read(path).items()
+            if metric['type'] != 'gauge'
+        }
+        if stopped:
+            totals = self._combine([self._read(retired), stopped])
+            write_atomic(retired, encode(totals))
+
+        os.remove(path)
+
+    def _collect(
+        self
+    ) -> list:
+        '''
+        Read the snapshots from other workers
+            Files from workers that have stopped saving are retired
+            The caller must hold the retired file's lock, so no worker
+            is counted twice (or not at all) while it's retired
+
+        Returns:
+            list: The snapshots, including the retired totals
+        '''
+
+        try:
+            files = os.listdir(self.path)
+        except OSError:
+            files = []
+
+        snapshots = []
+        now = time.time()
+        own_file = self._file()
+        for file in files:
+            path = os.path.join(self.path, file)
+            if (
+                path == own_file or
+                file == RETIRED_FILE or
+                not file.endswith('.json')
+            ):
+                continue
+
+            try:
+                if now - os.stat(path).st_mtime > WORKER_TIMEOUT:
+                    self._retire(path)
+                    continue
+
+            # Another worker may have retired it
+            except OSError:
+                continue
+
+            snapshots.append(self._read(path))
+
+        snapshots.append(self._read(os.path.join(self.path, RETIRED_FILE)))
+        return snapshots
+
+    @staticmethod
+    def _combine(
+        snapshots: list,
+    ) -> dict:
+        '''
+        Add up snapshots
+            Counters, gauges and histograms with the same labels are
+            added together
+
+        Args:
+            snapshots (list): The snapshots
+
+        Returns:
+            dict: Metric names, to their combined snapshot
+        '''
+
+        merged = {}
+        for snapshot in snapshots:
+            for name, metric in snapshot.items():
+                target = merged.setdefault(
+                    name,
+                    dict(metric, series={}),
+                )
+                for values, value in metric['series']:
+                    key = tuple(values)
+                    current = target['series'].get(key)
+                    if current is None:
+                        target['series'][key] = (
+                            Histogram._copy(value)
+                            if metric['type'] == 'histogram' else value
+                        )
+                    elif metric['type'] == 'histogram':
+                        current['sum'] += value['sum']
+                        current['count'] += value['count']
+                        current['buckets'] = [
+                            a + b for a, b in zip(
+                                current['buckets'], value['buckets']
+                            )
+                        ]
+                    else:
+                        target['series'][key] = current + value
+
+        for metric in merged.values():
+            metric['series'] = sorted(metric['series'].items())
+
+        return merged
+
+    def _merge(
+        self,
+        own: dict,
+    ) -> dict:
+        '''
+        Add up the metrics from every worker
+            Includes the totals from workers that have stopped
+
+        Args:
+            own (dict): This worker's snapshot
+
+        Returns:
+            dict: Metric names, to their merged snapshot
+        '''
+
+        snapshots = [own]
+        try:
+            with locked(os.path.join(self.path, f"{RETIRED_FILE}.lock")):
+                snapshots.extend(self._collect())
+
+        except OSError as e:
+            print(
+                Fore.RED,
+                'Could not read metrics from other workers',
+                Style.RESET_ALL
+            )
+            print(e)
+
+        return self._combine(snapshots)
+
+    def render(
+        self
+    ) -> str:
+        '''
+        Render every worker's metrics in the text format
+
+        Returns:
+            str: The metrics, ready to be scraped
+        '''
+
+        merged = self._merge(self.save())
+
+        lines = []
+        for name, metric in sorted(merged.items()):
+            if not metric['series']:
+                continue
+
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            renderer = (
+                Histogram.lines if metric['type'] == 'histogram'
+                else Metric.lines
+            )
+            lines.extend(renderer(name, metric))
+
+        return '\n'.join(lines) + '\n'
+
+
+# The shared registry
+metrics = MetricsRegistry()
+
+# API routes (streamed responses are timed until they start)
+http_seconds = metrics.histogram(
+    'pafe_http_request_duration_seconds',
+    'Time taken to handle API requests',
+    labels=('route', 'method', 'status'),
+)
+
+# Calls to devices, labelled by their host
+#   Operations are the transport (eg, rest, xml) or Junos RPC name
+device_api_seconds = metrics.histogram(
+    'pafe_device_api_duration_seconds',
+    'Time taken by API calls to devices',
+    labels=('vendor', 'device', 'operation', 'result'),
+    max_series=2000,
+    span='device',
+)
+
+# SQL operations
+sql_seconds = metrics.histogram(
+    'pafe_sql_duration_seconds',
+    'Time taken by SQL operations',
+    labels=('operation', 'table', 'result'),
+    span='sql',
+)
+
+# PBKDF2 key derivations (CPU bound)
+pbkdf2_seconds = metrics.histogram(
+    'pafe_pbkdf2_duration_seconds',
+    'Time taken to derive keys from the master password',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    span='pbkdf2',
+)
+
+# Cache lookups
+cache_requests = metrics.counter(
+    'pafe_cache_requests_total',
+    'Cache lookups, by cache, dataset and result (hit or miss)',
+    labels=('cache', 'dataset', 'result'),
+)
+
+# Devices waiting for a thread or a slot in get_devices()
+device_load_queue = metrics.gauge(
+    'pafe_device_load_queue',
+    'Devices waiting to be loaded',
+)
+
+
+def start_request(
+) -> None:
+    '''
+    Note when an API request starts
+        This is registered as a 'before request' hook
+    '''
+
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(
+    response: Response,
+) -> Response:
+    '''
+    Time an API request
+        This is registered as an 'after request' hook
+        The route is the URL rule, so IDs in URLs don't add series
+
+    Args:
+        response (Response): The response
+
+    Returns:
+        Response: The same response
+    '''
+
+    start = g.get('metrics_start')
+    if start is not None:
+        http_seconds.observe(
+            time.perf_counter() - start,
+            route=(
+                request.url_rule.rule if request.url_rule is not None
+                else 'unmatched'
+            ),
+            method=request.method,
+            status=response.status_code,
+        )
+
+    return response
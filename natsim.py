@@ -0,0 +1,452 @@
+'''
+Simulate NAT on a flow
+
+Given a flow before NAT (the pre-NAT tuple), find the NAT rule that
+    matches it, and work out what the flow looks like after NAT
+
+NAT rules are matched the same way as security rules
+    The rules are compiled into a RuleLookup, and the first match wins
+    NAT rules match on zones, addresses and service (not application)
+
+Bi-directional static NAT also translates traffic in the other direction
+    A reverse rule is added straight after the original rule
+    This matches traffic from any zone to the translated address (in the
+    rule's destination zone), and translates the destination back to the
+    original address
+
+Translations:
+    static-ip: The source is mapped one to one
+        If the original and translated ranges are the same size, the
+        offset in the range is kept (eg, 10.0.0.5 -> 192.0.2.5)
+    dynamic-ip-and-port / dynamic-ip: The source is taken from a pool
+        The first address in the pool is shown, as the device picks one
+    destination-translation: The destination (and port) are replaced
+
+Classes:
+    NatSimulator
+        A compiled NAT rulebase that translates flows
+'''
+
+from objectdiff import members
+from resolver import GroupResolver
+from rulelookup import RuleLookup
+
+import ipaddress
+
+
+class NatSimulator:
+    '''
+    A compiled NAT rulebase that translates flows
+
+    Methods:
+        __init__: Compile the NAT rulebase
+        __len__: The number of NAT rules
+        translate: Translate a single flow
+        translate_many: Translate a list of flows
+        _static: Get the static source translation of a rule
+        _source_nat: Apply a rule's source translation to a flow
+        _destination_nat: Apply a rule's destination translation to a flow
+        _range: Resolve address names to a single IP range
+        _first: Get the first IP from address names
+        _map: Map an IP from one range to another
+    '''
+
+    def __init__(
+        self,
+        rules: list,
+        addresses: list = (),
+        address_groups: list = (),
+        services: list = (),
+        service_groups: list = (),
+        resolver: GroupResolver = None,
+    ) -> None:
+        '''
+        Compile the NAT rulebase
+
+        Args:
+            rules (list): NAT rules, as returned by the API
+            addresses (list): Address objects
+            address_groups (list): Address groups
+            services (list): Service objects
+            service_groups (list): Service groups
+            resolver (GroupResolver): Resolves the objects and groups
+                If this is given, the lists of objects are not used
+        '''
+
+        self.rules = rules
+
+        # Object and group names, resolved to their members
+        if resolver is None:
+            resolver = GroupResolver(
+                addresses=addresses,
+                address_groups=address_groups,
+                services=services,
+                service_groups=service_groups,
+            )
+        self.resolver = resolver
+
+        # Match entries, with a reverse entry for bi-directional rules
+        #   Each entry is (rule position, direction)
+        self._entries = []
+        match_rules = []
+        for position, rule in enumerate(rules):
+            self._entries.append((position, 'forward'))
+            match_rules.append(
+                {
+                    'name': rule.get('name'),
+                    'from': rule.get('from'),
+                    'to': rule.get('to'),
+                    'source': rule.get('source'),
+                    'destination': rule.get('destination'),
+                    'service': rule.get('service'),
+                    'disabled': rule.get('disabled', 'no'),
+                }
+            )
+
+            static = self._static(rule)
+            if static and static.get('bi-directional') == 'yes':
+                self._entries.append((position, 'reverse'))
+                match_rules.append(
+                    {
+                        'name': f"{rule.get('name')} (reverse)",
+                        'from': 'any',
+                        'to': rule.get('to'),
+                        'source': 'any',
+                        'destination': static.get('translated-address'),
+                        'service': 'any',
+                        'disabled': rule.get('disabled', 'no'),
+                    }
+                )
+
+        self._lookup = RuleLookup(rules=match_rules, resolver=resolver)
+
+    def __len__(
+        self
+    ) -> int:
+        '''
+        The number of NAT rules
+
+        Returns:
+            int: Number of rules
+        '''
+
+        return len(self.rules)
+
+    @staticmethod
+    def _static(
+        rule: dict,
+    ) -> dict | None:
+        '''
+        Get the static source translation of a rule, if there is one
+
+        Args:
+            rule (dict): The NAT rule
+
+        Returns:
+            dict: The 'static-ip' settings
+            None: If the rule does not use static NAT
+        '''
+
+        source_trans = rule.get('source_trans')
+        if isinstance(source_trans, dict):
+            return source_trans.get('static-ip')
+
+        return None
+
+    def translate(
+        self,
+        source: str,
+        destination: str,
+        protocol: str = 'tcp',
+        port: int = None,
+        from_zone: str = None,
+        to_zone: str = None,
+    ) -> dict:
+        '''
+        Translate a single flow
+
+        Args:
+            source (str): The source IP (before NAT)
+            destination (str): The destination IP (before NAT)
+            protocol (str): The protocol (tcp or udp)
+            port (int): The destination port (before NAT)
+            from_zone (str): The source zone
+            to_zone (str): The destination zone (before NAT)
+
+        Raises:
+            ValueError: If an IP address is invalid
+
+        Returns:
+            dict: The result
+                match (str): The name of the matching NAT rule, or None
+                position (int): The position of the rule, or None
+                direction (str): 'forward', or 'reverse' for bi-directional
+                pre (dict): The flow before NAT
+                post (dict): The flow after NAT
+                notes (list): Details that couldn't be worked out exactly
+        '''
+
+        pre = {
+            'source': str(ipaddress.ip_address(source)),
+            'destination': str(ipaddress.ip_address(destination)),
+            'protocol': protocol,
+            'port': port,
+        }
+
+        result = self._lookup.lookup(
+            source=source,
+            destination=destination,
+            protocol=protocol,
+            port=port,
+            from_zone=from_zone,
+            to_zone=to_zone,
+        )
+
+        # No NAT rule matched, so the flow is unchanged
+        if result['default']:
+            return {
+                'match': None,
+                'position': None,
+                'direction': None,
+                'pre': pre,
+                'post': dict(pre),
+                'notes': [],
+            }
+
+        position, direction = self._entries[result['position']]
+        rule = self.rules[position]
+        post = dict(pre)
+        notes = []
+
+        # Reverse of bi-directional static NAT, translate the destination
+        if direction == 'reverse':
+            static = self._static(rule)
+            post['destination'] = self._map(
+                pre['destination'],
+                self._range(static.get('translated-address')),
+                self._range(rule.get('source')),
+                notes,
+            )
+
+        else:
+            self._source_nat(rule, pre, post, notes)
+            self._destination_nat(rule, post, notes)
+
+        return {
+            'match': rule.get('name'),
+            'position': position,
+            'direction': direction,
+            'pre': pre,
+            'post': post,
+            'notes': notes,
+        }
+
+    def translate_many(
+        self,
+        flows: list,
+    ) -> list:
+        '''
+        Translate a list of flows
+            Errors are returned with the flow, so one bad flow doesn't
+            stop the others
+
+        Args:
+            flows (list): Dictionaries of 'translate()' arguments
+
+        Returns:
+            list: The result of each flow, in the same order
+        '''
+
+        results = []
+        for flow in flows:
+            try:
+                results.append(self.translate(**flow))
+            except (TypeError, ValueError) as e:
+                results.append({'flow': flow, 'error': str(e)})
+
+        return results
+
+    def _source_nat(
+        self,
+        rule: dict,
+        pre: dict,
+        post: dict,
+        notes: list,
+    ) -> None:
+        '''
+        Apply a rule's source translation to a flow
+
+        Args:
+            rule (dict): The NAT rule
+            pre (dict): The flow before NAT
+            post (dict): The flow after NAT (updated)
+            notes (list): Notes about the translation (updated)
+        '''
+
+        source_trans = rule.get('source_trans')
+        if not isinstance(source_trans, dict):
+            return
+
+        # Static NAT maps one to one
+        if 'static-ip' in source_trans:
+            static = source_trans['static-ip']
+            post['source'] = self._map(
+                pre['source'],
+                self._range(rule.get('source')),
+                self._range(static.get('translated-address')),
+                notes,
+            )
+            return
+
+        # Dynamic NAT picks an address from a pool
+        for kind in ('dynamic-ip-and-port', 'dynamic-ip'):
+            if kind not in source_trans:
+                continue
+
+            settings = source_trans[kind] or {}
+            if 'interface-address' in settings:
+                interface = settings['interface-address']
+                ip = interface.get('ip')
+                # The IP is either the interface IP, or an address object
+                if ip and '/' in ip:
+                    post['source'] = ip.split('/')[0]
+                elif ip:
+                    post['source'] = self._first(ip, notes)
+                else:
+                    post['source'] = None
+                    notes.append(
+                        "Source is the IP of interface "
+                        f"{interface.get('interface')}"
+                    )
+            else:
+                post['source'] = self._first(
+                    settings.get('translated-address'),
+                    notes,
+                )
+                notes.append('Source is picked from a pool')
+
+            if kind == 'dynamic-ip-and-port':
+                notes.append('Source port is picked by the device')
+
+    def _destination_nat(
+        self,
+        rule: dict,
+        post: dict,
+        notes: list,
+    ) -> None:
+        '''
+        Apply a rule's destination translation to a flow
+
+        Args:
+            rule (dict): The NAT rule
+            post (dict): The flow after NAT (updated)
+            notes (list): Notes about the translation (updated)
+        '''
+
+        dest_trans = rule.get('dest_trans')
+        if not isinstance(dest_trans, dict):
+            return
+
+        if dest_trans.get('translated-address'):
+            post['destination'] = self._first(
+                dest_trans['translated-address'],
+                notes,
+            )
+
+        if dest_trans.get('translated-port'):
+            post['port'] = int(dest_trans['translated-port'])
+
+    def _range(
+        self,
+        names,
+    ) -> tuple[int, int, int] | None:
+        '''
+        Resolve address names to a single IP range
+            Used for static NAT, which maps one range to another
+
+        Args:
+            names: Address objects, groups or IPs (as 'members()' accepts)
+
+        Returns:
+            tuple: (version, first IP, last IP)
+            None: If this isn't a single IP range
+        '''
+
+        values = self.resolver.resolve_many('address', members(names)).values
+        if len(values) != 1:
+            return None
+
+        return values[0]
+
+    def _first(
+        self,
+        names,
+        notes: list,
+    ) -> str | None:
+        '''
+        Get the first IP from address names
+
+        Args:
+            names: Address objects, groups or IPs (as 'members()' accepts)
+            notes (list): Notes about the translation (updated)
+
+        Returns:
+            str: The first IP
+            None: If the names can't be resolved to an IP
+        '''
+
+        for value in members(names):
+            values = self.resolver.resolve('address', value).values
+            if values:
+                # Integers alone don't say which IP version they are
+                version, first, _ = values[0]
+                address = (
+                    ipaddress.IPv4Address if version == 4
+                    else ipaddress.IPv6Address
+                )
+                return str(address(first))
+
+        notes.append(f'Could not resolve {names} to an IP')
+        return None
+
+    @staticmethod
+    def _map(
+        ip: str,
+        original: tuple | None,
+        translated: tuple | None,
+        notes: list,
+    ) -> str | None:
+        '''
+        Map an IP from one range to another
+
+        Args:
+            ip (str): The IP to map
+            original (tuple): The range the IP is in
+            translated (tuple): The range to map to
+            notes (list): Notes about the translation (updated)
+
+        Returns:
+            str: The mapped IP
+            None: If the translated range is unknown
+        '''
+
+        if translated is None:
+            notes.append('Could not resolve the translated address')
+            return None
+
+        version, first, last = translated
+        value = first
+
+        # Keep the offset if the ranges are the same size
+        if (
+            original is not None and
+            original[0] == version and
+            original[2] - original[1] == last - first
+        ):
+            value = first + int(ipaddress.ip_address(ip)) - original[1]
+
+        # Integers alone don't say which IP version they are
+        address = (
+            ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        )
+        return str(address(value))
@@ -0,0 +1,311 @@
+'''
+Find unused and duplicate objects
+
+Unused objects are found with a reference graph
+    (1) Policies (security, NAT and QoS) reference objects and groups
+    (2) Groups reference objects and other groups
+    Anything that can't be reached from a policy is unused, including
+    objects that are only in unused groups
+    If any policies couldn't be collected, these are listed as unknown
+    instead, as a missing policy may use them
+
+Duplicates are objects with the same value, but different names
+    Each object's value is normalized (eg, 10.1.1.1 and 10.1.1.1/32 are
+    the same), and hashed. Objects with the same hash are duplicates.
+    This takes one pass over the objects, rather than comparing each pair
+
+Across the fleet, objects are compared between devices
+    Duplicates: the same value with different names (eg, on each site)
+    Inconsistent: the same name with different values
+
+Functions:
+    object_values
+        Get the normalized value of each object
+    analyse_device
+        Find unused and duplicate objects on a device
+    analyse_fleet
+        Compare objects across many devices
+'''
+
+from objectdiff import content_hash, members, normalize
+
+
+# Object datasets, the names they share, and the field with their value
+OBJECT_DATASETS = {
+    'addresses': ('address', ('addr',)),
+    'address_groups': ('address', ('static',)),
+    'services': ('service', ('protocol', 'dest_port')),
+    'service_groups': ('service', ('members',)),
+}
+
+# Policy datasets, and the fields that reference each kind of name
+POLICY_DATASETS = {
+    'security': {
+        'address': ('source', 'destination'),
+        'service': ('service',),
+    },
+    'nat': {
+        'address': ('source', 'destination'),
+        'service': ('service',),
+    },
+    'qos': {
+        'address': ('source', 'destination'),
+        'service': ('service',),
+    },
+}
+
+# Names that are not objects
+RESERVED = {'any', 'application-default', 'none'}
+
+
+def _translated(
+    rule: dict,
+) -> list:
+    '''
+    Get the translated addresses of a NAT rule
+
+    Args:
+        rule (dict): A NAT rule
+
+    Returns:
+        list: Address names used in the source and destination translation
+    '''
+
+    names = []
+    for field in ('source_trans', 'dest_trans'):
+        value = rule.get(field)
+        if not isinstance(value, dict):
+            continue
+
+        # Destination translation has the address at the top level
+        if 'translated-address' in value:
+            names.extend(members(value['translated-address']))
+
+        for settings in value.values():
+            if isinstance(settings, dict):
+                names.extend(members(settings.get('translated-address')))
+
+    return names
+
+
+def _items(
+    dataset,
+) -> list:
+    '''
+    Get the entries of a dataset
+
+    Args:
+        dataset: A Dataset, a list of entries, or None
+
+    Returns:
+        list: The entries
+    '''
+
+    if dataset is None:
+        return []
+
+    return getattr(dataset, 'items', dataset)
+
+
+def object_values(
+    datasets: dict,
+) -> list:
+    '''
+    Get the normalized value of each object
+
+    Args:
+        datasets (dict): Dataset objects (or lists of entries), by name
+
+    Returns:
+        list: Tuples of (dataset, name, value hash, value)
+            Objects with no value (eg, 'No IP') are left out
+    '''
+
+    values = []
+    for dataset, (_, fields) in OBJECT_DATASETS.items():
+        for entry in _items(datasets.get(dataset)):
+            normal = normalize(entry)
+            value = {
+                field: normal[field] for field in fields if field in normal
+            }
+            if value:
+                values.append(
+                    (dataset, entry.get('name'), content_hash(value), value)
+                )
+
+    return values
+
+
+def analyse_device(
+    datasets: dict,
+) -> dict:
+    '''
+    Find unused and duplicate objects on a device
+
+    Args:
+        datasets (dict): Dataset objects (or lists of entries), by name
+            Objects, groups, and policies (security, nat, qos)
+
+    Returns:
+        dict: The results
+            unused (list): Objects and groups not used by any policy
+                type (str): The dataset (eg, 'addresses')
+                name (str): The object name
+                groups (list): Unused groups that contain it
+            unknown (list): Objects and groups not used by the policies
+                that were collected (as for 'unused')
+                Only when some policies are incomplete, as they may
+                be used by those
+            duplicates (list): Objects with the same value
+                type (str): The dataset
+                value (dict): The normalized value
+                names (list): The objects with this value
+            counts (dict): The number of objects in each dataset
+            incomplete (list): Policy datasets that weren't available
+    '''
+
+    # Every object and group, by the kind of name
+    defined = {'address': {}, 'service': {}}
+    groups = {'address': {}, 'service': {}}
+    for dataset, (kind, _) in OBJECT_DATASETS.items():
+        for entry in _items(datasets.get(dataset)):
+            defined[kind][entry.get('name')] = dataset
+            if dataset.endswith('_groups'):
+                field = 'static' if kind == 'address' else 'members'
+                groups[kind][entry.get('name')] = members(entry.get(field))
+
+    # Names referenced directly by policies
+    used = {'address': set(), 'service': set()}
+    incomplete = []
+    for dataset, fields in POLICY_DATASETS.items():
+        if datasets.get(dataset) is None:
+            incomplete.append(dataset)
+            continue
+
+        for rule in _items(datasets[dataset]):
+            for kind, names in fields.items():
+                for field in names:
+                    used[kind].update(members(rule.get(field)))
+            if dataset == 'nat':
+                used['address'].update(_translated(rule))
+
+    # Follow groups to everything they contain (each group is seen once)
+    for kind in used:
+        pending = [name for name in used[kind] if name in groups[kind]]
+        while pending:
+            for member in groups[kind][pending.pop()]:
+                if member not in used[kind]:
+                    used[kind].add(member)
+                    if member in groups[kind]:
+                        pending.append(member)
+
+    # Groups that contain each unused object
+    unused = []
+    for kind in defined:
+        containers = {}
+        for group, names in groups[kind].items():
+            for name in names:
+                containers.setdefault(name, []).append(group)
+
+        for name, dataset in sorted(defined[kind].items()):
+            if name in used[kind] or name.lower() in RESERVED:
+                continue
+            unused.append(
+                {
+                    'type': dataset,
+                    'name': name,
+                    'groups': sorted(containers.get(name, [])),
+                }
+            )
+
+    # Objects with the same value hash are duplicates
+    by_hash = {}
+    for dataset, name, digest, value in object_values(datasets):
+        by_hash.setdefault((dataset, digest), (value, []))[1].append(name)
+
+    duplicates = [
+        {'type': dataset, 'value': value, 'names': sorted(names)}
+        for (dataset, _), (value, names) in by_hash.items()
+        if len(names) > 1
+    ]
+    duplicates.sort(key=lambda entry: (entry['type'], entry['names']))
+
+    return {
+        'unused': [] if incomplete else unused,
+        'unknown': unused if incomplete else [],
+        'duplicates': duplicates,
+        'counts': {
+            dataset: len(_items(datasets.get(dataset)))
+            for dataset in OBJECT_DATASETS
+        },
+        'incomplete': incomplete,
+    }
+
+
+def analyse_fleet(
+    devices: list,
+) -> dict:
+    '''
+    Compare objects across many devices
+
+    Args:
+        devices (list): Dictionaries for each device
+            id (str): The device ID
+            name (str): The device name
+            site (str): The site name
+            values (list): From 'object_values()'
+
+    Returns:
+        dict: The results
+            duplicates (list): Values with more than one name
+                type (str): The dataset
+                value (dict): The normalized value
+                names (dict): Each name, to the devices that use it
+                sites (list): The sites these objects are on
+            inconsistent (list): Names with more than one value
+                type (str): The dataset
+                name (str): The object name
+                values (list): Each value, with the devices that use it
+    '''
+
+    by_value = {}
+    by_name = {}
+    for device in devices:
+        for dataset, name, digest, value in device['values']:
+            entry = by_value.setdefault((dataset, digest), (value, {}, set()))
+            entry[1].setdefault(name, []).append(device['name'])
+            entry[2].add(device['site'] or '')
+
+            by_name.setdefault((dataset, name), {}).setdefault(
+                digest, (value, [])
+            )[1].append(device['name'])
+
+    duplicates = [
+        {
+            'type': dataset,
+            'value': value,
+            'names': {name: sorted(used) for name, used in names.items()},
+            'sites': sorted(sites),
+        }
+        for (dataset, _), (value, names, sites) in by_value.items()
+        if len(names) > 1
+    ]
+    duplicates.sort(key=lambda entry: (entry['type'], sorted(entry['names'])))
+
+    inconsistent = [
+        {
+            'type': dataset,
+            'name': name,
+            'values': [
+                {'value': value, 'devices': sorted(used)}
+                for value, used in values.values()
+            ],
+        }
+        for (dataset, name), values in sorted(by_name.items())
+        if len(values) > 1
+    ]
+
+    return {
+        'duplicates': duplicates,
+        'inconsistent': inconsistent,
+    }
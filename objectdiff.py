@@ -0,0 +1,329 @@
+'''
+Compare lists of objects or policies from two devices
+
+Entries are normalized to a common form, so PAN-OS and Junos entries
+    can be compared with each other
+    (1) Placeholder values (eg, 'No description') are removed
+    (2) Member lists are sorted, in whatever form the vendor uses
+    (3) IP addresses are written the same way (eg, 10.1.1.1/32)
+    (4) PAN-OS service protocols are split into protocol and port
+
+Entries are matched by name, using a dictionary
+    Identical entries are skipped, and the rest are normalized and hashed
+    This finds added, removed and changed entries in linear time
+
+Functions:
+    members
+        Get a list of members from a field
+    normalize
+        Convert an entry to the common form
+    content_hash
+        Hash the contents of a normalized entry
+    moved
+        Find entries that are in a different order
+    diff
+        Compare two lists of entries
+'''
+
+import bisect
+import hashlib
+import ipaddress
+
+from jsonprovider import encode
+
+
+# Values that mean the field is empty
+PLACEHOLDERS = {
+    '',
+    'none',
+    'no ip',
+    'no tag',
+    'no tags',
+    'no port',
+    'no colour',
+    'no members',
+    'no description',
+    'no description available',
+    'no applications',
+}
+
+# Fields that hold a list of names, where the order does not matter
+MEMBER_FIELDS = {
+    'tag',
+    'tag_group',
+    'static',
+    'members',
+    'to',
+    'from',
+    'source',
+    'destination',
+    'source_user',
+    'category',
+    'application',
+    'service',
+}
+
+
+def members(
+    value,
+) -> list:
+    '''
+    Get a list of members from a field
+        Fields may be a string, a list, or a dict with a 'member' list
+        Junos lists are dicts with a 'name' key
+
+    Args:
+        value: The value of the field
+
+    Returns:
+        list: The members, as strings
+    '''
+
+    if isinstance(value, dict):
+        value = value.get('member', [])
+
+    if isinstance(value, list):
+        names = []
+        for member in value:
+            if isinstance(member, dict):
+                member = member.get('name', '')
+            names.append(str(member))
+        return names
+
+    if value is None:
+        return []
+
+    return [str(value)]
+
+
+def _address(
+    value: str,
+) -> str:
+    '''
+    Write an IP address, prefix or range in a standard way
+
+    Args:
+        value (str): The address
+
+    Returns:
+        str: The standard form, or the original value if it's not an IP
+    '''
+
+    try:
+        if '-' in value:
+            first, last = value.split('-')
+            first = ipaddress.ip_address(first.strip())
+            last = ipaddress.ip_address(last.strip())
+            return f'{first}-{last}'
+
+        return str(ipaddress.ip_network(value.strip(), strict=False))
+
+    # FQDNs and other values are left as they are
+    except ValueError:
+        return value.strip()
+
+
+def normalize(
+    entry: dict,
+) -> dict:
+    '''
+    Convert an entry to the common form
+
+    Args:
+        entry (dict): An entry, as returned by the API
+
+    Returns:
+        dict: The normalized entry, without the name
+    '''
+
+    normal = {}
+    for field, value in entry.items():
+        if field == 'name':
+            continue
+
+        # PAN-OS protocols look like {'tcp': {'port': '443'}}
+        if field == 'protocol' and isinstance(value, dict):
+            for protocol, settings in value.items():
+                normal['protocol'] = protocol
+                if isinstance(settings, dict) and 'port' in settings:
+                    normal['dest_port'] = str(settings['port'])
+            continue
+
+        # Lists of names are sorted, without placeholders
+        if field in MEMBER_FIELDS:
+            names = sorted(
+                name.strip() for name in members(value)
+                if name.strip().lower() not in PLACEHOLDERS
+            )
+            if names:
+                normal[field] = names
+            continue
+
+        # Other nested values are compared as they are
+        if isinstance(value, (dict, list)):
+            normal[field] = value
+            continue
+
+        value = str(value).strip()
+        if value.lower() in PLACEHOLDERS:
+            continue
+
+        normal[field] = _address(value) if field == 'addr' else value
+
+    return normal
+
+
+def content_hash(
+    normal: dict,
+) -> str:
+    '''
+    Hash the contents of a normalized entry
+
+    Args:
+        normal (dict): The normalized entry
+
+    Returns:
+        str: The hash
+    '''
+
+    return hashlib.sha1(
+        encode(normal, sort_keys=True, default=str)
+    ).hexdigest()
+
+
+def moved(
+    names: list,
+    position: dict,
+) -> list:
+    '''
+    Find entries that are in a different order on the second device
+        The longest run of entries already in order is kept in place,
+        and everything else is counted as moved
+
+    Args:
+        names (list): Names that are on both devices, in the first order
+        position (dict): The position of each name on the second device
+
+    Returns:
+        list: Names of the entries that have moved
+    '''
+
+    # Longest increasing subsequence of positions (patience sorting)
+    tails = []
+    tail_index = []
+    previous = [None] * len(names)
+    for index, name in enumerate(names):
+        spot = bisect.bisect_left(tails, position[name])
+        if spot == len(tails):
+            tails.append(position[name])
+            tail_index.append(index)
+        else:
+            tails[spot] = position[name]
+            tail_index[spot] = index
+        previous[index] = tail_index[spot - 1] if spot else None
+
+    # Walk back through the subsequence to find what stayed in order
+    in_order = set()
+    index = tail_index[-1] if tail_index else None
+    while index is not None:
+        in_order.add(index)
+        index = previous[index]
+
+    return [
+        name for index, name in enumerate(names)
+        if index not in in_order
+    ]
+
+
+def diff(
+    list_a: list,
+    list_b: list,
+    ordered: bool = False,
+) -> dict:
+    '''
+    Compare two lists of entries
+        Entries are matched by name (ignoring case)
+
+    Args:
+        list_a (list): Entries from the first device
+        list_b (list): Entries from the second device
+        ordered (bool): The order matters (eg, policies)
+
+    Returns:
+        dict: The differences
+            added (list): Entries only on the second device
+            removed (list): Entries only on the first device
+            changed (list): Entries on both devices, with differences
+                name (str): The name of the entry
+                fields (list): The fields that are different
+                a (dict): The entry from the first device
+                b (dict): The entry from the second device
+            moved (list): Names of entries in a different order
+                Only included if the order matters
+            unchanged (int): Number of entries that are the same
+    '''
+
+    # Index the second list by name
+    index_b = {}
+    for position, entry in enumerate(list_b):
+        index_b[str(entry.get('name', '')).lower()] = (position, entry)
+
+    removed = []
+    changed = []
+    common = []
+    unchanged = 0
+
+    for entry_a in list_a:
+        key = str(entry_a.get('name', '')).lower()
+        if key not in index_b:
+            removed.append(entry_a)
+            continue
+
+        common.append(key)
+        entry_b = index_b[key][1]
+
+        # Identical entries don't need to be normalized
+        if entry_a == entry_b:
+            unchanged += 1
+            continue
+
+        normal_a = normalize(entry_a)
+        normal_b = normalize(entry_b)
+
+        if content_hash(normal_a) == content_hash(normal_b):
+            unchanged += 1
+            continue
+
+        changed.append(
+            {
+                'name': entry_a.get('name'),
+                'fields': sorted(
+                    field for field in normal_a.keys() | normal_b.keys()
+                    if normal_a.get(field) != normal_b.get(field)
+                ),
+                'a': entry_a,
+                'b': entry_b,
+            }
+        )
+
+    # Anything left in the second list was added
+    names_a = set(common)
+    added = [
+        entry for key, (_, entry) in index_b.items()
+        if key not in names_a
+    ]
+
+    result = {
+        'added': added,
+        'removed': removed,
+        'changed': changed,
+        'unchanged': unchanged,
+    }
+
+    if ordered:
+        position = {key: index_b[key][0] for key in common}
+        result['moved'] = [
+            index_b[key][1].get('name') for key in moved(common, position)
+        ]
+
+    return result
@@ -23,6 +23,18 @@ Authentication:
         (prefixed with 'Basic')
 
     The REST API uses a token, which is sent in the 'X-PAN-KEY' header
+
+Classes:
+    DeviceApi
+        Access a device's API
+    AsyncDeviceApi
+        The same methods, as coroutines, for calling many devices at once
+
+Functions:
+    async_session
+        Get the HTTP session shared by async clients on this event loop
+    close_async_session
+        Close the HTTP session for this event loop
 '''
 
 
@@ -36,6 +48,525 @@ import json
 from colorama import Fore, Style
 import xml.etree.ElementTree as ET
 
+import asyncio
+import weakref
+
+from metrics import device_api_seconds
+from profiling import traced
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# XML API commands
+XML_CONFIG = "/?type=config&action=show&xpath=/"
+XML_SYSTEM_INFO = (
+    "/?type=op&cmd=<show><system><info></info></system></show>"
+)
+XML_HA_STATE = (
+    "/?type=op&cmd=<show>"
+    "<high-availability>"
+    "<state></state>"
+    "</high-availability>"
+    "</show>"
+)
+XML_GP_SESSIONS = (
+    "/?type=op&cmd=<show>"
+    "<global-protect-gateway>"
+    "<current-user/>"
+    "</global-protect-gateway>"
+    "</show>"
+)
+XML_VPN_FLOW = (
+    "/?type=op&cmd=<show>"
+    "<vpn>"
+    "<flow>"
+    "</flow>"
+    "</vpn>"
+    "</show>"
+)
+
+# Connections shared by the async client (total, and per device)
+ASYNC_POOL_SIZE = 1000
+ASYNC_POOL_PER_HOST = 4
+
+# Seconds before an async request is abandoned
+ASYNC_TIMEOUT = 120
+
+# Shared HTTP sessions for the async client, one per event loop
+_sessions = weakref.WeakKeyDictionary()
+
+
+def _error_message(
+    text: str,
+) -> str:
+    '''
+    Get the error message from an XML API response
+
+    Args:
+        text (str): The response body
+
+    Returns:
+        str: The message, or the body if there isn't one
+    '''
+
+    try:
+        msg_tag = ET.fromstring(text).find(".//msg")
+    except ET.ParseError:
+        return text
+
+    return msg_tag.text if msg_tag is not None else text
+
+
+@traced('xml')
+def _parse_config(
+    text: str,
+) -> str:
+    '''
+    Remove the outer tags from a config
+
+    Args:
+        text (str): The response to XML_CONFIG
+
+    Returns:
+        str: The configuration in XML format
+    '''
+
+    root = ET.fromstring(text)
+    result_content = root.find('.//config')
+    if result_content is None:
+        return ''
+
+    return ET.tostring(
+        result_content,
+        encoding='unicode',
+        method='xml'
+    )
+
+
+@traced('xml')
+def _parse_device(
+    text: str,
+) -> Tuple[str, str, str]:
+    '''
+    Get the device basics from a response
+
+    Args:
+        text (str): The response to XML_SYSTEM_INFO
+
+    Returns:
+        Tuple[str, str, str]:
+            The model, serial number, and software version of the device.
+    '''
+
+    root = ET.fromstring(text)
+    model = root.find(".//model").text
+    serial = root.find(".//serial").text
+    version = root.find(".//sw-version").text
+
+    return model, serial, version
+
+
+@traced('xml')
+def _parse_ha(
+    text: str,
+) -> Union[bool, Tuple[bool, str, str, str, str]]:
+    '''
+    Get high availability details from a response
+
+    Args:
+        text (str): The response to XML_HA_STATE
+
+    Returns:
+        bool: False if HA is disabled
+        Tuple[bool, str, str, str, str]:
+            Whether the device is enabled, local state, peer state,
+            peer serial number, and config sync state
+    '''
+
+    root = ET.fromstring(text)
+    enabled = root.find(".//enabled").text == 'yes'
+    if not enabled:
+        return False
+
+    local_state = root.find(".//state").text
+    peer_state = root.find(".//peer-info/state").text
+    peer_serial = root.find(".//peer-info/serial-num").text
+
+    # Whether the running config is synchronized with the peer
+    running_sync = root.find(".//running-sync")
+    sync_state = running_sync.text if running_sync is not None else None
+
+    return enabled, local_state, peer_state, peer_serial, sync_state
+
+
+@traced('xml')
+def _parse_gp_sessions(
+    text: str,
+) -> list:
+    '''
+    Get Global Protect sessions from a response
+
+    Args:
+        text (str): The response to XML_GP_SESSIONS
+
+    Returns:
+        list of dicts: The active sessions.
+    '''
+
+    root = ET.fromstring(text)
+    results = root.find(".//result")
+
+    session_list = []
+    for gp_session in results:
+        session = {
+            'username': gp_session.find(".//username").text,
+            'primary-username': gp_session.find(
+                ".//primary-username"
+            ).text,
+            'source-region': gp_session.find(".//source-region").text,
+            'computer': gp_session.find(".//computer").text,
+            'client': gp_session.find(".//client").text,
+            'vpn-type': gp_session.find(".//vpn-type").text,
+            'host-id': gp_session.find(".//host-id").text,
+            'app-version': gp_session.find(".//app-version").text,
+            'virtual-ip': gp_session.find(".//virtual-ip").text,
+            'public-ip': gp_session.find(".//public-ip").text,
+            'tunnel-type': gp_session.find(".//tunnel-type").text,
+            'login-time': gp_session.find(".//login-time").text,
+            'login-time-utc': gp_session.findtext(".//login-time-utc"),
+        }
+        session_list.append(session)
+
+    return session_list
+
+
+@traced('xml')
+def _parse_vpn_status(
+    text: str,
+) -> list:
+    '''
+    Get VPN tunnel status from a response
+
+    Args:
+        text (str): The response to XML_VPN_FLOW
+
+    Returns:
+        list of dicts: The tunnels.
+    '''
+
+    root = ET.fromstring(text)
+    results = root.find(".//result/IPSec")
+
+    tunnel_list = []
+    for vpn in results:
+        tunnel = {
+            'id': vpn.find(".//id").text,
+            'name': vpn.find(".//name").text,
+            'inner-if': vpn.find(".//inner-if").text,
+            'outer-if': vpn.find(".//outer-if").text,
+            'gwid': vpn.find(".//gwid").text,
+            'ipsec-mode': vpn.find(".//ipsec-mode").text,
+            'localip': vpn.find(".//localip").text,
+            'peerip': vpn.find(".//peerip").text,
+            'state': vpn.find(".//state").text,
+            'monitor': vpn.find(".//mon").text,
+            'owner': vpn.find(".//owner").text,
+        }
+        tunnel_list.append(tunnel)
+
+    return tunnel_list
+
+
+def _tag_members(
+    tags: str | list,
+) -> list:
+    '''
+    Turn tags into a list of members
+
+    Args:
+        tags (str | list): A tag, comma separated tags, or a list
+
+    Returns:
+        list: The tags
+    '''
+
+    # If there's more than one tag, split them into a list
+    if isinstance(tags, str) and "," in tags:
+        tags = tags.split(",")
+
+    # If it's not a list, make it a list
+    if type(tags) is not list:
+        tags = [tags]
+
+    return tags
+
+
+def _tag_body(
+    name: str,
+    colour: str,
+    comment: str,
+) -> dict:
+    '''
+    Build the body to create a tag
+
+    Args:
+        name (str): The name of the tag
+        colour (str): The colour of the tag
+        comment (str): The comment of the tag
+
+    Returns:
+        dict: The request body
+    '''
+
+    body = {
+        "entry": {
+            "@name": name,
+            "comments": comment
+        }
+    }
+
+    # Add the colour if it is not 'no colour' or None
+    if colour is not None and colour != 'no colour':
+        body['color'] = colour
+
+    return body
+
+
+def _address_body(
+    name: str,
+    address: str,
+    description: str = None,
+    tags: str = None,
+) -> dict:
+    '''
+    Build the body to create an address object
+
+    Args:
+        name (str): The name of the address object
+        address (str): The IP address and netmask
+        description (str): The description of the address
+        tags (str): Zero or more tags to apply to the address
+
+    Returns:
+        dict: The request body
+    '''
+
+    body = {
+        "entry": {
+            "@name": name,
+            "ip-netmask": address,
+        }
+    }
+
+    # Add the tag if it is has been included
+    if tags is not None:
+        body['entry']['tag'] = {'member': _tag_members(tags)}
+
+    # Add a description if it has been included
+    if description is not None:
+        body['entry']['description'] = description
+
+    return body
+
+
+def _addr_group_body(
+    name: str,
+    members: list,
+    description: str = None,
+    tags: str = None,
+) -> dict | None:
+    '''
+    Build the body to create an address group
+
+    Args:
+        name (str): The name of the address group
+        members (list): The members of the group
+        description (str): The description of the group
+        tags (str): Zero or more tags to apply to the group
+
+    Returns:
+        dict: The request body
+        None: If the members are not valid
+    '''
+
+    # Sanity check for 'members'
+    if not members:
+        print(
+            Fore.RED,
+            'Error: No members provided',
+            Style.RESET_ALL
+        )
+        return None
+
+    if type(members) is not list:
+        print(
+            Fore.RED,
+            'Error: Members should be a list',
+            Style.RESET_ALL
+        )
+        return None
+
+    body = {
+        "entry": {
+            "@name": name,
+            "static": {
+                "member": members
+            },
+            "description": description
+        }
+    }
+
+    # Add the tag if it is has been included
+    if tags is not None:
+        body['entry']['tag'] = {'member': _tag_members(tags)}
+
+    # Add a description if it has been included
+    if description is not None:
+        body['entry']['description'] = description
+
+    return body
+
+
+def _app_group_body(
+    name: str,
+    members: list,
+) -> dict:
+    '''
+    Build the body to create an application group
+
+    Args:
+        name (str): The name of the application group
+        members (list): The members of the group
+
+    Returns:
+        dict: The request body
+    '''
+
+    return {
+        "entry": {
+            "@name": name,
+            "members": {
+                "member": members
+            }
+        }
+    }
+
+
+def _service_body(
+    name: str,
+    protocol: str,
+    dest_port: str,
+    description: str = '',
+    tags: str = None,
+) -> dict:
+    '''
+    Build the body to create a service object
+
+    Args:
+        name (str): The name of the service object
+        protocol (str): The protocol of the service (eg, tcp)
+        dest_port (str): The destination port of the service
+        description (str): The description of the service
+        tags (str): Zero or more tags to apply to the service
+
+    Returns:
+        dict: The request body
+    '''
+
+    body = {
+        "entry": {
+            "@name": name,
+            "protocol": {
+                protocol: {
+                    "port": dest_port
+                }
+            }
+        }
+    }
+
+    # Add the tag if it is has been included
+    if tags is not None:
+        body['entry']['tag'] = {'member': _tag_members(tags)}
+
+    # Add a description if it has been included
+    if description is not None:
+        body['entry']['description'] = description
+
+    return body
+
+
+def _service_group_body(
+    name: str,
+    members: list,
+    tags: str = None,
+) -> dict:
+    '''
+    Build the body to create a service group
+
+    Args:
+        name (str): The name of the service group
+        members (list): The members of the group
+        tags (str): Zero or more tags to apply to the group
+
+    Returns:
+        dict: The request body
+    '''
+
+    body = {
+        "entry": {
+            "@name": name,
+            "members": {
+                "member": members
+            }
+        }
+    }
+
+    # Add the tag if it is has been included
+    if tags is not None:
+        body['entry']['tag'] = {'member': _tag_members(tags)}
+
+    return body
+
+
+def async_session(
+) -> 'aiohttp.ClientSession':
+    '''
+    Get the HTTP session shared by async clients on this event loop
+        Connections are pooled and reused across devices and calls
+
+    Returns:
+        aiohttp.ClientSession: The session
+    '''
+
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=ASYNC_POOL_SIZE,
+                limit_per_host=ASYNC_POOL_PER_HOST,
+            ),
+            timeout=aiohttp.ClientTimeout(total=ASYNC_TIMEOUT),
+        )
+        _sessions[loop] = session
+
+    return session
+
+
+async def close_async_session(
+) -> None:
+    '''
+    Close the HTTP session for this event loop
+        Call this before the event loop is closed
+    '''
+
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
 
 class DeviceApi:
     '''
@@ -51,6 +582,7 @@ class DeviceApi:
         __exit__: Exit method for context manager
         _rest_request: Send a REST request to the device
         _xml_request: Send an XML request to the device
+        _rest_post: Send a REST request to create an entry on the device
         get_config: Get the running configuration of the device
         get_device: Get the device basics
         get_ha: Get high availability details
@@ -167,12 +699,18 @@ class DeviceApi:
             int: The response code if an error occurred
         '''
 
-        # Send the request
-        response = requests.get(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-        )
+        # Send the request (timed, see metrics.py)
+        with device_api_seconds.time(
+            vendor='paloalto',
+            device=self.hostname,
+            operation='rest',
+        ) as call:
+            response = requests.get(
+                f"{self.rest_base_url}{url}",
+                headers=self.rest_headers,
+                params=self.params,
+            )
+            call.ok = response.status_code == 200
 
         # Check the response code for errors
         if response.status_code != 200:
@@ -204,7 +742,13 @@ class DeviceApi:
 
         full_url = f"{self.xml_base_url}{url}"
         try:
-            response = requests.get(full_url, headers=self.xml_headers)
+            with device_api_seconds.time(
+                vendor='paloalto',
+                device=self.hostname,
+                operation='xml',
+            ) as call:
+                response = requests.get(full_url, headers=self.xml_headers)
+                call.ok = response.status_code == 200
         except (ConnectionError, MaxRetryError, NewConnectionError) as e:
             print(
                 Fore.RED,
@@ -223,13 +767,62 @@ class DeviceApi:
             return 500
 
         if response.status_code != 200:
-            root = ET.fromstring(response.text)
-            msg_tag = root.find(".//msg")
-            print(Fore.RED, msg_tag.text, Style.RESET_ALL)
+            print(Fore.RED, _error_message(response.text), Style.RESET_ALL)
             return response.status_code
 
         return response.text
 
+    def _rest_post(
+        self,
+        url: str,
+        name: str,
+        body: dict,
+    ) -> dict | int:
+        '''
+        Send a REST request to create an entry on the device
+
+        Args:
+            url (str): The URL to send the request to
+                Example: "/Objects/Tags"
+            name (str): The name of the entry
+            body (dict): The request body
+
+        Returns:
+            dict: The response body
+            int: The response code if an error occurred
+        '''
+
+        # The name in the params must be the same as the name in the body
+        params = {**self.params, 'name': name}
+
+        # Send the request
+        with device_api_seconds.time(
+            vendor='paloalto',
+            device=self.hostname,
+            operation='rest_post',
+        ) as call:
+            response = requests.post(
+                f"{self.rest_base_url}{url}",
+                headers=self.rest_headers,
+                params=params,
+                json=body,
+            )
+            call.ok = response.status_code == 200
+
+        # Check the response code for errors
+        if response.status_code != 200:
+            print(
+                Fore.RED,
+                response.status_code,
+                response.text,
+                Style.RESET_ALL
+            )
+
+            return response.status_code
+
+        # Return the body of the response
+        return response.json()
+
     def get_config(
         self
     ) -> Union[str, int]:
@@ -242,7 +835,7 @@ class DeviceApi:
         '''
 
         # Send an XML request
-        xml_config = self._xml_request("/?type=config&action=show&xpath=/")
+        xml_config = self._xml_request(XML_CONFIG)
 
         # If we get an error code, return it
         if isinstance(xml_config, int):
@@ -250,18 +843,7 @@ class DeviceApi:
             return xml_config
 
         # Clean the XML to remove the outer tags
-        root = ET.fromstring(xml_config)
-        result_content = root.find('.//config')
-        if result_content is not None:
-            cleaned_xml = ET.tostring(
-                result_content,
-                encoding='unicode',
-                method='xml'
-            )
-        else:
-            cleaned_xml = ''
-
-        return cleaned_xml
+        return _parse_config(xml_config)
 
     def get_device(
         self
@@ -275,55 +857,34 @@ class DeviceApi:
             int: The response code if an error occurred.
         '''
 
-        response = self._xml_request(
-            "/?type=op&cmd=<show><system><info></info></system></show>"
-        )
+        response = self._xml_request(XML_SYSTEM_INFO)
         if isinstance(response, int):
             return response
 
-        root = ET.fromstring(response)
-        model = root.find(".//model").text
-        serial = root.find(".//serial").text
-        version = root.find(".//sw-version").text
-
-        return model, serial, version
+        return _parse_device(response)
 
     def get_ha(
         self
-    ) -> Union[bool, Tuple[bool, str, str, str], int]:
+    ) -> Union[bool, Tuple[bool, str, str, str, str], int]:
         '''
         Get high availability details using the XML API.
 
         Returns:
             bool:
                 Whether the device is enabled (False if HA is disabled).
-            Tuple[bool, str, str, str]:
+            Tuple[bool, str, str, str, str]:
                 Whether the device is enabled, local state,
-                    peer state, and peer serial number.
+                    peer state, peer serial number, and config sync
+                    state (eg, 'synchronized', or None if unknown).
             int:
                 The response code if an error occurred.
         '''
 
-        response = self._xml_request(
-            "/?type=op&cmd=<show>"
-            "<high-availability>"
-            "<state></state>"
-            "</high-availability>"
-            "</show>"
-        )
+        response = self._xml_request(XML_HA_STATE)
         if isinstance(response, int):
             return response
 
-        root = ET.fromstring(response)
-        enabled = root.find(".//enabled").text == 'yes'
-        if not enabled:
-            return False
-
-        local_state = root.find(".//state").text
-        peer_state = root.find(".//peer-info/state").text
-        peer_serial = root.find(".//peer-info/serial-num").text
-
-        return enabled, local_state, peer_state, peer_serial
+        return _parse_ha(response)
 
     def get_gp_sessions(
         self
@@ -335,40 +896,12 @@ class DeviceApi:
             list of dicts: The active sessions.
             int: The response code if an error occurred.
         '''
-        response = self._xml_request(
-            "/?type=op&cmd=<show>"
-            "<global-protect-gateway>"
-            "<current-user/>"
-            "</global-protect-gateway>"
-            "</show>"
-        )
+
+        response = self._xml_request(XML_GP_SESSIONS)
         if isinstance(response, int):
             return response
 
-        root = ET.fromstring(response)
-        results = root.find(".//result")
-
-        session_list = []
-        for gp_session in results:
-            session = {
-                'username': gp_session.find(".//username").text,
-                'primary-username': gp_session.find(
-                    ".//primary-username"
-                ).text,
-                'source-region': gp_session.find(".//source-region").text,
-                'computer': gp_session.find(".//computer").text,
-                'client': gp_session.find(".//client").text,
-                'vpn-type': gp_session.find(".//vpn-type").text,
-                'host-id': gp_session.find(".//host-id").text,
-                'app-version': gp_session.find(".//app-version").text,
-                'virtual-ip': gp_session.find(".//virtual-ip").text,
-                'public-ip': gp_session.find(".//public-ip").text,
-                'tunnel-type': gp_session.find(".//tunnel-type").text,
-                'login-time': gp_session.find(".//login-time").text,
-            }
-            session_list.append(session)
-
-        return session_list
+        return _parse_gp_sessions(response)
 
     def get_vpn_status(
         self
@@ -380,38 +913,12 @@ class DeviceApi:
             list of dicts: The active sessions.
             int: The response code if an error occurred.
         '''
-        response = self._xml_request(
-            "/?type=op&cmd=<show>"
-            "<vpn>"
-            "<flow>"
-            "</flow>"
-            "</vpn>"
-            "</show>"
-        )
+
+        response = self._xml_request(XML_VPN_FLOW)
         if isinstance(response, int):
             return response
 
-        root = ET.fromstring(response)
-        results = root.find(".//result/IPSec")
-
-        tunnel_list = []
-        for vpn in results:
-            tunnel = {
-                'id': vpn.find(".//id").text,
-                'name': vpn.find(".//name").text,
-                'inner-if': vpn.find(".//inner-if").text,
-                'outer-if': vpn.find(".//outer-if").text,
-                'gwid': vpn.find(".//gwid").text,
-                'ipsec-mode': vpn.find(".//ipsec-mode").text,
-                'localip': vpn.find(".//localip").text,
-                'peerip': vpn.find(".//peerip").text,
-                'state': vpn.find(".//state").text,
-                'monitor': vpn.find(".//mon").text,
-                'owner': vpn.find(".//owner").text,
-            }
-            tunnel_list.append(tunnel)
-
-        return tunnel_list
+        return _parse_vpn_status(response)
 
     def get_tags(
         self
@@ -451,43 +958,12 @@ class DeviceApi:
             json: The response body
         '''
 
-        url = '/Objects/Tags'
-
-        body = {
-            "entry": {
-                "@name": name,
-                "comments": comment
-            }
-        }
-
-        # Add the colour if it is not 'no colour' or None
-        if colour is not None and colour != 'no colour':
-            body['color'] = colour
-
-        # The name in the params must be the same as the name in the tag
-        self.params['name'] = name
-
-        # Send the request
-        response = requests.post(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-            json=body,
+        return self._rest_post(
+            '/Objects/Tags',
+            name,
+            _tag_body(name, colour, comment),
         )
 
-        # Check the response code for errors
-        if response.status_code != 200:
-            print(
-                Fore.RED,
-                response.status_code,
-                Style.RESET_ALL
-            )
-
-            return response.status_code
-
-        # Return the body of the response
-        return response.json()
-
     def get_addresses(
         self
     ) -> list:
@@ -529,57 +1005,12 @@ class DeviceApi:
             json: The response body
         '''
 
-        url = '/Objects/Addresses'
-
-        body = {
-            "entry": {
-                "@name": name,
-                "ip-netmask": address,
-            }
-        }
-
-        # Add the tag if it is has been included
-        if tags is not None:
-            # If there's more than one tag, split them into a list
-            if "," in tags:
-                tags = tags.split(",")
-
-            # If it's not a list, make it a list
-            if type(tags) is not list:
-                tags = [tags]
-
-            body['entry']['tag'] = {}
-            body['entry']['tag']['member'] = tags
-
-        # Add a description if it has been included
-        if description is not None:
-            body['entry']['description'] = description
-
-        # The name in the params must be the same as the name in the tag
-        self.params['name'] = name
-
-        # Send the request
-        response = requests.post(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-            json=body,
+        return self._rest_post(
+            '/Objects/Addresses',
+            name,
+            _address_body(name, address, description, tags),
         )
 
-        # Check the response code for errors
-        if response.status_code != 200:
-            print(
-                Fore.RED,
-                response.status_code,
-                response.text,
-                Style.RESET_ALL
-            )
-
-            return response.status_code
-
-        # Return the body of the response
-        return response.json()
-
     def get_address_groups(
         self
     ) -> list:
@@ -622,83 +1053,18 @@ class DeviceApi:
             json: The response body
         '''
 
-        # Sanity check for 'members'
-        if not members:
-            print(
-                Fore.RED,
-                'Error: No members provided',
-                Style.RESET_ALL
-            )
-            return None
-
-        if type(members) is not list:
-            print(
-                Fore.RED,
-                'Error: Members should be a list',
-                Style.RESET_ALL
-            )
+        body = _addr_group_body(name, members, description, tags)
+        if body is None:
             return None
 
-        url = '/Objects/AddressGroups'
-
-        body = {
-            "entry": {
-                "@name": name,
-                "static": {
-                    "member": members
-                },
-                "description": description
-            }
-        }
+        return self._rest_post('/Objects/AddressGroups', name, body)
 
-        # Add the tag if it is has been included
-        if tags is not None:
-            # If there's more than one tag, split them into a list
-            if "," in tags:
-                tags = tags.split(",")
-
-            # If it's not a list, make it a list
-            if type(tags) is not list:
-                tags = [tags]
-
-            body['entry']['tag'] = {}
-            body['entry']['tag']['member'] = tags
-
-        # Add a description if it has been included
-        if description is not None:
-            body['entry']['description'] = description
-
-        # The name in the params must be the same as the name in the tag
-        self.params['name'] = name
-
-        # Send the request
-        response = requests.post(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-            json=body,
-        )
-
-        # Check the response code for errors
-        if response.status_code != 200:
-            print(
-                Fore.RED,
-                response.status_code,
-                response.text,
-                Style.RESET_ALL
-            )
-
-            return response.status_code
-
-        # Return the body of the response
-        return response.json()
-
-    def get_application_groups(
-        self
-    ) -> list:
-        '''
-        Get application group objects from the device
-            REST API, /Objects/ApplicationGroups
+    def get_application_groups(
+        self
+    ) -> list:
+        '''
+        Get application group objects from the device
+            REST API, /Objects/ApplicationGroups
 
         Returns:
             list: The application groups
@@ -729,42 +1095,12 @@ class DeviceApi:
             json: The response body
         '''
 
-        url = '/Objects/ApplicationGroups'
-
-        body = {
-            "entry": {
-                "@name": name,
-                "members": {
-                    "member": members
-                }
-            }
-        }
-
-        # The name in the params must be the same as the name in the tag
-        self.params['name'] = name
-
-        # Send the request
-        response = requests.post(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-            json=body,
+        return self._rest_post(
+            '/Objects/ApplicationGroups',
+            name,
+            _app_group_body(name, members),
         )
 
-        # Check the response code for errors
-        if response.status_code != 200:
-            print(
-                Fore.RED,
-                response.status_code,
-                response.text,
-                Style.RESET_ALL
-            )
-
-            return response.status_code
-
-        # Return the body of the response
-        return response.json()
-
     def get_services(
         self
     ) -> list:
@@ -812,61 +1148,12 @@ class DeviceApi:
             json: The response body
         '''
 
-        url = '/Objects/Services'
-
-        body = {
-            "entry": {
-                "@name": name,
-                "protocol": {
-                    protocol: {
-                        "port": dest_port
-                    }
-                }
-            }
-        }
-
-        # Add the tag if it is has been included
-        if tags is not None:
-            # If there's more than one tag, split them into a list
-            if "," in tags:
-                tags = tags.split(",")
-
-            # If it's not a list, make it a list
-            if type(tags) is not list:
-                tags = [tags]
-
-            body['entry']['tag'] = {}
-            body['entry']['tag']['member'] = tags
-
-        # Add a description if it has been included
-        if description is not None:
-            body['entry']['description'] = description
-
-        # The name in the params must be the same as the name in the tag
-        self.params['name'] = name
-
-        # Send the request
-        response = requests.post(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-            json=body,
+        return self._rest_post(
+            '/Objects/Services',
+            name,
+            _service_body(name, protocol, dest_port, description, tags),
         )
 
-        # Check the response code for errors
-        if response.status_code != 200:
-            print(
-                Fore.RED,
-                response.status_code,
-                response.text,
-                Style.RESET_ALL
-            )
-
-            return response.status_code
-
-        # Return the body of the response
-        return response.json()
-
     def get_service_groups(
         self
     ) -> list:
@@ -907,55 +1194,12 @@ class DeviceApi:
             json: The response body
         '''
 
-        url = '/Objects/ServiceGroups'
-
-        body = {
-            "entry": {
-                "@name": name,
-                "members": {
-                    "member": members
-                }
-            }
-        }
-
-        # Add the tag if it is has been included
-        if tags is not None:
-            # If there's more than one tag, split them into a list
-            if "," in tags:
-                tags = tags.split(",")
-
-            # If it's not a list, make it a list
-            if type(tags) is not list:
-                tags = [tags]
-
-            body['entry']['tag'] = {}
-            body['entry']['tag']['member'] = tags
-
-        # The name in the params must be the same as the name in the tag
-        self.params['name'] = name
-
-        # Send the request
-        response = requests.post(
-            f"{self.rest_base_url}{url}",
-            headers=self.rest_headers,
-            params=self.params,
-            json=body,
+        return self._rest_post(
+            '/Objects/ServiceGroups',
+            name,
+            _service_group_body(name, members, tags),
         )
 
-        # Check the response code for errors
-        if response.status_code != 200:
-            print(
-                Fore.RED,
-                response.status_code,
-                response.text,
-                Style.RESET_ALL
-            )
-
-            return response.status_code
-
-        # Return the body of the response
-        return response.json()
-
     def get_nat_policies(
         self
     ) -> list:
@@ -1098,6 +1342,645 @@ class DeviceApi:
         return qos_rules
 
 
+class AsyncDeviceApi:
+    '''
+    Asynchronous access to the Palo Alto's device API
+        Has the same methods as DeviceApi, as coroutines
+        Many devices can be called at once from one event loop, without
+        a thread for each call
+
+    Connections are pooled in one HTTP session per event loop
+        Call close_async_session() before the event loop is closed
+
+    If 'aiohttp' is not installed, requests run in worker threads instead
+        (through DeviceApi), so the methods still work
+
+    Methods:
+        __init__: Initialise the class
+        __aenter__: Enter method for async context manager
+        __aexit__: Exit method for async context manager
+        _rest_request: Send a REST request to the device
+        _xml_request: Send an XML request to the device
+        _rest_post: Send a REST request to create an entry on the device
+        _xml_get: Send an XML request, and parse the response
+        get_config: Get the running configuration of the device
+        get_device: Get the device basics
+        get_ha: Get high availability details
+        get_gp_sessions: Get active Global Protect sessions
+        get_vpn_status: Get VPN tunnels
+        get_tags: Get the tags from the device
+        create_tag: Add a tag to the device
+        get_addresses: Get address object from the device
+        create_address: Add an address to the device
+        get_address_groups: Get address group objects from the device
+        create_addr_group: Add an address group to the device
+        get_application_groups: Get application group objects
+        create_app_group: Add an application group to the device
+        get_services: Get services objects from the device
+        create_service: Add a service object to the device
+        get_service_groups: Get service group objects from the device
+        create_service_group: Add service group to the device
+        get_nat_policies: Get NAT policies from the device
+        get_security_policies: Get security policies from the device
+        get_qos_policies: Get QoS policies from the device
+    '''
+
+    def __init__(
+        self,
+        hostname: str,
+        rest_key: str = '',
+        xml_key: str = '',
+        version: str = 'v11.0',
+        location: str = 'vsys',
+        vsys: str = 'vsys1',
+    ) -> None:
+        '''
+        Initialise the class
+            The arguments are the same as DeviceApi
+
+        Args:
+            hostname (str): The hostname of the device
+            rest_key (str): The REST API key
+            xml_key (str): The XML API key
+            version (str): The PANOS version number (REST)
+            location (str): The location of the device (REST)
+            vsys (str): The vsys to connect to (REST)
+        '''
+
+        # The URLs and headers, and the fallback without aiohttp
+        self.api = DeviceApi(
+            hostname=hostname,
+            rest_key=rest_key,
+            xml_key=xml_key,
+            version=version,
+            location=location,
+            vsys=vsys,
+        )
+
+    async def __aenter__(
+        self,
+    ) -> 'AsyncDeviceApi':
+        '''
+        Enter method for async context manager
+
+        Returns:
+            AsyncDeviceApi: The instance of the class
+        '''
+
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> Optional[bool]:
+        '''
+        Exit method for async context manager
+            The shared session stays open, for other devices
+
+        Args:
+            exc_type : Exception
+                The type of exception raised
+            exc_value : Exception
+                The value of the exception raised
+            traceback : Exception
+                The traceback of the exception raised
+        '''
+
+        # handle errors that were raised
+        if exc_type:
+            print(
+                f"Exception of type {exc_type.__name__} occurred: {exc_value}"
+            )
+
+    async def _rest_request(
+        self,
+        url: str,
+    ) -> dict | int:
+        '''
+        Send a REST request to the device
+        Handles checking the response
+
+        Args:
+            url (str): The URL to send the request to
+                Example: "/Objects/Tags"
+
+        Returns:
+            dict: The response body
+            int: The response code if an error occurred
+        '''
+
+        if aiohttp is None:
+            return await asyncio.to_thread(self.api._rest_request, url)
+
+        # Send the request
+        try:
+            with device_api_seconds.time(
+                vendor='paloalto',
+                device=self.api.hostname,
+                operation='rest',
+            ) as call:
+                async with async_session().get(
+                    f"{self.api.rest_base_url}{url}",
+                    headers=self.api.rest_headers,
+                    params=self.api.params,
+                ) as response:
+                    call.ok = response.status == 200
+                    if response.status != 200:
+                        print(
+                            Fore.RED,
+                            response.status,
+                            Style.RESET_ALL
+                        )
+                        return response.status
+
+                    body = await response.json(content_type=None)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(
+                Fore.RED,
+                f"Error connecting to {self.api.hostname}: {e}",
+                Style.RESET_ALL
+            )
+            return 500
+
+        # Return the body of the response
+        return body['result']['entry']
+
+    async def _xml_request(
+        self,
+        url: str
+    ) -> Union[str, int]:
+        '''
+        Send an XML request to the device and handle the response.
+
+        Args:
+            url (str): The URL to send the request to.
+
+        Returns:
+            str: The response body if successful.
+            int: The response code if an error occurred.
+        '''
+
+        if aiohttp is None:
+            return await asyncio.to_thread(self.api._xml_request, url)
+
+        try:
+            with device_api_seconds.time(
+                vendor='paloalto',
+                device=self.api.hostname,
+                operation='xml',
+            ) as call:
+                async with async_session().get(
+                    f"{self.api.xml_base_url}{url}",
+                    headers=self.api.xml_headers,
+                ) as response:
+                    call.ok = response.status == 200
+                    text = await response.text()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(
+                Fore.RED,
+                "DNS resolution or connection issue\n",
+                Fore.YELLOW,
+                e,
+                Style.RESET_ALL
+            )
+            return 500
+
+        if response.status != 200:
+            print(Fore.RED, _error_message(text), Style.RESET_ALL)
+            return response.status
+
+        return text
+
+    async def _rest_post(
+        self,
+        url: str,
+        name: str,
+        body: dict,
+    ) -> dict | int:
+        '''
+        Send a REST request to create an entry on the device
+
+        Args:
+            url (str): The URL to send the request to
+            name (str): The name of the entry
+            body (dict): The request body
+
+        Returns:
+            dict: The response body
+            int: The response code if an error occurred
+        '''
+
+        if aiohttp is None:
+            return await asyncio.to_thread(
+                self.api._rest_post, url, name, body
+            )
+
+        # The name in the params must be the same as the name in the body
+        params = {**self.api.params, 'name': name}
+
+        try:
+            with device_api_seconds.time(
+                vendor='paloalto',
+                device=self.api.hostname,
+                operation='rest_post',
+            ) as call:
+                async with async_session().post(
+                    f"{self.api.rest_base_url}{url}",
+                    headers=self.api.rest_headers,
+                    params=params,
+                    json=body,
+                ) as response:
+                    call.ok = response.status == 200
+                    if response.status != 200:
+                        print(
+                            Fore.RED,
+                            response.status,
+                            await response.text(),
+                            Style.RESET_ALL
+                        )
+                        return response.status
+
+                    return await response.json(content_type=None)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(
+                Fore.RED,
+                f"Error connecting to {self.api.hostname}: {e}",
+                Style.RESET_ALL
+            )
+            return 500
+
+    async def _xml_get(
+        self,
+        url: str,
+        parse,
+    ):
+        '''
+        Send an XML request, and parse the response
+
+        Args:
+            url (str): The URL to send the request to
+            parse (Callable): Parses the response body
+
+        Returns:
+            The parsed response, or the response code if an error occurred
+        '''
+
+        response = await self._xml_request(url)
+        if isinstance(response, int):
+            return response
+
+        return parse(response)
+
+    async def get_config(
+        self
+    ) -> Union[str, int]:
+        '''
+        Get the running configuration of the device using the XML API.
+
+        Returns:
+            str: The configuration in XML format as a string.
+            int: The response code if an error occurred.
+        '''
+
+        xml_config = await self._xml_get(XML_CONFIG, _parse_config)
+        if isinstance(xml_config, int):
+            print("Error getting the configuration")
+
+        return xml_config
+
+    async def get_device(
+        self
+    ) -> Union[Tuple[str, str, str], int]:
+        '''
+        Get the device basics using the XML API.
+
+        Returns:
+            Tuple[str, str, str]:
+                The model, serial number, and software version of the device.
+            int: The response code if an error occurred.
+        '''
+
+        return await self._xml_get(XML_SYSTEM_INFO, _parse_device)
+
+    async def get_ha(
+        self
+    ) -> Union[bool, Tuple[bool, str, str, str, str], int]:
+        '''
+        Get high availability details using the XML API.
+
+        Returns:
+            bool: False if HA is disabled.
+            Tuple[bool, str, str, str, str]: As DeviceApi.get_ha()
+            int: The response code if an error occurred.
+        '''
+
+        return await self._xml_get(XML_HA_STATE, _parse_ha)
+
+    async def get_gp_sessions(
+        self
+    ) -> Union[list, int]:
+        '''
+        Get active Global Protect sessions using the XML API.
+
+        Returns:
+            list of dicts: The active sessions.
+            int: The response code if an error occurred.
+        '''
+
+        return await self._xml_get(XML_GP_SESSIONS, _parse_gp_sessions)
+
+    async def get_vpn_status(
+        self
+    ) -> Union[list, int]:
+        '''
+        Get VPN tunnel status using the XML API.
+
+        Returns:
+            list of dicts: The tunnels.
+            int: The response code if an error occurred.
+        '''
+
+        return await self._xml_get(XML_VPN_FLOW, _parse_vpn_status)
+
+    async def get_tags(
+        self
+    ) -> list:
+        '''
+        Get the tags from the device
+            REST API, /Objects/Tags
+
+        Returns:
+            list: The tags (see DeviceApi.get_tags)
+        '''
+
+        return await self._rest_request("/Objects/Tags")
+
+    async def create_tag(
+        self,
+        name: str,
+        colour: str,
+        comment: str,
+    ) -> json:
+        '''
+        Add a tag to the device
+            REST API, /Objects/Tags
+
+        Args:
+            name (str): The name of the tag
+            colour (str): The colour of the tag
+            comment (str): The comment of the tag
+
+        Returns:
+            json: The response body
+        '''
+
+        return await self._rest_post(
+            '/Objects/Tags',
+            name,
+            _tag_body(name, colour, comment),
+        )
+
+    async def get_addresses(
+        self
+    ) -> list:
+        '''
+        Get address object from the device
+            REST API, /Objects/Addresses
+
+        Returns:
+            list: The addresses (see DeviceApi.get_addresses)
+        '''
+
+        return await self._rest_request("/Objects/Addresses")
+
+    async def create_address(
+        self,
+        name: str,
+        address: str,
+        description: str = None,
+        tags: str = None,
+    ):
+        '''
+        Add an address to the device
+            REST API, /Objects/Addresses
+
+        Args:
+            name (str): The name of the address object
+            address (str): The IP address and netmask
+            description (str): The description of the address
+            tag (str): Zero or more tags to apply to the address
+
+        Returns:
+            json: The response body
+        '''
+
+        return await self._rest_post(
+            '/Objects/Addresses',
+            name,
+            _address_body(name, address, description, tags),
+        )
+
+    async def get_address_groups(
+        self
+    ) -> list:
+        '''
+        Get address group objects from the device
+            REST API, /Objects/AddressGroups
+
+        Returns:
+            list: The address groups (see DeviceApi.get_address_groups)
+        '''
+
+        return await self._rest_request("/Objects/AddressGroups")
+
+    async def create_addr_group(
+        self,
+        name: str,
+        members: list,
+        description: str = None,
+        tags: str = None,
+    ):
+        '''
+        Add an address group to the device
+            REST API, /Objects/AddressGroups
+
+        Args:
+            name (str): The name of the address object
+            members (list): The members of the group
+            tags (str): Zero or more tags to apply to the address
+
+        Returns:
+            json: The response body
+        '''
+
+        body = _addr_group_body(name, members, description, tags)
+        if body is None:
+            return None
+
+        return await self._rest_post('/Objects/AddressGroups', name, body)
+
+    async def get_application_groups(
+        self
+    ) -> list:
+        '''
+        Get application group objects from the device
+            REST API, /Objects/ApplicationGroups
+
+        Returns:
+            list: The application groups
+                (see DeviceApi.get_application_groups)
+        '''
+
+        return await self._rest_request("/Objects/ApplicationGroups")
+
+    async def create_app_group(
+        self,
+        name: str,
+        members: list,
+    ):
+        '''
+        Add an application group to the device
+            REST API, /Objects/ApplicationGroups
+
+        Args:
+            name (str): The name of the application group
+            members (list): The members of the group
+
+        Returns:
+            json: The response body
+        '''
+
+        return await self._rest_post(
+            '/Objects/ApplicationGroups',
+            name,
+            _app_group_body(name, members),
+        )
+
+    async def get_services(
+        self
+    ) -> list:
+        '''
+        Get services objects from the device
+            REST API, /Objects/Services
+
+        Returns:
+            list: The services (see DeviceApi.get_services)
+        '''
+
+        return await self._rest_request("/Objects/Services")
+
+    async def create_service(
+        self,
+        name: str,
+        protocol: str,
+        dest_port: str,
+        description: str = '',
+        tags: str = None,
+    ):
+        '''
+        Add a service object to the device
+            REST API, /Objects/Service
+
+        Args:
+            name (str): The name of the service object
+            protocol (str): The protocol of the service (eg, tcp)
+            dest_port (str): The destination port of the service
+            description (str): The description of the service
+            tags (str): Zero or more tags to apply to the service
+
+        Returns:
+            json: The response body
+        '''
+
+        return await self._rest_post(
+            '/Objects/Services',
+            name,
+            _service_body(name, protocol, dest_port, description, tags),
+        )
+
+    async def get_service_groups(
+        self
+    ) -> list:
+        '''
+        Get service group objects from the device
+            REST API, /Objects/ServiceGroups
+
+        Returns:
+            list: The service groups (see DeviceApi.get_service_groups)
+        '''
+
+        return await self._rest_request("/Objects/ServiceGroups")
+
+    async def create_service_group(
+        self,
+        name: str,
+        members: list,
+        tags: str = None,
+    ):
+        '''
+        Add service group to the device
+            REST API, /Objects/ServiceGroups
+
+        Args:
+            name (str): The name of the address object
+            members (list): The members of the group
+            tags (str): Zero or more tags to apply to the address
+
+        Returns:
+            json: The response body
+        '''
+
+        return await self._rest_post(
+            '/Objects/ServiceGroups',
+            name,
+            _service_group_body(name, members, tags),
+        )
+
+    async def get_nat_policies(
+        self
+    ) -> list:
+        '''
+        Get NAT policies from the device
+            REST API, /Policies/NATRules
+
+        Returns:
+            list: The NAT rules (see DeviceApi.get_nat_policies)
+        '''
+
+        return await self._rest_request("/Policies/NATRules")
+
+    async def get_security_policies(
+        self
+    ) -> list:
+        '''
+        Get security policies from the device
+            REST API, /Policies/SecurityRules
+
+        Returns:
+            list: The security rules (see DeviceApi.get_security_policies)
+        '''
+
+        return await self._rest_request("/Policies/SecurityRules")
+
+    async def get_qos_policies(
+        self
+    ) -> list:
+        '''
+        Get QoS policies from the device
+            REST API, /Policies/QoSRules
+
+        Returns:
+            list: The QoS rules (see DeviceApi.get_qos_policies)
+        '''
+
+        return await self._rest_request("/Policies/QoSRules")
+
+
 if __name__ == '__main__':
     print("This contains the classes to access the Palo Alto API")
     print("please run the api-test.py file to test the API")
@@ -0,0 +1,789 @@
+'''
+Profile API requests, with nested timing spans
+
+Each API request is traced, as a tree of timing spans
+    Spans are opened around the slow parts of a request
+        sql: SQL operations (see sql.py)
+        pbkdf2: Decrypting secrets (see encryption.py)
+        device: Calls to devices (REST, XML, and Junos RPCs)
+        xml: Parsing XML responses from devices
+        json: Serializing the response
+    Spans are kept in a context variable, so they nest correctly, and
+    follow async tasks and asyncio.to_thread()
+    Work in other thread pools (eg, fleet queries) isn't traced
+    Outside a request, spans cost almost nothing
+
+Admins can ask for a request to be profiled
+    Send an 'X-Profile' header, or a 'profile' parameter
+        1 (or spans): Send the spans in a 'Server-Timing' header
+        cprofile: Also profile the request with cProfile
+        sample: Also sample the request's stack every few milliseconds
+    The trace is saved, and its ID is sent in an 'X-Profile-Id' header
+    Only one cProfile can run at once. If one is running, the request
+    is traced without it
+
+Slow requests (and profiled ones) are kept in a ring buffer
+    Each worker saves its buffer to the state directory, so the slowest
+    requests can be found from any worker
+    Each worker's file is named after its PID, which is read when it
+    saves, as the log is created before uWSGI forks the workers
+
+Classes:
+    Trace
+        A request's timing spans, and optional profile
+    Sampler
+        Samples a thread's stack in the background
+    RequestLog
+        A ring buffer of slow and profiled requests
+
+Functions:
+    span
+        Time a block of code, as a span in the current trace
+    traced
+        A decorator, to time a function as a span
+    start_request
+        Start tracing an API request (a 'before request' hook)
+    finish_request
+        Finish tracing an API request (an 'after request' hook)
+    end_request
+        Clean up after an API request (a 'teardown request' hook)
+
+Misc Variables:
+    request_log
+        The shared RequestLog object
+'''
+
+from flask import Response, g, request, session
+from colorama import Fore, Style
+
+import collections
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import typing as t
+import uuid
+
+from settings import config
+
+
+# Requests slower than this (seconds) are kept
+SLOW_THRESHOLD = 1.0
+
+# The number of requests kept by each worker
+LOG_SIZE = 100
+
+# The most spans kept for one request
+MAX_SPANS = 1000
+
+# Seconds between stack samples, and the number of stacks kept
+SAMPLE_INTERVAL = 0.005
+SAMPLE_STACKS = 50
+
+# The number of functions kept from a cProfile
+PROFILE_LINES = 30
+
+# Where each worker saves its requests, and how long they're kept
+STATE_DIR = os.path.join('state', 'profiling')
+KEEP_FOR = 86400
+
+# Profile modes, and the values that ask for them
+MODES = {
+    '1': 'spans',
+    'true': 'spans',
+    'spans': 'spans',
+    'cprofile': 'cprofile',
+    'sample': 'sample',
+}
+
+# The current trace and span (None when not tracing)
+_current = contextvars.ContextVar('span', default=None)
+
+# cProfile can only profile one request at a time
+_profile_lock = threading.Lock()
+
+
+class Trace:
+    '''
+    A request's timing spans, and optional profile
+
+    Methods:
+        __init__: Start a trace
+        open: Open a span, under another span
+        close: Close a span
+        finish: End the trace
+        summary: Add up the time spent in each kind of span
+        server_timing: Format the summary as a Server-Timing header
+        to_dict: Get the trace, to save or return
+    '''
+
+    def __init__(
+        self,
+        mode: str = None,
+    ) -> None:
+        '''
+        Start a trace
+
+        Args:
+            mode (str): The profile mode, or None if not profiled
+        '''
+
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.spans = 0
+        self.dropped = 0
+        self.profile = None
+
+        # The root span covers the whole request
+        self.root = {
+            'name': 'request',
+            'start': 0.0,
+            'duration': None,
+            'children': [],
+        }
+
+    def open(
+        self,
+        parent: dict,
+        name: str,
+        attrs: dict,
+    ) -> dict | None:
+        '''
+        Open a span, under another span
+
+        Args:
+            parent (dict): The parent span
+            name (str): The kind of span (eg, 'sql')
+            attrs (dict): Details of the span (eg, the table)
+
+        Returns:
+            dict: The new span
+            None: If the trace has too many spans
+        '''
+
+        if self.spans >= MAX_SPANS:
+            self.dropped += 1
+            return None
+        self.spans += 1
+
+        child = {
+            'name': name,
+            'start': round((time.perf_counter() - self._start) * 1000, 3),
+            'duration': None,
+            'children': [],
+        }
+        if attrs:
+            child['attrs'] = {k: str(v) for k, v in attrs.items()}
+
+        # Appending to a list is safe across threads
+        parent['children'].append(child)
+        return child
+
+    def close(
+        self,
+        entry: dict,
+        ok: bool = True,
+    ) -> None:
+        '''
+        Close a span
+
+        Args:
+            entry (dict): The span
+            ok (bool): False if the block raised an error
+        '''
+
+        entry['duration'] = round(
+            (time.perf_counter() - self._start) * 1000 - entry['start'],
+            3,
+        )
+        if not ok:
+            entry['error'] = True
+
+    def finish(
+        self
+    ) -> float:
+        '''
+        End the trace
+
+        Returns:
+            float: Milliseconds the request took
+        '''
+
+        self.root['duration'] = round(
+            (time.perf_counter() - self._start) * 1000,
+            3,
+        )
+
+        return self.root['duration']
+
+    def summary(
+        self
+    ) -> dict:
+        '''
+        Add up the time spent in each kind of span
+            Nested spans are counted in their parent too (eg, a SQL
+            connection includes decrypting the password)
+
+        Returns:
+            dict: Span names, to 'duration' (ms) and 'count'
+        '''
+
+        totals = {}
+        pending = list(self.root['children'])
+        while pending:
+            entry = pending.pop()
+            pending.extend(entry['children'])
+            total = totals.setdefault(
+                entry['name'],
+                {'duration': 0.0, 'count': 0},
+            )
+            total['duration'] += entry['duration'] or 0.0
+            total['count'] += 1
+
+        for total in totals.values():
+            total['duration'] = round(total['duration'], 3)
+
+        return totals
+
+    def server_timing(
+        self
+    ) -> str:
+        '''
+        Format the summary as a Server-Timing header
+
+        Returns:
+            str: The header (eg, 'sql;dur=12.5;desc="2 calls", ...')
+        '''
+
+        timings = [
+            f'{name};dur={total["duration"]};desc="{total["count"]} calls"'
+            for name, total in sorted(self.summary().items())
+        ]
+        timings.append(f'total;dur={self.root["duration"]}')
+
+        return ', '.join(timings)
+
+    def to_dict(
+        self
+    ) -> dict:
+        '''
+        Get the trace, to save or return
+
+        Returns:
+            dict: The trace
+                id (str): The trace ID
+                mode (str): The profile mode, or None
+                started (float): When the request started (epoch)
+                duration (float): Milliseconds the request took
+                summary (dict): The time spent in each kind of span
+                spans (dict): The root span, and the spans under it
+                dropped (int): Spans that weren't kept (over the limit)
+                profile (list | str): The cProfile or stack samples
+        '''
+
+        return {
+            'id': self.id,
+            'mode': self.mode,
+            'started': self.started,
+            'duration': self.root['duration'],
+            'summary': self.summary(),
+            'spans': self.root,
+            'dropped': self.dropped,
+            'profile': self.profile,
+        }
+
+
+@contextlib.contextmanager
+def span(
+    name: str,
+    **attrs,
+) -> t.Iterator[None]:
+    '''
+    Time a block of code, as a span in the current trace
+        This does nothing if there is no trace
+
+    Args:
+        name (str): The kind of span (eg, 'sql')
+        attrs: Details of the span (eg, table='devices')
+    '''
+
+    current = _current.get()
+    if current is None:
+        yield
+        return
+
+    trace, parent = current
+    entry = trace.open(parent, name, attrs)
+    if entry is None:
+        yield
+        return
+
+    token = _current.set((trace, entry))
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        _current.reset(token)
+        trace.close(entry, ok)
+
+
+def traced(
+    name: str,
+) -> t.Callable:
+    '''
+    A decorator, to time a function as a span
+
+    Args:
+        name (str): The kind of span (eg, 'xml')
+
+    Returns:
+        Callable: The decorator
+    '''
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, function=func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Sampler:
+    '''
+    Samples a thread's stack in the background
+        Stacks are counted, so the most common ones show where the
+        time goes (like a flame graph)
+
+    Methods:
+        __init__: Create a sampler for the current thread
+        start: Start sampling
+        _run: Take samples until stopped
+        stop: Stop sampling, and get the most common stacks
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Create a sampler for the current thread
+        '''
+
+        self.thread_id = threading.get_ident()
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(
+        self
+    ) -> None:
+        '''
+        Start sampling
+        '''
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name='profile-sampler',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(
+        self
+    ) -> None:
+        '''
+        Take samples until stopped
+            Each stack is folded into one line, outermost call first
+        '''
+
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(
+        self
+    ) -> list:
+        '''
+        Stop sampling, and get the most common stacks
+
+        Returns:
+            list: Dicts of 'stack' and 'samples', most common first
+        '''
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        return [
+            {'stack': stack, 'samples': count}
+            for stack, count in self.stacks.most_common(SAMPLE_STACKS)
+        ]
+
+
+class RequestLog:
+    '''
+    A ring buffer of slow and profiled requests
+
+    Methods:
+        __init__: Create an empty log
+        add: Add a request, and share it with other workers
+        _file: Get this worker's file
+        _forked: Start again in a new worker
+        _save: Save this worker's requests
+        _load: Read the requests from every worker
+        slowest: Get the slowest recent requests
+        get: Get a request's trace by its ID
+    '''
+
+    def __init__(
+        self,
+        path: str = STATE_DIR,
+        size: int = LOG_SIZE,
+    ) -> None:
+        '''
+        Create an empty log
+
+        Args:
+            path (str): The directory that workers save requests in
+            size (int): The number of requests each worker keeps
+        '''
+
+        self.path = path
+        self._requests = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+        # The process the file is named after, and when it started
+        self._pid = None
+        self._started = None
+
+        # Workers are forked after the log is created
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _file(
+        self
+    ) -> str:
+        '''
+        Get this worker's file
+            Named after the current process (and when it started, in
+            case a PID is reused)
+
+        Returns:
+            str: The path of the file
+        '''
+
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._started = int(time.time())
+
+        return os.path.join(self.path, f"{pid}-{self._started}.json")
+
+    def _forked(
+        self
+    ) -> None:
+        '''
+        Start again in a new worker
+            The parent's requests are in the parent's file already
+        '''
+
+        self._lock = threading.Lock()
+        self._requests = collections.deque(maxlen=self._requests.maxlen)
+
+    def add(
+        self,
+        entry: dict,
+    ) -> None:
+        '''
+        Add a request, and share it with other workers
+
+        Args:
+            entry (dict): The request, and its trace
+        '''
+
+        with self._lock:
+            self._requests.append(entry)
+            self._save(list(self._requests))
+
+    def _save(
+        self,
+        entries: list,
+    ) -> None:
+        '''
+        Save this worker's requests
+            The file is replaced in one step, so readers never see part
+            of it
+            The caller must hold the lock
+
+        Args:
+            entries (list): The requests
+        '''
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            file = self._file()
+            temp = f"{file}.tmp"
+            with open(temp, 'wb') as f:
+                f.write(json.dumps(entries, default=str).encode())
+            os.replace(temp, file)
+
+        except OSError as e:
+            print(
+                Fore.RED,
+                'Could not save slow requests',
+                Style.RESET_ALL
+            )
+            print(e)
+
+    def _load(
+        self
+    ) -> list:
+        '''
+        Read the requests from every worker
+            Files that haven't changed for a day are removed
+
+        Returns:
+            list: The requests
+        '''
+
+        with self._lock:
+            entries = list(self._requests)
+
+        try:
+            files = os.listdir(self.path)
+        except OSError:
+            files = []
+
+        now = time.time()
+        own_file = self._file()
+        for file in files:
+            path = os.path.join(self.path, file)
+            if path == own_file or not file.endswith('.json'):
+                continue
+
+            try:
+                if now - os.stat(path).st_mtime > KEEP_FOR:
+                    os.remove(path)
+                    continue
+                with open(path, 'rb') as f:
+                    entries.extend(json.loads(f.read()))
+
+            # Another worker may be part way through replacing it
+            except (OSError, ValueError):
+                continue
+
+        return entries
+
+    def slowest(
+        self,
+        limit: int = 20,
+        route: str = None,
+    ) -> list:
+        '''
+        Get the slowest recent requests
+            Span trees are left out, use get() for the full trace
+
+        Args:
+            limit (int): The most requests to return
+            route (str): Only requests to this route (eg, /api/objects)
+
+        Returns:
+            list: The requests, slowest first
+        '''
+
+        entries = [
+            {k: v for k, v in entry.items() if k != 'trace'}
+            | {'summary': entry['trace']['summary']}
+            for entry in self._load()
+            if route is None or entry['route'] == route
+        ]
+        entries.sort(key=lambda entry: entry['duration'], reverse=True)
+
+        return entries[:limit]
+
+    def get(
+        self,
+        trace_id: str,
+    ) -> dict | None:
+        '''
+        Get a request's trace by its ID
+
+        Args:
+            trace_id (str): The trace ID (from the X-Profile-Id header)
+
+        Returns:
+            dict: The request, and its trace
+            None: If it isn't kept any more
+        '''
+
+        for entry in self._load():
+            if entry['id'] == trace_id:
+                return entry
+
+        return None
+
+
+def _profile_mode(
+) -> str | None:
+    '''
+    Get the profile mode the request asked for
+        Only admins can profile requests (anyone, in debug mode)
+
+    Returns:
+        str: The mode (see MODES), or None
+    '''
+
+    value = request.headers.get('X-Profile', request.args.get('profile'))
+    if not value:
+        return None
+
+    if config.web_debug is not True and (
+        config.azure_admin_group not in session.get('groups', [])
+    ):
+        return None
+
+    return MODES.get(value.lower())
+
+
+def start_request(
+) -> None:
+    '''
+    Start tracing an API request
+        This is registered as a 'before request' hook
+    '''
+
+    trace = Trace(_profile_mode())
+    g.trace = trace
+    _current.set((trace, trace.root))
+
+    # Optional profilers
+    g.profiler = None
+    if trace.mode == 'cprofile' and _profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError:
+            # Another profiler (eg, a debugger) is running
+            g.profiler = None
+            _profile_lock.release()
+
+    elif trace.mode == 'sample':
+        g.profiler = Sampler()
+        g.profiler.start()
+
+
+def _stop_profiler(
+) -> list | None:
+    '''
+    Stop the request's profiler, if it has one
+
+    Returns:
+        list: The cProfile's lines, or the most common stacks
+        None: If there was no profiler
+    '''
+
+    profiler = g.get('profiler')
+    g.profiler = None
+
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        _profile_lock.release()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return output.getvalue().splitlines()
+
+    if isinstance(profiler, Sampler):
+        return profiler.stop()
+
+    return None
+
+
+def finish_request(
+    response: Response,
+) -> Response:
+    '''
+    Finish tracing an API request
+        This is registered as an 'after request' hook
+        Profiled requests get 'Server-Timing' and 'X-Profile-Id' headers
+        Slow and profiled requests are kept in the request log
+
+    Args:
+        response (Response): The response
+
+    Returns:
+        Response: The response, with headers if it was profiled
+    '''
+
+    trace = g.get('trace')
+    _current.set(None)
+    if trace is None:
+        return response
+
+    duration = trace.finish()
+    trace.profile = _stop_profiler()
+
+    if trace.mode is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers['X-Profile-Id'] = trace.id
+
+    if trace.mode is not None or duration >= SLOW_THRESHOLD * 1000:
+        request_log.add(
+            {
+                'id': trace.id,
+                'route': (
+                    request.url_rule.rule if request.url_rule is not None
+                    else request.path
+                ),
+                'path': request.full_path.rstrip('?'),
+                'method': request.method,
+                'status': response.status_code,
+                'started': trace.started,
+                'duration': duration,
+                'profiled': trace.mode,
+                'worker': os.getpid(),
+                'trace': trace.to_dict(),
+            }
+        )
+
+    return response
+
+
+def end_request(
+    error: BaseException = None,
+) -> None:
+    '''
+    Clean up after an API request, even if it failed
+        This is registered as a 'teardown request' hook
+        If the view raised an error, the profiler is still running
+
+    Args:
+        error (BaseException): The error, if there was one
+    '''
+
+    _current.set(None)
+    _stop_profiler()
+
+
+# The shared request log
+request_log = RequestLog()
@@ -0,0 +1,663 @@
+'''
+Resolve nested groups of addresses, services and applications
+
+Groups can contain objects and other groups, nested to any depth
+    The references form a graph, with an edge from each group to its members
+    Each group is flattened once, and the result is memoized
+
+What a name resolves to:
+    Addresses: merged IP ranges, as (version, first IP, last IP)
+    Services: merged port ranges, as (protocol, first port, last port)
+    Applications: a sorted list of application names
+
+Groups are flattened one strongly connected component at a time
+    Groups in a cycle all contain the same members, so they are resolved
+    together, then the groups that contain them (Tarjan's algorithm)
+
+When an object or group changes, only the groups that depend on it
+    (directly or through other groups) are resolved again
+
+Problems are reported, rather than raised
+    Cycles: groups that contain themselves, through any number of groups
+    Dangling references: members that are not objects or groups
+    Unresolved names: names that can't be turned into ranges (eg, FQDNs)
+
+Junos address sets are in address books
+    All address books are treated as one set of names
+
+Classes:
+    Membership
+        The flattened members of a name
+    GroupResolver
+        Resolves names to their flattened members
+'''
+
+import threading
+import typing as t
+
+from intervals import merge, parse_address, parse_ports
+from objectdiff import PLACEHOLDERS, members
+
+
+# Services that are built in to PAN-OS
+BUILTIN_SERVICES = {
+    'service-http': [('tcp', 80, 80), ('tcp', 8080, 8080)],
+    'service-https': [('tcp', 443, 443)],
+}
+
+# Each kind of name, with the types of objects and groups of that kind
+KINDS = {
+    'address': ('address', 'address_group'),
+    'service': ('service', 'service_group'),
+    'app': (None, 'app_group'),
+}
+
+# The datasets of objects and groups, and the type of entry in each
+DATASETS = {
+    'addresses': 'address',
+    'address_groups': 'address_group',
+    'services': 'service',
+    'service_groups': 'service_group',
+    'app_groups': 'app_group',
+}
+
+
+class Membership(t.NamedTuple):
+    '''
+    The flattened members of a name
+
+    Attributes:
+        values (tuple): Merged ranges, or application names
+        unresolved (tuple): Names that couldn't be resolved, sorted
+    '''
+
+    values: tuple
+    unresolved: tuple
+
+
+class GroupResolver:
+    '''
+    Resolves names to their flattened members
+        Safe to share between threads
+
+    Methods:
+        __init__: Load the objects and groups
+        __enter__: Hold the lock, so nothing changes while compiling
+        __exit__: Release the lock
+        resolve: Get the flattened members of a name
+        resolve_many: Get the flattened members of a list of names
+        update: Add or change an object or group
+        remove: Remove an object or group
+        sync: Update to match new lists of objects and groups
+        cycles: Find groups that contain themselves
+        dangling: Find group members that don't exist
+        groups: Get the names of the groups of a kind
+        report: Summarise the problems found
+        _flatten: Resolve a group, and the groups it contains
+        _close: Resolve a strongly connected component of groups
+        _leaf: Resolve a name that isn't a group
+        _service_ranges: Get the port ranges of a service object
+        _invalidate: Forget a name and everything that depends on it
+    '''
+
+    def __init__(
+        self,
+        addresses: list = (),
+        address_groups: list = (),
+        services: list = (),
+        service_groups: list = (),
+        app_groups: list = (),
+    ) -> None:
+        '''
+        Load the objects and groups
+            Nothing is resolved until it is needed
+
+        Args:
+            addresses (list): Address objects
+            address_groups (list): Address groups
+            services (list): Service objects
+            service_groups (list): Service groups
+            app_groups (list): Application groups
+        '''
+
+        # Definitions of each object and group, as returned by the API
+        self._entries = {dataset: {} for dataset in DATASETS.values()}
+
+        # The graph: group members, and the groups each name is in
+        self._members = {kind: {} for kind in KINDS}
+        self._dependents = {kind: {} for kind in KINDS}
+
+        # Resolved names, and the cycle each group is part of
+        self._memo = {}
+        self._cycles = {}
+
+        self._lock = threading.RLock()
+
+        self.sync(
+            addresses=addresses,
+            address_groups=address_groups,
+            services=services,
+            service_groups=service_groups,
+            app_groups=app_groups,
+        )
+
+    def __enter__(
+        self
+    ) -> 'GroupResolver':
+        '''
+        Hold the lock, so nothing changes while compiling
+
+        Returns:
+            GroupResolver: This resolver
+        '''
+
+        self._lock.acquire()
+        return self
+
+    def __exit__(
+        self,
+        exc_type,
+        exc_value,
+        traceback,
+    ) -> None:
+        '''
+        Release the lock
+        '''
+
+        self._lock.release()
+
+    def resolve(
+        self,
+        kind: str,
+        name: str,
+    ) -> Membership:
+        '''
+        Get the flattened members of a name
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            name (str): An object, group, or literal (eg, an IP)
+
+        Returns:
+            Membership: The merged ranges (or names), and unresolved names
+        '''
+
+        with self._lock:
+            key = (kind, name)
+            if key not in self._memo:
+                if name in self._members[kind]:
+                    self._flatten(kind, name)
+                else:
+                    self._memo[key] = self._leaf(kind, name)
+
+            return self._memo[key]
+
+    def resolve_many(
+        self,
+        kind: str,
+        names: t.Iterable[str],
+    ) -> Membership:
+        '''
+        Get the flattened members of a list of names, combined
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            names (Iterable): Objects, groups, or literals
+
+        Returns:
+            Membership: The merged ranges (or names), and unresolved names
+        '''
+
+        values = []
+        unresolved = set()
+        for name in names:
+            membership = self.resolve(kind, name)
+            values.extend(membership.values)
+            unresolved.update(membership.unresolved)
+
+        return Membership(
+            values=self._combine(kind, values),
+            unresolved=tuple(sorted(unresolved)),
+        )
+
+    def update(
+        self,
+        dataset: str,
+        entry: dict,
+    ) -> None:
+        '''
+        Add or change an object or group
+            Groups that depend on it will be resolved again when needed
+
+        Args:
+            dataset (str): The type of entry (eg, 'address_group')
+            entry (dict): The object or group, as returned by the API
+        '''
+
+        name = entry['name']
+        kind = self._kind(dataset)
+
+        with self._lock:
+            self._entries[dataset][name] = entry
+
+            # Replace the group's edges in the graph
+            if dataset.endswith('_group'):
+                field = 'static' if kind == 'address' else 'members'
+                self._unlink(kind, name)
+
+                # Empty groups have a placeholder (eg, 'None'), not members
+                self._members[kind][name] = tuple(
+                    member for member in members(entry.get(field))
+                    if member.strip().lower() not in PLACEHOLDERS
+                )
+                for member in self._members[kind][name]:
+                    self._dependents[kind].setdefault(member, set()).add(
+                        name
+                    )
+
+            self._invalidate(kind, name)
+
+    def remove(
+        self,
+        dataset: str,
+        name: str,
+    ) -> None:
+        '''
+        Remove an object or group
+            Groups that contained it will now report it as dangling
+
+        Args:
+            dataset (str): The type of entry (eg, 'address_group')
+            name (str): The name of the object or group
+        '''
+
+        kind = self._kind(dataset)
+
+        with self._lock:
+            if self._entries[dataset].pop(name, None) is None:
+                return
+
+            if dataset.endswith('_group'):
+                self._unlink(kind, name)
+                del self._members[kind][name]
+
+            self._invalidate(kind, name)
+
+    def sync(
+        self,
+        **datasets: list,
+    ) -> int:
+        '''
+        Update to match new lists of objects and groups
+            Only entries that have been added, changed or removed are
+            updated, so unchanged groups keep their resolved members
+
+        Args:
+            **datasets (list): Lists of entries, by dataset name
+                (addresses, address_groups, services, service_groups,
+                app_groups). Datasets that aren't given are not changed.
+
+        Raises:
+            ValueError: If a dataset is unknown
+
+        Returns:
+            int: The number of entries that changed
+        '''
+
+        changes = 0
+        with self._lock:
+            for name, entries in datasets.items():
+                if name not in DATASETS:
+                    raise ValueError(f"Unknown dataset '{name}'")
+                dataset = DATASETS[name]
+
+                current = self._entries[dataset]
+                names = set()
+                for entry in entries:
+                    names.add(entry['name'])
+                    if current.get(entry['name']) != entry:
+                        self.update(dataset, entry)
+                        changes += 1
+
+                for name in [name for name in current if name not in names]:
+                    self.remove(dataset, name)
+                    changes += 1
+
+        return changes
+
+    def cycles(
+        self
+    ) -> list:
+        '''
+        Find groups that contain themselves
+            Every group is resolved, so all cycles are found
+
+        Returns:
+            list: Each cycle found
+                kind (str): 'address', 'service' or 'app'
+                groups (list): The groups in the cycle, sorted
+        '''
+
+        with self._lock:
+            for kind in KINDS:
+                for name in list(self._members[kind]):
+                    self.resolve(kind, name)
+
+            found = {
+                (kind, groups)
+                for (kind, _), groups in self._cycles.items()
+            }
+
+        return [
+            {'kind': kind, 'groups': list(groups)}
+            for kind, groups in sorted(found)
+        ]
+
+    def dangling(
+        self
+    ) -> list:
+        '''
+        Find group members that don't exist
+            Address literals (eg, 10.0.0.0/8) and built in services exist
+            Applications are defined by the device, so are not checked
+
+        Returns:
+            list: Each group with dangling members
+                kind (str): 'address' or 'service'
+                group (str): The group name
+                members (list): The members that don't exist
+        '''
+
+        found = []
+        with self._lock:
+            for kind in ('address', 'service'):
+                for group, names in sorted(self._members[kind].items()):
+                    missing = [
+                        name for name in names
+                        if name not in self._members[kind] and
+                        name not in self._entries[kind] and
+                        not self._leaf(kind, name).values
+                    ]
+                    if missing:
+                        found.append(
+                            {'kind': kind, 'group': group, 'members': missing}
+                        )
+
+        return found
+
+    def groups(
+        self,
+        kind: str,
+    ) -> list:
+        '''
+        Get the names of the groups of a kind
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+
+        Returns:
+            list: The group names, sorted
+        '''
+
+        with self._lock:
+            return sorted(self._members[kind])
+
+    def report(
+        self
+    ) -> dict:
+        '''
+        Summarise the problems found
+
+        Returns:
+            dict: The problems
+                cycles (list): From 'cycles()'
+                dangling (list): From 'dangling()'
+        '''
+
+        return {
+            'cycles': self.cycles(),
+            'dangling': self.dangling(),
+        }
+
+    @staticmethod
+    def _kind(
+        dataset: str,
+    ) -> str:
+        '''
+        Get the kind of name an object or group dataset holds
+
+        Args:
+            dataset (str): The type of entry (eg, 'address_group')
+
+        Raises:
+            ValueError: If the dataset is unknown
+
+        Returns:
+            str: 'address', 'service' or 'app'
+        '''
+
+        for kind, datasets in KINDS.items():
+            if dataset in datasets:
+                return kind
+
+        raise ValueError(f"Unknown dataset '{dataset}'")
+
+    @staticmethod
+    def _combine(
+        kind: str,
+        values: list,
+    ) -> tuple:
+        '''
+        Combine the values of several names
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            values (list): Ranges, or application names
+
+        Returns:
+            tuple: Merged ranges, or sorted unique application names
+        '''
+
+        if kind == 'app':
+            return tuple(sorted(set(values)))
+
+        return tuple(merge(values))
+
+    def _unlink(
+        self,
+        kind: str,
+        name: str,
+    ) -> None:
+        '''
+        Remove a group's edges from the graph
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            name (str): The group name
+        '''
+
+        for member in self._members[kind].get(name, ()):
+            groups = self._dependents[kind].get(member)
+            if groups is not None:
+                groups.discard(name)
+
+    def _flatten(
+        self,
+        kind: str,
+        name: str,
+    ) -> None:
+        '''
+        Resolve a group, and any unresolved groups it contains
+            Groups that are already resolved are not visited again
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            name (str): The group name
+        '''
+
+        groups = self._members[kind]
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+
+        def visit(group):
+            index[group] = low[group] = len(index)
+            stack.append(group)
+            on_stack.add(group)
+
+            for member in groups[group]:
+                if member not in groups or (kind, member) in self._memo:
+                    continue
+                if member not in index:
+                    visit(member)
+                    low[group] = min(low[group], low[member])
+                elif member in on_stack:
+                    low[group] = min(low[group], index[member])
+
+            # This group is the root of a component, so resolve it
+            if low[group] == index[group]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == group:
+                        break
+                self._close(kind, component)
+
+        visit(name)
+
+    def _close(
+        self,
+        kind: str,
+        component: list,
+    ) -> None:
+        '''
+        Resolve a strongly connected component of groups
+            Groups it contains outside the component are already resolved
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            component (list): Group names that all contain each other
+        '''
+
+        inside = set(component)
+        values = []
+        unresolved = set()
+        for group in component:
+            for member in self._members[kind][group]:
+                if member in inside:
+                    continue
+                membership = self.resolve(kind, member)
+                values.extend(membership.values)
+                unresolved.update(membership.unresolved)
+
+        membership = Membership(
+            values=self._combine(kind, values),
+            unresolved=tuple(sorted(unresolved)),
+        )
+
+        # A cycle is more than one group, or a group that contains itself
+        cycle = len(component) > 1 or component[0] in (
+            self._members[kind][component[0]]
+        )
+        for group in component:
+            self._memo[(kind, group)] = membership
+            if cycle:
+                self._cycles[(kind, group)] = tuple(sorted(component))
+
+    def _leaf(
+        self,
+        kind: str,
+        name: str,
+    ) -> Membership:
+        '''
+        Resolve a name that isn't a group
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            name (str): An object, or a literal
+
+        Returns:
+            Membership: The ranges (or name), or the unresolved name
+        '''
+
+        if kind == 'app':
+            return Membership(values=(name,), unresolved=())
+
+        if kind == 'address':
+            entry = self._entries['address'].get(name)
+            value = entry.get('addr') if entry is not None else name
+            values = [parse_address(str(value))]
+        else:
+            values = self._service_ranges(name)
+
+        if None in values:
+            return Membership(values=(), unresolved=(name,))
+
+        return Membership(values=tuple(merge(values)), unresolved=())
+
+    def _service_ranges(
+        self,
+        name: str,
+    ) -> list:
+        '''
+        Get the port ranges of a service object
+
+        Args:
+            name (str): The service name
+
+        Returns:
+            list: Tuples of (protocol, first port, last port)
+                [None] if the service can't be resolved
+        '''
+
+        if name in BUILTIN_SERVICES:
+            return BUILTIN_SERVICES[name]
+
+        service = self._entries['service'].get(name)
+        if service is None:
+            return [None]
+
+        # PAN-OS services look like {'tcp': {'port': '443'}}
+        protocol = service.get('protocol')
+        if isinstance(protocol, dict):
+            return [
+                (proto, first, last)
+                for proto, settings in protocol.items()
+                if isinstance(settings, dict)
+                for first, last in parse_ports(settings.get('port', ''))
+            ] or [None]
+
+        # Junos services have a protocol and destination port
+        return [
+            (str(protocol).lower(), first, last)
+            for first, last in parse_ports(service.get('dest_port', ''))
+        ] or [None]
+
+    def _invalidate(
+        self,
+        kind: str,
+        name: str,
+    ) -> None:
+        '''
+        Forget a name, and every group that depends on it
+            They are resolved again the next time they are needed
+
+        Args:
+            kind (str): 'address', 'service' or 'app'
+            name (str): The object or group that changed
+        '''
+
+        pending = [name]
+        seen = {name}
+        while pending:
+            current = pending.pop()
+            self._memo.pop((kind, current), None)
+            self._cycles.pop((kind, current), None)
+
+            for group in self._dependents[kind].get(current, ()):
+                if group not in seen:
+                    seen.add(group)
+                    pending.append(group)
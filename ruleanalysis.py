@@ -0,0 +1,497 @@
+'''
+Find security rules that can never match, or could be combined
+
+Each rule matches a set of traffic, in several fields
+    Zones, users, URL categories and applications are sets of names
+    Addresses and services are resolved to merged IP and port ranges
+
+A rule is covered if the rules before it match all of its traffic
+    Shadowed: it's covered, and an earlier rule has a different action
+        The rule never matches, and its action never applies
+    Redundant: it's covered by rules with the same action
+        The rule can be removed, with no change to what is allowed
+
+Covering rules are found with the same bitmask indexes as rule lookups
+    Each rule is a bit, and each field has an index of the rules that
+    contain a value or range. ANDing the masks of each field gives every
+    earlier rule that covers a rule completely, without comparing pairs.
+
+A rule may also be covered by several rules together
+    For example, two rules for 10.0.0.0/25 and 10.0.0.128/25 cover a rule
+    for 10.0.0.0/24, if the other fields are covered
+    For each field, the rules that cover every other field are found, and
+    their ranges in this field are merged and checked (interval set union)
+
+Mergeable rules are next to each other, with the same action, and only
+    differ in one field. They could be one rule, with both values.
+
+Limitations:
+    Negated addresses and schedules are not considered
+    'application-default' is only covered by 'any' or 'application-default'
+    Addresses that can't be resolved (eg, FQDNs) are only covered by 'any'
+
+Classes:
+    RuleAnalysis
+        Finds shadowed, redundant and mergeable rules in a rulebase
+'''
+
+import bisect
+import time
+
+from intervals import IntervalTree, merge
+from objectdiff import members
+from resolver import GroupResolver
+
+
+# Fields matched by name
+NAME_FIELDS = ('from', 'to', 'source_user', 'category', 'application')
+
+# Fields matched by range, and the kind of name they hold
+RANGE_FIELDS = {
+    'source': 'address',
+    'destination': 'address',
+    'service': 'service',
+}
+
+# Settings that must be the same for rules to be merged
+MERGE_SETTINGS = ('action', 'type', 'log', 'log_start', 'log_end', 'tag')
+
+# Values that mean a field matches anything
+ANY = ('any', 'None', '')
+
+
+class RuleAnalysis:
+    '''
+    Finds shadowed, redundant and mergeable rules in a rulebase
+
+    Methods:
+        __init__: Resolve the rules, and build the indexes
+        report: Find shadowed, redundant and mergeable rules
+        _fields: Resolve the fields of a rule
+        _cover: Get the masks of rules that cover each field of a rule
+        _range_cover: Get the mask of rules containing a range
+        _union_cover: Check if several rules together cover a rule
+        _contains_range: Check if merged ranges contain a whole range
+        _mergeable: Find groups of rules that could be merged
+    '''
+
+    def __init__(
+        self,
+        rules: list,
+        resolver: GroupResolver = None,
+    ) -> None:
+        '''
+        Resolve the rules, and build the indexes
+
+        Args:
+            rules (list): Security rules, as returned by the API
+            resolver (GroupResolver): Resolves the objects and groups
+        '''
+
+        self.rules = rules
+        self.resolver = resolver or GroupResolver()
+
+        # Resolved fields of each enabled rule (None if disabled)
+        self._resolved = []
+
+        # Masks of rules with 'any' in each field, and all enabled rules
+        self._all = 0
+        self._any = {field: 0 for field in NAME_FIELDS + tuple(RANGE_FIELDS)}
+        self._app_default = 0
+
+        # Names to masks of rules, and ranges for the interval trees
+        self._names = {field: {} for field in NAME_FIELDS}
+        ranges = {field: {} for field in RANGE_FIELDS}
+
+        with self.resolver:
+            for position, rule in enumerate(rules):
+                if str(rule.get('disabled', 'no')).lower() == 'yes':
+                    self._resolved.append(None)
+                    continue
+
+                bit = 1 << position
+                self._all |= bit
+                fields = self._fields(rule)
+                self._resolved.append(fields)
+
+                for field in NAME_FIELDS:
+                    if fields[field] is None:
+                        self._any[field] |= bit
+                        continue
+                    for name in fields[field]:
+                        index = self._names[field]
+                        index[name] = index.get(name, 0) | bit
+
+                for field in RANGE_FIELDS:
+                    value = fields[field]
+                    if value is None:
+                        self._any[field] |= bit
+                    elif value == 'application-default':
+                        self._app_default |= bit
+                    else:
+                        for key, first, last in value[0]:
+                            ranges[field].setdefault(key, []).append(
+                                (first, last, (last, bit))
+                            )
+
+        self._trees = {
+            field: {
+                key: IntervalTree(intervals)
+                for key, intervals in by_key.items()
+            }
+            for field, by_key in ranges.items()
+        }
+
+        # Masks of rules containing a range, shared by rules
+        self._memo = {}
+
+    def _fields(
+        self,
+        rule: dict,
+    ) -> dict:
+        '''
+        Resolve the fields of a rule
+
+        Args:
+            rule (dict): The rule
+
+        Returns:
+            dict: Each field, resolved
+                Name fields are a frozenset of names, or None for 'any'
+                Range fields are (merged ranges, unresolved names),
+                None for 'any', or 'application-default'
+        '''
+
+        fields = {}
+        for field in NAME_FIELDS:
+            names = members(rule.get(field))
+            if field == 'application' and names:
+                names = self.resolver.resolve_many('app', names).values
+            if not names or any(name in ANY for name in names):
+                fields[field] = None
+            else:
+                fields[field] = frozenset(names)
+
+        for field, kind in RANGE_FIELDS.items():
+            names = members(rule.get(field))
+            if not names or any(name in ANY for name in names):
+                fields[field] = None
+            elif 'application-default' in names:
+                fields[field] = 'application-default'
+            else:
+                membership = self.resolver.resolve_many(kind, names)
+                unresolved = membership.unresolved
+
+                # Empty groups match nothing, so aren't treated as covered
+                if not membership.values and not unresolved:
+                    unresolved = tuple(names)
+                fields[field] = (membership.values, unresolved)
+
+        return fields
+
+    def _range_cover(
+        self,
+        field: str,
+        key,
+        first: int,
+        last: int,
+    ) -> int:
+        '''
+        Get the mask of rules containing a range
+
+        Args:
+            field (str): 'source', 'destination' or 'service'
+            key: The IP version, or the protocol
+            first (int): The start of the range
+            last (int): The end of the range
+
+        Returns:
+            int: Mask of rules with a range that contains this one
+        '''
+
+        memo_key = (field, key, first, last)
+        if memo_key not in self._memo:
+            mask = 0
+            tree = self._trees[field].get(key)
+            if tree is not None:
+                for end, bit in tree.stab(first):
+                    if end >= last:
+                        mask |= bit
+            self._memo[memo_key] = mask
+
+        return self._memo[memo_key]
+
+    def _cover(
+        self,
+        fields: dict,
+    ) -> dict:
+        '''
+        Get the masks of rules that cover each field of a rule
+
+        Args:
+            fields (dict): The resolved fields of the rule
+
+        Returns:
+            dict: Each field, to the mask of rules that cover it
+        '''
+
+        masks = {}
+        for field in NAME_FIELDS:
+            mask = self._any[field]
+            if fields[field] is not None:
+                names = self._all
+                for name in fields[field]:
+                    names &= self._names[field].get(name, 0)
+                mask |= names
+            masks[field] = mask
+
+        for field in RANGE_FIELDS:
+            value = fields[field]
+            mask = self._any[field]
+            if value == 'application-default':
+                mask |= self._app_default
+
+            # Unresolved names might be anything, so only 'any' covers them
+            elif value is not None and not value[1]:
+                ranges = self._all
+                for key, first, last in value[0]:
+                    ranges &= self._range_cover(field, key, first, last)
+                mask |= ranges
+
+            masks[field] = mask
+
+        return masks
+
+    def _union_cover(
+        self,
+        fields: dict,
+        masks: dict,
+        earlier: int,
+    ) -> int:
+        '''
+        Check if several rules together cover a rule
+            For each field, the rules that cover all other fields are
+            combined, and checked against this field
+
+        Args:
+            fields (dict): The resolved fields of the rule
+            masks (dict): The masks of rules that cover each field
+            earlier (int): Mask of the enabled rules before this one
+
+        Returns:
+            int: Mask of the rules that cover it together, or 0
+        '''
+
+        names = list(masks)
+        for field in names:
+            value = fields[field]
+            if value is None or value == 'application-default':
+                continue
+            if field in RANGE_FIELDS and value[1]:
+                continue
+
+            # Rules that cover every other field
+            others = earlier
+            for other in names:
+                if other != field:
+                    others &= masks[other]
+            if not others:
+                continue
+
+            # Combine their values in this field (sets, or merged ranges)
+            combined = set() if field in NAME_FIELDS else []
+            mask = others
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                theirs = self._resolved[bit.bit_length() - 1][field]
+                if theirs is None or theirs == 'application-default':
+                    continue
+                if field in NAME_FIELDS:
+                    combined.update(theirs)
+                else:
+                    combined.extend(theirs[0])
+
+            if field in NAME_FIELDS:
+                covered = value <= combined
+            else:
+                combined = merge(combined)
+                covered = all(
+                    self._contains_range(combined, key, first, last)
+                    for key, first, last in value[0]
+                )
+
+            if covered:
+                return others
+
+        return 0
+
+    @staticmethod
+    def _contains_range(
+        ranges: list,
+        key,
+        first: int,
+        last: int,
+    ) -> bool:
+        '''
+        Check if merged ranges contain a whole range
+            As the ranges are merged, one of them must contain it all
+
+        Args:
+            ranges (list): Merged ranges, sorted
+            key: The IP version, or the protocol
+            first (int): The start of the range
+            last (int): The end of the range
+
+        Returns:
+            bool: True if the range is contained
+        '''
+
+        index = bisect.bisect_right(ranges, (key, first, float('inf'))) - 1
+        if index < 0:
+            return False
+
+        range_key, start, end = ranges[index]
+        return range_key == key and start <= first and last <= end
+
+    def report(
+        self
+    ) -> dict:
+        '''
+        Find shadowed, redundant and mergeable rules
+
+        Returns:
+            dict: The report
+                rules (int): The number of rules
+                shadowed (list): Rules covered by a different action
+                redundant (list): Rules covered by the same action
+                    name (str): The rule name
+                    position (int): The rule's position
+                    action (str): The rule's action
+                    by (list): The names of the covering rules
+                mergeable (list): Rules that could be merged
+                    rules (list): The rule names
+                    field (str): The field they differ in
+                elapsed (float): Seconds taken
+        '''
+
+        start = time.perf_counter()
+        shadowed = []
+        redundant = []
+
+        for position, fields in enumerate(self._resolved):
+            if fields is None:
+                continue
+
+            earlier = self._all & ((1 << position) - 1)
+            if not earlier:
+                continue
+
+            masks = self._cover(fields)
+            covering = earlier
+            for mask in masks.values():
+                covering &= mask
+
+            # One earlier rule covers it, so the first of them applies
+            if covering:
+                covering &= -covering
+            else:
+                covering = self._union_cover(fields, masks, earlier)
+            if not covering:
+                continue
+
+            rule = self.rules[position]
+            by = []
+            actions = set()
+            while covering:
+                bit = covering & -covering
+                covering ^= bit
+                other = self.rules[bit.bit_length() - 1]
+                by.append(other.get('name'))
+                actions.add(other.get('action'))
+
+            entry = {
+                'name': rule.get('name'),
+                'position': position,
+                'action': rule.get('action'),
+                'by': by,
+            }
+            if actions == {rule.get('action')}:
+                redundant.append(entry)
+            else:
+                shadowed.append(entry)
+
+        return {
+            'rules': len(self.rules),
+            'shadowed': shadowed,
+            'redundant': redundant,
+            'mergeable': self._mergeable(),
+            'elapsed': round(time.perf_counter() - start, 3),
+        }
+
+    def _mergeable(
+        self
+    ) -> list:
+        '''
+        Find groups of rules that could be merged
+            Rules must be next to each other (ignoring disabled rules),
+            have the same action and settings, and differ in one field
+
+        Returns:
+            list: Each group
+                rules (list): The rule names
+                field (str): The field they differ in
+        '''
+
+        fields = NAME_FIELDS + tuple(RANGE_FIELDS)
+        groups = []
+
+        # Blocks of rules in a row with the same settings
+        blocks = []
+        previous = None
+        for position, resolved in enumerate(self._resolved):
+            if resolved is None:
+                continue
+            rule = self.rules[position]
+            settings = tuple(
+                str(rule.get(setting)) for setting in MERGE_SETTINGS
+            )
+            if settings != previous:
+                blocks.append([])
+                previous = settings
+            blocks[-1].append(position)
+
+        for block in blocks:
+            if len(block) < 2:
+                continue
+
+            # Rules with the same values in all but one field
+            for field in fields:
+                matches = {}
+                for position in block:
+                    rule = self.rules[position]
+                    key = tuple(
+                        tuple(sorted(members(rule.get(other))))
+                        for other in fields
+                        if other != field
+                    )
+                    matches.setdefault(key, []).append(position)
+
+                for positions in matches.values():
+                    # Identical rules are reported as redundant instead
+                    values = {
+                        tuple(sorted(members(self.rules[position].get(field))))
+                        for position in positions
+                    }
+                    if len(positions) > 1 and len(values) > 1:
+                        groups.append(
+                            {
+                                'rules': [
+                                    self.rules[position].get('name')
+                                    for position in positions
+                                ],
+                                'field': field,
+                            }
+                        )
+
+        return groups
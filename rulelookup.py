@@ -0,0 +1,371 @@
+'''
+Find which security rule matches a flow
+
+A rulebase is compiled into indexes, once per version of the rules
+    (1) Zones: a map of zone names to the rules that use them
+    (2) Addresses: interval trees of the source and destination ranges
+        Address objects and groups are resolved to IP ranges first,
+        with a GroupResolver (which can be shared with other rulebases)
+    (3) Services: interval trees of the ports, per protocol
+    (4) Applications: a map of application names to rules
+
+Each rule is one bit in an integer mask
+    Each index returns a mask of the rules that could match
+    The masks are combined, and the lowest bit is the first match
+
+Limitations:
+    Users, URL categories, and negated addresses are not considered
+    'application-default' is treated as any port
+    Addresses that can't be resolved to IPs (eg, FQDNs) never match
+
+Classes:
+    RuleLookup
+        A compiled rulebase that answers first match queries
+'''
+
+import ipaddress
+
+from intervals import IntervalTree
+from objectdiff import members
+from resolver import GroupResolver
+
+
+class RuleLookup:
+    '''
+    A compiled rulebase that answers first match queries
+
+    Methods:
+        __init__: Compile the rulebase
+        __len__: The number of rules
+        lookup: Find the first rule that matches a flow
+        _compile: Add a rule to the indexes
+        _addresses: Resolve address names to merged IP ranges
+        _services: Resolve service names to merged port ranges
+        _applications: Resolve application names, expanding groups
+        _tree_mask: Get the mask of rules with a range containing a point
+    '''
+
+    def __init__(
+        self,
+        rules: list,
+        addresses: list = (),
+        address_groups: list = (),
+        services: list = (),
+        service_groups: list = (),
+        app_groups: list = (),
+        resolver: GroupResolver = None,
+    ) -> None:
+        '''
+        Compile the rulebase
+
+        Args:
+            rules (list): Security rules, as returned by the API
+            addresses (list): Address objects
+            address_groups (list): Address groups
+            services (list): Service objects
+            service_groups (list): Service groups
+            app_groups (list): Application groups
+            resolver (GroupResolver): Resolves the objects and groups
+                If this is given, the lists of objects are not used
+        '''
+
+        self.rules = rules
+
+        # Object and group names, resolved to their members
+        if resolver is None:
+            resolver = GroupResolver(
+                addresses=addresses,
+                address_groups=address_groups,
+                services=services,
+                service_groups=service_groups,
+                app_groups=app_groups,
+            )
+        self.resolver = resolver
+
+        # Names that couldn't be resolved, per rule
+        self.unresolved = {}
+
+        # Masks of rules that match any value in each field
+        self._all = 0
+        self._any = {
+            'from': 0, 'to': 0, 'source': 0, 'destination': 0,
+            'service': 0, 'application': 0,
+        }
+
+        # Zone and application names, to masks of rules
+        self._names = {'from': {}, 'to': {}, 'application': {}}
+
+        # Ranges for each rule, before building the interval trees
+        ranges = {'source': {}, 'destination': {}, 'service': {}}
+
+        # Hold the resolver, so the objects don't change while compiling
+        with resolver:
+            for position, rule in enumerate(rules):
+                if str(rule.get('disabled', 'no')).lower() == 'yes':
+                    continue
+
+                bit = 1 << position
+                self._all |= bit
+                self._compile(
+                    rule=rule,
+                    bit=bit,
+                    name=rule.get('name', str(position)),
+                    ranges=ranges,
+                )
+
+        # Build the interval trees
+        self._trees = {
+            field: {
+                key: IntervalTree(intervals)
+                for key, intervals in by_key.items()
+            }
+            for field, by_key in ranges.items()
+        }
+
+    def __len__(
+        self
+    ) -> int:
+        '''
+        The number of rules in the rulebase
+
+        Returns:
+            int: Number of rules
+        '''
+
+        return len(self.rules)
+
+    def lookup(
+        self,
+        source: str = None,
+        destination: str = None,
+        protocol: str = 'tcp',
+        port: int = None,
+        from_zone: str = None,
+        to_zone: str = None,
+        application: str = None,
+    ) -> dict:
+        '''
+        Find the first rule that matches a flow
+            Any part of the flow that is not given is not checked
+
+        Args:
+            source (str): The source IP
+            destination (str): The destination IP
+            protocol (str): The protocol (tcp or udp)
+            port (int): The destination port
+            from_zone (str): The source zone
+            to_zone (str): The destination zone
+            application (str): The application
+
+        Raises:
+            ValueError: If an IP address is invalid
+
+        Returns:
+            dict: The result
+                match (dict): The matching rule, or None
+                position (int): The position of the rule, or None
+                action (str): The action of the rule, or the default
+                default (bool): True if no rule matched
+        '''
+
+        mask = self._all
+
+        # Check zones and applications by name
+        for field, value in (
+            ('from', from_zone),
+            ('to', to_zone),
+            ('application', application),
+        ):
+            if value:
+                mask &= self._any[field] | self._names[field].get(value, 0)
+
+        # Check addresses and services by range
+        for field, value in (
+            ('source', source),
+            ('destination', destination),
+        ):
+            if value and mask:
+                ip = ipaddress.ip_address(value)
+                mask &= self._any[field] | self._tree_mask(
+                    field,
+                    ip.version,
+                    int(ip),
+                )
+
+        if port is not None and mask:
+            mask &= self._any['service'] | self._tree_mask(
+                'service',
+                protocol.lower(),
+                int(port),
+            )
+
+        # The lowest bit is the first matching rule
+        if mask:
+            position = (mask & -mask).bit_length() - 1
+            rule = self.rules[position]
+            return {
+                'match': rule,
+                'position': position,
+                'action': rule.get('action'),
+                'default': False,
+            }
+
+        # Default rules allow traffic within a zone, and deny between zones
+        if from_zone and to_zone:
+            action = 'allow' if from_zone == to_zone else 'deny'
+        else:
+            action = 'deny'
+
+        return {
+            'match': None,
+            'position': None,
+            'action': action,
+            'default': True,
+        }
+
+    def _compile(
+        self,
+        rule: dict,
+        bit: int,
+        name: str,
+        ranges: dict,
+    ) -> None:
+        '''
+        Add a rule to the indexes
+
+        Args:
+            rule (dict): The rule
+            bit (int): The rule's bit in the masks
+            name (str): The rule name, to record unresolved names
+            ranges (dict): Ranges for each field, for the interval trees
+        '''
+
+        # Zones and applications are matched by name
+        for field in ('from', 'to', 'application'):
+            values = members(rule.get(field))
+            if field == 'application':
+                values = self._applications(values)
+
+            if not values or 'any' in values:
+                self._any[field] |= bit
+                continue
+
+            for value in values:
+                index = self._names[field]
+                index[value] = index.get(value, 0) | bit
+
+        # Addresses are matched by IP range
+        for field in ('source', 'destination'):
+            values = members(rule.get(field))
+            if not values or 'any' in values:
+                self._any[field] |= bit
+                continue
+
+            for key, first, last in self._addresses(values, name):
+                ranges[field].setdefault(key, []).append((first, last, bit))
+
+        # Services are matched by protocol and port
+        values = members(rule.get('service'))
+        if (
+            not values or
+            'any' in values or
+            'application-default' in values
+        ):
+            self._any['service'] |= bit
+        else:
+            for key, first, last in self._services(values, name):
+                ranges['service'].setdefault(key, []).append(
+                    (first, last, bit)
+                )
+
+    def _addresses(
+        self,
+        names: list,
+        rule: str,
+    ) -> list:
+        '''
+        Resolve address names to merged IP ranges
+
+        Args:
+            names (list): Address objects, groups, or IPs
+            rule (str): The rule name, to record unresolved names
+
+        Returns:
+            list: Merged tuples of (version, first IP, last IP)
+        '''
+
+        membership = self.resolver.resolve_many('address', names)
+        if membership.unresolved:
+            self.unresolved.setdefault(rule, []).extend(
+                membership.unresolved
+            )
+
+        return list(membership.values)
+
+    def _services(
+        self,
+        names: list,
+        rule: str,
+    ) -> list:
+        '''
+        Resolve service names to merged port ranges
+
+        Args:
+            names (list): Service objects or groups
+            rule (str): The rule name, to record unresolved names
+
+        Returns:
+            list: Merged tuples of (protocol, first port, last port)
+        '''
+
+        membership = self.resolver.resolve_many('service', names)
+        if membership.unresolved:
+            self.unresolved.setdefault(rule, []).extend(
+                membership.unresolved
+            )
+
+        return list(membership.values)
+
+    def _applications(
+        self,
+        names: list,
+    ) -> list:
+        '''
+        Resolve application names, expanding application groups
+
+        Args:
+            names (list): Applications or application groups
+
+        Returns:
+            list: Application names
+        '''
+
+        return list(self.resolver.resolve_many('app', names).values)
+
+    def _tree_mask(
+        self,
+        field: str,
+        key,
+        point: int,
+    ) -> int:
+        '''
+        Get the mask of rules with a range containing a point
+
+        Args:
+            field (str): 'source', 'destination' or 'service'
+            key: The IP version, or the protocol
+            point (int): The IP (as an integer) or port
+
+        Returns:
+            int: Mask of matching rules
+        '''
+
+        tree = self._trees[field].get(key)
+        if tree is None:
+            return 0
+
+        mask = 0
+        for bit in tree.stab(point):
+            mask |= bit
+
+        return mask
@@ -0,0 +1,1622 @@
+'''
+Poll devices in the background, and keep the results in memory
+
+Device facts, HA state, and VPN and GlobalProtect status are polled on a
+    schedule, so API routes can read the latest results, rather than
+    waiting for a live call to the device
+
+Each device has a job for each metric
+    A job runs at the metric's interval, or a per-device override
+    A random jitter is added, so devices aren't all polled at once
+    When more jobs are due than can run, the highest priority runs first
+
+Slow or failing devices are backed off
+    A failed or slow poll doubles the job's interval, up to a limit
+    The next successful poll resets it
+
+A global cap limits how many polls run at once
+    Polls also wait for their vendor's and device's limits, which are
+    shared with other fan-outs (see concurrency.py)
+
+HA, VPN and GlobalProtect polls are coroutines, run on one event loop
+    They use the async API clients (AsyncDeviceApi), so Palo Alto calls
+    share one HTTP connection pool, rather than a thread each
+    Facts are polled in worker threads, as they update the database
+
+Only one worker process polls
+    uWSGI forks its workers, and threads don't survive a fork, so each
+    worker starts the scheduler after it forks (see main.py)
+    The first worker to lock a shared file runs the scheduler. If it
+    exits, another worker takes over
+    Without file locks (eg, Windows), every worker polls
+
+The results are shared with the other workers through a file
+    The polling worker saves them each second, if they've changed
+    Other workers read the file again when it changes, and apply the
+    facts and HA state to their own devices, so the device list, HA
+    pairs and version are the same in every worker
+    Watchers are only called in the polling worker
+    Other workers pass refreshes and interval changes to it through a
+    second file
+
+Classes:
+    StateStore
+        The latest result of each poll, shared between workers
+    PollScheduler
+        Runs polling jobs on a schedule
+
+Functions:
+    device_api
+        Create the API object for a device
+    poll_facts
+        Poll the model, serial, version and HA state of a device
+    poll_ha
+        Poll the HA state of a device
+    poll_vpn
+        Poll the VPN tunnel status of a device
+    poll_gp
+        Poll the GlobalProtect sessions of a device
+
+Misc Variables:
+    device_state
+        The shared StateStore object
+    poll_scheduler
+        The shared PollScheduler object
+'''
+
+from colorama import Fore, Style
+
+import asyncio
+import base64
+import concurrent.futures
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import typing as t
+
+from concurrency import concurrency
+from jsonprovider import encode
+from device import Device, device_manager
+from pa_api import AsyncDeviceApi as PaAsyncDeviceApi
+from pa_api import DeviceApi as PaDeviceApi
+from junos_api import AsyncDeviceApi as JunosAsyncDeviceApi
+from junos_api import DeviceApi as JunosDeviceApi
+from state import STATE_DIR, SharedJsonFile, leader_lock, locked
+
+
+# How often each metric is polled (seconds)
+INTERVALS = {
+    'facts': 3600,
+    'ha': 60,
+    'vpn': 30,
+    'gp': 60,
+}
+
+# Which metric runs first when several are waiting (lowest first)
+PRIORITY = {
+    'ha': 0,
+    'vpn': 1,
+    'gp': 1,
+    'facts': 2,
+}
+
+# Priority of a poll that was asked for (eg, by a refresh)
+URGENT = -1
+
+# Random change to each interval (fraction of the interval)
+JITTER = 0.1
+
+# A poll slower than this (seconds) is backed off
+SLOW_POLL = 10
+
+# The most an interval is multiplied by, when backing off
+MAX_BACKOFF = 16
+
+# The most polls that run at once
+MAX_CONCURRENT = 8
+
+# How often the device list is checked for changes (seconds)
+SYNC_INTERVAL = 30
+
+# Results older than this many intervals are stale
+STALE_AFTER = 3
+
+# Files for the shared results, for choosing the polling worker, and
+#   for requests from the other workers
+STATE_FILE = os.path.join(STATE_DIR, 'device_state.json')
+LOCK_FILE = os.path.join(STATE_DIR, 'poller.lock')
+REQUEST_FILE = os.path.join(STATE_DIR, 'poll_requests.jsonl')
+
+# How often the results are saved, or read again (seconds)
+SAVE_INTERVAL = 1
+
+# How often other workers try to become the polling worker (seconds)
+LEADER_RETRY = 10
+
+
+class StateStore:
+    '''
+    The latest result of each poll, shared between workers
+        Keyed by device ID and metric
+        The writer (the polling worker) keeps the results in memory,
+        and saves them to a file. Other workers read the file
+
+    Methods:
+        __init__: Create an empty store
+        version: Changes whenever a result is stored
+        set: Store the result of a successful poll
+        fail: Record a failed poll
+        get: Get the result of a poll
+        device: Get the results of every poll of a device
+        discard: Remove the result of a poll
+        share: Save extra data with the results
+        extra: Get the extra data saved with the results
+        save: Save the results, if they've changed
+        load: Read the saved results, and become the writer
+        refresh: Read the saved results now, if the file has changed
+        follow: Call a function whenever new results are read
+        watch: Call a function whenever a metric is polled
+        _read: Read the saved results, if the file has changed
+        _notify: Call the functions watching a metric
+    '''
+
+    def __init__(
+        self,
+        path: str = STATE_FILE,
+    ) -> None:
+        '''
+        Create an empty store
+
+        Args:
+            path (str): The file the results are shared through
+        '''
+
+        self._file = SharedJsonFile(path)
+        self._lock = threading.Lock()
+        self._state = {}
+
+        # Functions to call when each metric is polled, and when new
+        #   results are read from the file
+        self._watchers = {}
+        self._followers = []
+
+        # Changes whenever a result is stored
+        self._version = 0
+
+        # Whether this worker stores results, or reads them from the file
+        self.writer = False
+
+        # The version last saved, and when the file was last checked
+        self._saved = 0
+        self._checked = 0
+
+        # Extra data saved with the results (eg, the jobs), and the
+        #   functions that get it
+        self._extra = {}
+        self._sharers = {}
+
+    @property
+    def version(
+        self
+    ) -> int:
+        '''
+        Changes whenever a result is stored
+            The same in every worker, so it can be used in ETags
+
+        Returns:
+            int: The version
+        '''
+
+        self._read()
+        return self._version
+
+    def set(
+        self,
+        device_id: str,
+        metric: str,
+        value: t.Any,
+        elapsed: float,
+    ) -> None:
+        '''
+        Store the result of a successful poll
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric (eg, 'vpn')
+            value (Any): The result
+            elapsed (float): Seconds the poll took
+        '''
+
+        now = time.time()
+        with self._lock:
+            self._state[(str(device_id), metric)] = {
+                'value': value,
+                'updated': now,
+                'polled': now,
+                'elapsed': round(elapsed, 3),
+                'error': None,
+                'failures': 0,
+            }
+            self._version += 1
+
+        self._notify(device_id, metric)
+
+    def fail(
+        self,
+        device_id: str,
+        metric: str,
+        error: str,
+        elapsed: float,
+    ) -> None:
+        '''
+        Record a failed poll
+            The last good result is kept
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+            error (str): What went wrong
+            elapsed (float): Seconds the poll took
+        '''
+
+        with self._lock:
+            entry = self._state.setdefault(
+                (str(device_id), metric),
+                {'value': None, 'updated': None, 'failures': 0},
+            )
+            entry['error'] = error
+            entry['polled'] = time.time()
+            entry['elapsed'] = round(elapsed, 3)
+            entry['failures'] += 1
+            self._version += 1
+
+        self._notify(device_id, metric)
+
+    def get(
+        self,
+        device_id: str,
+        metric: str,
+        max_age: float = None,
+    ) -> dict | None:
+        '''
+        Get the result of a poll
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+            max_age (float): Ignore results older than this (seconds)
+
+        Returns:
+            dict: The result, or None if there is no recent result
+                value (Any): The result (None if no poll has worked)
+                updated (float): When it was polled (epoch seconds)
+                polled (float): When it was last polled, whether it
+                    worked or not (epoch seconds)
+                age (float): Seconds since it was polled
+                elapsed (float): Seconds the last poll took
+                error (str): Why the last poll failed (None if it worked)
+                failures (int): Failed polls since the last success
+        '''
+
+        self._read()
+        with self._lock:
+            entry = self._state.get((str(device_id), metric))
+            if entry is None:
+                return None
+            entry = dict(entry)
+
+        # Polls that have never worked have no age
+        entry['age'] = None
+        if entry['updated'] is not None:
+            entry['age'] = round(time.time() - entry['updated'], 3)
+
+        if max_age is not None and (
+            entry['age'] is None or entry['age'] > max_age
+        ):
+            return None
+
+        return entry
+
+    def device(
+        self,
+        device_id: str,
+    ) -> dict:
+        '''
+        Get the results of every poll of a device
+
+        Args:
+            device_id (str): The device ID
+
+        Returns:
+            dict: Metrics, to their results (as from get())
+        '''
+
+        self._read()
+        with self._lock:
+            metrics = [
+                metric for key, metric in self._state
+                if key == str(device_id)
+            ]
+
+        return {
+            metric: self.get(device_id, metric)
+            for metric in sorted(metrics)
+        }
+
+    def discard(
+        self,
+        device_id: str,
+        metric: str,
+    ) -> None:
+        '''
+        Remove the result of a poll (eg, when a device is deleted)
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+        '''
+
+        with self._lock:
+            if self._state.pop((str(device_id), metric), None) is not None:
+                self._version += 1
+
+    def share(
+        self,
+        key: str,
+        callback: t.Callable[[], t.Any],
+    ) -> None:
+        '''
+        Save extra data with the results
+            Other workers read it with extra()
+            It is saved whenever the results are, so it should only
+            change after a poll
+
+        Args:
+            key (str): The name of the data (eg, 'jobs')
+            callback (Callable): Gets the data, when it is saved
+        '''
+
+        with self._lock:
+            self._sharers[key] = callback
+
+    def extra(
+        self
+    ) -> dict:
+        '''
+        Get the extra data saved with the results
+
+        Returns:
+            dict: The extra data (empty if there isn't any)
+        '''
+
+        self._read()
+        return self._extra
+
+    def save(
+        self
+    ) -> None:
+        '''
+        Save the results, if they've changed
+            The file is replaced in one step, so readers never see part
+        '''
+
+        with self._lock:
+            if self._version == self._saved:
+                return
+
+            version = self._version
+            results = [
+                [device_id, metric, dict(entry)]
+                for (device_id, metric), entry in self._state.items()
+            ]
+            sharers = dict(self._sharers)
+
+        try:
+            self._file.write(
+                {
+                    'version': version,
+                    'results': results,
+                    'extra': {
+                        key: callback() for key, callback in sharers.items()
+                    },
+                }
+            )
+            self._saved = version
+
+        except (OSError, TypeError) as e:
+            print(
+                Fore.RED,
+                'Could not save the polling results',
+                Style.RESET_ALL
+            )
+            print(e)
+
+    def load(
+        self
+    ) -> None:
+        '''
+        Read the saved results, and become the writer
+            Used when this worker takes over polling, so the results
+            (and the version) carry on from the last polling worker
+        '''
+
+        self._read(force=True)
+        with self._lock:
+            self.writer = True
+            self._saved = self._version
+
+    def _read(
+        self,
+        force: bool = False,
+    ) -> None:
+        '''
+        Read the saved results, if the file has changed
+            The writer has the results in memory, so doesn't read them
+            The file is checked at most once each SAVE_INTERVAL
+
+        Args:
+            force (bool): Check the file now
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            if self.writer or (
+                not force and now - self._checked < SAVE_INTERVAL
+            ):
+                return
+            self._checked = now
+
+            if not self._file.read():
+                return
+
+            saved = self._file.data
+            self._state = {
+                (device_id, metric): entry
+                for device_id, metric, entry in saved.get('results', [])
+            }
+            self._version = saved.get('version', 0)
+            self._extra = saved.get('extra', {})
+            followers = list(self._followers)
+
+        # Outside the lock, as followers read the results
+        for callback in followers:
+            try:
+                callback()
+            except Exception as e:
+                print(
+                    Fore.RED,
+                    'Could not apply the polling results',
+                    Style.RESET_ALL
+                )
+                print(e)
+
+    def refresh(
+        self
+    ) -> None:
+        '''
+        Read the saved results now, if the file has changed
+            Followers are called if there are new results
+        '''
+
+        self._read(force=True)
+
+    def follow(
+        self,
+        callback: t.Callable[[], None],
+    ) -> None:
+        '''
+        Call a function whenever new results are read from the file
+            This is only in the workers that don't poll, so they can
+            apply the results (eg, to their Device objects)
+            It is called in the thread that read the file
+
+        Args:
+            callback (Callable): Called with no arguments
+        '''
+
+        with self._lock:
+            self._followers.append(callback)
+
+    def watch(
+        self,
+        metric: str,
+        callback: t.Callable[[str, str], None],
+    ) -> None:
+        '''
+        Call a function whenever a metric is polled
+            It is called after each success or failure is stored, in
+            the polling thread, so it should be quick
+            This is only in the polling worker
+
+        Args:
+            metric (str): The metric (eg, 'vpn')
+            callback (Callable): Called with the device ID and metric
+        '''
+
+        with self._lock:
+            self._watchers.setdefault(metric, []).append(callback)
+
+    def _notify(
+        self,
+        device_id: str,
+        metric: str,
+    ) -> None:
+        '''
+        Call the functions watching a metric
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+        '''
+
+        with self._lock:
+            callbacks = list(self._watchers.get(metric, ()))
+
+        for callback in callbacks:
+            try:
+                callback(str(device_id), metric)
+            except Exception as e:
+                print(
+                    Fore.RED,
+                    f"Could not update '{metric}' for '{device_id}'",
+                    Style.RESET_ALL
+                )
+                print(e)
+
+
+class PollScheduler:
+    '''
+    Runs polling jobs on a schedule
+
+    Jobs wait in a heap, ordered by when they are due
+        Due jobs move to a second heap, ordered by priority
+        Jobs are started from the second heap, up to the global cap
+
+    Only the leader (the polling worker) has jobs
+        The jobs are saved with the results, for the other workers
+        Other workers send changes to the leader through a file
+
+    Methods:
+        __init__: Create a scheduler with no jobs
+        register: Add a metric to poll
+        set_interval: Override a metric's interval for a device
+        interval: Get the current interval of a job
+        latest: Get the latest result of a poll, if it isn't stale
+        sync: Add and remove jobs to match the device list
+        poll_now: Run a device's jobs as soon as possible
+        status: Get the state of every job
+        start: Run the scheduler in the background
+        _schedule: Queue a job to run after a delay
+        _run: Poll a device in a worker thread
+        _run_async: Poll a device on the event loop
+        _finish: Store a poll's result, and schedule the next poll
+        _jobs_list: List the jobs, to save with the results
+        _shared_jobs: Get the jobs saved by the leader
+        _request: Ask the leader to make a change
+        _drain: Make the changes other workers have asked for
+        _elect: Wait to become the leader, then start polling
+        _loop: Start jobs when they are due
+    '''
+
+    def __init__(
+        self,
+        store: StateStore,
+        max_concurrent: int = MAX_CONCURRENT,
+        lock_path: str = LOCK_FILE,
+        request_path: str = REQUEST_FILE,
+    ) -> None:
+        '''
+        Create a scheduler with no jobs
+
+        Args:
+            store (StateStore): Where results are stored
+            max_concurrent (int): The most polls that run at once
+            lock_path (str): The file that chooses the leader
+            request_path (str): The file other workers send changes in
+        '''
+
+        self.store = store
+        self.max_concurrent = max_concurrent
+        self.lock_path = lock_path
+        self.request_path = request_path
+
+        # Whether this worker polls
+        self.leader = False
+
+        # Reloads the device list, when another worker asks
+        self._reload = None
+
+        # Metrics, to how they are polled
+        self._metrics = {}
+
+        # Per-device intervals, by (device ID, metric)
+        self._overrides = {}
+
+        # Jobs by (device ID, metric), and the queues they wait in
+        #   Queue entries hold a token. If the job is rescheduled or
+        #   removed, the token no longer matches and the entry is skipped
+        self._jobs = {}
+        self._waiting = []
+        self._ready = []
+        self._sequence = itertools.count()
+
+        self._condition = threading.Condition()
+        self._running = 0
+        self._thread = None
+
+        # Runs the polls that are coroutines (on the leader)
+        self._event_loop = None
+
+        # The leader's jobs, as read by other workers, and their version
+        self._shared = {}
+        self._shared_version = None
+        store.share('jobs', self._jobs_list)
+
+    def register(
+        self,
+        metric: str,
+        poller: t.Callable[[Device], t.Any],
+        interval: float,
+        priority: int = 1,
+        applies: t.Callable[[Device], bool] = None,
+    ) -> None:
+        '''
+        Add a metric to poll
+
+        Args:
+            metric (str): The name of the metric
+            poller (Callable): Polls a device, and returns the result
+                Raises an exception if the poll fails
+                Coroutine functions run on the scheduler's event loop
+            interval (float): Seconds between polls
+            priority (int): Lower numbers run first
+            applies (Callable): Whether a device has this metric
+                If None, all devices do
+        '''
+
+        self._metrics[metric] = {
+            'poller': poller,
+            'interval': interval,
+            'priority': priority,
+            'applies': applies,
+        }
+
+    def set_interval(
+        self,
+        device_id: str,
+        metric: str,
+        interval: float = None,
+    ) -> None:
+        '''
+        Override a metric's interval for a device
+            Takes effect after the next poll
+            Other workers pass this to the leader
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+            interval (float): Seconds between polls
+                None to use the metric's interval again
+        '''
+
+        if not self.leader:
+            self._request(
+                'set_interval',
+                device_id=str(device_id),
+                metric=metric,
+                interval=interval,
+            )
+            return
+
+        key = (str(device_id), metric)
+        if interval is None:
+            self._overrides.pop(key, None)
+        else:
+            self._overrides[key] = interval
+
+    def interval(
+        self,
+        device_id: str,
+        metric: str,
+    ) -> float:
+        '''
+        Get the current interval of a job
+            This includes any override, and backoff
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+
+        Returns:
+            float: Seconds between polls
+        '''
+
+        key = (str(device_id), metric)
+
+        # Other workers use the leader's jobs
+        if not self.leader:
+            job = self._shared_jobs().get(key)
+            if job is not None:
+                return job['interval']
+            return self._metrics[metric]['interval']
+
+        interval = self._overrides.get(
+            key,
+            self._metrics[metric]['interval'],
+        )
+        job = self._jobs.get(key)
+        if job is not None:
+            interval *= job['backoff']
+
+        return interval
+
+    def latest(
+        self,
+        device_id: str,
+        metric: str,
+    ) -> t.Any:
+        '''
+        Get the latest result of a poll, if it isn't stale
+
+        Args:
+            device_id (str): The device ID
+            metric (str): The metric
+
+        Returns:
+            Any: The result, or None if there isn't a recent one
+        '''
+
+        if metric not in self._metrics:
+            return None
+
+        entry = self.store.get(
+            device_id,
+            metric,
+            max_age=self.interval(device_id, metric) * STALE_AFTER,
+        )
+
+        return entry['value'] if entry is not None else None
+
+    def _schedule(
+        self,
+        job: dict,
+        delay: float,
+    ) -> None:
+        '''
+        Queue a job to run after a delay
+            The caller must hold the condition
+
+        Args:
+            job (dict): The job
+            delay (float): Seconds until the job is due
+        '''
+
+        job['token'] += 1
+        job['due'] = time.monotonic() + max(delay, 0)
+        heapq.heappush(
+            self._waiting,
+            (job['due'], next(self._sequence), job['key'], job['token']),
+        )
+
+    def sync(
+        self,
+        devices: t.Iterable[Device],
+    ) -> None:
+        '''
+        Add and remove jobs to match the device list
+            New jobs start at a random point in their interval
+            Other workers ask the leader to reload its device list
+
+        Args:
+            devices (Iterable): The current Device objects
+        '''
+
+        if not self.leader:
+            self._request('sync')
+            return
+
+        wanted = {}
+        for device in list(devices):
+            for metric, spec in self._metrics.items():
+                if spec['applies'] is None or spec['applies'](device):
+                    wanted[(str(device.id), metric)] = device
+
+        with self._condition:
+            for key in list(self._jobs):
+                if key not in wanted:
+                    del self._jobs[key]
+                    self.store.discard(*key)
+
+            for key, device in wanted.items():
+                job = self._jobs.get(key)
+
+                # Device objects are replaced when the list is refreshed
+                if job is not None:
+                    job['device'] = device
+                    continue
+
+                job = {
+                    'key': key,
+                    'device': device,
+                    'priority': self._metrics[key[1]]['priority'],
+                    'backoff': 1,
+                    'token': 0,
+                    'due': None,
+                    'running': False,
+                    'again': False,
+                    'last': None,
+                }
+                self._jobs[key] = job
+                self._schedule(
+                    job,
+                    random.uniform(0, self.interval(*key)),
+                )
+
+            self._condition.notify()
+
+    def poll_now(
+        self,
+        device_id: str,
+        metric: str = None,
+    ) -> int:
+        '''
+        Run a device's jobs as soon as possible
+            They go ahead of other jobs that are waiting
+            Other workers pass this to the leader
+
+        Args:
+            device_id (str): The device ID
+            metric (str): Only run this metric (None for all)
+
+        Returns:
+            int: The number of jobs queued
+        '''
+
+        if not self.leader:
+            self._request(
+                'poll_now',
+                device_id=str(device_id),
+                metric=metric,
+            )
+            return len(
+                [
+                    key for key in self._shared_jobs()
+                    if key[0] == str(device_id) and
+                    metric in (None, key[1])
+                ]
+            )
+
+        queued = 0
+        with self._condition:
+            for key, job in self._jobs.items():
+                if key[0] != str(device_id) or metric not in (None, key[1]):
+                    continue
+
+                queued += 1
+                if job['running']:
+                    job['again'] = True
+                    continue
+
+                job['priority'] = URGENT
+                self._schedule(job, 0)
+
+            self._condition.notify()
+
+        return queued
+
+    def status(
+        self
+    ) -> list:
+        '''
+        Get the state of every job
+
+        Returns:
+            list: Each job
+                device (str): The device ID
+                metric (str): The metric
+                interval (float): Seconds between polls, with backoff
+                backoff (int): What the interval is multiplied by
+                due (float): Seconds until the next poll
+                running (bool): Whether it is being polled now
+                last (dict): The last poll (see StateStore.get)
+        '''
+
+        jobs = self._jobs_list() if self.leader else [
+            dict(job) for job in self._shared_jobs().values()
+        ]
+
+        now = time.time()
+        for job in jobs:
+            job['due'] = round(max(job.pop('due_at') - now, 0), 1)
+            job['last'] = self.store.get(job['device'], job['metric'])
+
+        return sorted(jobs, key=lambda job: (job['device'], job['metric']))
+
+    def _run(
+        self,
+        job: dict,
+    ) -> None:
+        '''
+        Poll a device in a worker thread
+
+        Args:
+            job (dict): The job
+        '''
+
+        # Polls share the vendor and device limits with other fan-outs
+        #   Only the poll is timed, not the wait for a slot
+        device_id, metric = job['key']
+        device = job['device']
+        value = None
+        elapsed = 0.0
+        try:
+            with concurrency.slot(device.vendor, device_id):
+                start = time.perf_counter()
+                try:
+                    value = self._metrics[metric]['poller'](device)
+                    error = None
+                finally:
+                    elapsed = time.perf_counter() - start
+        except Exception as e:
+            error = str(e) or type(e).__name__
+
+        self._finish(job, value, error, elapsed)
+
+    async def _run_async(
+        self,
+        job: dict,
+    ) -> None:
+        '''
+        Poll a device on the event loop
+
+        Args:
+            job (dict): The job
+        '''
+
+        # The same limits as _run(), waited for without blocking the loop
+        device_id, metric = job['key']
+        device = job['device']
+        value = None
+        elapsed = 0.0
+        try:
+            async with concurrency.async_slot(device.vendor, device_id):
+                start = time.perf_counter()
+                try:
+                    value = await self._metrics[metric]['poller'](device)
+                    error = None
+                finally:
+                    elapsed = time.perf_counter() - start
+        except Exception as e:
+            error = str(e) or type(e).__name__
+
+        # Watchers are called when the result is stored, so this is done
+        #   in a thread, to keep the event loop free
+        await asyncio.to_thread(self._finish, job, value, error, elapsed)
+
+    def _finish(
+        self,
+        job: dict,
+        value: t.Any,
+        error: str | None,
+        elapsed: float,
+    ) -> None:
+        '''
+        Store a poll's result, and schedule the next poll
+
+        Args:
+            job (dict): The job
+            value (Any): The result (None if the poll failed)
+            error (str): Why the poll failed (None if it worked)
+            elapsed (float): Seconds the poll took
+        '''
+
+        device_id, metric = job['key']
+        if error is None:
+            self.store.set(device_id, metric, value, elapsed)
+        else:
+            self.store.fail(device_id, metric, error, elapsed)
+            print(
+                Fore.YELLOW,
+                f"Polling '{metric}' on '{job['device']}' failed",
+                Style.RESET_ALL
+            )
+            print(error)
+
+        with self._condition:
+            self._running -= 1
+            job['running'] = False
+            job['last'] = time.monotonic()
+
+            # Back off slow or failing devices, reset when they recover
+            slow = elapsed > min(SLOW_POLL, self.interval(*job['key']) / 2)
+            if error is not None or slow:
+                job['backoff'] = min(job['backoff'] * 2, MAX_BACKOFF)
+            else:
+                job['backoff'] = 1
+
+            # Reschedule, unless the device was removed while polling
+            if self._jobs.get(job['key']) is job:
+                if job['again']:
+                    job['again'] = False
+                    job['priority'] = URGENT
+                    self._schedule(job, 0)
+                else:
+                    job['priority'] = self._metrics[metric]['priority']
+                    interval = self.interval(*job['key'])
+                    self._schedule(
+                        job,
+                        interval * random.uniform(1 - JITTER, 1 + JITTER),
+                    )
+
+            self._condition.notify()
+
+    def _jobs_list(
+        self
+    ) -> list:
+        '''
+        List the jobs, to save with the results
+            Due times are epoch seconds, so other workers can use them
+
+        Returns:
+            list: Each job (see status(), with 'due_at' for 'due')
+        '''
+
+        offset = time.time() - time.monotonic()
+        with self._condition:
+            return [
+                {
+                    'device': job['key'][0],
+                    'metric': job['key'][1],
+                    'interval': self.interval(*job['key']),
+                    'backoff': job['backoff'],
+                    'due_at': job['due'] + offset,
+                    'running': job['running'],
+                }
+                for job in self._jobs.values()
+            ]
+
+    def _shared_jobs(
+        self
+    ) -> dict:
+        '''
+        Get the jobs saved by the leader
+            They're indexed again when the saved results change
+
+        Returns:
+            dict: (device ID, metric), to the job (see _jobs_list())
+        '''
+
+        version = self.store.version
+        if version != self._shared_version:
+            self._shared = {
+                (job['device'], job['metric']): job
+                for job in self.store.extra().get('jobs', [])
+            }
+            self._shared_version = version
+
+        return self._shared
+
+    def _request(
+        self,
+        action: str,
+        **kwargs: t.Any,
+    ) -> None:
+        '''
+        Ask the leader to make a change
+            Requests are added to a file, which the leader reads
+
+        Args:
+            action (str): 'sync', 'poll_now' or 'set_interval'
+            kwargs (Any): The arguments to the method
+        '''
+
+        try:
+            with locked(f"{self.request_path}.lock"):
+                with open(self.request_path, 'ab') as f:
+                    f.write(
+                        encode(dict(kwargs, action=action), newline=True)
+                    )
+
+        except OSError as e:
+            print(
+                Fore.RED,
+                f"Could not send '{action}' to the polling worker",
+                Style.RESET_ALL
+            )
+            print(e)
+
+    def _drain(
+        self,
+        devices: t.Callable[[], t.Iterable[Device]],
+    ) -> None:
+        '''
+        Make the changes other workers have asked for
+            Runs in the scheduler thread, on the leader
+
+        Args:
+            devices (Callable): Returns the current Device objects
+        '''
+
+        try:
+            if os.path.getsize(self.request_path) == 0:
+                return
+
+            with locked(f"{self.request_path}.lock"):
+                with open(self.request_path, 'r+b') as f:
+                    lines = f.read().splitlines()
+                    f.seek(0)
+                    f.truncate()
+
+        except OSError:
+            return
+
+        requests = []
+        for line in lines:
+            try:
+                requests.append(json.loads(line))
+            except ValueError:
+                continue
+
+        # Several refreshes only need one reload
+        if any(request['action'] == 'sync' for request in requests):
+            try:
+                if self._reload is not None:
+                    self._reload()
+                self.sync(devices())
+            except Exception as e:
+                print(
+                    Fore.RED,
+                    'Could not reload the device list',
+                    Style.RESET_ALL
+                )
+                print(e)
+
+        for request in requests:
+            action = request.pop('action')
+            if action == 'poll_now':
+                self.poll_now(**request)
+            elif action == 'set_interval':
+                self.set_interval(**request)
+
+    def _elect(
+        self,
+        devices: t.Callable[[], t.Iterable[Device]],
+        executor: concurrent.futures.Executor,
+    ) -> None:
+        '''
+        Wait to become the leader, then start polling
+            Runs in the scheduler thread, and never returns
+            While waiting, the leader's results are read each second
+
+        Args:
+            devices (Callable): Returns the current Device objects
+            executor (Executor): Runs the polls
+        '''
+
+        next_try = 0
+        while True:
+            if time.monotonic() >= next_try:
+                try:
+                    if leader_lock(self.lock_path):
+                        break
+                except OSError as e:
+                    print(
+                        Fore.RED,
+                        'Could not check for the polling worker',
+                        Style.RESET_ALL
+                    )
+                    print(e)
+                next_try = time.monotonic() + LEADER_RETRY
+
+            # Keep this worker's devices up to date with the leader's
+            #   results, even when no request reads them
+            self.store.refresh()
+            time.sleep(SAVE_INTERVAL)
+
+        # Carry on from the last leader's results
+        self.store.load()
+        self.leader = True
+
+        # Polls that are coroutines share one event loop
+        self._event_loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._event_loop.run_forever,
+            name='poll-events',
+            daemon=True,
+        ).start()
+
+        self._loop(devices, executor)
+
+    def _loop(
+        self,
+        devices: t.Callable[[], t.Iterable[Device]],
+        executor: concurrent.futures.Executor,
+    ) -> None:
+        '''
+        Start jobs when they are due
+            Runs in the scheduler thread, and never returns
+
+        Args:
+            devices (Callable): Returns the current Device objects
+            executor (Executor): Runs the polls
+        '''
+
+        next_sync = 0
+        next_save = 0
+        while True:
+            now = time.monotonic()
+
+            # Make any changes the other workers asked for
+            self._drain(devices)
+
+            # Pick up devices that were added or removed
+            if now >= next_sync:
+                try:
+                    self.sync(devices())
+                except Exception as e:
+                    print(
+                        Fore.RED,
+                        'Could not update the polling jobs',
+                        Style.RESET_ALL
+                    )
+                    print(e)
+                next_sync = now + SYNC_INTERVAL
+
+            with self._condition:
+                # Move due jobs to the ready queue, by priority
+                while self._waiting and self._waiting[0][0] <= now:
+                    due, sequence, key, token = heapq.heappop(self._waiting)
+                    job = self._jobs.get(key)
+                    if job is None or job['token'] != token:
+                        continue
+                    heapq.heappush(
+                        self._ready,
+                        (job['priority'], due, sequence, key, token),
+                    )
+
+                # Start as many as the cap allows
+                while self._ready and self._running < self.max_concurrent:
+                    *_, key, token = heapq.heappop(self._ready)
+                    job = self._jobs.get(key)
+                    if job is None or job['token'] != token:
+                        continue
+                    job['running'] = True
+                    self._running += 1
+                    poller = self._metrics[key[1]]['poller']
+                    if asyncio.iscoroutinefunction(poller):
+                        asyncio.run_coroutine_threadsafe(
+                            self._run_async(job),
+                            self._event_loop,
+                        )
+                    else:
+                        executor.submit(self._run, job)
+
+            # Share the results with the other workers
+            if now >= next_save:
+                self.store.save()
+                next_save = now + SAVE_INTERVAL
+
+            with self._condition:
+                # Wait for the next job, a finished poll, the next save,
+                #   or the next sync
+                wake = min(next_sync, next_save)
+                if self._waiting:
+                    wake = min(wake, self._waiting[0][0])
+                self._condition.wait(max(wake - time.monotonic(), 0.01))
+
+    def start(
+        self,
+        devices: t.Callable[[], t.Iterable[Device]],
+        reload: t.Callable[[], None] = None,
+    ) -> None:
+        '''
+        Run the scheduler in the background
+            Each worker waits to become the leader, so if the leader
+            exits, another takes over
+            Call this after forking, as threads don't survive a fork
+
+        Args:
+            devices (Callable): Returns the current Device objects
+            reload (Callable): Reloads the device list, when another
+                worker asks
+        '''
+
+        if self._thread is not None:
+            return
+
+        self._reload = reload
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrent,
+            thread_name_prefix='poller',
+        )
+        self._thread = threading.Thread(
+            target=self._elect,
+            args=(devices, executor),
+            name='poll-scheduler',
+            daemon=True,
+        )
+        self._thread.start()
+
+
+def device_api(
+    device: Device,
+    asynchronous: bool = False,
+) -> (
+    PaDeviceApi | JunosDeviceApi | PaAsyncDeviceApi | JunosAsyncDeviceApi
+):
+    '''
+    Create the API object for a device
+        Uses the password decrypted when the device was loaded
+
+    Args:
+        device (Device): The device
+        asynchronous (bool): Create the async API object instead
+
+    Raises:
+        ValueError: If the password isn't available, or the vendor is
+            unknown
+
+    Returns:
+        PaDeviceApi | JunosDeviceApi: The API object
+        PaAsyncDeviceApi | JunosAsyncDeviceApi: The async API object
+    '''
+
+    if device.decrypted_pw is None:
+        raise ValueError('The password has not been decrypted')
+
+    if device.vendor == 'paloalto':
+        api_pass = base64.b64encode(
+            f'{device.username}:{device.decrypted_pw}'.encode()
+        ).decode()
+        api_class = PaAsyncDeviceApi if asynchronous else PaDeviceApi
+        return api_class(
+            hostname=device.hostname,
+            xml_key=api_pass,
+        )
+
+    if device.vendor == 'juniper':
+        api_class = (
+            JunosAsyncDeviceApi if asynchronous else JunosDeviceApi
+        )
+        return api_class(
+            hostname=device.hostname,
+            username=device.username,
+            password=device.decrypted_pw,
+        )
+
+    raise ValueError(f"Unknown vendor '{device.vendor}'")
+
+
+async def _call_async(
+    device: Device,
+    method: str,
+) -> t.Any:
+    '''
+    Call a method of a device's async API
+        Palo Alto calls share the event loop's HTTP connection pool
+        Junos calls run in the Junos client's thread pool
+
+    Args:
+        device (Device): The device
+        method (str): The method name (eg, 'get_vpn_status')
+
+    Raises:
+        RuntimeError: If the API returned an error code
+
+    Returns:
+        Any: The result
+    '''
+
+    async with device_api(device, asynchronous=True) as api:
+        result = await getattr(api, method)()
+
+    # Integers are returned if the API call fails
+    if type(result) is int:
+        raise RuntimeError(f"{method} failed (error {result})")
+
+    return result
+
+
+def _ha_state(
+    device: Device,
+) -> dict:
+    '''
+    Summarise the HA state of a device
+
+    Args:
+        device (Device): The device
+
+    Returns:
+        dict: The HA details
+    '''
+
+    return {
+        'enabled': device.ha_enabled,
+        'local_state': device.ha_local_state,
+        'peer_state': device.ha_peer_state,
+        'peer_serial': device.ha_peer_serial,
+        'sync': device.ha_sync,
+    }
+
+
+def _set_ha_state(
+    device: Device,
+    state: dict,
+) -> bool:
+    '''
+    Set the HA state of a device, from a poll's summary
+
+    Args:
+        device (Device): The device
+        state (dict): The HA details, as from _ha_state()
+
+    Returns:
+        bool: True if the HA state changed
+    '''
+
+    if _ha_state(device) == state:
+        return False
+
+    device.ha_enabled = state['enabled']
+    device.ha_local_state = state['local_state']
+    device.ha_peer_state = state['peer_state']
+    device.ha_peer_serial = state['peer_serial']
+    device.ha_sync = state['sync']
+    return True
+
+
+def _apply_results() -> None:
+    '''
+    Apply the polling worker's results to this worker's devices
+        Only the polling worker updates its Device objects as it polls
+        The others apply the facts, and the newest HA state (from
+        either poll), then find HA pairs again if anything changed
+    '''
+
+    if device_manager is None:
+        return
+
+    changed = False
+    for device in list(device_manager.device_list):
+        facts = device_state.get(device.id, 'facts')
+        ha = device_state.get(device.id, 'ha')
+
+        # Facts, and the HA state polled with them
+        states = []
+        if facts is not None and facts['value'] is not None:
+            for field in ('model', 'serial', 'version'):
+                value = facts['value'][field]
+                if getattr(device, field) != value:
+                    setattr(device, field, value)
+                    changed = True
+            states.append((facts['updated'], facts['value']['ha']))
+
+        # The HA poll is usually newer
+        if ha is not None and ha['value'] is not None:
+            states.append((ha['updated'], ha['value']))
+
+        if states:
+            _, state = max(states, key=lambda entry: entry[0])
+            if _set_ha_state(device, state):
+                changed = True
+
+    if changed:
+        device_manager.update_state()
+
+
+def poll_facts(
+    device: Device,
+) -> dict:
+    '''
+    Poll the model, serial, version and HA state of a device
+        The device object and database are updated
+
+    Args:
+        device (Device): The device
+
+    Returns:
+        dict: The facts, and the HA state
+    '''
+
+    device.get_details()
+    device_manager.update_state()
+
+    return {
+        'model': device.model,
+        'serial': device.serial,
+        'version': device.version,
+        'ha': _ha_state(device),
+    }
+
+
+async def poll_ha(
+    device: Device,
+) -> dict:
+    '''
+    Poll the HA state of a device
+        The device object is updated, and HA pairs are found again if
+        the state changed (eg, after a failover)
+
+    Args:
+        device (Device): The device
+
+    Returns:
+        dict: The HA state
+    '''
+
+    if device.set_ha(await _call_async(device, 'get_ha')):
+        device_manager.update_state()
+
+    return _ha_state(device)
+
+
+async def poll_vpn(
+    device: Device,
+) -> list:
+    '''
+    Poll the VPN tunnel status of a device
+
+    Args:
+        device (Device): The device
+
+    Returns:
+        list: The tunnels, as returned by get_vpn_status()
+    '''
+
+    return await _call_async(device, 'get_vpn_status')
+
+
+async def poll_gp(
+    device: Device,
+) -> list:
+    '''
+    Poll the GlobalProtect sessions of a device
+
+    Args:
+        device (Device): The device
+
+    Returns:
+        list: The sessions, as returned by get_gp_sessions()
+    '''
+
+    return await _call_async(device, 'get_gp_sessions')
+
+
+def _is_paloalto(
+    device: Device,
+) -> bool:
+    '''
+    Check if a device is a Palo Alto firewall
+        HA and GlobalProtect are only polled on these
+
+    Args:
+        device (Device): The device
+
+    Returns:
+        bool: True if it is
+    '''
+
+    return device.vendor == 'paloalto'
+
+
+# The shared state store and scheduler
+device_state = StateStore()
+poll_scheduler = PollScheduler(device_state)
+device_state.follow(_apply_results)
+poll_scheduler.register(
+    'facts', poll_facts, INTERVALS['facts'], PRIORITY['facts'],
+)
+poll_scheduler.register(
+    'ha', poll_ha, INTERVALS['ha'], PRIORITY['ha'], _is_paloalto,
+)
+poll_scheduler.register(
+    'vpn', poll_vpn, INTERVALS['vpn'], PRIORITY['vpn'],
+)
+poll_scheduler.register(
+    'gp', poll_gp, INTERVALS['gp'], PRIORITY['gp'], _is_paloalto,
+)
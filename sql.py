@@ -6,9 +6,41 @@ import pymssql
 import traceback as tb
 from colorama import Fore, Style
 import base64
+import functools
+import typing as t
 
 from settings import AppSettings
 from encryption import CryptoSecret
+from metrics import sql_seconds
+
+
+def _timed(
+    method: t.Callable,
+) -> t.Callable:
+    '''
+    Time an SQL operation, by name and table (see metrics.py)
+        Returning False counts as a failure, as the methods do this
+        when the operation fails
+
+    Args:
+        method (Callable): A SqlServer method
+
+    Returns:
+        Callable: The method, timed
+    '''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with sql_seconds.time(
+            operation=method.__name__,
+            table=self.table,
+        ) as call:
+            result = method(self, *args, **kwargs)
+            call.ok = result is not False
+
+        return result
+
+    return wrapper
 
 
 class SqlServer:
@@ -29,14 +61,24 @@ class SqlServer:
             Gracefully disconnect from the server
         create_table()
             Create a table
+        table_exists()
+            Check if the table exists
         add()
             Add a record
+        add_many()
+            Add several records in a single transaction
         read()
             Read a record
+        read_range()
+            Read records with a field in a range
         update()
             Update a record
+        update_many()
+            Update several records in a single transaction
         delete()
             Delete a record
+        delete_before()
+            Delete records with a field below a value
     '''
 
     def __init__(
@@ -152,6 +194,7 @@ class SqlServer:
         else:
             return False
 
+    @_timed
     def connect(
         self
     ) -> bool:
@@ -247,6 +290,7 @@ class SqlServer:
         if self.conn:
             self.conn.close()
 
+    @_timed
     def create_table(
         self,
         fields: dict[str, str]
@@ -303,6 +347,31 @@ class SqlServer:
 
         return True
 
+    def table_exists(
+        self
+    ) -> bool:
+        '''
+        Check if the table exists in the database
+
+        Returns:
+            True : boolean
+                If the table exists
+            False : boolean
+                If it doesn't, or the check failed
+        '''
+
+        sql_string = "SELECT 1 FROM INFORMATION_SCHEMA.TABLES\n"
+        sql_string += "WHERE TABLE_NAME = %s;"
+
+        try:
+            self.cursor.execute(sql_string, (self.table,))
+            return self.cursor.fetchone() is not None
+
+        except Exception as err:
+            print(f"SQL read error: {err}")
+            return False
+
+    @_timed
     def add(
         self,
         fields: dict[str, str],
@@ -371,6 +440,69 @@ class SqlServer:
         # If all was good, return True
         return True
 
+    @_timed
+    def add_many(
+        self,
+        rows: list[dict[str, str]],
+    ) -> bool:
+        '''
+        Add several entries to the database as a single transaction
+            Rows are sent in batches, with many rows in each INSERT
+            Values are sent as parameters, so they don't need quoting
+
+        Args:
+            rows : list
+                Dictionaries of named fields and values to write
+                Every row must have the same fields
+
+        Returns:
+            True : boolean
+                If all rows were committed
+            False : boolean
+                If any write failed (the transaction is rolled back)
+        '''
+
+        if not rows:
+            return True
+
+        # SQL Server allows 1000 rows and 2100 parameters per statement
+        columns = list(rows[0])
+        batch = max(1, min(1000, 2000 // len(columns)))
+        placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+
+        # Run each INSERT command, without committing
+        try:
+            for start in range(0, len(rows), batch):
+                chunk = rows[start:start + batch]
+                sql_string = (
+                    f"INSERT INTO [{self.db}].[dbo].[{self.table}] "
+                    f"({', '.join(columns)})\n"
+                )
+                sql_string += 'VALUES '
+                sql_string += ', '.join([placeholders] * len(chunk)) + ';'
+
+                self.cursor.execute(
+                    sql_string,
+                    tuple(row[column] for row in chunk for column in columns)
+                )
+
+        # If there was a problem, undo all changes
+        except Exception as err:
+            print(f"SQL execution error: {err}")
+            self.conn.rollback()
+            return False
+
+        # Commit the transaction
+        try:
+            self.conn.commit()
+        except Exception as err:
+            print(f"SQL commit error: {err}")
+            self.conn.rollback()
+            return False
+
+        return True
+
+    @_timed
     def read(
         self,
         field: str,
@@ -429,6 +561,68 @@ class SqlServer:
         # If it all worked, return the entry
         return entry
 
+    @_timed
+    def read_range(
+        self,
+        field: str,
+        start: str,
+        end: str,
+        columns: list[str],
+        filters: dict[str, str] = None,
+        limit: int = None,
+        newest: bool = False,
+    ) -> list | bool:
+        '''
+        Read entries with a field in a range, in order of that field
+            The range includes the start, but not the end
+
+        Args:
+            field : str
+                The field to look in (usually a time)
+            start : str
+                The lowest value to include
+            end : str
+                The value to stop before
+            columns : list
+                The fields to return, in this order
+            filters : dict
+                Other fields that must be equal to these values
+            limit : int
+                The most entries to return
+            newest : bool
+                Return the highest values first (eg, the latest)
+
+        Returns:
+            entry : list
+                A list of entries (tuples of the columns)
+            False : boolean
+                If the read failed
+        '''
+
+        # Build the SQL string, with the values as parameters
+        sql_string = "SELECT "
+        if limit is not None:
+            sql_string += f"TOP ({int(limit)}) "
+        sql_string += f"{', '.join(columns)}\n"
+        sql_string += f"FROM [{self.db}].[dbo].[{self.table}]\n"
+        sql_string += f"WHERE {field} >= %s AND {field} < %s"
+        params = [start, end]
+        for name, value in (filters or {}).items():
+            sql_string += f" AND {name} = %s"
+            params.append(value)
+        sql_string += f"\nORDER BY {field}"
+        sql_string += ' DESC;' if newest else ';'
+
+        # Send the SQL command to the server and execute
+        try:
+            self.cursor.execute(sql_string, tuple(params))
+            return list(self.cursor)
+
+        except Exception as err:
+            print(f"SQL read error: {err}")
+            return False
+
+    @_timed
     def update(
         self,
         field: str,
@@ -493,6 +687,60 @@ class SqlServer:
         # If it all worked
         return True
 
+    @_timed
+    def update_many(
+        self,
+        field: str,
+        entries: dict[str, dict[str, str]],
+    ) -> bool:
+        '''
+        Update several entries in the database as a single transaction
+            Either all entries are updated, or none of them are
+
+        Parameters:
+            field : str
+                The field to look in (usually an ID)
+            entries : dict
+                Maps the value to look for (usually a UUID)
+                    to a dictionary of values to update
+
+        Returns:
+            True : boolean
+                If all updates were committed
+            False : boolean
+                If any update failed (the transaction is rolled back)
+        '''
+
+        # Run each UPDATE command, without committing
+        try:
+            for value, body in entries.items():
+                sql_string = f"UPDATE [{self.db}].[dbo].[{self.table}]\n"
+                sql_string += "SET "
+                for entry in body:
+                    sql_string += f"{entry} = \'{body[entry]}\', "
+                sql_string = sql_string.strip(", ")
+                sql_string += '\n'
+                sql_string += f"WHERE {field} = \'{value}\';"
+
+                self.cursor.execute(sql_string)
+
+        # If there was a problem, undo all changes
+        except Exception as err:
+            print(f"SQL update error: {err}")
+            self.conn.rollback()
+            return False
+
+        # Commit the transaction
+        try:
+            self.conn.commit()
+        except Exception as err:
+            print(f"SQL commit error: {err}")
+            self.conn.rollback()
+            return False
+
+        return True
+
+    @_timed
     def delete(
         self,
         field: str,
@@ -540,3 +788,54 @@ class SqlServer:
 
         # If all was good, return True
         return True
+
+    @_timed
+    def delete_before(
+        self,
+        field: str,
+        value: str,
+        filters: dict[str, str] = None,
+    ) -> bool:
+        '''
+        Delete entries with a field below a value (eg, old records)
+
+        Args:
+            field : str
+                The field to compare (usually a time)
+            value : str
+                Entries below this value are deleted
+            filters : dict
+                Other fields that must be equal to these values
+
+        Returns:
+            True : boolean
+                If the delete was successful
+            False : boolean
+                If the delete failed
+        '''
+
+        # Build the SQL string, with the values as parameters
+        sql_string = f'DELETE FROM {self.table}\n'
+        sql_string += f'WHERE {field} < %s'
+        params = [value]
+        for name, filter_value in (filters or {}).items():
+            sql_string += f" AND {name} = %s"
+            params.append(filter_value)
+        sql_string += ';'
+
+        try:
+            self.cursor.execute(sql_string, tuple(params))
+
+        except Exception as err:
+            print(f"SQL execution error: {err}")
+            return False
+
+        # Commit the transaction
+        try:
+            self.conn.commit()
+
+        except Exception as err:
+            print(f"SQL commit error: {err}")
+            return False
+
+        return True
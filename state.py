@@ -0,0 +1,273 @@
+'''
+Share state between worker processes, through files
+
+uWSGI runs several worker processes, which don't share memory
+    Anything that should be the same in every worker (eg, the polling
+    results) is kept in a file, under the state directory
+
+Files are replaced in one step, so readers never see part of one
+    They are written to a temporary name, then renamed
+
+Changes are made while a file is locked, if the OS supports it
+    Without file locks (eg, Windows), changes from different workers
+    may overwrite each other
+
+Some work is only done by one worker (eg, polling)
+    The first worker to lock the leader file does it, and keeps the
+    lock until it exits. Another worker can then take over
+    Without file locks, every worker does it
+
+Classes:
+    SharedJsonFile
+        A JSON file that workers read, and update in turn
+
+Functions:
+    write_atomic
+        Write a file, so readers never see part of it
+    locked
+        Lock a file while it's changed
+    leader_lock
+        Check if this worker is the leader for a file
+
+Misc Variables:
+    STATE_DIR
+        The directory the shared files are kept in
+'''
+
+import contextlib
+import json
+import os
+import threading
+import typing as t
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from jsonprovider import encode
+
+
+# The directory the shared files are kept in (relative to the app)
+STATE_DIR = 'state'
+
+# Leader files this worker has locked, by path
+_leaders = {}
+
+
+def write_atomic(
+    path: str,
+    data: bytes,
+) -> None:
+    '''
+    Write a file, so readers never see part of it
+        The file is written to a temporary name, then renamed
+        The temporary name is unique to the process and thread
+
+    Args:
+        path (str): The file to write
+        data (bytes): The contents
+
+    Raises:
+        OSError: If the file can't be written
+    '''
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temp)
+        raise
+
+
+@contextlib.contextmanager
+def locked(
+    path: str,
+) -> t.Iterator[None]:
+    '''
+    Lock a file while it's changed
+        Waits for other workers (and threads) to unlock it first
+        The file is created if needed, and isn't changed
+
+    Args:
+        path (str): The file to lock
+
+    Raises:
+        OSError: If the file can't be opened
+    '''
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+
+        # Closing the file releases its lock
+        yield
+
+
+def leader_lock(
+    path: str,
+) -> bool:
+    '''
+    Check if this worker is the leader for a file
+        The first worker to lock the file keeps it until it exits
+        Without file locks (eg, Windows), every worker leads
+
+    Args:
+        path (str): The leader file
+
+    Raises:
+        OSError: If the file can't be opened
+
+    Returns:
+        bool: True if this worker is the leader
+    '''
+
+    if fcntl is None or path in _leaders:
+        return True
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    handle = open(path, 'a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+
+    _leaders[path] = handle
+    return True
+
+
+class SharedJsonFile:
+    '''
+    A JSON file that workers read, and update in turn
+        The file is only read again when it changes (by its inode,
+        modified time and size)
+
+    Methods:
+        __init__: Create a reader for a file
+        read: Read the file again, if it has changed
+        write: Replace the file
+        update: Change the file, while it's locked
+    '''
+
+    def __init__(
+        self,
+        path: str,
+        default: t.Callable[[], t.Any] = dict,
+    ) -> None:
+        '''
+        Create a reader for a file
+            Nothing is read until read() is called
+
+        Args:
+            path (str): The file
+            default (Callable): Makes the data, when there's no file
+        '''
+
+        self.path = path
+        self.data = default()
+
+        # The version of the file that was read
+        self._version = None
+
+    def read(
+        self,
+        force: bool = False,
+    ) -> bool:
+        '''
+        Read the file again, if it has changed
+            The data is kept if the file is missing, or part written
+
+        Args:
+            force (bool): Read the file, even if it hasn't changed
+
+        Returns:
+            bool: True if new data was read
+        '''
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version == self._version and not force:
+            return False
+
+        try:
+            with open(self.path, 'rb') as f:
+                self.data = json.loads(f.read())
+
+        # Another worker may be part way through replacing it
+        except (OSError, ValueError):
+            return False
+
+        self._version = version
+        return True
+
+    def write(
+        self,
+        data: t.Any,
+        keep: bool = False,
+    ) -> None:
+        '''
+        Replace the file
+            Only use this if one worker writes the file, or while it's
+            locked (see update())
+            The data is read back by the next read(), so later changes
+            to the object passed in aren't seen by readers
+
+        Args:
+            data (Any): The new data (anything that can be JSON)
+            keep (bool): Keep the data, rather than reading it back
+                Only if it won't be changed after it's written
+
+        Raises:
+            OSError: If the file can't be written
+            TypeError: If the data can't be JSON
+        '''
+
+        write_atomic(self.path, encode(data, default=str))
+
+        if keep:
+            stat = os.stat(self.path)
+            self.data = data
+            self._version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def update(
+        self,
+        change: t.Callable[[t.Any], t.Any],
+    ) -> t.Any:
+        '''
+        Change the file, while it's locked
+            The file is read first, in case another worker changed it
+
+        Args:
+            change (Callable): Gets the current data, and returns the
+                new data
+
+        Raises:
+            OSError: If the file can't be locked or written
+            TypeError: If the data can't be JSON
+
+        Returns:
+            Any: The new data
+        '''
+
+        with locked(f"{self.path}.lock"):
+            self.read()
+            self.write(change(self.data))
+            self.read(force=True)
+
+        return self.data
+
+
+# A child process doesn't lead, even if its parent did
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_leaders.clear)
@@ -5,6 +5,7 @@
     Manage the navigation bar
     Pop up notifications
     Toggle between light and dark modes
+    Watch for live changes from the server
 */
 
 // Adjust the margins of the header and nav bar when the page loads or is resized
@@ -244,3 +245,50 @@ function toggleDarkMode() {
         localStorage.setItem("theme", "light-mode");
     }
 }
+
+
+/**
+ * Watch for live changes from the server (Server-Sent Events)
+ * The browser reconnects by itself if the stream ends
+ * If the server has too many streams open, it refuses with a 503, and the
+ *  browser gives up; the stream is opened again after a delay
+ *
+ * @param {string} types - Comma separated kinds of event (eg, "ha,device")
+ * @param {Object} handlers - A function for each kind of event (and "reset")
+ *  Each gets the event's data (parsed from JSON)
+ */
+function watchEvents(types, handlers) {
+    if (!window.EventSource) {
+        return;
+    }
+
+    // Seconds to wait before trying again, after a refused stream
+    const retryDelay = 30;
+
+    // The last event seen, so a new stream starts where this one ended
+    let lastId = null;
+
+    const open = () => {
+        let url = `/api/events?types=${types}`;
+        if (lastId != null) {
+            url += `&last_id=${lastId}`;
+        }
+        const events = new EventSource(url);
+
+        for (const [type, handler] of Object.entries(handlers)) {
+            events.addEventListener(type, (event) => {
+                lastId = event.lastEventId || lastId;
+                handler(JSON.parse(event.data));
+            });
+        }
+
+        // The stream was refused (not just dropped), so try again later
+        events.onerror = () => {
+            if (events.readyState === EventSource.CLOSED) {
+                setTimeout(open, retryDelay * 1000);
+            }
+        };
+    };
+
+    open();
+}
@@ -28,6 +28,19 @@ window.addEventListener('resize', function () {
 // Clear lines on navigation
 window.addEventListener('beforeunload', clearLines);
 
+// The API route for each comparison, so the server can find the differences
+const DIFF_ROUTES = {
+    tagAccordionA: '/api/objects?object=tags',
+    addressAccordionA: '/api/objects?object=addresses',
+    addressGroupAccordionA: '/api/objects?object=address_groups',
+    applicationGroupAccordionA: '/api/objects?object=app_groups',
+    serviceAccordionA: '/api/objects?object=services',
+    serviceGroupAccordionA: '/api/objects?object=service_groups',
+    natAccordionA: '/api/policies?type=nat',
+    securityAccordionA: '/api/policies?type=security',
+    qosAccordionA: '/api/policies?type=qos',
+};
+
 
 /**
  * Setup the comparison of two lists, as needed by the event listeners
@@ -38,7 +51,7 @@ window.addEventListener('beforeunload', clearLines);
  * @param {*} listB         The second list of objects
  * @param {*} sort          Whether to sort the lists alphabetically (good for objects, bad for policies)
  */
-function setupComparison(listAId, listBId, listA, listB, sort = true) {
+async function setupComparison(listAId, listBId, listA, listB, sort = true) {
     // Get the two parent containers
     let listAContainer = document.getElementById(listAId);
     let listBContainer = document.getElementById(listBId);
@@ -60,13 +73,48 @@ function setupComparison(listAId, listBId, listA, listB, sort = true) {
         listA.sort((a, b) => a.name.localeCompare(b.name));
         listB.sort((a, b) => a.name.localeCompare(b.name));
     }
-    highlightDifferences(listA, listB, listAContainer, listBContainer);
+    const changedNames = await fetchDifferences(listAId, listAContainer, listBContainer);
+    highlightDifferences(listA, listB, listAContainer, listBContainer, changedNames);
 
     // Show a notification that the comparison is complete
     showNotification('Comparison complete', 'Success');
 }
 
 
+/**
+ * Ask the server which objects are different between the two devices
+ * Only the differences are downloaded, not the full lists
+ * 
+ * @param {*} listAId           The ID of the first list container
+ * @param {*} listAContainer    The parent container for the first list
+ * @param {*} listBContainer    The parent container for the second list
+ * @returns                     A set of lowercase names that are different, or null if the server can't compare them
+ */
+async function fetchDifferences(listAId, listAContainer, listBContainer) {
+    const route = DIFF_ROUTES[listAId];
+    if (!route) {
+        return null;
+    }
+
+    try {
+        const deviceA = encodeURIComponent(listAContainer.dataset.deviceId);
+        const deviceB = encodeURIComponent(listBContainer.dataset.deviceId);
+        const response = await fetch(`${route}&action=diff&id=${deviceA}&compare=${deviceB}`);
+        if (!response.ok) {
+            return null;
+        }
+
+        const data = await response.json();
+        return new Set(data.changed.map(item => item.name.toLowerCase()));
+
+    } catch (error) {
+        // Fall back to comparing in the browser
+        console.error('Error:', error);
+        return null;
+    }
+}
+
+
 /**
  * Add items to the tables
  * These are shown in the lists of objects like tags, addresses, etc.
@@ -200,29 +248,37 @@ function compareAndAppend(listA, listB, listAContainer, listBContainer) {
             };
         })(index, list[index]));
     }
+    // The names in each list, so lookups don't need to scan the list
+    const namesA = new Set(listA.map(item => item.name.toLowerCase()));
+    const namesB = new Set(listB.map(item => item.name.toLowerCase()));
+
     // Loop as long as there are items in either list
     while (listA.length > index || listB.length > index) {
         // Handle getting to the end of listA while listB still has items
         if (listA[index] === undefined) {
             listA.push(listB[index]);
+            namesA.add(listB[index].name.toLowerCase());
             createAndAppendElements(listA, listAContainer, index);
         }
 
         // Handle getting to the end of listB while listA still has items
         if (listB[index] === undefined) {
             listB.push(listA[index]);
+            namesB.add(listA[index].name.toLowerCase());
             createAndAppendElements(listB, listBContainer, index);
         }
 
         // Check if the ListA item is anywhere in ListB
-        if (!listB.some(item => item.name.toLowerCase() === listA[index].name.toLowerCase())) {
+        if (!namesB.has(listA[index].name.toLowerCase())) {
             listB.splice(index, 0, listA[index]);
+            namesB.add(listA[index].name.toLowerCase());
             createAndAppendElements(listA, listBContainer, index);
         }
 
         // Check if the ListB item is anywhere in ListA
-        if (!listA.some(item => item.name.toLowerCase() === listB[index].name.toLowerCase())) {
+        if (!namesA.has(listB[index].name.toLowerCase())) {
             listA.splice(index, 0, listB[index]);
+            namesA.add(listB[index].name.toLowerCase());
             createAndAppendElements(listB, listAContainer, index);
         }
 
@@ -744,13 +800,15 @@ function sortDivsByIdSuffix(parentSelector) {
 /**
  * Finds objects that are different between two lists
  * Looks at properties, not just the name
+ * If the server has already found the differences, those are used instead
  * 
  * @param {*} listA 
  * @param {*} listB 
  * @param {*} containerA 
  * @param {*} containerB 
+ * @param {*} changedNames  Lowercase names that the server found are different (optional)
  */
-function highlightDifferences(listA, listB, containerA, containerB) {
+function highlightDifferences(listA, listB, containerA, containerB, changedNames = null) {
     // Ensure the SVG is the correct size for the window (in case we need to draw lines)
     setSvgDimensions();
 
@@ -760,7 +818,11 @@ function highlightDifferences(listA, listB, containerA, containerB) {
         const itemB = listB[index];
 
         // Compare the two items
-        if (areObjectsDifferent(itemA, itemB)) {
+        // Items in different positions (eg, policies) are also different
+        const different = changedNames
+            ? changedNames.has(itemA.name.toLowerCase()) || itemA.name.toLowerCase() !== itemB.name.toLowerCase()
+            : areObjectsDifferent(itemA, itemB);
+        if (different) {
             // Select the two buttons, and apply CSS to highlight
             const buttonA = containerA.querySelector(`#${containerA.id}_${sanitizeId(itemA.name)} button`);
             const buttonB = containerB.querySelector(`#${containerB.id}_${sanitizeId(itemB.name)} button`);
@@ -7,6 +7,7 @@
     - Download configuration files
     - Add sites and devices
     - Show a confirmation modal before deleting
+    - Show HA and reachability changes as they happen
 
     Modal list:
     - Add Device modal
@@ -90,6 +91,8 @@ document.getElementById('confirmCancel').addEventListener('click', function () {
     closeConfirmModal();
 });
 
+document.addEventListener('DOMContentLoaded', watchDeviceEvents);           // Watch for HA and reachability changes (once base.js has loaded)
+
 
 /**
  * Handle the submit button click event for various forms
@@ -487,3 +490,58 @@ function toggleCollapsibleContent(event) {
         collapseIcon.classList.toggle('rotate-icon');
     }
 }
+
+
+/**
+ * Update device cards as HA states and reachability change
+ * Changes are streamed from the server (see watchEvents() in base.js)
+ */
+function watchDeviceEvents() {
+    watchEvents('ha,device', {
+        // A device's HA state changed (eg, a failover)
+        ha: (change) => {
+            const card = findDeviceCard(change.device);
+            if (card == null) {
+                return;
+            }
+
+            const localState = card.querySelector('.ha-local-state');
+            if (localState != null) {
+                localState.textContent = change.to;
+            }
+            const peerState = card.querySelector('.ha-peer-state');
+            if (peerState != null) {
+                peerState.textContent = change.peer_state;
+            }
+        },
+
+        // A device became reachable or unreachable
+        device: (change) => {
+            const card = findDeviceCard(change.device);
+            if (card == null) {
+                return;
+            }
+
+            const tag = card.querySelector('.device-unreachable');
+            tag.style.display = change.reachable ? 'none' : 'inline-block';
+            tag.title = change.reachable ? '' : (change.errors || []).join('\n');
+        },
+
+        // Some changes were missed, so load the page again
+        reset: () => {
+            location.reload();
+        },
+    });
+}
+
+
+/**
+ * Find a device's card on the page
+ * @param {*} deviceId
+ * @returns the card, or null if the device isn't shown
+ */
+function findDeviceCard(deviceId) {
+    return document.querySelector(
+        `.device-card[data-device-id="${CSS.escape(String(deviceId))}"]`
+    );
+}
@@ -3,6 +3,13 @@
 */
 
 
+// Gateways whose sessions are shown (device ID to name)
+let shownGateways = {};
+
+// Watch for changes once base.js has loaded
+document.addEventListener('DOMContentLoaded', watchGpEvents);
+
+
 /*
     Get a list of devices that might host Global Protect sessions
     This will ignore passive HA devices
@@ -89,6 +96,7 @@ document.getElementById('gp-session-button').addEventListener('click', function
         // Get the div that will hold the session info, and clear it
         const sessionAccordion = document.getElementById('sessionAccordion');
         sessionAccordion.innerHTML = '';
+        shownGateways = {};
 
         // Fetch the session info for the selected device
         fetch(url, {
@@ -100,51 +108,17 @@ document.getElementById('gp-session-button').addEventListener('click', function
             .then(response => response.json())
             .then(data => {
                 data.forEach(data => {
-                    // Create a new div element for the session info
-                    const parentDiv = document.createElement('div');
-                    parentDiv.id = data.host;
-
-                    // Create a button for each element
-                    const button = document.createElement('button');
-                    button.className = 'w3-button w3-block w3-left-align';
-                    button.textContent = data.name;
-                    button.onclick = function () { expandList('list_' + data.host) };
-
-                    // Create a div for the session info
-                    const listDiv = document.createElement('div');
-                    listDiv.id = 'list_' + data.host;
-                    listDiv.className = 'w3-hide w3-border';
-
-                    // Create a table for the session info
-                    const table = document.createElement('table');
-                    table.className = 'w3-table indented-table';
-                    addChildTableItem(table, 'Username', data.name);
-                    addChildTableItem(table, 'Alternate Username', data.username);
-                    addChildTableItem(table, 'Device Name', data.computer);
-                    addChildTableItem(table, 'Login Time', data.login);
-                    addChildTableItem(table, 'Region Code', data.region);
-                    addChildTableItem(table, 'IP Address', data.inside_ip);
-                    addChildTableItem(table, 'Public IP', data.outside_ip);
-                    addChildTableItem(table, 'Client OS', data.client);
-                    addChildTableItem(table, 'Client Version', data.version);
-                    addChildTableItem(table, 'Host ID', data.host);
-                    addChildTableItem(table, 'Device Name', deviceName);
-                    listDiv.appendChild(table);
-
-                    // Append to the parent div (id == 'sessionAccordion')
-                    parentDiv.appendChild(button);
-                    parentDiv.appendChild(listDiv);
-
-                    sessionAccordion.appendChild(parentDiv);
+                    addSession(sessionAccordion, data, deviceId, deviceName);
                 });
 
+                // Watch this gateway for logins and logouts
+                shownGateways[deviceId] = deviceName;
+
                 // Hide loading spinner when the response is received
                 document.getElementById('loadingSpinner').style.display = 'none';
 
                 // Add session count
-                let sessionCount = sessionAccordion.getElementsByTagName('table').length;
-                let heading = document.getElementById('sessionHeader');
-                heading.innerHTML = `<h3>Global Protect Sessions (${sessionCount})</h3>`;
+                updateSessionCount();
 
             })
 
@@ -157,6 +131,122 @@ document.getElementById('gp-session-button').addEventListener('click', function
 });
 
 
+/**
+ * Add a session to the list
+ * 
+ * @param {*} sessionAccordion - The div that holds the sessions
+ * @param {*} data - The session
+ * @param {*} deviceId - The gateway's device ID
+ * @param {*} deviceName - The gateway's name
+ */
+function addSession(sessionAccordion, data, deviceId, deviceName) {
+    // Create a new div element for the session info
+    const parentDiv = document.createElement('div');
+    parentDiv.id = data.host;
+    parentDiv.setAttribute('data-gateway', deviceId);
+    parentDiv.setAttribute('data-session-key', sessionKey(data));
+
+    // Create a button for each element
+    const button = document.createElement('button');
+    button.className = 'w3-button w3-block w3-left-align';
+    button.textContent = data.name;
+    button.onclick = function () { expandList('list_' + data.host) };
+
+    // Create a div for the session info
+    const listDiv = document.createElement('div');
+    listDiv.id = 'list_' + data.host;
+    listDiv.className = 'w3-hide w3-border';
+
+    // Create a table for the session info
+    const table = document.createElement('table');
+    table.className = 'w3-table indented-table';
+    addChildTableItem(table, 'Username', data.name);
+    addChildTableItem(table, 'Alternate Username', data.username);
+    addChildTableItem(table, 'Device Name', data.computer);
+    addChildTableItem(table, 'Login Time', data.login);
+    addChildTableItem(table, 'Region Code', data.region);
+    addChildTableItem(table, 'IP Address', data.inside_ip);
+    addChildTableItem(table, 'Public IP', data.outside_ip);
+    addChildTableItem(table, 'Client OS', data.client);
+    addChildTableItem(table, 'Client Version', data.version);
+    addChildTableItem(table, 'Host ID', data.host);
+    addChildTableItem(table, 'Device Name', deviceName);
+    listDiv.appendChild(table);
+
+    // Append to the parent div (id == 'sessionAccordion')
+    parentDiv.appendChild(button);
+    parentDiv.appendChild(listDiv);
+
+    sessionAccordion.appendChild(parentDiv);
+}
+
+
+/**
+ * Identify a session, so a logout can be matched to it
+ * The same user, host and login time is the same session
+ * 
+ * @param {*} data - The session
+ * @returns the key
+ */
+function sessionKey(data) {
+    const login = data.login_utc != null ? data.login_utc : data.login;
+    return `${String(data.name).toLowerCase()}|${data.host}|${login}`;
+}
+
+
+/**
+ * Show the number of sessions in the heading
+ */
+function updateSessionCount() {
+    const sessionAccordion = document.getElementById('sessionAccordion');
+    let sessionCount = sessionAccordion.getElementsByTagName('table').length;
+    let heading = document.getElementById('sessionHeader');
+    heading.innerHTML = `<h3>Global Protect Sessions (${sessionCount})</h3>`;
+}
+
+
+/**
+ * Apply logins and logouts as they happen, without fetching the sessions
+ * Only gateways whose sessions are shown are updated
+ * Changes are streamed from the server (see watchEvents() in base.js)
+ */
+function watchGpEvents() {
+    watchEvents('gp', {
+        // Users logged in to, or out of, a gateway
+        gp: (change) => {
+            const deviceName = shownGateways[change.device];
+            if (deviceName === undefined) {
+                return;
+            }
+
+            const sessionAccordion = document.getElementById('sessionAccordion');
+            for (const data of change.logouts) {
+                const key = CSS.escape(sessionKey(data));
+                const gateway = CSS.escape(change.device);
+                const entry = sessionAccordion.querySelector(
+                    `[data-gateway="${gateway}"][data-session-key="${key}"]`
+                );
+                if (entry != null) {
+                    entry.remove();
+                }
+            }
+            for (const data of change.logins) {
+                addSession(sessionAccordion, data, change.device, deviceName);
+            }
+
+            updateSessionCount();
+        },
+
+        // Some changes were missed, so fetch the sessions again
+        reset: () => {
+            if (Object.keys(shownGateways).length > 0) {
+                document.getElementById('gp-session-button').click();
+            }
+        },
+    });
+}
+
+
 /**
  * Manage an accordian list button
  * The 'button' the name of an object
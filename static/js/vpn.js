@@ -10,6 +10,9 @@ fetchAndStoreDevices();
 setupPage();
 getVpnList();
 
+// Watch for changes once base.js has loaded
+document.addEventListener('DOMContentLoaded', watchVpnEvents);
+
 
 /**
  * Function to get the list of VPN Tunnels
@@ -302,6 +305,63 @@ async function vpnStatus(id, vpn) {
 }
 
 
+/**
+ * Update tunnel status icons as they change, without reloading the list
+ * Changes are streamed from the server (see watchEvents() in base.js)
+ */
+function watchVpnEvents() {
+    watchEvents("tunnel", {
+        // A tunnel changed state, so update the icon for each endpoint
+        tunnel: (change) => {
+            const name = sanitizeName(change.name);
+            setEndpointIcon(`gridEndA${name}`, change.endpoints.a);
+
+            // Endpoint B isn't polled if it's not a managed device
+            if ("b" in change.endpoints) {
+                setEndpointIcon(`gridEndB${name}`, change.endpoints.b);
+            }
+        },
+
+        // Some changes were missed, so load the list again
+        reset: () => {
+            document.getElementById("vpnContainer").innerHTML = "";
+            getVpnList();
+        },
+    });
+}
+
+
+/**
+ * Set the status icon of a tunnel endpoint
+ * The icon is added if the endpoint doesn't have one yet
+ *
+ * @param {string} gridId - The ID of the endpoint's grid element
+ * @param {string} state - The endpoint's state (up, down, or unknown)
+ */
+function setEndpointIcon(gridId, state) {
+    const grid = document.getElementById(gridId);
+    if (grid == null) {
+        return;
+    }
+
+    const icons = {
+        up: ["static/img/green_tick.png", "Up"],
+        down: ["static/img/red_cross.png", "Down"],
+    };
+    const [src, alt] = icons[state] ||
+        ["static/img/question_mark.png", "Status Unknown"];
+
+    let icon = grid.querySelector(".status-icon");
+    if (icon == null) {
+        icon = document.createElement("img");
+        icon.className = "status-icon";
+        grid.appendChild(icon);
+    }
+    icon.src = src;
+    icon.alt = alt;
+}
+
+
 /**
  * Sanitize a name by replacing invalid characters with underscores
  * 
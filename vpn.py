@@ -15,6 +15,7 @@ from settings import AppSettings
 from settings import config
 from sql import SqlServer
 from colorama import Fore, Style
+import hashlib
 
 
 class ManagedVPN:
@@ -198,6 +199,10 @@ class VPNManager:
         add_vpn():
             Define a new VPN
             Used when adding a VPN
+        delete_vpn():
+            Delete a managed VPN
+        version:
+            A hash of the managed VPN details
     '''
 
     def __init__(
@@ -244,6 +249,29 @@ class VPNManager:
         else:
             raise StopIteration
 
+    @property
+    def version(
+        self
+    ) -> str:
+        '''
+        A hash of the managed VPN details
+            This changes whenever a VPN is added, removed or changed
+            It is used to check if the browser already has the VPN list
+
+        Returns:
+            str: The version of the VPN list
+        '''
+
+        details = [
+            sorted(
+                (key, str(value)) for key, value in vars(vpn).items()
+                if not isinstance(value, dict)
+            )
+            for vpn in self.vpn_list
+        ]
+
+        return hashlib.sha1(str(details).encode()).hexdigest()[:16]
+
     def load_vpn(
         self
     ) -> None:
@@ -0,0 +1,434 @@
+'''
+Track the health of every managed IPSec tunnel
+
+Tunnel status comes from the background poller (see scheduler.py)
+    Every device's VPN status is polled on a schedule, concurrently,
+    within the shared limits
+    This is told when each poll finishes, and updates the tunnels that
+    use that device
+
+Each managed VPN is joined to the tunnels on its devices by peer IP
+    Endpoint A's tunnel is the one whose peer is endpoint B's address
+    (its tunnel destination, cloud IP, or outside NAT), and the same for
+    endpoint B, if it is managed
+
+Each VPN has a state, and the time it last changed
+    up: Every endpoint that was polled has the tunnel up
+    down: Every endpoint that was polled has the tunnel down
+    partial: One endpoint is up, and the other is down
+    unknown: No recent poll, or the tunnel wasn't found on the device
+    Recent transitions are kept, to spot tunnels that are flapping
+    Transitions are published as 'tunnel' events (see events.py)
+
+The whole fleet's status is served from memory, in one call
+
+Only the worker that polls tracks the tunnels
+    The tunnels are saved with the poll results (see scheduler.py), so
+    every worker serves the same states and transitions
+    Every VPN is checked again each minute, so a device that stops
+    answering shows as unknown
+
+Classes:
+    TunnelMonitor
+        The current state of each managed VPN, and its transitions
+
+Functions:
+    clean_tunnel
+        Rename the fields of a tunnel's status, for either vendor
+
+Misc Variables:
+    tunnel_monitor
+        The shared TunnelMonitor object
+'''
+
+import collections
+import threading
+import time
+
+from device import device_manager
+from events import event_bus
+from scheduler import STALE_AFTER, device_state, poll_scheduler
+from vpn import vpn_manager
+
+
+# Tunnel fields, and the fields they come from (Palo Alto, then Junos)
+TUNNEL_FIELDS = {
+    'ike_name': ('ike-name', 'ike_name'),
+    'ike_status': ('ike_state',),
+    'local_ip': ('localip',),
+    'ipsec_name': ('ipsec-name', 'name', 'ipsec_name'),
+    'destination': ('peerip', 'ike_address'),
+    'ipsec_status': ('ipsec_state', 'state'),
+    'physical_if': ('outer-if', 'ike_interface'),
+    'tunnel_if': ('inner-if', 'ipsec_interface'),
+}
+
+# The number of transitions kept for each VPN
+HISTORY = 20
+
+# How often every VPN is checked, not just those on the polled device
+#   (seconds)
+CHECK_ALL = 60
+
+
+def clean_tunnel(
+    tunnel: dict,
+) -> dict:
+    '''
+    Rename the fields of a tunnel's status, for either vendor
+        Missing fields are 'None', as the web pages expect
+
+    Args:
+        tunnel (dict): A tunnel, as returned by get_vpn_status()
+
+    Returns:
+        dict: The tunnel, with the same fields for every vendor
+    '''
+
+    entry = {}
+    for field, sources in TUNNEL_FIELDS.items():
+        entry[field] = next(
+            (tunnel[source] for source in sources if source in tunnel),
+            'None',
+        )
+
+    # Palo Alto calls an up tunnel 'active'
+    if entry['ipsec_status'] == 'active':
+        entry['ipsec_status'] = 'up'
+
+    return entry
+
+
+class TunnelMonitor:
+    '''
+    The current state of each managed VPN, and its transitions
+
+    Methods:
+        __init__: Create a monitor with no tunnels yet
+        version: Changes whenever a VPN's state changes
+        observe: Update the VPNs that use a device, after it's polled
+        update: Work out the state of VPNs, and record transitions
+        _endpoint: Find a VPN's tunnel on one of its devices
+        _export: Get the tunnels, to share with other workers
+        status: Get the state of every managed VPN
+    '''
+
+    def __init__(
+        self
+    ) -> None:
+        '''
+        Create a monitor with no tunnels yet
+        '''
+
+        self._lock = threading.Lock()
+
+        # VPN names, to their state
+        self._tunnels = {}
+
+        # Changes whenever a VPN's state changes
+        self._version = 0
+
+        # When every VPN was last checked
+        self._checked_all = 0
+
+    @property
+    def version(
+        self
+    ) -> int:
+        '''
+        Changes whenever a VPN's state changes
+            Other workers get it from the polling worker
+
+        Returns:
+            int: The version
+        '''
+
+        if device_state.writer:
+            return self._version
+
+        return device_state.extra().get('tunnels', {}).get('version', 0)
+
+    def observe(
+        self,
+        device_id: str,
+        metric: str = 'vpn',
+    ) -> None:
+        '''
+        Update the VPNs that use a device, after it's polled
+            Called by the state store, in the worker that polls
+            Every VPN is checked now and then, to find stale polls
+
+        Args:
+            device_id (str): The device that was polled
+            metric (str): The metric that was polled
+        '''
+
+        now = time.time()
+        if now - self._checked_all > CHECK_ALL:
+            self._checked_all = now
+            self.update(now=now)
+        else:
+            self.update(device_id, now=now)
+
+    def update(
+        self,
+        device_id: str = None,
+        now: float = None,
+    ) -> int:
+        '''
+        Work out the state of VPNs, and record transitions
+
+        Args:
+            device_id (str): Only VPNs that use this device (None for all)
+            now (float): The current time (epoch seconds)
+
+        Returns:
+            int: The number of VPNs that changed state
+        '''
+
+        now = time.time() if now is None else now
+        changed = 0
+
+        # Each device's tunnels by peer, so each is only cleaned once
+        devices_seen = {}
+
+        with self._lock:
+            vpns = list(vpn_manager.vpn_list)
+            for vpn in vpns:
+                devices = (str(vpn.a_device), str(vpn.b_device))
+                if device_id is not None and device_id not in devices:
+                    continue
+
+                # Each endpoint, and the peer addresses it could use
+                endpoints = {
+                    'a': self._endpoint(
+                        vpn.a_device,
+                        (vpn.a_dest, vpn.b_cloud, vpn.b_outside_nat),
+                        now,
+                        devices_seen,
+                    ),
+                }
+                if vpn.b_type and vpn.b_device:
+                    endpoints['b'] = self._endpoint(
+                        vpn.b_device,
+                        (vpn.b_dest, vpn.a_outside_nat),
+                        now,
+                        devices_seen,
+                    )
+
+                states = {
+                    endpoint['state'] for endpoint in endpoints.values()
+                    if endpoint['state'] != 'unknown'
+                }
+                if not states:
+                    state = 'unknown'
+                elif len(states) > 1:
+                    state = 'partial'
+                else:
+                    state = states.pop()
+
+                tunnel = self._tunnels.get(vpn.name)
+                if tunnel is None:
+                    tunnel = self._tunnels[vpn.name] = {
+                        'name': vpn.name,
+                        'state': None,
+                        'since': None,
+                        'transitions': 0,
+                        'history': collections.deque(maxlen=HISTORY),
+                    }
+                tunnel['endpoints'] = endpoints
+                tunnel['checked'] = now
+
+                # Record when the state changes
+                if state != tunnel['state']:
+                    if tunnel['state'] is not None:
+                        tunnel['transitions'] += 1
+                        tunnel['history'].append(
+                            {
+                                'from': tunnel['state'],
+                                'to': state,
+                                'at': now,
+                            }
+                        )
+                        event_bus.publish(
+                            'tunnel',
+                            {
+                                'name': vpn.name,
+                                'from': tunnel['state'],
+                                'to': state,
+                                'at': now,
+                                'endpoints': {
+                                    key: endpoint['state']
+                                    for key, endpoint in endpoints.items()
+                                },
+                            }
+                        )
+                    tunnel['state'] = state
+                    tunnel['since'] = now
+                    changed += 1
+
+            # Forget VPNs that have been deleted
+            if device_id is None:
+                names = {vpn.name for vpn in vpns}
+                for name in list(self._tunnels):
+                    if name not in names:
+                        del self._tunnels[name]
+                        changed += 1
+
+            if changed:
+                self._version += 1
+
+        return changed
+
+    def _endpoint(
+        self,
+        device_id: str,
+        peers: tuple,
+        now: float,
+        devices_seen: dict,
+    ) -> dict:
+        '''
+        Find a VPN's tunnel on one of its devices
+            The caller must hold the lock
+
+        Args:
+            device_id (str): The device at this endpoint
+            peers (tuple): Addresses the tunnel's peer could have
+            now (float): The current time
+            devices_seen (dict): Device IDs, to their tunnels by peer
+                Filled in as devices are looked up
+
+        Returns:
+            dict: The endpoint
+                device (str): The device ID
+                name (str): The device name
+                state (str): 'up', 'down' or 'unknown'
+                tunnel (dict): The tunnel (see clean_tunnel), or None
+                updated (float): When the device was polled
+                error (str): Why the state is unknown
+        '''
+
+        device_id = str(device_id)
+        endpoint = {
+            'device': device_id,
+            'name': device_manager.id_to_name(device_id),
+            'state': 'unknown',
+            'tunnel': None,
+            'updated': None,
+            'error': None,
+        }
+
+        entry = device_state.get(device_id, 'vpn')
+        if entry is None or entry['value'] is None:
+            endpoint['error'] = (
+                entry['error'] if entry is not None else 'Not polled yet'
+            )
+            return endpoint
+
+        endpoint['updated'] = entry['updated']
+        max_age = poll_scheduler.interval(device_id, 'vpn') * STALE_AFTER
+        if now - entry['updated'] > max_age:
+            endpoint['error'] = entry['error'] or 'The last poll is stale'
+            return endpoint
+
+        # Find the tunnel to the peer
+        tunnels = devices_seen.get(device_id)
+        if tunnels is None:
+            tunnels = devices_seen[device_id] = {}
+            for tunnel in entry['value'] or []:
+                cleaned = clean_tunnel(tunnel)
+                tunnels.setdefault(str(cleaned['destination']), cleaned)
+
+        for peer in peers:
+            cleaned = tunnels.get(str(peer)) if peer else None
+            if cleaned is not None:
+                endpoint['tunnel'] = cleaned
+                endpoint['state'] = (
+                    'up' if str(cleaned['ipsec_status']).lower() == 'up'
+                    else 'down'
+                )
+                return endpoint
+
+        endpoint['error'] = 'No tunnel to the peer was found'
+        return endpoint
+
+    def _export(
+        self
+    ) -> dict:
+        '''
+        Get the tunnels, to share with other workers
+            Saved with the poll results (see StateStore.share)
+
+        Returns:
+            dict: The tunnels
+                version (int): Changes whenever a state changes
+                tunnels (list): Each VPN, sorted by name
+        '''
+
+        with self._lock:
+            return {
+                'version': self._version,
+                'tunnels': [
+                    dict(tunnel, history=list(tunnel['history']))
+                    for _, tunnel in sorted(self._tunnels.items())
+                ],
+            }
+
+    def status(
+        self,
+        state: str = None,
+    ) -> dict:
+        '''
+        Get the state of every managed VPN
+            In the worker that polls, states are refreshed first, so
+            stale polls show as unknown
+            Other workers read the states it has shared
+
+        Args:
+            state (str): Only VPNs in this state
+
+        Returns:
+            dict: The fleet's tunnels
+                summary (dict): The number of VPNs in each state
+                tunnels (list): Each VPN, sorted by name
+                    name (str): The VPN name
+                    state (str): 'up', 'down', 'partial' or 'unknown'
+                    since (float): When it changed to this state
+                    duration (float): Seconds in this state
+                    transitions (int): State changes since startup
+                    history (list): Recent transitions ('from', 'to', 'at')
+                    endpoints (dict): 'a' and 'b', see _endpoint()
+                version (int): Changes whenever a state changes
+        '''
+
+        now = time.time()
+        if device_state.writer:
+            self.update(now=now)
+            shared = self._export()
+        else:
+            shared = device_state.extra().get('tunnels', {})
+
+        tunnels = [
+            dict(tunnel, duration=round(now - tunnel['since'], 1))
+            for tunnel in shared.get('tunnels', [])
+        ]
+        version = shared.get('version', 0)
+
+        summary = {'up': 0, 'down': 0, 'partial': 0, 'unknown': 0}
+        for tunnel in tunnels:
+            summary[tunnel['state']] += 1
+
+        return {
+            'summary': summary,
+            'tunnels': [
+                tunnel for tunnel in tunnels
+                if state in (None, tunnel['state'])
+            ],
+            'version': version,
+        }
+
+
+# The shared tunnel monitor, updated after each VPN poll
+tunnel_monitor = TunnelMonitor()
+device_state.watch('vpn', tunnel_monitor.observe)
+device_state.share('tunnels', tunnel_monitor._export)
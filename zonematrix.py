@@ -0,0 +1,299 @@
+'''
+Summarise security rules as a zone to zone matrix
+
+Answers "what is allowed from zone X to zone Y?" for every pair of zones
+    Each cell has the rules that apply to the pair, in order, with a
+    count of allow and deny rules, and the services they use
+
+The matrix is built in one pass over the rulebase
+    Each rule is added to a bucket for its zones (or '*' for any)
+    A cell combines four buckets: (X, Y), (X, any), (any, Y), (any, any)
+    The buckets are already in rule order, so they are merged, not sorted
+
+Rule types are respected
+    intrazone rules only apply when the zones are the same
+    interzone rules only apply when the zones are different
+
+Limitations:
+    Zones only appear if a rule names them
+    Disabled rules are left out
+    Allowed ports don't subtract earlier deny rules
+
+Classes:
+    ZoneMatrix
+        The rules that apply to each pair of zones
+'''
+
+import heapq
+import itertools
+
+from intervals import merge
+from objectdiff import members
+from resolver import GroupResolver
+
+
+# Actions that allow traffic (everything else blocks it)
+ALLOW_ACTIONS = ('allow',)
+
+# Values that mean a field matches anything
+ANY = ('any', 'None', '')
+
+# The key used for 'any' zone in the buckets
+ANY_ZONE = '*'
+
+
+class ZoneMatrix:
+    '''
+    The rules that apply to each pair of zones
+
+    Methods:
+        __init__: Bucket the rules by zone, and build the cells
+        report: Get the matrix, or part of it
+        _rule: Summarise a rule
+        _cell: Combine the rules that apply to a pair of zones
+        _format_ports: Format port ranges as strings
+    '''
+
+    def __init__(
+        self,
+        rules: list,
+        resolver: GroupResolver = None,
+    ) -> None:
+        '''
+        Bucket the rules by zone, and build the cells
+
+        Args:
+            rules (list): Security rules, as returned by the API
+            resolver (GroupResolver): Resolves the service objects and groups
+        '''
+
+        self.resolver = resolver or GroupResolver()
+
+        # Summaries of each enabled rule, and the buckets they are in
+        #   Port ranges are kept for each rule, to merge them in cells
+        self.rules = []
+        self._ports = []
+        buckets = {}
+        zones = set()
+
+        with self.resolver:
+            for position, rule in enumerate(rules):
+                if str(rule.get('disabled', 'no')).lower() == 'yes':
+                    continue
+
+                sources = [
+                    zone for zone in members(rule.get('from'))
+                    if zone not in ANY
+                ] or [ANY_ZONE]
+                targets = [
+                    zone for zone in members(rule.get('to'))
+                    if zone not in ANY
+                ] or [ANY_ZONE]
+                zones.update(sources + targets)
+
+                index = len(self.rules)
+                self.rules.append(self._rule(rule, position))
+                for key in itertools.product(sources, targets):
+                    buckets.setdefault(key, []).append(index)
+
+        zones.discard(ANY_ZONE)
+        self.zones = sorted(zones)
+        self.cells = {
+            (source, target): self._cell(source, target, buckets)
+            for source in self.zones
+            for target in self.zones
+        }
+
+    def _rule(
+        self,
+        rule: dict,
+        position: int,
+    ) -> dict:
+        '''
+        Summarise a rule
+
+        Args:
+            rule (dict): The security rule
+            position (int): The rule's position in the rulebase
+
+        Returns:
+            dict: The summary
+                name (str): The rule name
+                position (int): The rule's position
+                action (str): The rule's action
+                type (str): 'universal', 'intrazone' or 'interzone'
+                services (list): The service names
+                ports (list): Resolved ports (eg, 'tcp/443'), 'any', or
+                    'application-default'
+                unresolved (list): Services that couldn't be resolved
+        '''
+
+        services = members(rule.get('service'))
+        rule_type = str(rule.get('type', 'universal'))
+        if rule_type not in ('intrazone', 'interzone'):
+            rule_type = 'universal'
+
+        ranges = ()
+        unresolved = []
+        if not services or any(name in ANY for name in services):
+            ports = ['any']
+        elif 'application-default' in services:
+            ports = ['application-default']
+        else:
+            membership = self.resolver.resolve_many('service', services)
+            ranges = membership.values
+            ports = self._format_ports(ranges)
+            unresolved = list(membership.unresolved)
+        self._ports.append((ports, ranges))
+
+        return {
+            'name': rule.get('name'),
+            'position': position,
+            'action': rule.get('action'),
+            'type': rule_type,
+            'services': services,
+            'ports': ports,
+            'unresolved': unresolved,
+        }
+
+    def _cell(
+        self,
+        source: str,
+        target: str,
+        buckets: dict,
+    ) -> dict:
+        '''
+        Combine the rules that apply to a pair of zones
+
+        Args:
+            source (str): The source zone
+            target (str): The destination zone
+            buckets (dict): Pairs of zones (or '*'), to rule indexes
+
+        Returns:
+            dict: The cell
+                from (str): The source zone
+                to (str): The destination zone
+                rules (list): Indexes of the rules that apply, in order
+                allow (int): The number of rules that allow traffic
+                deny (int): The number of rules that block traffic
+                summary (str): 'allow', 'deny', 'mixed', or 'default'
+                    if no rules apply
+                default (str): The action if no rule matches
+                services (list): The services used by the rules
+                ports (list): The ports allowed by the rules
+        '''
+
+        intrazone = source == target
+        indexes = [
+            index
+            for index in heapq.merge(
+                buckets.get((source, target), []),
+                buckets.get((source, ANY_ZONE), []),
+                buckets.get((ANY_ZONE, target), []),
+                buckets.get((ANY_ZONE, ANY_ZONE), []),
+            )
+            if self.rules[index]['type'] != (
+                'interzone' if intrazone else 'intrazone'
+            )
+        ]
+
+        allow = 0
+        services = set()
+        special = set()
+        ranges = []
+        for index in indexes:
+            rule = self.rules[index]
+            services.update(rule['services'])
+            if rule['action'] in ALLOW_ACTIONS:
+                allow += 1
+                ports, rule_ranges = self._ports[index]
+                if rule_ranges:
+                    ranges.extend(rule_ranges)
+                else:
+                    special.update(ports)
+
+        deny = len(indexes) - allow
+        if not indexes:
+            summary = 'default'
+        elif not deny:
+            summary = 'allow'
+        elif not allow:
+            summary = 'deny'
+        else:
+            summary = 'mixed'
+
+        return {
+            'from': source,
+            'to': target,
+            'rules': indexes,
+            'allow': allow,
+            'deny': deny,
+            'summary': summary,
+            'default': 'allow' if intrazone else 'deny',
+            'services': sorted(services),
+            'ports': (
+                ['any'] if 'any' in special
+                else sorted(special) + self._format_ports(merge(ranges))
+            ),
+        }
+
+    @staticmethod
+    def _format_ports(
+        ranges: list,
+    ) -> list:
+        '''
+        Format port ranges as strings
+
+        Args:
+            ranges (list): Tuples of (protocol, first port, last port)
+
+        Returns:
+            list: Strings such as 'tcp/443' or 'udp/5000-5010'
+        '''
+
+        return [
+            f"{protocol}/{first}" if first == last
+            else f"{protocol}/{first}-{last}"
+            for protocol, first, last in ranges
+        ]
+
+    def report(
+        self,
+        source: str = None,
+        target: str = None,
+    ) -> dict:
+        '''
+        Get the matrix, or part of it
+
+        Args:
+            source (str): Only include cells from this zone
+            target (str): Only include cells to this zone
+
+        Returns:
+            dict: The matrix
+                zones (list): Every zone, sorted
+                cells (list): The cells, with rule indexes into 'rules'
+                rules (list): The rules used by these cells
+        '''
+
+        cells = [
+            cell for (from_zone, to_zone), cell in self.cells.items()
+            if source in (None, from_zone) and target in (None, to_zone)
+        ]
+
+        # Only send the rules these cells use, and renumber them
+        used = sorted({index for cell in cells for index in cell['rules']})
+        numbers = {index: number for number, index in enumerate(used)}
+
+        return {
+            'zones': self.zones,
+            'cells': [
+                dict(
+                    cell,
+                    rules=[numbers[index] for index in cell['rules']],
+                )
+                for cell in cells
+            ],
+            'rules': [self.rules[index] for index in used],
+        }